@@ -0,0 +1,40 @@
+"""
+ai-worker 單元測試的共用設定
+
+worker/ 底下的模組以 llm_app.* / observability.* 匯入（容器內以 python worker/main.py 啟動），
+這裡把 worker/ 加進 sys.path；Redis 一律以 fakeredis 取代，不需要實際的服務。
+
+執行（於 services/ai-worker/ 目錄下）：
+    PYTHONPATH=. pytest
+"""
+
+import os
+import sys
+
+import fakeredis
+import pytest
+
+WORKER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "worker")
+if WORKER_DIR not in sys.path:
+    sys.path.insert(0, WORKER_DIR)
+
+import llm_app.toolkits.redis_store as redis_store  # noqa: E402
+
+
+class NoopProfileRepository:
+    """commit_turn 在新 session 時會更新最後聯絡時間；測試中不碰資料庫。"""
+
+    def touch_last_contact_ts(self, *args, **kwargs) -> None:
+        pass
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    """
+    以 fakeredis 取代 redis_store.get_redis。
+    以 from .redis_store import get_redis 匯入的模組（decision_cache、answer_cache、llm_client …）須另外替換。
+    """
+    r = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(redis_store, "get_redis", lambda: r)
+    monkeypatch.setattr(redis_store, "ProfileRepository", NoopProfileRepository)
+    return r
@@ -0,0 +1,99 @@
+"""
+Health agent 快取（llm_app.toolkits.agent_cache）：LRU 上限、閒置 TTL、畫像指紋
+"""
+
+import threading
+
+from llm_app.toolkits.agent_cache import AgentCache, profile_fingerprint
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Factory:
+    def __init__(self, clock=None, build_sec=0.0):
+        self.built = []
+        self.clock = clock
+        self.build_sec = build_sec
+
+    def __call__(self, user_id):
+        self.built.append(user_id)
+        if self.clock:
+            self.clock.now += self.build_sec
+        return object()
+
+
+def test_hit_reuses_agent_and_fingerprint_change_rebuilds():
+    factory = Factory()
+    cache = AgentCache(factory, max_size=4, ttl_sec=0)
+    fp = profile_fingerprint("喜歡散步")
+    first = cache.get("u1", fp)
+
+    assert cache.get("u1", fp) is first
+    assert cache.get("u1") is first
+    assert cache.get("u1", profile_fingerprint("最近常喘")) is not first
+    assert factory.built == ["u1", "u1"]
+    assert (cache.stats["hit"], cache.stats["miss"], cache.stats["stale"]) == (2, 1, 1)
+
+
+def test_lru_evicts_least_recently_used():
+    cache = AgentCache(Factory(), max_size=2, ttl_sec=0)
+    cache.get("u1")
+    cache.get("u2")
+    cache.get("u1")
+    cache.get("u3")
+
+    assert "u1" in cache and "u3" in cache and "u2" not in cache
+    assert cache.stats["evicted"] == 1
+
+
+def test_idle_entries_expire():
+    clock = FakeClock()
+    cache = AgentCache(Factory(), max_size=10, ttl_sec=60, clock=clock)
+    cache.get("u1")
+    clock.now = 30
+    cache.get("u2")
+    clock.now = 70
+    cache.get("u2")
+
+    assert "u1" not in cache and "u2" in cache
+    assert cache.stats["expired"] == 1
+
+
+def test_slow_factory_is_stamped_when_it_returns():
+    clock = FakeClock()
+    cache = AgentCache(Factory(clock, build_sec=50), max_size=10, ttl_sec=60, clock=clock)
+    agent = cache.get("u1")
+    clock.now += 30
+
+    assert cache.get("u1") is agent
+
+
+def test_size_stays_bounded_under_concurrency():
+    cache = AgentCache(Factory(), max_size=16, ttl_sec=0)
+
+    def worker(n):
+        for i in range(200):
+            cache.get(f"u{(n * 7 + i) % 64}")
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(cache) == 16
+
+
+def test_release_drops_entry():
+    cache = AgentCache(Factory(), max_size=4, ttl_sec=0)
+    cache.get("u1")
+    cache.release("u1")
+
+    assert "u1" not in cache
+    assert profile_fingerprint("") == ""
@@ -0,0 +1,113 @@
+"""
+一般衛教問題的語意答案快取（llm_app.toolkits.answer_cache）
+
+embedding 以確定性的字元 bigram 向量代替（尺度與 OpenAI embedding 不同，門檻另訂）。
+"""
+
+import math
+import zlib
+from typing import List
+
+import fakeredis
+import pytest
+
+import llm_app.toolkits.answer_cache as answer_cache
+from llm_app.toolkits.answer_cache import AnswerCache, is_eligible
+
+THRESHOLD = 0.6
+VETTED = {
+    "吸入器怎麼用": "吸入器先搖一搖，吐氣後含住深吸，再閉氣十秒喔。",
+    "走路會喘怎麼辦": "走路會喘就放慢腳步，用噘嘴呼吸，歇一下再走。",
+    "COPD是什麼病": "COPD 是慢性阻塞性肺病，氣管變窄，呼吸比較費力。",
+}
+VARIANTS = [
+    ("吸入器怎麼用", v) for v in ["吸入器怎麼用？", "吸入器要怎麼用", "請問吸入器怎麼用", "吸入器怎麼用啊"]
+] + [
+    ("走路會喘怎麼辦", v) for v in ["走路會喘怎麼辦", "走路就會喘怎麼辦？", "走路會喘要怎麼辦"]
+] + [
+    ("COPD是什麼病", v) for v in ["COPD是什麼病？", "copd 是什麼病", "請問COPD是什麼病"]
+]
+
+
+def bigram_vector(text: str, dim: int = 512) -> List[float]:
+    vec = [0.0] * dim
+    for i in range(max(1, len(text) - 1)):
+        vec[zlib.crc32(text[i : i + 2].encode("utf-8")) % dim] += 1.0
+    norm = math.sqrt(sum(x * x for x in vec))
+    return [x / norm for x in vec] if norm else []
+
+
+def gate(text: str) -> str:
+    """代替 memory gate：提到過去或醫囑的提問視為個人化（USE）。"""
+    return "USE" if any(w in text for w in ("我上次", "醫師說", "之前", "一樣")) else "SKIP"
+
+
+class Clock:
+    now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def cache(monkeypatch, clock):
+    # 不依賴環境變數中的緊急字詞設定
+    monkeypatch.setattr(answer_cache, "ANSWER_CACHE_BYPASS_WORDS", ["胸痛", "喘不過氣", "不想活"])
+    r = fakeredis.FakeRedis(decode_responses=True)
+    c = AnswerCache(lambda: r, bigram_vector, threshold=THRESHOLD, refresh_sec=0, clock=clock)
+    for q, a in VETTED.items():
+        c.add(q, a, ttl_sec=3600)
+    return c
+
+
+def serve(cache: AnswerCache, text: str):
+    if not is_eligible(text):
+        cache.count_ineligible()
+        return None
+    match, _ = cache.lookup(text)
+    return cache.serve(match, gate(text))
+
+
+@pytest.mark.parametrize("question,variant", VARIANTS)
+def test_paraphrase_hits_vetted_answer(cache, question, variant):
+    assert serve(cache, variant) == VETTED[question]
+
+
+@pytest.mark.parametrize("text", ["今天天氣很好", "孫子下禮拜要回來", "晚餐吃什麼好"])
+def test_unrelated_question_misses(cache, text):
+    assert serve(cache, text) is None
+
+
+@pytest.mark.parametrize("text", ["我上次說的藥還要吃嗎", "醫師說我要多走路對嗎", "跟之前一樣的吸入器嗎"])
+def test_personal_question_bypasses_cache(cache, text):
+    assert serve(cache, text) is None
+
+
+@pytest.mark.parametrize("text", ["我現在胸痛喘不過氣", "走路會喘不過氣怎麼辦"])
+def test_urgent_message_is_not_eligible(cache, text):
+    assert not is_eligible(text)
+    assert serve(cache, text) is None
+
+
+def test_expired_entry_no_longer_hits(cache, clock):
+    clock.now += 3601
+
+    assert serve(cache, "吸入器怎麼用") is None
+
+
+def test_candidate_is_served_only_after_approval(cache):
+    match, vec = cache.lookup("痰很多怎麼辦")
+    cache.record_candidate("痰很多怎麼辦", "多喝溫水，咳痰時身體往前傾。", vec)
+    cache.record_candidate("痰很多怎麼辦？", "（第二次的回覆不會覆蓋）", vec)
+    candidates = cache.candidates()
+
+    assert match is None
+    assert len(candidates) == 1 and candidates[0]["count"] == 2
+    assert serve(cache, "痰很多怎麼辦") is None
+    cache.approve(candidates[0]["id"])
+    assert serve(cache, "痰很多怎麼辦？") == "多喝溫水，咳痰時身體往前傾。"
@@ -0,0 +1,94 @@
+"""
+任務上下文隔離（llm_app.toolkits.task_context）
+
+多位使用者的任務交錯執行時，每個任務、以及它交給執行緒池的子工作，讀到的 user_id / request_id 都必須是自己的。
+"""
+
+import contextvars
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from llm_app.toolkits.task_context import bind_task_context, current_task, reset_task_context, task_context
+
+
+def test_nested_binding_keeps_outer_fields_and_restores():
+    with task_context(request_id="r1"):
+        with task_context(user_id=42, line_user_id="U42") as ctx:
+            assert (ctx.user_id, ctx.request_id, ctx.line_user_id) == ("42", "r1", "U42")
+        assert current_task().user_id is None
+        assert current_task().request_id == "r1"
+    assert current_task().request_id is None
+
+
+def test_interleaved_tasks_and_pool_subtasks_do_not_leak():
+    users, tasks, concurrency = 20, 10, 8
+    rng = random.Random(42)
+    jobs = [(1000 + u, n) for n in range(tasks) for u in range(users)]
+    rng.shuffle(jobs)
+    delays = {job: rng.uniform(0, 0.003) for job in jobs}
+    errors = []
+    lock = threading.Lock()
+
+    def observe(job, where):
+        time.sleep(delays[job])
+        ctx = current_task()
+        expected = (str(job[0]), f"{job[0]}-{job[1]}")
+        if (ctx.user_id, ctx.request_id) != expected:
+            with lock:
+                errors.append(f"{where}: 預期 {expected}，讀到 {(ctx.user_id, ctx.request_id)}")
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="pre-llm") as shared_pool:
+
+        def run_task(job):
+            token = bind_task_context(user_id=job[0], request_id=f"{job[0]}-{job[1]}")
+            try:
+                # 與 chat_pipeline._submit 相同：子工作帶著提交當下的上下文
+                futures = [shared_pool.submit(contextvars.copy_context().run, observe, job, f"子工作#{i}") for i in range(3)]
+                observe(job, "任務本體")
+                for f in futures:
+                    f.result()
+                observe(job, "子工作完成後")
+            finally:
+                reset_task_context(token)
+
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="consumer") as consumers:
+            list(consumers.map(run_task, jobs))
+
+    assert errors == []
+
+
+def test_pipeline_alerts_belong_to_the_triggering_patient():
+    """以 loadtest.replay 的替身重播緊急訊息（direct 模式會呼叫 alert_case_manager），每則通報都屬於觸發它的病患。"""
+    pytest.importorskip("crewai")
+    pytest.importorskip("pymilvus")
+    from loadtest import replay
+    from loadtest.stubs import StubClock
+
+    clock = StubClock(replay.parse_latencies(["llm=uniform:5,30", "postgres=const:1"]), seed=42, time_scale=1.0)
+    consumer, broker = replay.install_stubs(clock, {}, fake_redis=True)
+    import llm_app.chat_pipeline as chat_pipeline
+
+    chat_pipeline.HEALTH_AGENT_MODE = "direct"
+    messages = [
+        {
+            "patient_id": uid,
+            "line_user_id": f"U{uid:032d}",
+            "task_id": f"iso-{uid}-{n}",
+            "text": f"我現在胸痛喘不過氣（{uid}-{n}）",
+        }
+        for n in range(3)
+        for uid in range(1000, 1008)
+    ]
+    random.Random(42).shuffle(messages)
+
+    replay.run_replay(consumer.on_task_message, broker, messages, 8, 0.0, quiet=True)
+
+    expected = {m["task_id"]: str(m["patient_id"]) for m in messages}
+    alerts = [json.loads(body) for key, body in broker.published if key == "alert_queue"]
+    assert len(alerts) == len(messages)
+    assert {a["request_id"]: str(a["user_id"]) for a in alerts} == expected
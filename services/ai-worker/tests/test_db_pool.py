@@ -0,0 +1,181 @@
+"""
+AI worker 的連線池（llm_app.models.db_engine）與 unit of work（llm_app.repositories.unit_of_work）
+
+以 SQLite 檔案資料庫（代替 Postgres）+ fakeredis，經 db_engine.make_engine 建立小容量的連線池。
+"""
+
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+import llm_app.models.db_engine as db_engine
+import llm_app.toolkits.redis_store as redis_store
+from llm_app.models.chat_profile import ChatUserProfile, SessionLocal
+from llm_app.repositories.profile_repository import ProfileRepository
+from llm_app.repositories.unit_of_work import current_session, session_scope, unit_of_work
+from observability.metrics import registry
+
+THREADS = 6
+TASKS = 10
+
+
+def counter(name: str, **labels) -> int:
+    return int(registry.get_counter(name, labels))
+
+
+def gauge(name: str, pool: str) -> float:
+    return registry.snapshot()["gauges"].get(name, {}).get(str({"pool": pool}), 0.0)
+
+
+@pytest.fixture
+def make_engine(tmp_path):
+    """make_engine(name, **overrides)：同一個 SQLite 檔案上的小容量連線池（容量 3、等待 0.3 秒）。"""
+    engines = []
+
+    def make(name: str, **overrides):
+        kwargs = {"pool_size": 2, "max_overflow": 1, "pool_timeout": 0.3, "connect_args": {"check_same_thread": False, "timeout": 30}}
+        kwargs.update(overrides)
+        engine = db_engine.make_engine(f"sqlite:///{tmp_path / 'pool.db'}", name, **kwargs)
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        engine.dispose()
+
+
+@pytest.fixture
+def pool(fake_redis, make_engine, monkeypatch):
+    """SessionLocal 綁定容量 3、不開 overflow 的連線池；回傳 pool 名稱。"""
+    engine = make_engine("test-uow", pool_size=3, max_overflow=0, pool_timeout=30)
+    ChatUserProfile.__table__.create(engine, checkfirst=True)
+    monkeypatch.setitem(SessionLocal.kw, "bind", engine)
+    return "test-uow"
+
+
+def finalize_like(uid: int) -> None:
+    """收尾流程的 repository 呼叫：讀畫像（快取未命中）→ 更新 → 再讀 → 確認紀錄存在。"""
+    repo = ProfileRepository()
+    redis_store.get_redis().delete(f"profile:cache:{uid}")
+    repo.read_profile_as_dict(uid)
+    repo.update_profile_facts(uid, {"add": {"health_status": {"回診": f"user {uid}"}}})
+    repo.read_profile_as_dict(uid)
+    repo.get_or_create_by_user_id(uid)
+
+
+def test_unit_of_work_shares_one_session_per_task(pool):
+    task0 = counter("ai_worker_db_sessions_total", scope="task")
+    call0 = counter("ai_worker_db_sessions_total", scope="call")
+
+    for i in range(TASKS):
+        with unit_of_work():
+            finalize_like(100 + i)
+            # repository 呼叫結束後連線即歸還
+            assert gauge("ai_worker_db_pool_in_use", pool) == 0
+
+    assert counter("ai_worker_db_sessions_total", scope="task") - task0 == TASKS
+    assert counter("ai_worker_db_sessions_total", scope="call") == call0
+
+    # 對照組：不在 unit of work 內，每次呼叫各開一個 Session
+    for i in range(TASKS):
+        finalize_like(100 + i)
+    assert counter("ai_worker_db_sessions_total", scope="call") - call0 >= 3 * TASKS
+
+
+def test_session_is_not_shared_with_other_threads(pool):
+    with unit_of_work() as outer, ThreadPoolExecutor(1) as executor:
+        other = executor.submit(contextvars.copy_context().run, current_session).result()
+
+        def scoped():
+            with session_scope() as s:
+                return s
+
+        scoped_other = executor.submit(contextvars.copy_context().run, scoped).result()
+        with unit_of_work() as nested, session_scope() as inner:
+            assert nested is outer
+            assert inner is outer
+
+    assert other is None
+    assert scoped_other is not outer
+
+
+def test_workload_reuses_pooled_connections(pool):
+    connects0 = counter("ai_worker_db_pool_events_total", pool=pool, event="connect")
+
+    def worker(t: int) -> None:
+        for i in range(TASKS):
+            with unit_of_work():
+                finalize_like(1000 + t * TASKS + i)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(THREADS)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    # overflow 連線歸還時會關閉，這裡 max_overflow=0，新建連線數不超過 pool_size
+    assert counter("ai_worker_db_pool_events_total", pool=pool, event="connect") - connects0 <= 3
+
+
+def test_saturated_pool_times_out_extra_requests(fake_redis, make_engine, monkeypatch):
+    name, capacity = "test-saturation", 3
+    monkeypatch.setitem(SessionLocal.kw, "bind", make_engine(name))
+    peaks: List[float] = []
+    monkeypatch.setattr(registry, "_observers", [
+        *registry._observers,
+        lambda metric, value, labels: peaks.append(value)
+        if metric == "ai_worker_db_pool_in_use_at_checkout" and labels.get("pool") == name else None,
+    ])
+    results = {"ok": 0, "timeout": 0}
+    lock = threading.Lock()
+    barrier = threading.Barrier(THREADS)
+
+    def hold() -> None:
+        barrier.wait()
+        try:
+            with session_scope() as db:
+                db.execute(text("SELECT 1"))
+                time.sleep(0.8)  # 大於 pool_timeout
+            outcome = "ok"
+        except PoolTimeoutError:
+            outcome = "timeout"
+        with lock:
+            results[outcome] += 1
+
+    threads = [threading.Thread(target=hold) for _ in range(THREADS)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    assert results == {"ok": capacity, "timeout": THREADS - capacity}
+    assert max(peaks) == capacity
+    assert counter("ai_worker_db_pool_events_total", pool=name, event="timeout") == THREADS - capacity
+    assert gauge("ai_worker_db_pool_in_use", name) == 0
+    assert gauge("ai_worker_db_pool_saturation", name) == 0
+
+
+@pytest.mark.parametrize("pre_ping", [True, False])
+def test_pre_ping_reconnects_after_server_drops_connection(make_engine, pre_ping):
+    name = f"test-ping-{pre_ping}"
+    engine = make_engine(name, pool_size=1, max_overflow=0, pool_pre_ping=pre_ping, pool_reset_on_return=None)
+    pooled = engine.raw_connection()
+    pooled.dbapi_connection.close()  # 模擬 Postgres 重啟／idle 連線被切斷
+    pooled.close()  # 歸還連線池（pool_reset_on_return=None，歸還時不碰這條連線）
+
+    def query() -> None:
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+
+    if pre_ping:
+        query()
+        assert counter("ai_worker_db_pool_events_total", pool=name, event="invalidate") > 0
+    else:
+        with pytest.raises(Exception):
+            query()
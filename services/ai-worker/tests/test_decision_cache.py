@@ -0,0 +1,109 @@
+"""
+Guardrail / MemoryGate 決策快取（llm_app.toolkits.decision_cache）
+"""
+
+import pytest
+
+import llm_app.toolkits.decision_cache as decision_cache
+
+
+@pytest.fixture
+def cache(fake_redis, monkeypatch):
+    monkeypatch.setattr(decision_cache, "get_redis", lambda: fake_redis)
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_ENABLED", True)
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_SIM_THRESHOLD", 0)
+    return fake_redis
+
+
+def _unit(vec):
+    norm = sum(x * x for x in vec) ** 0.5
+    return [x / norm for x in vec]
+
+
+class CountingLLM:
+    def __init__(self, decision="USE"):
+        self.decision = decision
+        self.calls = []
+
+    def __call__(self, text):
+        self.calls.append(text)
+        if isinstance(self.decision, Exception):
+            raise self.decision
+        return self.decision
+
+
+def test_normalize_text_ignores_punctuation_spacing_and_width():
+    assert decision_cache.normalize_text(" 早安！") == decision_cache.normalize_text("早安~")
+    assert decision_cache.normalize_text("ＯＫ 啦😀") == "ok啦"
+
+
+def test_repeated_input_calls_llm_once(cache):
+    llm = CountingLLM("SKIP")
+    assert decision_cache.cached_decision("memory_gate", "謝謝", llm) == "SKIP"
+    assert decision_cache.cached_decision("memory_gate", "謝謝！", llm) == "SKIP"
+
+    assert llm.calls == ["謝謝"]
+    stats = decision_cache.decision_cache_stats(("memory_gate",))["memory_gate"]
+    assert (stats["hit"], stats["miss"], stats["hit_rate"]) == (1, 1, 0.5)
+
+
+def test_kinds_are_cached_separately(cache):
+    decision_cache.cached_decision("memory_gate", "早安", CountingLLM("SKIP"))
+    guard = CountingLLM("OK")
+
+    assert decision_cache.cached_decision("guardrail", "早安", guard) == "OK"
+    assert guard.calls == ["早安"]
+
+
+def test_invalid_decision_is_not_cached(cache):
+    llm = CountingLLM("")
+    decision_cache.cached_decision("guardrail", "你好", llm, is_valid=lambda d: d.startswith(("OK", "BLOCK")))
+    decision_cache.cached_decision("guardrail", "你好", llm, is_valid=lambda d: d.startswith(("OK", "BLOCK")))
+
+    assert len(llm.calls) == 2
+
+
+def test_llm_error_propagates_and_is_not_cached(cache):
+    with pytest.raises(RuntimeError):
+        decision_cache.cached_decision("guardrail", "你好", CountingLLM(RuntimeError("timeout")))
+    llm = CountingLLM("OK")
+
+    assert decision_cache.cached_decision("guardrail", "你好", llm) == "OK"
+    assert llm.calls == ["你好"]
+
+
+def test_long_input_bypasses_cache(cache, monkeypatch):
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_MAX_CHARS", 4)
+    llm = CountingLLM("USE")
+    decision_cache.cached_decision("memory_gate", "我這禮拜去復健三次", llm)
+    decision_cache.cached_decision("memory_gate", "我這禮拜去復健三次", llm)
+
+    assert len(llm.calls) == 2
+    assert not cache.keys("decision:memory_gate:*")
+
+
+def test_redis_failure_falls_back_to_llm(cache, monkeypatch):
+    def broken():
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(decision_cache, "get_redis", broken)
+    llm = CountingLLM("OK")
+
+    assert decision_cache.cached_decision("guardrail", "你好", llm) == "OK"
+    assert llm.calls == ["你好"]
+
+
+def test_similar_input_reuses_decision(cache, monkeypatch):
+    vectors = {"早安": [1.0, 0.0], "早安啊": [0.98, 0.2], "我會喘": [0.0, 1.0]}
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_SIM_THRESHOLD", 0.9)
+    monkeypatch.setattr(decision_cache, "DECISION_CACHE_SIM_KINDS", {"memory_gate"})
+    monkeypatch.setattr(decision_cache, "_embed", lambda norm: _unit(vectors[norm]))
+    llm = CountingLLM("SKIP")
+    decision_cache.cached_decision("memory_gate", "早安", llm)
+
+    assert decision_cache.cached_decision("memory_gate", "早安啊", llm) == "SKIP"
+    assert llm.calls == ["早安"]
+    llm.decision = "USE"
+    assert decision_cache.cached_decision("memory_gate", "我會喘", llm) == "USE"
+    stats = decision_cache.decision_cache_stats(("memory_gate",))["memory_gate"]
+    assert stats["similar_hit"] == 1
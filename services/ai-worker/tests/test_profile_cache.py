@@ -0,0 +1,166 @@
+"""
+使用者畫像的 Redis 快取（llm_app.toolkits.profile_cache）
+
+以 SQLite（代替 Postgres）+ fakeredis 模擬 session，畫像讀取走 ProfileRepository.read_profile_as_dict
+（與 HealthBot.agent.profile_section 相同的呼叫），以 SQLAlchemy 事件計算送出的 SQL 數。
+"""
+
+from typing import Dict
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+import llm_app.repositories.profile_repository as profile_repository
+import llm_app.toolkits.profile_cache as profile_cache
+import llm_app.toolkits.redis_store as redis_store
+from llm_app.models.chat_profile import Base, ChatUserProfile, SessionLocal
+from observability.metrics import registry
+
+FACTS = {"add": {"health_status": {"diagnosis": "COPD 第二期", "inhaler": "每天早晚各一次"}}}
+UPDATE = {"update": {"health_status": {"inhaler": "改為每天三次"}}, "add": {"life_events": {"回診": "下週二胸腔科"}}}
+
+
+class SqlCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args, **kwargs) -> None:
+        self.count += 1
+
+    def during(self, fn, *args) -> int:
+        before = self.count
+        fn(*args)
+        return self.count - before
+
+
+@pytest.fixture
+def sql(fake_redis, monkeypatch):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine, tables=[ChatUserProfile.__table__])
+    monkeypatch.setitem(SessionLocal.kw, "bind", engine)
+    return SqlCounter(engine)
+
+
+@pytest.fixture
+def repo(monkeypatch):
+    # conftest 把 redis_store.ProfileRepository 換成空實作；這裡的 session 需要實際建立紀錄
+    monkeypatch.setattr(redis_store, "ProfileRepository", profile_repository.ProfileRepository)
+    return profile_repository.ProfileRepository()
+
+
+def db_profile(uid: int) -> Dict:
+    db = SessionLocal()
+    try:
+        return profile_repository.ProfileRepository._profile_dict(
+            db.query(ChatUserProfile).filter(ChatUserProfile.user_id == uid).one()
+        )
+    finally:
+        db.close()
+
+
+def cache_results() -> Dict[str, float]:
+    return {
+        r: registry.get_counter("ai_worker_profile_cache_total", {"result": r})
+        for r in ("hit", "miss", "fill", "stale", "invalidate", "error")
+    }
+
+
+def run_turns(uid: int, turns: int, sql: SqlCounter, read) -> list:
+    """每輪：刷新 session + 讀畫像；回傳每輪的 SQL 數。"""
+
+    def turn() -> None:
+        redis_store.start_or_refresh_session(str(uid))
+        read(uid)
+
+    return [sql.during(turn) for _ in range(turns)]
+
+
+def test_steady_state_turns_do_not_query_postgres(sql, repo, fake_redis):
+    cached = run_turns(1000, 10, sql, repo.read_profile_as_dict)
+
+    # 新使用者：session 啟動時 touch_last_contact_ts 建立紀錄並寫入快取
+    assert fake_redis.hexists("profile:cache:1000", "profile")
+    assert cached[1:] == [0] * 9
+
+    fake_redis.flushall()
+    legacy = run_turns(1000, 10, sql, repo.get_or_create_by_user_id)
+    assert all(n >= 1 for n in legacy[1:])
+
+
+def test_cold_cache_queries_postgres_once(sql, repo, fake_redis):
+    repo.get_or_create_by_user_id(1000)
+    repo.update_profile_facts(1000, FACTS)
+    fake_redis.flushall()
+
+    assert sql.during(repo.read_profile_as_dict, 1000) == 1
+    assert sum(sql.during(repo.read_profile_as_dict, 1000) for _ in range(10)) == 0
+
+
+def test_write_invalidates_and_next_read_refills(sql, repo, fake_redis):
+    repo.get_or_create_by_user_id(1000)
+    repo.update_profile_facts(1000, FACTS)
+    version_1 = int(fake_redis.hget("profile:cache:1000", "v"))
+    repo.update_profile_facts(1000, UPDATE)
+    version_2 = int(fake_redis.hget("profile:cache:1000", "v"))
+
+    assert version_2 == version_1 + 1
+    assert not fake_redis.hexists("profile:cache:1000", "profile")
+
+    before = sql.count
+    after_write = repo.read_profile_as_dict(1000)
+    assert sql.count - before == 1
+    assert after_write == db_profile(1000)
+    assert after_write["health_status"]["inhaler"] == "改為每天三次"
+    assert sql.during(repo.read_profile_as_dict, 1000) == 0
+    assert 0 < fake_redis.ttl("profile:cache:1000") <= profile_cache.PROFILE_CACHE_TTL_SEC
+
+
+def test_stale_fill_after_concurrent_write_is_rejected(sql, repo, fake_redis):
+    repo.get_or_create_by_user_id(1001)
+    repo.update_profile_facts(1001, FACTS)
+    fake_redis.hdel("profile:cache:1001", "profile")  # 快取內容過期，但版本還在
+    _, seen_version = profile_cache.get_cached_profile(1001)
+    stale = db_profile(1001)
+    stale_before = cache_results()["stale"]
+
+    repo.update_profile_facts(1001, UPDATE)
+
+    assert not profile_cache.fill_profile(1001, seen_version, stale)
+    assert cache_results()["stale"] == stale_before + 1
+    assert repo.read_profile_as_dict(1001) == db_profile(1001)
+
+
+def test_invalidation_arriving_out_of_order_keeps_latest(sql, repo, monkeypatch):
+    repo.get_or_create_by_user_id(1002)
+    deferred = []
+    # A 提交，快取操作延後到 B 之後才到達 Redis
+    with monkeypatch.context() as m:
+        m.setattr(profile_repository, "invalidate_profile", deferred.append)
+        repo.update_profile_facts(1002, FACTS)
+    assert deferred == [1002]
+
+    repo.read_profile_as_dict(1002)  # 兩次更新之間有人讀過（快取內容為 A）
+    repo.update_profile_facts(1002, UPDATE)  # B 提交並使快取失效
+    repo.read_profile_as_dict(1002)  # 回填 B
+    for uid in deferred:
+        profile_repository.invalidate_profile(uid)
+
+    latest = repo.read_profile_as_dict(1002)
+    assert latest == db_profile(1002)
+    assert latest["health_status"]["inhaler"] == "改為每天三次"
+
+
+def test_falls_back_to_postgres_when_redis_is_down(sql, repo, monkeypatch):
+    repo.get_or_create_by_user_id(1000)
+    repo.update_profile_facts(1000, FACTS)
+    errors_before = cache_results()["error"]
+
+    def broken():
+        raise ConnectionError("redis down")
+
+    monkeypatch.setattr(redis_store, "get_redis", broken)
+
+    assert repo.read_profile_as_dict(1000) == db_profile(1000)
+    assert cache_results()["error"] > errors_before
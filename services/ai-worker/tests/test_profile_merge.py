@@ -0,0 +1,216 @@
+"""
+畫像更新在資料庫端合併（ProfileRepository.update_profile_facts）
+
+以 SQLite 檔案資料庫（代替 Postgres，合併改用 json_patch / json_remove）+ fakeredis；
+合併語意與舊版的 Python 合併（讀出整份 → 深度合併 → 整份寫回）比對。
+"""
+
+import copy
+import random
+import threading
+from typing import Dict, List
+
+import pytest
+from sqlalchemy import create_engine, event, func, update
+from sqlalchemy.dialects import postgresql
+
+import llm_app.repositories.profile_repository as profile_repository
+from llm_app.models.chat_profile import PROFILE_MERGE_FUNCTION, Base, ChatUserProfile, SessionLocal
+
+THREADS = 8
+UPDATES = 10
+
+
+class UpdateBytes:
+    """累計 UPDATE 語句送出的參數位元組。"""
+
+    def __init__(self, engine):
+        self.bytes = 0
+        self.statements = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        if not statement.lstrip().upper().startswith("UPDATE"):
+            return
+        values = parameters.values() if isinstance(parameters, dict) else parameters
+        size = sum(len(str(v).encode("utf-8")) for v in values)
+        with self._lock:
+            self.bytes += size
+            self.statements += 1
+
+    def reset(self) -> None:
+        self.bytes = self.statements = 0
+
+
+@pytest.fixture
+def meter(fake_redis, monkeypatch, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'profiles.db'}", connect_args={"check_same_thread": False, "timeout": 30})
+    Base.metadata.create_all(engine, tables=[ChatUserProfile.__table__])
+    monkeypatch.setitem(SessionLocal.kw, "bind", engine)
+    yield UpdateBytes(engine)
+    engine.dispose()
+
+
+def big_profile(keys: int) -> Dict:
+    return {
+        "personal_background": {"居住": "與女兒同住", "興趣": {"音樂": "老歌", "運動": "散步"}},
+        "health_status": {f"紀錄{i:03d}": f"第 {i} 次回診，肺功能穩定，持續使用吸入器" for i in range(keys)},
+        "life_events": {"孫子婚禮": "下個月"},
+    }
+
+
+def seed(uid: int, profile: Dict) -> None:
+    db = SessionLocal()
+    try:
+        db.add(ChatUserProfile(user_id=uid, **{f"profile_{k}": v for k, v in profile.items()}))
+        db.commit()
+    finally:
+        db.close()
+
+
+def db_profile(uid: int) -> Dict:
+    db = SessionLocal()
+    try:
+        return profile_repository.ProfileRepository._profile_dict(
+            db.query(ChatUserProfile).filter(ChatUserProfile.user_id == uid).one()
+        )
+    finally:
+        db.close()
+
+
+def legacy_merge(profile: Dict, commands: Dict) -> Dict:
+    """舊版 update_profile_facts 的 Python 合併（add / update 深度合併，remove 依點號路徑刪除）。"""
+
+    def deep_merge(d1, d2):
+        for k, v in d2.items():
+            if k in d1 and isinstance(d1[k], dict) and isinstance(v, dict):
+                d1[k] = deep_merge(d1[k], v)
+            else:
+                d1[k] = v
+        return d1
+
+    out = copy.deepcopy(profile)
+    for op in ("add", "update"):
+        for category, facts in commands.get(op, {}).items():
+            if category in out:
+                out[category] = deep_merge(out[category] or {}, facts)
+    for path in commands.get("remove", []):
+        parts = path.split(".")
+        node = out.get(parts[0])
+        for part in parts[1:-1]:
+            node = node.get(part) if isinstance(node, dict) else None
+        if len(parts) > 1 and isinstance(node, dict):
+            node.pop(parts[-1], None)
+    return out
+
+
+def legacy_update(uid: int, commands: Dict) -> None:
+    """舊流程：讀出整列 → Python 合併 → 指令涉及的類別整份寫回。"""
+    db = SessionLocal()
+    try:
+        row = db.query(ChatUserProfile).filter(ChatUserProfile.user_id == uid).first()
+        merged = legacy_merge(profile_repository.ProfileRepository._profile_dict(row), commands)
+        for category in {*commands.get("add", {}), *commands.get("update", {})}:
+            setattr(row, f"profile_{category}", merged[category])
+        row.updated_at = func.now()
+        db.commit()
+    finally:
+        db.close()
+
+
+def fact(t: int, i: int) -> Dict:
+    return {"add": {"health_status": {f"新事實_{t}_{i}": f"執行緒 {t} 第 {i} 次"}}}
+
+
+def run_concurrent(uid: int) -> None:
+    # 模擬同一使用者的多個 finalize 同時收尾
+    repo = profile_repository.ProfileRepository()
+
+    def worker(t: int) -> None:
+        for i in range(UPDATES):
+            repo.update_profile_facts(uid, fact(t, i))
+
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(THREADS)]
+    for th in pool:
+        th.start()
+    for th in pool:
+        th.join()
+
+
+def semantic_cases(rng: random.Random) -> List[Dict]:
+    cases = [
+        {"add": {"personal_background": {"興趣": {"園藝": "種菜"}}}},
+        {"update": {"personal_background": {"興趣": "下棋"}}},
+        {"update": {"personal_background": {"居住": {"城市": "台中"}}}},
+        {"remove": ["personal_background.興趣.運動", "life_events.不存在", "health_status.紀錄001.子鍵"]},
+        {"add": {"life_events": {"回診": {"日期": "9/2", "科別": "胸腔科"}}}, "remove": ["life_events.孫子婚禮"]},
+        {"add": {"unknown_category": {"x": 1}}, "remove": ["health_status"]},
+    ]
+    for _ in range(10):
+        cases.append({
+            "add": {"health_status": {f"紀錄{rng.randrange(20):03d}": {"數值": rng.randint(1, 9)}}},
+            "update": {"personal_background": {"興趣": {"音樂": rng.choice(["老歌", "歌仔戲", "古典"])}}},
+            "remove": [f"health_status.紀錄{rng.randrange(20):03d}"],
+        })
+    return cases
+
+
+def test_concurrent_updates_are_not_lost(meter):
+    seed(1, big_profile(100))
+
+    run_concurrent(1)
+
+    health = db_profile(1)["health_status"]
+    assert [k for t in range(THREADS) for i in range(UPDATES) if f"新事實_{t}_{i}" not in health] == []
+    assert meter.statements == THREADS * UPDATES
+
+
+def test_update_sends_patch_not_whole_profile(meter):
+    seed(1, big_profile(100))
+    seed(2, big_profile(100))
+    repo = profile_repository.ProfileRepository()
+
+    for i in range(UPDATES):
+        legacy_update(1, fact(0, i))
+    legacy_bytes = meter.bytes / meter.statements
+    meter.reset()
+    for i in range(UPDATES):
+        repo.update_profile_facts(2, fact(0, i))
+    new_bytes = meter.bytes / meter.statements
+
+    assert db_profile(1) == db_profile(2)
+    assert new_bytes * 5 < legacy_bytes
+
+
+def test_merge_matches_legacy_semantics(meter):
+    expected = big_profile(20)
+    seed(3, expected)
+    repo = profile_repository.ProfileRepository()
+
+    for case in semantic_cases(random.Random(7)):
+        expected = legacy_merge(expected, case)
+        repo.update_profile_facts(3, case)
+        assert db_profile(3) == expected, case
+
+
+def test_postgres_merges_in_a_single_update():
+    values = profile_repository._profile_update_values(
+        "postgresql", {"add": {"health_status": {"a": {"b": 1}}}, "remove": ["life_events.孫子婚禮"]}
+    )
+    sql = str(update(ChatUserProfile).values(values).returning(ChatUserProfile.profile_health_status).compile(dialect=postgresql.dialect()))
+
+    assert PROFILE_MERGE_FUNCTION in sql
+    assert "#-" in sql
+    assert "RETURNING" in sql
+
+
+def test_concurrent_updates_invalidate_cache(meter, fake_redis):
+    seed(2, big_profile(20))
+    repo = profile_repository.ProfileRepository()
+    repo.read_profile_as_dict(2)
+
+    run_concurrent(2)
+
+    assert not fake_redis.hexists("profile:cache:2", "profile")
+    assert repo.read_profile_as_dict(2) == db_profile(2)
@@ -0,0 +1,79 @@
+"""
+主回覆上下文的 token 預算（llm_app.toolkits.prompt_budget）與只讀歷史尾端（redis_store.fetch_session_context）
+"""
+
+import json
+
+import pytest
+
+import llm_app.toolkits.redis_store as redis_store
+from llm_app.toolkits.prompt_budget import allocate, assemble_context, count_tokens, truncate_tokens
+
+BUDGET = 2000
+PROFILE = "👤 使用者畫像 (Profile):\n" + json.dumps(
+    {"health_status": {"diagnosis": "COPD 第二期", "inhaler": "每天早晚各一次"}, "life_events": {"孫子": "下個月結婚"}},
+    ensure_ascii=False, indent=2,
+)
+MEMORY = "\n".join(f"- 第 {i} 則記憶：阿嬤說早上散步二十分鐘後會有點喘，休息一下就好。" for i in range(40))
+
+
+def fill_session(r, uid: str, rounds: int) -> None:
+    r.rpush(f"session:{uid}:history", *[
+        json.dumps({"input": f"第 {i} 輪：今天早上起來有點咳嗽，痰是白色的", "output": f"第 {i} 輪：記得多喝溫水，咳不停要跟醫師說喔", "rid": f"r{i}"}, ensure_ascii=False)
+        for i in range(rounds)
+    ])
+    # 摘要長度固定（只看歷史部分的讀取量），內容足以讓摘要段落被截斷
+    r.set(f"session:{uid}:summary:text", "".join(f"第 {i} 段摘要：病況穩定，提醒用藥。" for i in range(60)) + f"（共 {rounds} 輪）")
+
+
+def read_bytes(summary, rounds) -> int:
+    return len(summary.encode("utf-8")) + sum(len(json.dumps(r, ensure_ascii=False).encode("utf-8")) for r in rounds)
+
+
+@pytest.mark.parametrize("rounds", [10, 100, 2000])
+def test_long_session_fits_budget_and_keeps_the_latest(fake_redis, rounds):
+    fill_session(fake_redis, "u1", rounds)
+    summary, recent = redis_store.fetch_session_context("u1", 6)
+
+    ctx, report = assemble_context(profile=PROFILE, memory=MEMORY, summary=summary, rounds=recent, budget=BUDGET)
+
+    assert len(recent) == min(6, rounds)
+    assert report["total"] <= BUDGET
+    assert recent[-1]["output"] in ctx
+    assert summary[-10:] in ctx
+    assert "memory" in report["truncated"]
+
+
+def test_history_read_does_not_grow_with_session_length(fake_redis):
+    sizes = []
+    for n in (10, 500, 2000):
+        fill_session(fake_redis, f"u{n}", n)
+        sizes.append(read_bytes(*redis_store.fetch_session_context(f"u{n}", 6)))
+
+    # 輪次編號的位數會讓每輪長度差幾個位元組
+    assert max(sizes) <= min(sizes) * 1.1
+
+
+def test_short_context_is_not_truncated():
+    ctx, report = assemble_context(profile=PROFILE, summary="病況穩定", rounds=[{"input": "早安", "output": "早安喔"}], budget=BUDGET)
+
+    assert report["truncated"] == []
+    assert "早安喔" in ctx and "病況穩定" in ctx
+
+
+def test_spare_budget_flows_to_sections_that_need_it():
+    shares = {"profile": 0.2, "memory": 0.3, "summary": 0.2, "recent": 0.3}
+    alloc = allocate({"profile": 10, "memory": 0, "summary": 100, "recent": 900}, 1000, shares)
+
+    assert alloc["profile"] == 10 and alloc["memory"] == 0
+    assert sum(alloc.values()) == 1000
+    assert alloc["recent"] == 1000 - 10 - alloc["summary"] and alloc["recent"] > 300
+
+
+def test_truncate_keeps_the_requested_end():
+    text = "一二三四五六七八九十" * 20
+
+    head, tail = truncate_tokens(text, 20, keep="head"), truncate_tokens(text, 20, keep="tail")
+    assert head.startswith("一二三") and head.endswith("…")
+    assert tail.endswith("九十") and tail.startswith("…")
+    assert count_tokens(head) <= 21 and count_tokens(tail) <= 21
@@ -0,0 +1,134 @@
+"""
+主回覆請求的開頭位元組穩定性（llm_app.HealthBot.care_prompt）
+
+依實際流程組出請求（assemble_context → build_care_task → care_messages），同一位使用者連續多輪對話
+（每輪的長期記憶、近期對話、時間、輸入都不同，其中一輪被 guardrail 攔截）；
+供應商的 prompt caching 以與先前請求相同的開頭計算命中，開頭需依穩定程度排列。
+"""
+
+import json
+import random
+from typing import Dict, List
+
+import pytest
+
+import llm_app.toolkits.redis_store as redis_store
+from llm_app.HealthBot.care_prompt import (
+    CARE_TASK_RULES,
+    HEALTH_AGENT_GOAL,
+    HEALTH_AGENT_ROLE,
+    build_care_task,
+    care_messages,
+)
+from llm_app.toolkits.prompt_budget import RECENT_HEADER, SUMMARY_HEADER, assemble_context, count_tokens, render_rounds
+
+TURNS = 20
+PROFILE = "👤 使用者畫像 (Profile):\n" + json.dumps(
+    {
+        "personal_background": {"居住": "與女兒同住", "興趣": "唱老歌、散步"},
+        "health_status": {"diagnosis": "COPD 第二期", "inhaler": "每天早晚各一次"},
+        "life_events": {"回診": "2025-09-02 胸腔科"},
+    },
+    ensure_ascii=False, indent=2, sort_keys=True,
+)
+MEMORIES = [f"- 阿嬤說{x}" for x in ("早上散步二十分鐘後會喘", "孫子下個月結婚", "吸入器用完要去拿藥", "晚上睡不好", "喜歡吃地瓜粥", "女兒週末帶她去公園")]
+QUERIES = ["今天有點喘", "孫子打電話來了", "藥快吃完了", "晚上咳嗽", "早安", "想出去走走", "胸口悶悶的", "吃了稀飯"]
+
+
+def request_bytes(messages: List[Dict]) -> bytes:
+    """與 SDK 送出的 JSON 相同的逐字元跳脫；不含工具定義（固定內容，排在 messages 之前）。"""
+    return json.dumps({"messages": messages}, ensure_ascii=False).encode("utf-8")
+
+
+def json_prefix(messages: List[Dict]) -> bytes:
+    """messages 最後一則內容視為開頭片段時，序列化後必定出現的開頭位元組（去掉結尾的引號與括號）。"""
+    return request_bytes(messages)[: -len('"}]}')]
+
+
+def common_prefix(a: bytes, b: bytes) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def stable_prefix(summary: str) -> bytes:
+    """開頭到歷史摘要結尾（或畫像結尾）為止的位元組。"""
+    ctx, _ = assemble_context(profile=PROFILE, summary=summary)
+    return json_prefix(care_messages(CARE_TASK_RULES + "\n# CONTEXT\n[上下文資訊 (可能為空)]:\n" + ctx))
+
+
+def legacy_request(uid: str, now: str, memory: str, summary: str, rounds: List[Dict], query: str) -> List[Dict]:
+    """舊排列的重建：系統訊息帶 user_id，時間與上下文在規則之前，記憶在摘要之前。"""
+    ctx = "\n\n".join(
+        x for x in (PROFILE, memory, SUMMARY_HEADER + summary if summary else "", RECENT_HEADER + "\n".join(render_rounds(rounds))) if x
+    )
+    role, rules = CARE_TASK_RULES.split("# 你的思考流程", 1)
+    task = f"{role}# CONTEXT\n[當前時間]: {now}\n[上下文資訊 (可能為空)]:\n{ctx}\n[使用者本輪輸入]:\n{query}\n\n---\n\n# 你的思考流程{rules}"
+    return [
+        {"role": "system", "content": f"You are {HEALTH_AGENT_ROLE}. 陪伴使用者 {uid} 的溫暖孫女\nYour personal goal is: {HEALTH_AGENT_GOAL}"},
+        {"role": "user", "content": task},
+    ]
+
+
+def simulate(uid: str, turns: int, rng: random.Random) -> List[Dict]:
+    """每輪回傳新排列與舊排列的請求位元組、該輪的穩定開頭與每輪變動的內容；每 5 輪摘要推進一次。"""
+    out = []
+    for i in range(turns):
+        if i and i % 5 == 0:
+            redis_store.commit_summary_chunk(uid, i - 5, 5, f"--- 第{i - 4}至{i}輪對話摘要 ---\n長輩偶有喘，按時用藥，心情穩定。")
+        summary, rounds = redis_store.fetch_session_context(uid, 6)
+        memory = "⭐ 個人長期記憶:\n" + "\n".join(rng.sample(MEMORIES, rng.randint(0, 3))) if rng.random() < 0.7 else ""
+        query = rng.choice(QUERIES) + f"（第 {i} 輪）"
+        now = f"2025-08-21 09:{i:02d}:{rng.randint(0, 59):02d}"
+        ctx, _ = assemble_context(profile=PROFILE, memory=memory, summary=summary, rounds=rounds)
+        out.append({
+            "new": request_bytes(care_messages(build_care_task(now, ctx, query, i == 3))),
+            "old": request_bytes(legacy_request(uid, now, memory, summary, rounds, query)),
+            "stable": stable_prefix(summary),
+            "summary": summary,
+            "volatile": (now, query),
+        })
+        redis_store.commit_turn(uid, {"input": query, "output": "好喔，要多休息。", "rid": f"{uid}-{i}"}, chunk_size=0)
+    return out
+
+
+@pytest.fixture
+def turns(fake_redis):
+    return simulate("1001", TURNS, random.Random(7))
+
+
+def test_every_turn_starts_with_profile_and_summary(turns):
+    for turn in turns:
+        assert turn["new"].startswith(turn["stable"])
+        for volatile in turn["volatile"]:
+            assert volatile.encode("utf-8") not in turn["stable"]
+
+
+def test_consecutive_turns_share_prefix_until_summary_changes(turns):
+    profile_only = stable_prefix("")
+    for prev, cur in zip(turns, turns[1:]):
+        if prev["summary"] == cur["summary"]:
+            assert common_prefix(prev["new"], cur["new"]) >= len(cur["stable"])
+        # 摘要更新後，開頭到使用者畫像為止仍相同
+        assert cur["new"].startswith(profile_only)
+
+
+def test_rules_prefix_is_shared_across_users(fake_redis, turns):
+    other = simulate("2002", 2, random.Random(11))
+    rules_only = json_prefix(care_messages(CARE_TASK_RULES))
+
+    assert turns[0]["new"].startswith(rules_only)
+    assert other[0]["new"].startswith(rules_only)
+
+
+def test_shared_prefix_is_longer_than_legacy_layout(turns):
+    def avg_prefix_tokens(key: str) -> float:
+        sizes = [
+            count_tokens(cur[key][: common_prefix(prev[key], cur[key])].decode("utf-8", "ignore"))
+            for prev, cur in zip(turns, turns[1:])
+        ]
+        return sum(sizes) / len(sizes)
+
+    assert avg_prefix_tokens("new") > avg_prefix_tokens("old")
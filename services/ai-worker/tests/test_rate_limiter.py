@@ -0,0 +1,151 @@
+"""
+OpenAI 跨行程限流與共用 client（llm_app.toolkits.llm_client）
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import llm_app.toolkits.llm_client as llm_client
+from llm_app.toolkits.llm_client import BACKGROUND, INTERACTIVE, RateLimiter
+from observability.metrics import registry
+
+NO_WAIT = {INTERACTIVE: 0.05, BACKGROUND: 0.05}
+
+
+def limiter(fake_redis, **kwargs) -> RateLimiter:
+    kwargs.setdefault("background_reserve", 0.3)
+    return RateLimiter(redis_client=fake_redis, max_wait=NO_WAIT, key="test:ratelimit", **kwargs)
+
+
+def admit(rl: RateLimiter, priority: str = INTERACTIVE) -> str:
+    """送出一次 1 token 的請求，回傳限流結果（granted / waited / timeout / error）。"""
+    results = ("granted", "waited", "timeout", "error")
+    before = [registry.get_counter("ai_worker_openai_ratelimit_total", {"priority": priority, "result": r}) for r in results]
+    rl.acquire(1, priority)
+    after = [registry.get_counter("ai_worker_openai_ratelimit_total", {"priority": priority, "result": r}) for r in results]
+    return next(r for r, b, a in zip(results, before, after) if a > b)
+
+
+def tpm_level(fake_redis) -> float:
+    return float(fake_redis.hget("test:ratelimit:tpm", "level"))
+
+
+def test_disabled_limiter_never_touches_redis():
+    rl = RateLimiter(rpm=0, tpm=0, redis_client=object())
+
+    assert not rl.enabled
+    assert rl.acquire(10_000) == 0.0
+
+
+def test_rpm_budget_is_shared_and_then_waits(fake_redis):
+    a, b = limiter(fake_redis, rpm=4, tpm=0), limiter(fake_redis, rpm=4, tpm=0)
+
+    assert [admit(rl) for rl in (a, b, a, b)] == ["granted"] * 4
+    assert admit(a) == "timeout"
+
+
+def test_background_leaves_reserve_for_interactive(fake_redis):
+    rl = limiter(fake_redis, rpm=10, tpm=0)
+
+    assert [admit(rl, BACKGROUND) for _ in range(7)] == ["granted"] * 7
+    assert admit(rl, BACKGROUND) == "timeout"
+    assert [admit(rl, INTERACTIVE) for _ in range(3)] == ["granted"] * 3
+
+
+def test_settle_refunds_and_charges_tpm(fake_redis):
+    rl = limiter(fake_redis, rpm=0, tpm=1000)
+    rl.acquire(300)
+    after_acquire = tpm_level(fake_redis)
+
+    rl.settle(300, 100)
+    assert tpm_level(fake_redis) == pytest.approx(after_acquire + 200, abs=1)
+    rl.settle(100, 250)
+    assert tpm_level(fake_redis) == pytest.approx(after_acquire + 50, abs=1)
+
+
+def test_redis_failure_fails_open():
+    class Broken:
+        def register_script(self, _):
+            raise ConnectionError("redis down")
+
+    assert admit(RateLimiter(rpm=1, redis_client=Broken())) == "error"
+
+
+def test_estimate_tokens_counts_prompt_and_completion_allowance():
+    assert llm_client.estimate_tokens([{"content": "x" * 100}], max_tokens=50) == 50 + 1 + 50
+    assert llm_client.estimate_tokens(text=["abcd", "ef"]) == 4
+
+
+class RecordingLimiter:
+    def __init__(self):
+        self.acquired, self.settled = [], []
+
+    def acquire(self, tokens, priority=INTERACTIVE):
+        self.acquired.append((tokens, priority))
+        return 0.0
+
+    def settle(self, estimated, actual):
+        self.settled.append((estimated, actual))
+
+
+@pytest.fixture
+def recording(monkeypatch):
+    rl = RecordingLimiter()
+    usage = []
+    monkeypatch.setattr(llm_client, "get_rate_limiter", lambda: rl)
+    monkeypatch.setattr(llm_client, "record_usage", lambda stage, model, p, c, **kw: usage.append((stage, model, p, c)))
+    monkeypatch.setattr(llm_client, "record_crew_usage", lambda stage, output, latency: usage.append((stage, output)))
+    return rl, usage
+
+
+def test_pooled_client_acquires_settles_and_records(recording, monkeypatch):
+    rl, usage = recording
+    res = SimpleNamespace(model="gpt-4o-mini", usage=SimpleNamespace(prompt_tokens=40, completion_tokens=10, total_tokens=50))
+    base = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kw: res)))
+    monkeypatch.setattr(llm_client, "_base_client", lambda: base)
+
+    client = llm_client.PooledOpenAI(BACKGROUND, "summary")
+    assert client.chat.completions.create(model="gpt-4o-mini", messages=[{"content": "你好"}], max_tokens=20) is res
+    assert rl.acquired == [(22, BACKGROUND)]
+    assert rl.settled == [(22, 50)]
+    assert usage == [("summary", "gpt-4o-mini", 40, 10)]
+
+
+def test_abandoned_stream_is_still_settled(recording, monkeypatch):
+    rl, usage = recording
+    events = [SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content="您好喔", tool_calls=None))])] * 3
+    base = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=lambda **kw: iter(events))))
+    monkeypatch.setattr(llm_client, "_base_client", lambda: base)
+
+    stream = llm_client.PooledOpenAI(INTERACTIVE, "main_reply").chat.completions.create(
+        model="m", messages=[{"content": "x" * 40}], max_tokens=10, stream=True
+    )
+    next(stream)
+    stream.close()
+
+    assert len(rl.settled) == 1 and rl.settled[0][1] is not None
+    assert usage[0][:3] == ("main_reply", "m", 21)
+
+
+def test_kickoff_crew_counts_against_the_bucket(recording):
+    rl, usage = recording
+    output = SimpleNamespace(raw="OK", token_usage=SimpleNamespace(total_tokens=120))
+    crew = SimpleNamespace(kickoff=lambda: output)
+
+    assert llm_client.kickoff_crew(crew, "guardrail", "x" * 20, BACKGROUND) is output
+    assert rl.acquired == [(11 + llm_client.DEFAULT_COMPLETION_TOKENS, BACKGROUND)]
+    assert rl.settled == [(rl.acquired[0][0], 120)]
+    assert usage == [("guardrail", output)]
+
+
+def test_failed_kickoff_is_still_settled(recording):
+    rl, usage = recording
+
+    def boom():
+        raise RuntimeError("provider 500")
+
+    with pytest.raises(RuntimeError):
+        llm_client.kickoff_crew(SimpleNamespace(kickoff=boom), "profiler", "x")
+    assert rl.settled == [(rl.acquired[0][0], None)]
+    assert usage == [("profiler", None)]
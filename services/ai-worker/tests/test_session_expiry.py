@@ -0,0 +1,97 @@
+"""
+Session 過期索引（redis_store.get_expired_sessions / cleanup_session_keys）
+"""
+
+import time
+
+import fakeredis
+import pytest
+
+import llm_app.toolkits.redis_store as redis_store
+
+from conftest import NoopProfileRepository
+
+SESSIONS = 2000
+EXPIRED = 10
+
+
+class CountingRedis(fakeredis.FakeRedis):
+    """計算送出的指令數（pipeline 內的每個指令各算一次）。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commands = 0
+
+    def execute_command(self, *args, **kwargs):
+        self.commands += 1
+        return super().execute_command(*args, **kwargs)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super().pipeline(transaction, shard_hint)
+        original = pipe.execute
+
+        def execute(*args, **kwargs):
+            self.commands += len(pipe.command_stack)
+            return original(*args, **kwargs)
+
+        pipe.execute = execute
+        return pipe
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    """
+    一半是索引上線前的舊 session（只有 last_active key），一半經 start_or_refresh_session 進入索引；
+    兩邊各有 EXPIRED 個閒置超時，另有一個 active 已過期但還差 30 秒才超時。回傳 (redis, 過期的 user_id)。
+    """
+    r = CountingRedis(decode_responses=True)
+    monkeypatch.setattr(redis_store, "get_redis", lambda: r)
+    monkeypatch.setattr(redis_store, "ProfileRepository", NoopProfileRepository)
+    timeout = redis_store.SESSION_TIMEOUT_SECONDS
+    now = int(time.time())
+
+    legacy = [str(i) for i in range(SESSIONS // 2)]
+    pipe = r.pipeline(transaction=False)
+    for uid in legacy:
+        pipe.set(f"session:last_active:{uid}", now - 10)
+        pipe.set(f"session:active:{uid}", "1", ex=timeout)
+    pipe.execute()
+    for i in range(SESSIONS // 2, SESSIONS):
+        redis_store.start_or_refresh_session(str(i))
+
+    expired = [str(i) for i in range(SESSIONS - EXPIRED, SESSIONS)] + legacy[:EXPIRED]
+    for uid in expired:
+        r.delete(f"session:active:{uid}")
+        r.set(f"session:last_active:{uid}", now - timeout - 5)
+        if r.zscore(redis_store.SESSION_INDEX_KEY, uid) is not None:
+            r.zadd(redis_store.SESSION_INDEX_KEY, {uid: now - timeout - 5})
+    boundary = legacy[EXPIRED]
+    r.delete(f"session:active:{boundary}")
+    r.set(f"session:last_active:{boundary}", now - timeout + 30)
+    return r, expired
+
+
+def test_index_finds_the_same_expired_sessions_after_one_backfill(sessions):
+    r, expired = sessions
+
+    assert sorted(redis_store.get_expired_sessions()) == sorted(expired)
+    r.commands = 0
+    assert sorted(redis_store.get_expired_sessions()) == sorted(expired)
+    # 回填之後的掃描與過期數同級，不再隨曾經出現過的 session 數成長
+    assert r.commands <= len(expired) + 5
+
+
+def test_cleanup_removes_only_that_users_keys(sessions):
+    r, expired = sessions
+    redis_store.get_expired_sessions()
+    uid, other = expired[0], str(SESSIONS // 2)
+    r.rpush(f"session:{uid}:history", "{}")
+    r.set(f"session:{uid}:summary:text", "摘要")
+    r.set(f"session:{uid}:state", "FINALIZING")
+
+    redis_store.cleanup_session_keys(uid)
+
+    assert [k for k in r.keys(f"session:*{uid}*") if k.split(":")[-1] == uid or f":{uid}:" in k] == []
+    assert r.zscore(redis_store.SESSION_INDEX_KEY, uid) is None
+    assert r.exists(f"session:last_active:{other}")
+    assert r.zscore(redis_store.SESSION_INDEX_KEY, other) is not None
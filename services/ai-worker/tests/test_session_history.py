@@ -0,0 +1,89 @@
+"""
+Session 歷史的精簡編碼與裁切（redis_store.commit_turn / commit_summary_chunk / fetch_history_for_distillation）
+以及收尾蒸餾的逐字稿（HealthBot.agent._render_session_transcript）
+"""
+
+import json
+import re
+
+import pytest
+
+import llm_app.toolkits.redis_store as redis_store
+
+CHUNK = 5
+KEEP = 30
+
+
+@pytest.fixture(autouse=True)
+def trim_settings(monkeypatch):
+    monkeypatch.setattr(redis_store, "HISTORY_KEEP_SUMMARIZED", KEEP)
+    monkeypatch.setattr(redis_store, "HISTORY_MAX_ROUNDS", 0)
+
+
+def fact(i: int) -> str:
+    return f"第{i}件事：我每週{i % 7 + 1}去復健科"
+
+
+def play_session(uid: str, rounds: int) -> None:
+    """逐輪寫入；湊滿一段就以假摘要提交（摘要列出該段的事實）。"""
+    for i in range(1, rounds + 1):
+        _, start, chunk = redis_store.commit_turn(
+            uid, {"input": fact(i), "output": f"好的，記下第{i}件事", "rid": f"{uid}:{i}"}, chunk_size=CHUNK
+        )
+        if start is not None:
+            body = "；".join(r["input"] for r in chunk)
+            redis_store.commit_summary_chunk(uid, start, len(chunk), f"--- 第{start + 1}至{start + len(chunk)}輪對話摘要 ---\n{body}")
+
+
+def test_compact_encoding_round_trips_and_reads_legacy_rows():
+    row = {"input": "早安", "output": "早安喔", "rid": "r1", "proactive": True}
+
+    assert redis_store.decode_round(redis_store.encode_round(row)) == row
+    assert len(redis_store.encode_round(row)) < len(json.dumps(row, ensure_ascii=False))
+    assert redis_store.decode_round(json.dumps(row, ensure_ascii=False)) == row
+
+
+def test_short_session_is_kept_verbatim(fake_redis):
+    play_session("short", 25)
+    summary, trimmed, rounds = redis_store.fetch_history_for_distillation("short")
+
+    assert trimmed == 0
+    assert [r["input"] for r in rounds] == [fact(i) for i in range(1, 26)]
+
+
+def test_long_session_is_trimmed_but_every_fact_survives(fake_redis):
+    play_session("long", 120)
+    summary, trimmed, rounds = redis_store.fetch_history_for_distillation("long")
+
+    assert redis_store.history_len("long") <= KEEP + CHUNK
+    assert trimmed + len(rounds) == 120
+    assert [r["input"] for r in rounds] == [fact(i) for i in range(trimmed + 1, 121)]
+    assert all(fact(i) in summary for i in range(1, trimmed + 1))
+    # 只讀保留的回合會遺失被裁掉的部分
+    assert len(redis_store.fetch_all_history("long")) == 120 - trimmed
+
+
+def test_hysteresis_and_disabled_trim(fake_redis, monkeypatch):
+    monkeypatch.setattr(redis_store, "HISTORY_MAX_ROUNDS", 60)
+    play_session("capped", 50)
+    assert redis_store.history_len("capped") == 50
+    play_session("capped2", 70)
+    assert redis_store.history_len("capped2") <= KEEP + CHUNK
+
+    monkeypatch.setattr(redis_store, "HISTORY_MAX_ROUNDS", -1)
+    play_session("untrimmed", 120)
+    assert redis_store.history_len("untrimmed") == 120
+
+
+def test_distillation_transcript_marks_summary_and_keeps_numbering(fake_redis):
+    pytest.importorskip("crewai")
+    import llm_app.HealthBot.agent as agent
+
+    play_session("long", 120)
+    transcript = agent._render_session_transcript("long")
+    verbatim = {int(n): text for n, text in re.findall(r"^(\d+)\. 使用者：(.*)$", transcript, flags=re.M)}
+    first = min(verbatim)
+
+    assert "非逐字" in transcript
+    assert all(fact(i) in transcript for i in range(1, 121))
+    assert verbatim == {i: fact(i) for i in range(first, 121)}
@@ -0,0 +1,139 @@
+"""
+分層摘要濃縮（llm_app.toolkits.summary_compaction）
+
+長 session 的每一段經摘要佇列的 drain_user 摘要並視門檻濃縮；段落摘要與濃縮都以固定內容的假 LLM 代替。
+"""
+
+import re
+from typing import Dict
+
+import pytest
+
+import llm_app.toolkits.redis_store as redis_store
+import llm_app.toolkits.summary_compaction as compaction
+from llm_app.toolkits.prompt_budget import assemble_context
+from llm_app.toolkits.summary_queue import drain_user
+from observability.metrics import registry
+
+CHUNK = 5
+CHUNK_CHARS = 110
+FILLER = "長輩提到早上散步後有點喘，吸入器按時使用，晚上咳嗽較多，心情還不錯，週末孫子會回來。"
+
+
+def chunk_text(start: int, size: int, chars: int = CHUNK_CHARS) -> str:
+    return f"--- 第{start + 1}至{start + size}輪對話摘要 ---\n" + (FILLER * (chars // len(FILLER) + 1))[:chars]
+
+
+class FakeLLM:
+    """段落摘要與濃縮的替身；提交的段落原文另存一份供比對。"""
+
+    def __init__(self):
+        self.committed: Dict[int, str] = {}
+
+    def summarize(self, user_id: str, start: int, chunk: list) -> bool:
+        text = chunk_text(start, len(chunk))
+        ok = redis_store.commit_summary_chunk(user_id, start, len(chunk), text)
+        if ok:
+            self.committed[start] = text
+        return ok
+
+    def condense(self, text: str, max_chars: int) -> str:
+        spans = re.findall(r"第(\d+)至(\d+)輪", text)
+        covered = f"（涵蓋第{spans[0][0]}至{spans[-1][1]}輪）" if spans else ""
+        return (covered + "長期追蹤：喘與咳嗽反覆、吸入器使用規律、家人常探望。" * 40)[: int(max_chars * 0.8)]
+
+
+def broken(text: str, max_chars: int) -> str:
+    raise RuntimeError("LLM 無回應")
+
+
+@pytest.fixture
+def summary_tokens(monkeypatch):
+    """收集 ai_worker_summary_tokens 的觀測值（濃縮前後）。"""
+    observed = {"before": [], "after": []}
+    monkeypatch.setattr(registry, "_observers", list(registry._observers))
+    registry.add_observer(
+        lambda name, value, labels: observed[labels["phase"]].append(value) if name == "ai_worker_summary_tokens" else None
+    )
+    return observed
+
+
+@pytest.fixture
+def long_session(fake_redis, summary_tokens):
+    """400 輪的 session，每湊滿一段就排入佇列並立即排空；回傳 (FakeLLM, 每次排空後的摘要字數)。"""
+    llm, sizes = FakeLLM(), []
+    for i in range(400):
+        _, start, _ = redis_store.commit_turn(
+            "long", {"input": f"第 {i} 輪", "output": "好喔", "rid": f"long-{i}"}, chunk_size=CHUNK, enqueue_summary=True
+        )
+        job = redis_store.pop_summary_job(0) if start is not None else None
+        if job:
+            drain_user(job, llm.summarize, CHUNK, condense=llm.condense)
+            sizes.append(len(redis_store.get_summary("long")[0]))
+    return llm, sizes
+
+
+def test_summary_size_stays_bounded(long_session, summary_tokens):
+    llm, sizes = long_session
+    legacy = "\n\n".join(llm.committed[s] for s in sorted(llm.committed))
+
+    assert max(sizes) <= redis_store.SUMMARY_MAX_CHARS + CHUNK_CHARS + 30
+    assert len(legacy) > 5 * redis_store.SUMMARY_MAX_CHARS
+    _, after = assemble_context(summary=redis_store.get_summary("long")[0], budget=100000)
+    _, before = assemble_context(summary=legacy, budget=100000)
+    assert after["sections"]["summary"] < before["sections"]["summary"]
+    assert summary_tokens["before"] and max(summary_tokens["after"]) < max(summary_tokens["before"])
+
+
+def test_digest_then_contiguous_verbatim_chunks(long_session):
+    llm, _ = long_session
+    text, cursor = redis_store.get_summary("long")
+    digest, *chunks = compaction.split_blocks(text)
+
+    assert digest.digest and digest.start == 1
+    assert len(digest.text.split("\n", 1)[1]) <= compaction.SUMMARY_DIGEST_MAX_CHARS
+    assert len(chunks) >= compaction.SUMMARY_KEEP_RECENT_CHUNKS
+    expect = digest.end + 1
+    for block in chunks:
+        assert not block.digest and block.start == expect
+        assert block.text == llm.committed[block.start - 1]
+        expect = block.end + 1
+    assert expect - 1 == cursor
+
+
+def test_chunk_committed_during_condense_is_not_lost(fake_redis):
+    r, llm = fake_redis, FakeLLM()
+    r.set("session:race:summary:text", "\n\n".join(chunk_text(s, CHUNK, 150) for s in range(0, 60, CHUNK)))
+    r.set("session:race:summary:rounds", 60)
+    late = chunk_text(60, CHUNK, 150)
+
+    def racing(text: str, max_chars: int) -> str:
+        redis_store.commit_summary_chunk("race", 60, CHUNK, late)
+        return llm.condense(text, max_chars)
+
+    assert compaction.compact_summary("race", racing)["result"] == "conflict"
+    assert compaction.compact_summary("race", llm.condense)["result"] == "compacted"
+    assert late in redis_store.get_summary("race")[0]
+
+
+def test_llm_failure_keeps_summary_until_twice_the_limit(fake_redis):
+    over = "\n\n".join(chunk_text(s, CHUNK, 150) for s in range(0, 60, CHUNK))
+    fake_redis.set("session:fail1:summary:text", over)
+
+    assert compaction.compact_summary("fail1", broken)["result"] == "failed"
+    assert fake_redis.get("session:fail1:summary:text") == over
+
+
+def test_llm_failure_past_twice_the_limit_keeps_recent_chunks(fake_redis):
+    huge = "\n\n".join(chunk_text(s, CHUNK, 150) for s in range(0, 200, CHUNK))
+    fake_redis.set("session:fail2:summary:text", huge)
+
+    assert compaction.compact_summary("fail2", broken)["result"] == "fallback"
+    kept = fake_redis.get("session:fail2:summary:text")
+    assert len(kept) <= redis_store.SUMMARY_MAX_CHARS and huge.endswith(kept)
+
+
+def test_single_level_digest_from_older_versions_is_parsed():
+    text = "--- 第1至40輪對話摘要（已濃縮）---\n舊版濃縮內容\n\n" + chunk_text(40, CHUNK, 50)
+
+    assert [(b.start, b.end, b.digest) for b in compaction.split_blocks(text)] == [(1, 40, True), (41, 45, False)]
@@ -0,0 +1,176 @@
+"""
+背景摘要佇列（llm_app.toolkits.summary_queue、redis_store 的佇列函式）
+
+摘要的 LLM 以 FakeSummarizer 代替：等待固定延遲後以 CAS 提交固定內容的摘要（可設定每幾次失敗一次）。
+"""
+
+import re
+import threading
+import time
+
+import pytest
+
+import llm_app.toolkits.redis_store as redis_store
+import llm_app.toolkits.summary_queue as summary_queue
+
+CHUNK = 5
+HEADER = re.compile(r"--- 第(\d+)至(\d+)輪對話摘要 ---")
+
+
+class FakeSummarizer:
+    def __init__(self, llm_sec: float = 0.0, fail: bool = False):
+        self.llm_sec = llm_sec
+        self.fail = fail
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, user_id: str, start: int, chunk: list) -> bool:
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.llm_sec)
+        if self.fail:
+            return False
+        header = f"--- 第{start + 1}至{start + len(chunk)}輪對話摘要 ---\n"
+        return redis_store.commit_summary_chunk(user_id, start, len(chunk), header + "病況穩定。")
+
+
+class FakeTime:
+    """取代 redis_store 的 time 模組：sleep 只推進時鐘，租約與退避不必真的等待。"""
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, sec):
+        self.now += sec
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(redis_store, "time", fake)
+    return fake
+
+
+@pytest.fixture(autouse=True)
+def retry_settings(monkeypatch):
+    monkeypatch.setattr(summary_queue, "SUMMARY_RETRY_BASE_SEC", 30)
+    monkeypatch.setattr(summary_queue, "SUMMARY_RETRY_MAX_SEC", 100)
+
+
+def turn(uid: str, i: int):
+    return redis_store.commit_turn(
+        uid, {"input": f"第 {i} 輪提問", "output": f"第 {i} 輪回覆", "rid": f"{uid}-{i}"}, chunk_size=CHUNK, enqueue_summary=True
+    )
+
+
+def summarized_spans(r, uid: str):
+    return [(int(a), int(b)) for a, b in HEADER.findall(r.get(f"session:{uid}:summary:text") or "")]
+
+
+def queued(r):
+    return r.zrange(redis_store.SUMMARY_QUEUE_KEY, 0, -1)
+
+
+def test_full_chunk_is_queued_once_without_summarizing_inline(fake_redis):
+    results = [turn("u1", i) for i in range(CHUNK + 3)]
+
+    assert all(chunk == [] for _, _, chunk in results)
+    assert queued(fake_redis) == ["u1"]
+    assert not redis_store.enqueue_summary("u1")
+
+
+def test_concurrent_turns_summarize_every_chunk_exactly_once(fake_redis):
+    users, turns = 8, 22
+    summarize = FakeSummarizer(llm_sec=0.01)
+    worker = summary_queue.SummaryWorker(3, summarize=summarize, poll_sec=1).start()
+
+    def producer(u):
+        for i in range(turns):
+            turn(f"q{u}", i)
+            # 對話間隔比摘要延遲短，摘要進行中一定會有新回合湊滿下一段
+            time.sleep(0.003)
+
+    threads = [threading.Thread(target=producer, args=(u,)) for u in range(users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    deadline = time.time() + 20
+    while time.time() < deadline and (queued(fake_redis) or fake_redis.keys("lock:summary:*")):
+        time.sleep(0.05)
+    worker.stop(timeout=5)
+
+    want = [(s + 1, s + CHUNK) for s in range(0, turns // CHUNK * CHUNK, CHUNK)]
+    assert [summarized_spans(fake_redis, f"q{u}") for u in range(users)] == [want] * users
+    assert summarize.calls == users * (turns // CHUNK)
+    assert queued(fake_redis) == []
+
+
+def test_failed_summary_backs_off_exponentially(fake_redis, clock):
+    for i in range(CHUNK):
+        turn("flaky", i)
+    failing = FakeSummarizer(fail=True)
+
+    assert summary_queue.drain_user(redis_store.pop_summary_job(0), failing) == "failed"
+    assert fake_redis.zscore(redis_store.SUMMARY_QUEUE_KEY, "flaky") == pytest.approx(clock.now + 30)
+    # 退避期間新回合不會提早排入，也取不出來
+    turn("flaky", CHUNK)
+    assert redis_store.pop_summary_job(10) is None
+
+    assert summary_queue.drain_user(redis_store.pop_summary_job(30), failing) == "failed"
+    assert fake_redis.zscore(redis_store.SUMMARY_QUEUE_KEY, "flaky") == pytest.approx(clock.now + 60)
+    summary_queue.drain_user(redis_store.pop_summary_job(60), failing)
+    assert fake_redis.zscore(redis_store.SUMMARY_QUEUE_KEY, "flaky") == pytest.approx(clock.now + 100)
+
+    assert summary_queue.drain_user(redis_store.pop_summary_job(100), FakeSummarizer()) == "done"
+    assert summarized_spans(fake_redis, "flaky") == [(1, CHUNK)]
+    assert fake_redis.hget(redis_store.SUMMARY_ATTEMPTS_KEY, "flaky") is None
+    assert queued(fake_redis) == []
+
+
+def test_unacked_job_is_redelivered_after_the_lease(fake_redis, clock):
+    for i in range(CHUNK):
+        turn("lost", i)
+
+    assert redis_store.pop_summary_job(0, lease_sec=60) == "lost"
+    # 取出的執行緒在確認前當掉：租約到期前不會再被取出，到期後再取出
+    assert redis_store.pop_summary_job(59) is None
+    assert redis_store.pop_summary_job(5) == "lost"
+    assert summary_queue.drain_user("lost", FakeSummarizer()) == "done"
+    assert summarized_spans(fake_redis, "lost") == [(1, CHUNK)]
+    assert queued(fake_redis) == []
+
+
+def test_busy_job_is_dropped_and_holder_requeues_new_chunks(fake_redis, monkeypatch):
+    monkeypatch.setattr(summary_queue, "SUMMARY_MAX_CHUNKS_PER_JOB", 1)
+    for i in range(CHUNK):
+        turn("busy", i)
+    holder_started, release_holder = threading.Event(), threading.Event()
+
+    def slow_summarize(user_id, start, chunk):
+        holder_started.set()
+        release_holder.wait(5)
+        return FakeSummarizer()(user_id, start, chunk)
+
+    holder = threading.Thread(target=summary_queue.drain_user, args=(redis_store.pop_summary_job(0), slow_summarize))
+    holder.start()
+    holder_started.wait(5)
+    # 持鎖期間又湊滿一段：工作仍在佇列中（處理中）不會重複排入；另一個執行緒拿不到鎖就確認移除
+    for i in range(CHUNK, 2 * CHUNK):
+        turn("busy", i)
+    assert summary_queue.drain_user("busy", FakeSummarizer()) == "busy"
+    assert queued(fake_redis) == []
+    release_holder.set()
+    holder.join(5)
+
+    # 持鎖者釋放鎖、確認後發現還有完整段落，重新排入
+    assert queued(fake_redis) == ["busy"]
+    assert summary_queue.drain_user(redis_store.pop_summary_job(0), FakeSummarizer()) == "done"
+    assert summarized_spans(fake_redis, "busy") == [(1, CHUNK), (CHUNK + 1, 2 * CHUNK)]
+    assert queued(fake_redis) == []
@@ -2,22 +2,24 @@ import hashlib
 import json
 import os
 import time
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from datetime import datetime
 
 from crewai import LLM, Agent, Crew, Process, Task
-from langchain_openai import ChatOpenAI
-from openai import OpenAI
 
 # ---- 專案模組（注意相對匯入）----
 from ..embedding import safe_to_vector
+from ..toolkits.llm_client import BACKGROUND, cached_prompt_tokens, get_openai_client, kickoff_crew
 from ..toolkits.memory_store import retrieve_memory_pack_v3, upsert_atoms_and_surfaces
 from ..repositories.profile_repository import ProfileRepository
 
+from .care_prompt import HEALTH_AGENT_BACKSTORY, HEALTH_AGENT_GOAL, HEALTH_AGENT_ROLE, care_messages
+
 # redis 與工具：注意 summarize_chunk_and_commit 來自 tools.py
+from ..toolkits.prompt_budget import assemble_context
 from ..toolkits.redis_store import (
-    fetch_all_history,
-    get_summary,
+    fetch_history_for_distillation,
+    fetch_session_context,
     peek_remaining,
     cleanup_session_keys,
     set_state_if,
@@ -55,9 +57,18 @@ def _stable_group_key(display_text: str) -> str:
 
 
 def _render_session_transcript(user_id: str, k: int = 9999) -> str:
-    rounds = fetch_all_history(user_id) or []
+    """
+    收尾蒸餾用的本輪對話逐字稿。較早的已摘要回合已被裁切時，
+    那幾輪只剩摘要：以摘要開頭並註明不是原話（摘要抓不到的細節與可引用的原話會遺失），之後接保留的逐字回合。
+    """
+    summary, trimmed, rounds = fetch_history_for_distillation(user_id)
     out = []
-    for i, r in enumerate(rounds[-k:], 1):
+    if trimmed and summary.strip():
+        out.append(f"【第1至{trimmed}輪已不保留原文，以下為摘要（非逐字，不可當作 evidence 原話）】")
+        out.append(summary.strip())
+        out.append(f"【第{trimmed + 1}輪起為逐字對話】")
+    start = trimmed + max(len(rounds) - k, 0) + 1
+    for i, r in enumerate(rounds[-k:], start):
         q = (r.get("input") or "").strip()
         a = (r.get("output") or "").strip()
         out.append(f"{i:02d}. 使用者：{q}")
@@ -66,66 +77,59 @@ def _render_session_transcript(user_id: str, k: int = 9999) -> str:
 
 
 # ========= 檢索接點 (Prompt Building) =========
-def build_prompt_from_redis(user_id: str, line_user_id: Optional[str] = None, k: int = 6, current_input: str = "") -> str:
-    parts: List[str] = []
-    
-    # 0) 取使用者Profile
+def profile_section(user_id: str, line_user_id: Optional[str] = None) -> str:
+    """(0) 使用者 Profile 區塊；讀取失敗時回傳空字串。"""
     try:
-        profile = ProfileRepository().get_or_create_by_user_id(int(user_id), line_user_id=line_user_id)
-        profile_data = {
-            "personal_background": profile.profile_personal_background or {},
-            "health_status": profile.profile_health_status or {},
-            "life_events": profile.profile_life_events or {}
-        }
+        # 走 Redis 快取（toolkits.profile_cache），穩定狀態下每輪不查 Postgres
+        profile_data = ProfileRepository().read_profile_as_dict(int(user_id), line_user_id=line_user_id)
         profile_data = {k: v for k, v in profile_data.items() if v}
         if profile_data:
-            profile_str = json.dumps(profile_data, ensure_ascii=False, indent=2)
-            parts.append(f"👤 使用者畫像 (Profile):\n{profile_str}")
+            # 鍵依字母排序：畫像沒變時每輪輸出的位元組相同（prompt 開頭可被快取）
+            profile_str = json.dumps(profile_data, ensure_ascii=False, indent=2, sort_keys=True)
+            return f"👤 使用者畫像 (Profile):\n{profile_str}"
     except (ValueError, TypeError) as e:
         print(f"⚠️ [Build Prompt] user '{user_id}' 處理 Profile 失敗: {e}，將使用空的 Profile。")
-    
-    # (1) 長期記憶（原話導向）
-    if current_input:
-        qv = safe_to_vector(current_input)
-        if qv:
-            try:
-                mem_pack = retrieve_memory_pack_v3(
-                    user_id=user_id,
-                    query_vec=qv,
-                    topk_groups=5,
-                    sim_thr=0.5,
-                    tau_days=45,
-                    include_raw_qa=False,
-                )
-                if mem_pack:
-                    parts.append(mem_pack)
-            except Exception as e:
-                print(f"[memory v3 retrieval warn] {e}")
-
-    # (2) 歷史摘要（可選）
-    try:
-        summary_text, _ = get_summary(user_id)
-        if summary_text:
-            parts.append("📌 歷史摘要：\n" + summary_text.strip())
-    except Exception:
-        pass
+    return ""
+
 
-    # (3) 近期未摘要片段（可選）
+def memory_section(user_id: str, current_input: str) -> str:
+    """(1) 長期記憶（原話導向）：embedding + Milvus 檢索；無輸入或失敗時回傳空字串。"""
+    if not current_input:
+        return ""
+    qv = safe_to_vector(current_input)
+    if qv:
+        try:
+            return retrieve_memory_pack_v3(
+                user_id=user_id,
+                query_vec=qv,
+                topk_groups=5,
+                sim_thr=0.5,
+                tau_days=45,
+                include_raw_qa=False,
+            ) or ""
+        except Exception as e:
+            print(f"[memory v3 retrieval warn] {e}")
+    return ""
+
+
+def session_context(user_id: str, k: int = 6) -> Tuple[str, List[Dict]]:
+    """(2) 歷史摘要 與 (3) 最後 k 輪對話；只讀 history 的尾端，讀取失敗時回傳空值。"""
     try:
-        rounds = fetch_all_history(user_id) or []
-        tail = rounds[-k:]
-        if tail:
-            lines = []
-            for r in tail:
-                q = (r.get("input") or "").strip()
-                a = (r.get("output") or "").strip()
-                lines.append(f"使用者：{q}")
-                lines.append(f"助手：{a}")
-            parts.append("🕓 近期對話（未摘要）：\n" + "\n".join(lines))
-    except Exception:
-        pass
+        return fetch_session_context(user_id, k)
+    except Exception as e:
+        print(f"⚠️ [Build Prompt] user '{user_id}' 讀取摘要/近期對話失敗: {e}")
+        return "", []
 
-    return "\n\n".join([p for p in parts if p.strip()]) or ""
+
+def build_prompt_from_redis(user_id: str, line_user_id: Optional[str] = None, k: int = 6, current_input: str = "") -> str:
+    summary, rounds = session_context(user_id, k)
+    ctx, _ = assemble_context(
+        profile=profile_section(user_id, line_user_id),
+        memory=memory_section(user_id, current_input),
+        summary=summary,
+        rounds=rounds,
+    )
+    return ctx
 
 
 # ========= Profile 更新機制 =========
@@ -273,7 +277,7 @@ def create_profiler_agent() -> Agent:
         role="個案管理師",
         goal="根據新的對話，決定如何更新既有的使用者畫像，並以結構化的 JSON 指令格式輸出決策。",
         backstory="你是一位經驗豐富、心思縝密的個案管理師，專注於從對話中提取具有長期價值的資訊來維護精簡、準確的使用者畫像。",
-        llm=ChatOpenAI(model=os.getenv("MODEL_NAME", "gpt-4o-mini"), temperature=0.1), # 使用低溫以確保輸出穩定
+        llm=LLM(model=os.getenv("MODEL_NAME", "gpt-4o-mini"), temperature=0.1), # 使用低溫以確保輸出穩定
         memory=False,
         verbose=False,
         allow_delegation=False
@@ -324,7 +328,7 @@ def run_profiler_update(user_id: str, facts: List[Dict[str, Any]]):
         verbose=False
     )
     
-    crew_output = crew.kickoff()
+    crew_output = kickoff_crew(crew, "profiler", full_prompt, BACKGROUND)
     update_commands_str = crew_output.raw if crew_output else ""
     
     # 印出 LLM 原始輸出
@@ -384,7 +388,7 @@ def _distill_facts(user_id: str) -> List[Dict[str, Any]]:
     transcript = _render_session_transcript(user_id)
     if not transcript.strip():
         return []
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    client = get_openai_client(BACKGROUND, stage="distillation")
     res = client.chat.completions.create(
         model=OPENAI_MODEL,
         temperature=0.2,
@@ -536,18 +540,134 @@ def create_guardrail_agent() -> Agent:
     )
 
 
+def create_health_tools(user_id: Optional[str] = None) -> list:
+    # 緊急時會被任務 prompt 要求觸發；通報工具綁定使用者，不依賴行程全域狀態
+    return [SearchMilvusTool(), AlertCaseManagerTool(user_id=user_id)]
+
+
 def create_health_companion(user_id: str) -> Agent:
     return Agent(
-        role="National Granddaughter Ally",
-        goal="溫暖陪伴並給一行回覆；工具僅在符合當輪規則時使用，避免不必要的查詢與通報。",
-        backstory=f"陪伴使用者 {user_id} 的溫暖孫女",
-        tools=[
-            SearchMilvusTool(),
-            AlertCaseManagerTool(),
-        ],  # 緊急時會被任務 prompt 要求觸發
+        role=HEALTH_AGENT_ROLE,
+        goal=HEALTH_AGENT_GOAL,
+        backstory=HEALTH_AGENT_BACKSTORY,
+        tools=create_health_tools(user_id),
         verbose=False,
         allow_delegation=False,
         llm=granddaughter_llm,
         memory=False,
         max_iterations=1,
     )
+
+
+# ========= 直接 function calling 模式（不經 CrewAI 編排）=========
+# 最多幾輪工具往返；最後一輪不再開放工具，強制產生最終回覆
+DIRECT_AGENT_MAX_TOOL_ROUNDS = int(os.getenv("DIRECT_AGENT_MAX_TOOL_ROUNDS", 2))
+
+
+def _openai_tool_spec(tool) -> Dict[str, Any]:
+    return {
+        "type": "function",
+        "function": {
+            "name": tool.name,
+            "description": tool.description,
+            "parameters": tool.args_schema.model_json_schema(),
+        },
+    }
+
+
+def _call_tool(tools: Dict[str, Any], name: str, arguments: str) -> str:
+    tool = tools.get(name)
+    if tool is None:
+        return f"未知的工具：{name}"
+    try:
+        return str(tool._run(**json.loads(arguments or "{}")))
+    except Exception as e:
+        return f"工具 {name} 執行失敗：{e}"
+
+
+def _chat_once(client, messages: List[Dict[str, Any]], on_delta: Optional[Callable[[str], None]], **kwargs):
+    """
+    呼叫一次 chat completions，回傳 (文字, tool_calls, usage)。
+    有 on_delta 時改用串流：文字片段即時回呼，tool_calls 依 index 組回完整參數。
+    """
+    if on_delta is None:
+        res = client.chat.completions.create(model=OPENAI_MODEL, messages=messages, temperature=0.5, **kwargs)
+        msg = res.choices[0].message
+        calls = [
+            {"id": c.id, "type": "function", "function": {"name": c.function.name, "arguments": c.function.arguments}}
+            for c in (getattr(msg, "tool_calls", None) or [])
+        ]
+        return msg.content or "", calls, getattr(res, "usage", None)
+
+    stream = client.chat.completions.create(
+        model=OPENAI_MODEL, messages=messages, temperature=0.5,
+        stream=True, stream_options={"include_usage": True}, **kwargs,
+    )
+    parts: List[str] = []
+    calls: Dict[int, Dict[str, Any]] = {}
+    usage = None
+    for event in stream:
+        if getattr(event, "usage", None):
+            usage = event.usage
+        if not event.choices:
+            continue
+        delta = event.choices[0].delta
+        if getattr(delta, "content", None):
+            parts.append(delta.content)
+            on_delta(delta.content)
+        for tc in getattr(delta, "tool_calls", None) or []:
+            slot = calls.setdefault(tc.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            if tc.id:
+                slot["id"] = tc.id
+            if tc.function and tc.function.name:
+                slot["function"]["name"] += tc.function.name
+            if tc.function and tc.function.arguments:
+                slot["function"]["arguments"] += tc.function.arguments
+    return "".join(parts), [calls[i] for i in sorted(calls)], usage
+
+
+def run_direct_health_agent(
+    user_id: str,
+    task_description: str,
+    allow_tools: bool = True,
+    on_delta: Optional[Callable[[str], None]] = None,
+) -> Tuple[str, Dict[str, int]]:
+    """
+    以與 create_health_companion 相同的角色設定與任務提示，直接呼叫 chat completions；
+    search_milvus / alert_case_manager 以原生 function calling 提供。
+    不需工具時只有一次 LLM 呼叫，用了工具則多一次產生最終回覆。
+    提供 on_delta 時以串流產生回覆，每個文字片段到達即回呼；模型在呼叫工具的那一輪先講的話也已送到前端，
+    因此串流時回傳的完整回覆是所有輪次文字的串接，與使用者看到的一致（寫入歷史的也是這份）。
+    回傳 (完整回覆, 用量 {calls, prompt_tokens, completion_tokens, cached_tokens})。
+    """
+    tools = {t.name: t for t in create_health_tools(user_id)} if allow_tools else {}
+    specs = [_openai_tool_spec(t) for t in tools.values()]
+    messages: List[Dict[str, Any]] = care_messages(task_description)
+    usage = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    client = get_openai_client(stage="main_reply")
+    streamed: List[str] = []  # 串流時，先前呼叫工具的輪次已送出的文字
+
+    for round_no in range(DIRECT_AGENT_MAX_TOOL_ROUNDS + 1):
+        kwargs: Dict[str, Any] = {}
+        if specs:
+            kwargs = {"tools": specs, "tool_choice": "auto" if round_no < DIRECT_AGENT_MAX_TOOL_ROUNDS else "none"}
+        content, tool_calls, res_usage = _chat_once(client, messages, on_delta, **kwargs)
+        usage["calls"] += 1
+        if res_usage is not None:
+            usage["prompt_tokens"] += res_usage.prompt_tokens or 0
+            usage["completion_tokens"] += res_usage.completion_tokens or 0
+            usage["cached_tokens"] += cached_prompt_tokens(res_usage)
+
+        if not tool_calls:
+            return "".join(streamed + [content]).strip(), usage
+
+        if on_delta is not None and content:
+            streamed.append(content)
+        messages.append({"role": "assistant", "content": content or None, "tool_calls": tool_calls})
+        for c in tool_calls:
+            messages.append({
+                "role": "tool",
+                "tool_call_id": c["id"],
+                "content": _call_tool(tools, c["function"]["name"], c["function"]["arguments"]),
+            })
+    return "".join(streamed).strip(), usage
@@ -5,7 +5,7 @@ from apscheduler.jobstores.redis import RedisJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from dotenv import load_dotenv
-from .tasks import check_and_trigger_dynamic_care, patrol_silent_users, cleanup_expired_sessions
+from .tasks import check_and_trigger_dynamic_care, patrol_silent_users, cleanup_expired_sessions, rollup_llm_usage
 
 load_dotenv()
 TAIPEI_TZ = pytz.timezone("Asia/Taipei")
@@ -56,6 +56,16 @@ def initialize_scheduler():
         )
         print("✅ [Scheduler] 每週巡檢任務已新增。")
 
+    if not scheduler.get_job("llm_usage_rollup_job"):
+        scheduler.add_job(
+            rollup_llm_usage,
+            trigger=CronTrigger(hour=0, minute=15, timezone=TAIPEI_TZ),
+            id="llm_usage_rollup_job",
+            name="彙總前一天的 LLM 用量",
+            replace_existing=True,
+        )
+        print("✅ [Scheduler] LLM 用量彙總任務已新增。")
+
     print("🚀 主動關懷與 Session 清理排程服務已準備就緒...")
     scheduler.print_jobs()
 
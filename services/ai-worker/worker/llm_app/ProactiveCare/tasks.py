@@ -3,27 +3,41 @@ import os
 import time
 import pytz
 from datetime import datetime, timedelta
+from functools import lru_cache
 
-from crewai import Agent, Crew, Task
 from dotenv import load_dotenv
-from openai import OpenAI
 
 from .line_service import line_service
 from ..toolkits.redis_store import append_proactive_round, get_expired_sessions
-from ..toolkits.memory_store import get_recent_memories 
+from ..toolkits.task_context import task_context
+from ..toolkits.usage_ledger import rollup_day
 from ..repositories.profile_repository import ProfileRepository
+from ..repositories.unit_of_work import unit_of_work
 from ..models.chat_profile import ChatUserProfile
-from ..HealthBot.agent import create_guardrail_agent
-from ..llm_service import llm_service_instance
+from ..llm_service import get_llm_service
 
 
 load_dotenv()
 
 # --- 初始化 ---
 TAIPEI_TZ = pytz.timezone("Asia/Taipei")
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 MODEL_NAME = os.getenv("MODEL_NAME", "gpt-4o-mini")
-guardrail_agent = create_guardrail_agent()
+
+
+# OpenAI / CrewAI 在排程任務第一次真正需要時才載入，避免拖慢 worker 啟動
+def get_client():
+    # 主動關懷屬背景工作，與使用者對話共用連線池與限流，但不佔用保留給對話的額度
+    from ..toolkits.llm_client import BACKGROUND, get_openai_client
+
+    return get_openai_client(BACKGROUND, stage="proactive_care")
+
+
+@lru_cache(maxsize=1)
+def get_guardrail_agent():
+    from ..HealthBot.agent import create_guardrail_agent
+
+    return create_guardrail_agent()
+
 
 def cleanup_expired_sessions():
     """
@@ -40,7 +54,9 @@ def cleanup_expired_sessions():
     print(f"[Session Cleanup] 找到 {len(expired_user_ids)} 個閒置 sessions: {expired_user_ids}")
 
     for user_id in expired_user_ids:
-        llm_service_instance.finalize_user_session_now(user_id)
+        # 收尾中的摘要、蒸餾與 Profiler 用量記在該使用者名下；Profiler 的讀寫共用同一個 Session
+        with task_context(user_id=user_id), unit_of_work():
+            get_llm_service().finalize_user_session_now(user_id)
 
 
 def get_proactive_care_prompt_template() -> str:
@@ -175,6 +191,8 @@ def execute_proactive_care(profile_repo: ProfileRepository, user: object):
     profile_str = json.dumps(profile_data, ensure_ascii=False, indent=2) if profile_data else "{}"
 
     # 從 Milvus 讀取近期 LTM（tau_days=7 表示只看近一週的記憶，更具即時性）
+    from ..toolkits.memory_store import get_recent_memories
+
     recent_ltm_texts_str = get_recent_memories(user_id=line_user_id, topk=5, days_limit=7)
 
     # 2. 生成 Prompt
@@ -186,7 +204,7 @@ def execute_proactive_care(profile_repo: ProfileRepository, user: object):
 
     # 3. 呼叫 LLM
     try:
-        response = client.chat.completions.create(
+        response = get_client().chat.completions.create(
             model=MODEL_NAME, messages=[{"role": "user", "content": final_prompt}],
             temperature=0.7, max_tokens=200
         )
@@ -201,14 +219,19 @@ def execute_proactive_care(profile_repo: ProfileRepository, user: object):
 
     # 4. 輸出守衛
     final_care_msg = care_msg_draft
+    guardrail_agent = get_guardrail_agent()
     if guardrail_agent:
+        from crewai import Crew, Task
+
+        from ..toolkits.llm_client import BACKGROUND, kickoff_crew
+
         guard_task = Task(
             description=f"請檢查以下由 AI 生成的關懷訊息是否合規：'{care_msg_draft}'",
             agent=guardrail_agent,
             expected_output="合規回覆'OK'，不合規回覆'REJECT: <原因>'"
         )
         guard_crew = Crew(agents=[guardrail_agent], tasks=[guard_task], verbose=False)
-        crew_output = guard_crew.kickoff()
+        crew_output = kickoff_crew(guard_crew, "proactive_guard", guard_task.description, BACKGROUND)
         guard_result = (crew_output.raw if crew_output else "").strip()
         
         if guard_result.startswith("REJECT"):
@@ -229,8 +252,7 @@ def check_and_trigger_dynamic_care():
     """每 30 分鐘執行一次，檢查閒置超過特定時間的使用者。"""
     print(f"\n[動態任務] {datetime.now(TAIPEI_TZ)} 開始檢查閒置使用者...")
     repo = ProfileRepository()
-    db = repo._get_db()
-    try:
+    with unit_of_work() as db:
         # 統一使用 timezone-aware 的 UTC 時間進行所有計算
         now_utc = datetime.now(pytz.utc)
 
@@ -241,28 +263,37 @@ def check_and_trigger_dynamic_care():
         users_to_care = db.query(ChatUserProfile).filter(
             ChatUserProfile.last_contact_ts.between(time_window_start, time_window_end)
         ).all()
+        # 結束唯讀交易、歸還連線：之後逐一呼叫 LLM 時不占住連線
+        db.commit()
 
         print(f"[動態任務] 發現 {len(users_to_care)} 位符合條件的使用者。")
         for user in users_to_care:
-            execute_proactive_care(repo, user)
-    finally:
-        db.close()
+            with task_context(user_id=user.user_id):
+                execute_proactive_care(repo, user)
 
 
 def patrol_silent_users():
     """每週一早上 9 點執行，找出超過 7 天未互動的使用者。"""
     print(f"\n[巡檢任務] {datetime.now(TAIPEI_TZ)} 開始尋找長期沉默使用者...")
     repo = ProfileRepository()
-    db = repo._get_db()
-    try:
+    with unit_of_work() as db:
         now_utc = datetime.now(pytz.utc)
         seven_days_ago = now_utc - timedelta(days=7)
         users_to_care = db.query(ChatUserProfile).filter(
             (ChatUserProfile.last_contact_ts == None) | (ChatUserProfile.last_contact_ts < seven_days_ago)
         ).all()
+        db.commit()
         
         print(f"[巡檢任務] 發現 {len(users_to_care)} 位符合條件的使用者。")
         for user in users_to_care:
-            execute_proactive_care(repo, user)
-    finally:
-        db.close()
\ No newline at end of file
+            with task_context(user_id=user.user_id):
+                execute_proactive_care(repo, user)
+
+
+def rollup_llm_usage():
+    """每天凌晨執行，把前一天的 LLM 用量（Redis）彙總寫入 Postgres。"""
+    try:
+        count = rollup_day()
+        print(f"[用量彙總] 已寫入 {count} 筆 LLM 用量彙總。")
+    except Exception as e:
+        print(f"❌ [用量彙總] LLM 用量彙總失敗: {e}")
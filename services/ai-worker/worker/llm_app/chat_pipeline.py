@@ -1,72 +1,224 @@
+import contextvars
 import hashlib
 import os
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
 
 # 禁用 CrewAI 遙測功能（避免連接錯誤）
 os.environ["OTEL_SDK_DISABLED"] = "true"
 os.environ["CREWAI_TELEMETRY_OPT_OUT"] = "true"
 
 from crewai import Crew, Task
-from openai import OpenAI
 
+from .HealthBot.care_prompt import CARE_EXPECTED_OUTPUT, build_care_task
 from .HealthBot.agent import (
     build_prompt_from_redis,
     create_guardrail_agent,
     create_health_companion,
     finalize_session,
+    memory_section,
+    profile_section,
+    run_direct_health_agent,
+    session_context,
 )
 from .toolkits.redis_store import (
-    acquire_audio_lock,
-    append_round,
-    get_audio_result,
+    begin_audio_turn,
+    commit_turn,
     make_request_id,
-    peek_next_n,
-    read_and_clear_audio_segments,
     release_audio_lock,
-    set_audio_result,
     set_state_if,
-    try_register_request,
 )
+from .toolkits.agent_cache import AgentCache, profile_fingerprint
+from .toolkits.answer_cache import ANSWER_CACHE_ENABLED, ANSWER_CACHE_LEARN, get_answer_cache, is_eligible
+from .toolkits.decision_cache import cached_decision
+from .toolkits.llm_client import get_openai_client, kickoff_crew
+from .toolkits.memory_gate_rules import classify_by_rules
+from .toolkits.prompt_budget import assemble_context, count_tokens, format_report
+from .toolkits.streaming import SentenceChunker
+from .toolkits.summary_compaction import compact_summary
+from .toolkits.summary_queue import SUMMARY_ASYNC, SUMMARY_CHUNK_SIZE
+from .toolkits.task_context import bind_task_context, current_task, reset_task_context
 from .toolkits.tools import (
     MemoryGateTool,
     ModelGuardrailTool,
     SearchMilvusTool,
+    is_guardrail_decision,
     summarize_chunk_and_commit,
 )
 from datetime import datetime
 from .repositories.profile_repository import ProfileRepository
+from observability.metrics import registry, stage_timer
+
+# 主回覆前的前置階段（guardrail / memory gate / 上下文載入）並行用的執行緒數
+PRE_LLM_POOL_SIZE = int(os.getenv("PRE_LLM_POOL_SIZE", 8))
+# 與 memory gate 同時預先檢索長期記憶：只在本地規則判為 USE 或無法判定（需等 LLM gate）時才預先檢索，
+# 規則已判 SKIP 的輸入不檢索；之後 gate 判 SKIP 或 guardrail 攔截時捨棄結果。
+# 注意 future.cancel() 只能取消尚未開始的工作，已在執行的 embedding + Milvus 查詢仍會跑完。
+# 關閉時改為 gate 判 USE 後才檢索
+MEMORY_PREFETCH = os.getenv("MEMORY_PREFETCH", "true").lower() in ("1", "true", "yes")
+
+# 主回覆執行模式（依部署設定）：crew = CrewAI Agent/Task/Crew 編排；
+# direct = 相同提示直接呼叫 chat completions，工具走原生 function calling（省去 CrewAI 的隱藏提示與往返）
+HEALTH_AGENT_MODE = os.getenv("HEALTH_AGENT_MODE", "crew").strip().lower()
+
+registry.describe("ai_worker_main_llm_calls_total", "counter", "LLM requests made to produce the care reply, by agent mode.")
+registry.describe(
+    "ai_worker_main_llm_tokens_total",
+    "counter",
+    "Tokens spent on the care reply, by agent mode and kind (prompt / completion / cached = prompt tokens served from the provider's prompt cache).",
+)
 
-SUMMARY_CHUNK_SIZE = int(os.getenv("SUMMARY_CHUNK_SIZE", 5))
+_pre_llm_pool = ThreadPoolExecutor(max_workers=PRE_LLM_POOL_SIZE, thread_name_prefix="pre-llm")
 
 
 class AgentManager:
     def __init__(self):
         self.guardrail_agent = create_guardrail_agent()
-        self.health_agent_cache = {}
+        # LRU + TTL，上限見 AGENT_CACHE_MAX_SIZE / AGENT_CACHE_TTL_SEC
+        self.health_agent_cache = AgentCache(create_health_companion)
 
     def get_guardrail(self):
         return self.guardrail_agent
 
-    def get_health_agent(self, user_id: str):
-        if user_id not in self.health_agent_cache:
-            self.health_agent_cache[user_id] = create_health_companion(user_id)
-        return self.health_agent_cache[user_id]
+    def get_health_agent(self, user_id: str, profile_fp: Optional[str] = None):
+        """profile_fp 與快取中的 agent 不同時（畫像已更新）會重新建立。"""
+        return self.health_agent_cache.get(user_id, profile_fp)
 
     def release_health_agent(self, user_id: str):
-        if user_id in self.health_agent_cache:
-            del self.health_agent_cache[user_id]
+        self.health_agent_cache.release(user_id)
+
+
+def _submit(fn, *args):
+    """在前置階段執行緒池執行；複製 contextvars，讓追蹤 span 與任務上下文跟著工作走。"""
+    return _pre_llm_pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+def _crew_guardrail(agent_manager: AgentManager, full_text: str) -> str:
+    guard = agent_manager.get_guardrail()
+    guard_task = Task(
+        description=(
+            f"只判斷此輸入是否需要『攔截』：『{full_text}』。\n"
+            "務必使用 model_guardrail 工具進行判斷；僅輸出 OK 或 BLOCK: <原因>，不得回答內容本身。\n"
+            "【允許放行（OK）】症狀/感受描述、一般衛教/生活建議、求助訊息，"
+            "以及『自殺念頭/情緒表達（不含具體方法）』。\n"
+            "【必須攔截（BLOCK）】違法/危險行為之教學/交易/規避；成人/未成年不當內容；"
+            "自傷/他傷/自殺/自殘之『具體方法指導或鼓勵執行』；"
+            "醫療/用藥/劑量/診斷/處置等『具體、個案化、可執行』的專業指示；"
+            "法律/投資/稅務等之『具體、可執行』專業指導。\n"
+            "不確定時一律回 OK（讓後續 health agent 判斷緊急性）。"
+        ),
+        expected_output="OK 或 BLOCK: <原因>",
+        agent=guard,
+    )
+    output = kickoff_crew(Crew(agents=[guard], tasks=[guard_task], verbose=False), "guardrail", guard_task.description)
+    return (output.raw or "").strip()
+
+
+def run_guardrail(agent_manager: AgentManager, full_text: str) -> str:
+    # 先查決策快取；未命中優先用 CrewAI，失敗則 fallback 自行判斷
+    with stage_timer("guardrail"):
+        try:
+            return cached_decision(
+                "guardrail", full_text, lambda text: _crew_guardrail(agent_manager, text), is_guardrail_decision
+            )
+        except Exception:
+            return ModelGuardrailTool()._run(full_text)
+
+
+def run_memory_gate(full_text: str) -> str:
+    with stage_timer("memory_gate"):
+        return MemoryGateTool()._run(full_text)
+
 
+def retrieve_memory(user_id: str, full_text: str) -> str:
+    with stage_timer("memory_retrieval"):
+        return memory_section(user_id, full_text)
 
-def log_session(user_id: str, query: str, reply: str, request_id: Optional[str] = None, line_user_id: Optional[str] = None):
+
+def load_base_context(user_id: str, line_user_id: Optional[str], k: int) -> Tuple[str, str, List[Dict]]:
+    """Profile + 歷史摘要 + 最後 k 輪對話（不含長期記憶檢索）。"""
+    with stage_timer("context_load"):
+        return (profile_section(user_id, line_user_id), *session_context(user_id, k))
+
+
+def log_session(
+    user_id: str,
+    query: str,
+    reply: str,
+    request_id: Optional[str] = None,
+    line_user_id: Optional[str] = None,
+    audio_id: Optional[str] = None,
+    lock_id: Optional[str] = None,
+):
+    """
+    落歷史並視需要摘要。提供 audio_id / lock_id 時，結果快取與釋放音檔鎖併入同一次 Redis 往返。
+    SUMMARY_ASYNC 開啟時湊滿一段只排入背景摘要佇列（同一次往返），回覆不等待摘要。
+    """
     rid = request_id or make_request_id(user_id, query)
-    if not try_register_request(user_id, rid):
+    registered, start, chunk = commit_turn(
+        user_id,
+        {"input": query, "output": reply, "rid": rid},
+        line_user_id=line_user_id,
+        chunk_size=SUMMARY_CHUNK_SIZE,
+        audio_id=audio_id,
+        reply=reply,
+        lock_id=lock_id,
+        enqueue_summary=SUMMARY_ASYNC,
+    )
+    if not registered:
         # 去重，跳過重複請求
         return
-    append_round(user_id, {"input": query, "output": reply, "rid": rid}, line_user_id=line_user_id)
-    # 嘗試抓下一段 5 輪（不足會回空）→ LLM 摘要 → CAS 提交
-    start, chunk = peek_next_n(user_id, SUMMARY_CHUNK_SIZE)
+    # 同步模式：下一段 5 輪（不足時 start 為 None）→ LLM 摘要 → CAS 提交
     if start is not None and chunk:
-        summarize_chunk_and_commit(user_id, start_round=start, history_chunk=chunk)
+        if summarize_chunk_and_commit(user_id, start_round=start, history_chunk=chunk):
+            compact_summary(user_id)
+
+
+def lookup_cached_answer(text: str):
+    """
+    查語意答案快取；回傳 (條目或 None, 問題向量)，輸入不適用快取（太長、含緊急字詞）時回傳 None。
+    """
+    cache = get_answer_cache()
+    if not is_eligible(text):
+        cache.count_ineligible()
+        return None
+    try:
+        return cache.lookup(text)
+    except Exception as e:
+        print(f"⚠️ [Answer Cache] 查詢失敗，走完整流程: {e}")
+        return None
+
+
+def record_main_llm_usage(mode: str, calls: int, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> None:
+    registry.inc("ai_worker_main_llm_calls_total", {"mode": mode}, calls)
+    registry.inc("ai_worker_main_llm_tokens_total", {"mode": mode, "kind": "prompt"}, prompt_tokens)
+    registry.inc("ai_worker_main_llm_tokens_total", {"mode": mode, "kind": "completion"}, completion_tokens)
+    registry.inc("ai_worker_main_llm_tokens_total", {"mode": mode, "kind": "cached"}, cached_tokens)
+    if prompt_tokens:
+        print(f"🧊 Prompt cache: {cached_tokens}/{prompt_tokens} tokens 命中（{cached_tokens / prompt_tokens:.0%}）")
+
+
+def _crew_care_reply(
+    agent_manager: AgentManager, user_id: str, task_description: str, profile_fp: Optional[str] = None
+) -> str:
+    care = agent_manager.get_health_agent(user_id, profile_fp)
+    task = Task(
+        description=task_description,
+        expected_output=CARE_EXPECTED_OUTPUT,
+        agent=care,
+    )
+    with stage_timer("main_llm"):
+        output = kickoff_crew(Crew(agents=[care], tasks=[task], verbose=False), "main_reply", task_description)
+    usage = getattr(output, "token_usage", None)
+    if usage is not None:
+        record_main_llm_usage(
+            "crew",
+            getattr(usage, "successful_requests", 0) or 0,
+            getattr(usage, "prompt_tokens", 0) or 0,
+            getattr(usage, "completion_tokens", 0) or 0,
+            getattr(usage, "cached_prompt_tokens", 0) or 0,
+        )
+    return output.raw or ""
 
 
 def handle_user_message(
@@ -76,7 +228,14 @@ def handle_user_message(
     line_user_id: Optional[str] = None,
     audio_id: Optional[str] = None,
     is_final: bool = True,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    on_reset: Optional[Callable[[], None]] = None,
 ) -> str:
+    """
+    on_chunk：提供時以串流產生主回覆（僅 direct 模式），每湊滿一句就回呼一次；
+    回傳值與寫入歷史的仍是完整回覆。
+    on_reset：串流中途失敗、改用 fallback 回覆時呼叫，通知接收端捨棄已送出的片段。
+    """
     # 0) 統一音檔 ID（沒帶就用文字 hash 當臨時 ID，向後相容）
     audio_id = audio_id or hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]
 
@@ -91,45 +250,33 @@ def handle_user_message(
     lock_id = f"{user_id}#audio:{audio_id}"
     # 使用獨立的輕量鎖，避免與其他 session state 衝突
     # P0-1: 增加 TTL 到 180 秒，避免長語音處理時鎖過期
-    if not acquire_audio_lock(lock_id, ttl_sec=180):
-        cached = get_audio_result(user_id, audio_id)
-        return cached or "我正在處理你的語音，請稍等一下喔。"
-
+    # 取鎖與取出之前緩衝的 partial 合併為一次 Redis 往返
+    acquired, head = begin_audio_turn(user_id, audio_id, lock_id, ttl_sec=180)
+    if not acquired:
+        return head or "我正在處理你的語音，請稍等一下喔。"
+    lock_held = True
+
+    # 本任務的執行上下文（工具以此取得 user_id，不再經由行程全域的環境變數）
+    ctx_token = bind_task_context(
+        user_id=user_id,
+        line_user_id=line_user_id,
+        request_id=None if current_task().request_id else audio_id,
+    )
     try:
         # 3) 合併之前緩衝的 partial → 最終要處理的全文
-        head = read_and_clear_audio_segments(user_id, audio_id)
         full_text = (head + " " + query).strip() if head else query
 
-        # 4) 先 guardrail，再 health agent
-        os.environ["CURRENT_USER_ID"] = user_id
-
-        # 優先用 CrewAI；失敗則 fallback 自行判斷
-        try:
-            guard = agent_manager.get_guardrail()
-            guard_task = Task(
-                description=(
-                    f"只判斷此輸入是否需要『攔截』：『{full_text}』。\n"
-                    "務必使用 model_guardrail 工具進行判斷；僅輸出 OK 或 BLOCK: <原因>，不得回答內容本身。\n"
-                    "【允許放行（OK）】症狀/感受描述、一般衛教/生活建議、求助訊息，"
-                    "以及『自殺念頭/情緒表達（不含具體方法）』。\n"
-                    "【必須攔截（BLOCK）】違法/危險行為之教學/交易/規避；成人/未成年不當內容；"
-                    "自傷/他傷/自殺/自殘之『具體方法指導或鼓勵執行』；"
-                    "醫療/用藥/劑量/診斷/處置等『具體、個案化、可執行』的專業指示；"
-                    "法律/投資/稅務等之『具體、可執行』專業指導。\n"
-                    "不確定時一律回 OK（讓後續 health agent 判斷緊急性）。"
-                ),
-                expected_output="OK 或 BLOCK: <原因>",
-                agent=guard,
-            )
-            guard_res = (
-                Crew(agents=[guard], tasks=[guard_task], verbose=False).kickoff().raw
-                or ""
-            ).strip()
-
-        except Exception:
-            guard_res = ModelGuardrailTool()._run(full_text)
-
-            # 只保留攔截與否
+        # 4) guardrail、memory gate、上下文載入彼此獨立 → 並行執行，等待時間取最大值而非總和
+        guard_f = _submit(run_guardrail, agent_manager, full_text)
+        gate_f = _submit(run_memory_gate, full_text)
+        # 規則判定只是本地比對，先算好；已確定 SKIP 的輸入不預先檢索
+        prefetch = MEMORY_PREFETCH and classify_by_rules(full_text) != "SKIP"
+        memory_f = _submit(retrieve_memory, user_id, full_text) if prefetch else None
+        base_f = _submit(load_base_context, user_id, line_user_id, 6)
+        answer_f = _submit(lookup_cached_answer, full_text) if ANSWER_CACHE_ENABLED else None
+
+        # 只保留攔截與否
+        guard_res = guard_f.result()
         is_block = guard_res.startswith("BLOCK:")
         block_reason = guard_res[6:].strip() if is_block else ""
         
@@ -138,85 +285,67 @@ def handle_user_message(
         )
         if is_block:
             print(f"🚫 攔截原因: {block_reason}")
+            # 不再等待記憶與上下文；尚未開始的前置工作直接取消（已開始的會跑完，結果捨棄）
+            for f in (gate_f, memory_f, base_f, answer_f):
+                if f is not None:
+                    f.cancel()
+
+        # 4.5) 與個人無關的一般衛教問題命中答案快取 → 直接以審核過的答案回覆，不呼叫主 LLM
+        cache_lookup = answer_f.result() if answer_f is not None and not is_block else None
+        if cache_lookup is not None:
+            match, _ = cache_lookup
+            cached = get_answer_cache().serve(match, gate_f.result())
+            if cached is not None:
+                print(f"💾 答案快取命中（score={match['score']:.3f}）: {cached}")
+                for f in (memory_f, base_f):
+                    if f is not None:
+                        f.cancel()
+                if on_chunk:
+                    chunker = SentenceChunker(on_chunk)
+                    chunker.feed(cached)
+                    chunker.flush()
+                log_session(user_id, full_text, cached, line_user_id=line_user_id, audio_id=audio_id, lock_id=lock_id)
+                lock_held = False
+                return cached
 
         # 產生最終回覆：優先用 CrewAI；失敗則 fallback OpenAI + Milvus 查詢
         try:
-            care = agent_manager.get_health_agent(user_id)
             now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            profile_fp = None  # BLOCK 分支未載入畫像 → 沿用既有 agent
+            prompt_report = None
             # P0-3: BLOCK 分支直接跳過記憶/RAG 檢索，節省成本
             if is_block:
                 ctx = ""  # 不檢索記憶
                 print("⚠️ 因安全檢查攔截，跳過記憶檢索")
             else:
-                decision = MemoryGateTool()._run(full_text)
+                decision = gate_f.result()
                 print(f"🔍 MemoryGateTool 決策: {decision}")
                 if decision == "USE":
-                    ctx = build_prompt_from_redis(
-                        user_id, line_user_id=line_user_id, k=6, current_input=full_text
-                    )  # 檢索長期記憶
+                    # 檢索長期記憶（已預先檢索則直接取用）
+                    memory = memory_f.result() if memory_f is not None else retrieve_memory(user_id, full_text)
                 else:
-                    ctx = build_prompt_from_redis(
-                        user_id, line_user_id=line_user_id, k=6, current_input=""
-                    )  # 不檢索，只帶摘要/近期對話
-
-            task_description = f"""
-# ROLE & GOAL
-你是「國民孫女 Ally」，溫暖且務實。你的目標是根據提供的上下文，生成一句**極其簡潔、自然、口語化、像家人一樣**的回應（不超過30字）。
-
-# CONTEXT
-[當前時間]: {now_str}
-[上下文資訊 (可能為空)]:
-{ctx}
-[使用者本輪輸入]:
-{query}
-
----
-
-# 你的思考流程
-你必須嚴格遵循以下步驟來決定如何回應：
-
-## 步驟一：情境理解 (Context Analysis)
-1.  閱讀 [使用者畫像] 和 [個人長期記憶]：快速了解這位長輩的背景、健康狀況和近期事件。這將幫助你使用個人化的、有關懷的語氣。
-2.  分析 [使用者本輪輸入]：理解使用者這句話的核心意圖是什麼？是閒聊、分享資訊、詢問健康知識，還是表達緊急狀況？
-
-## 步驟二：意圖判斷與工具選擇 (Intent & Tool Selection)
-基於你對使用者意圖的分析，獨立判斷是否需要使用工具。這三個判斷是互斥的，一輪對話最多只會觸發一個工具，或者都不觸發。
-
-1.  是否需要知識檢索 (`search_milvus`)？
-    * 條件: 當且僅當使用者提出一個客觀的的健康衛教問題時（疾病概念、症狀、風險、就醫時機、生活衛教、自我照護等）或你對答案來源不確定時。
-    * 動作: 如果是，你的下一步 `Action` 應該是 `search_milvus`。
-
-2.  是否為緊急情況 (`alert_case_manager`)？
-    * 條件: 嚴格按照以下標準，僅根據[使用者本輪輸入]的字面內容判斷，歷史/記憶僅供語氣與背景參考，嚴禁作為觸發依據。：
-        * A. 明確的、計畫性的危險: 提及具體的自傷/自殺方法、時間、地點。
-        * B. 危急性身體症狀: 描述當下正在發生的嚴重症狀，如嚴重呼吸困難、胸痛合併出冷汗或噁心、疑似中風徵象、嚴重過敏、持續或大量出血等。
-        * C. 強烈的自殺意圖但無具體計畫: 清楚表達想死、使用現在式、持續痛苦、無保護因子等。若模糊求助或僅情緒低落，則不觸發。
-    * 動作: 如果滿足 A 或 B 或 C，你的下一步 `Action` 應該是 `alert_case_manager`，接著再進入步驟三，生成溫暖且具體的就醫/求助指引作為最終回應。
-
-3.  是否為一般對話 (無需工具)？
-    * 條件: 如果不滿足上述任何一項條件，例如使用者只是在閒聊、打招呼、分享心情或描述一個非緊急的狀態。
-    * 動作: 則無需使用任何工具。你的下一步應該是直接提供 `Final Answer`。
-
-## 步驟三：最終回應生成
-* 若使用工具: 在看到工具返回的 `Observation` 後，先理解重點，再用自己的話、結合所有上下文，生成最終回應。
-* 若不使用工具: 直接結合上下文，生成最終回應。
-* 回應原則:
-    * 個人化: 自然地提及你從上下文（畫像、記憶）中得知的資訊，讓回應聽起來更像家人。
-    * 人設與格式: 保持「金孫」人設，台語混中文、自然聊天感。絕對不超過30個中文字，且不能包含 "Thought:", "Action:", "Final Answer:" 等關鍵字。
-
----
-""" + (
-        """
-# 安全限制
-本次輸入已被 Guardrail 標記為高風險。你嚴禁呼叫任何工具，也不可提供任何具體建議或替代方案。請直接跳到步驟三，生成一句溫和的婉拒與提醒就醫的回應。
-""" if is_block else ""
-    )
+                    memory = ""  # 不檢索，只帶摘要/近期對話
+                profile, summary, rounds = base_f.result()
+                profile_fp = profile_fingerprint(profile)
+                ctx, prompt_report = assemble_context(profile=profile, memory=memory, summary=summary, rounds=rounds)
+
+            task_description = build_care_task(now_str, ctx, query, is_block)
+            if prompt_report:
+                print(f"🧮 Prompt tokens: {format_report(prompt_report, {'task': count_tokens(task_description)})}")
+            if HEALTH_AGENT_MODE == "direct":
+                # 單次 chat completions + 原生 function calling；BLOCK 時不提供工具
+                chunker = SentenceChunker(on_chunk) if on_chunk else None
+                with stage_timer("main_llm"):
+                    res, usage = run_direct_health_agent(
+                        user_id, task_description, allow_tools=not is_block,
+                        on_delta=chunker.feed if chunker else None,
+                    )
+                if chunker:
+                    chunker.flush()
+                record_main_llm_usage("direct", **usage)
+            else:
+                res = _crew_care_reply(agent_manager, user_id, task_description, profile_fp)
         
-            task = Task(
-                description=task_description,
-                expected_output="一句基於上下文、極其簡潔、自然、口語化、像家人一樣的回應，長度不超過30個中文字。",
-                agent=care,
-            )
             # task = Task(
             #     description=(
             #            f"""{ctx}
@@ -277,45 +406,59 @@ def handle_user_message(
             #     expected_output="回覆不得超過30個字。",
             #     agent=care,
             # )
-            res = Crew(agents=[care], tasks=[task], verbose=False).kickoff().raw or ""
             
         except Exception:
-            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+            if on_reset:
+                on_reset()
+            client = get_openai_client(stage="fallback_reply")
             model = os.getenv("MODEL_NAME", "gpt-4o-mini")
             if is_block:
                 # P0-3: BLOCK 分支跳過記憶/RAG 檢索
                 sys = "你是會講台語的健康陪伴者。當輸入被判為超出能力範圍時，必須婉拒且不可提供具體方案/診斷/劑量，只能一般性提醒就醫。語氣溫暖、不列點。"
                 user_msg = f"此輸入被判為超出能力範圍（{block_reason or '安全風險'}）。請用台語溫柔婉拒，不提供任何具體建議或替代作法，只做一般安全提醒與情緒安撫 1–2 句。"
-                res_obj = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": sys},
-                        {"role": "user", "content": user_msg},
-                    ],
-                    temperature=0.2,
-                )
+                with stage_timer("main_llm"):
+                    res_obj = client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": sys},
+                            {"role": "user", "content": user_msg},
+                        ],
+                        temperature=0.2,
+                    )
                 res = (res_obj.choices[0].message.content or "").strip()
             else:
-                ctx = build_prompt_from_redis(user_id, line_user_id=line_user_id, k=6, current_input=full_text)
+                with stage_timer("memory_retrieval"):
+                    ctx = build_prompt_from_redis(user_id, line_user_id=line_user_id, k=6, current_input=full_text)
                 qa = SearchMilvusTool()._run(full_text)
                 sys = "你是會講台語的健康陪伴者，語氣溫暖務實，避免醫療診斷與劑量指示。必要時提醒就醫。"
                 prompt = (
                     f"{ctx}\n\n相關資料（可能空）：\n{qa}\n\n"
                     f"使用者輸入：{full_text}\n請以台語風格回覆；結尾給一段溫暖鼓勵。"
                 )
-                res_obj = client.chat.completions.create(
-                    model=model,
-                    messages=[
-                        {"role": "system", "content": sys},
-                        {"role": "user", "content": prompt},
-                    ],
-                    temperature=0.5,
-                )
+                with stage_timer("main_llm"):
+                    res_obj = client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": sys},
+                            {"role": "user", "content": prompt},
+                        ],
+                        temperature=0.5,
+                    )
                 res = (res_obj.choices[0].message.content or "").strip()
-        # 5) 結果快取 + 落歷史
-        set_audio_result(user_id, audio_id, res)
-        log_session(user_id, full_text, res, line_user_id=line_user_id)
+        # 未命中的一般問題記為答案快取的候選（需人工審核才會上線）
+        if cache_lookup is not None and cache_lookup[0] is None and ANSWER_CACHE_LEARN and res:
+            if gate_f.result() == "SKIP":
+                try:
+                    get_answer_cache().record_candidate(full_text, res, cache_lookup[1])
+                except Exception as e:
+                    print(f"⚠️ [Answer Cache] 記錄候選失敗: {e}")
+
+        # 5) 結果快取 + 落歷史 + 釋放音檔鎖（同一次 Redis 往返）
+        log_session(user_id, full_text, res, line_user_id=line_user_id, audio_id=audio_id, lock_id=lock_id)
+        lock_held = False
         return res
 
     finally:
-        release_audio_lock(lock_id)
+        reset_task_context(ctx_token)
+        if lock_held:
+            release_audio_lock(lock_id)
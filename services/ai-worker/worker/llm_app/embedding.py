@@ -1,11 +1,12 @@
-import os
-from openai import OpenAI
 from typing import Union, List
 from dotenv import load_dotenv
 
 load_dotenv()
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from .toolkits.llm_client import get_openai_client
+
+# 與 chat completions 共用連線池與限流
+client = get_openai_client(stage="embedding")
 
 
 def to_vector(text: Union[str, List[str]], normalize: bool = True) -> List[float]:
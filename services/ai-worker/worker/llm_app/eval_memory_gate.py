@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# eval_memory_gate.py  (MemoryGate 規則式前置分類器的離線評估)
+"""
+在標註樣本上評估 memory_gate_rules：
+- 規則可直接判定的比例（= 省下的 LLM 呼叫比例）
+- 規則判定與人工標註（label）的一致率
+- 規則判定與 LLM 決策（llm）的一致率
+
+樣本為 JSONL：{"text": "...", "label": "USE|SKIP", "llm": "USE|SKIP"(可選)}。
+加上 --llm 會即時呼叫 MemoryGate 的 LLM（不經快取與規則）補上 llm 欄位，並可用 --record 存檔，
+之後即可完全離線重跑。
+
+用法（於 worker/ 目錄下）：
+    python -m llm_app.eval_memory_gate
+    python -m llm_app.eval_memory_gate --sample my_sample.jsonl --rules my_rules.json
+    python -m llm_app.eval_memory_gate --llm --record llm_app/memory_gate_sample.jsonl
+    python -m llm_app.eval_memory_gate --min-llm-agreement 0.95   # CI：樣本缺 llm 欄位或一致率不足時失敗
+"""
+
+import argparse
+import json
+import os
+import sys
+from collections import Counter
+from typing import Dict, List, Optional
+
+from .toolkits.memory_gate_rules import load_rules
+
+DEFAULT_SAMPLE = os.path.join(os.path.dirname(__file__), "memory_gate_sample.jsonl")
+
+
+def load_sample(path: str) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def agreement(pairs: List[tuple]) -> Optional[float]:
+    pairs = [(a, b) for a, b in pairs if a and b]
+    return sum(a == b for a, b in pairs) / len(pairs) if pairs else None
+
+
+def _pct(value: Optional[float]) -> str:
+    return "n/a" if value is None else f"{value:.1%}"
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="MemoryGate 規則式前置分類器離線評估")
+    parser.add_argument("--sample", default=DEFAULT_SAMPLE, help="標註樣本 JSONL")
+    parser.add_argument("--rules", default="", help="規則 JSON（預設使用內建規則）")
+    parser.add_argument("--llm", action="store_true", help="即時呼叫 LLM 取得 llm 欄位")
+    parser.add_argument("--record", default="", help="將含 llm 欄位的樣本另存為 JSONL")
+    parser.add_argument("--show", type=int, default=20, help="列出前 N 筆不一致樣本")
+    parser.add_argument("--min-llm-agreement", type=float, default=None,
+                        help="規則 vs LLM 一致率下限；低於下限或樣本缺 llm 欄位時以非零結束碼離開")
+    args = parser.parse_args(argv)
+
+    rules = load_rules(args.rules)
+    sample = load_sample(args.sample)
+
+    if args.llm:
+        from .toolkits.tools import MemoryGateTool
+
+        gate = MemoryGateTool()
+        for row in sample:
+            row["llm"] = gate._classify(row["text"])
+        if args.record:
+            with open(args.record, "w", encoding="utf-8") as f:
+                for row in sample:
+                    f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+    for row in sample:
+        row["rule"], row["rule_hit"] = rules.classify(row["text"])
+
+    resolved = [r for r in sample if r["rule"]]
+    print(f"=== MemoryGate 規則評估：{len(sample)} 筆（{args.sample}）===")
+    print(f"規則直接判定（省下 LLM 呼叫）：{len(resolved)}/{len(sample)} = {_pct(len(resolved) / len(sample) if sample else None)}")
+    print(f"  其中 USE {sum(r['rule'] == 'USE' for r in resolved)} 筆、SKIP {sum(r['rule'] == 'SKIP' for r in resolved)} 筆")
+    print(f"規則 vs 人工標註 一致率：{_pct(agreement([(r['rule'], r.get('label')) for r in resolved]))}")
+    with_llm = [r for r in sample if r.get("llm")]
+    llm_agreement = agreement([(r["rule"], r.get("llm")) for r in resolved])
+    if with_llm:
+        print(f"樣本含 llm 欄位：{len(with_llm)}/{len(sample)} 筆")
+        print(f"規則 vs LLM     一致率：{_pct(llm_agreement)}")
+        print(f"LLM  vs 人工標註 一致率（全部樣本）：{_pct(agreement([(r.get('llm'), r.get('label')) for r in sample]))}")
+        # 上線後的整體決策 = 規則可判定時用規則，否則用 LLM
+        combined = [(r["rule"] or r.get("llm"), r.get("label")) for r in sample]
+        print(f"規則+LLM 合併 vs 人工標註 一致率：{_pct(agreement(combined))}")
+    else:
+        print("（樣本無 llm 欄位；加上 --llm 可比較與 LLM 的一致率）")
+
+    confusion = Counter((r.get("label"), r["rule"]) for r in resolved)
+    print("混淆矩陣（標註 → 規則）：" + "，".join(f"{a}→{b}: {n}" for (a, b), n in sorted(confusion.items())))
+
+    mismatches = [r for r in resolved if r["rule"] != (r.get("llm") or r.get("label"))]
+    if mismatches:
+        print(f"\n不一致樣本（前 {args.show} 筆）：")
+        for r in mismatches[: args.show]:
+            print(f"  [{r['rule']} ≠ {r.get('llm') or r.get('label')}] {r['text']}  ← {r['rule_hit']}")
+
+    if args.min_llm_agreement is not None:
+        if len(with_llm) < len(sample) or llm_agreement is None:
+            print(f"\n[檢查] 失敗：{len(sample) - len(with_llm)} 筆樣本缺 llm 欄位（以 --llm --record 補上）")
+            return 1
+        if llm_agreement < args.min_llm_agreement:
+            print(f"\n[檢查] 失敗：規則 vs LLM 一致率 {_pct(llm_agreement)} 低於 {_pct(args.min_llm_agreement)}")
+            return 1
+        print("\n[檢查] 通過")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
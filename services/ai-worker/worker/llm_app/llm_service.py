@@ -1,21 +1,29 @@
 import importlib
 import os
 import sys
-from typing import Any, Dict
+import threading
+from typing import Any, Callable, Dict, Optional
 
 # 禁用 CrewAI 遙測功能（避免連接錯誤）
 os.environ["OTEL_SDK_DISABLED"] = "true"
 os.environ["CREWAI_TELEMETRY_OPT_OUT"] = "true"
 
-# 兼容「模組方式」與「直接腳本」兩種執行情境
-try:
-    from .chat_pipeline import AgentManager, handle_user_message
-    from .HealthBot.agent import finalize_session
-except Exception:
-    # 若以腳本模式執行（無封包上下文），把 /app/worker 加進 sys.path
-    sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-    from llm_app.chat_pipeline import AgentManager, handle_user_message
-    from llm_app.HealthBot.agent import finalize_session
+
+def _load_pipeline():
+    """
+    延遲匯入對話管道（CrewAI / OpenAI / pymilvus 都在這一層才載入），
+    讓只處理文字的 worker 不必在啟動時付出這些匯入成本。
+    """
+    global AgentManager, handle_user_message, finalize_session
+    # 兼容「模組方式」與「直接腳本」兩種執行情境
+    try:
+        from .chat_pipeline import AgentManager, handle_user_message
+        from .HealthBot.agent import finalize_session
+    except Exception:
+        # 若以腳本模式執行（無封包上下文），把 /app/worker 加進 sys.path
+        sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+        from llm_app.chat_pipeline import AgentManager, handle_user_message
+        from llm_app.HealthBot.agent import finalize_session
 
 
 class LLMService:
@@ -23,6 +31,7 @@ class LLMService:
 
     def __init__(self) -> None:
         print("🚀 Initializing a new LLMService instance...")
+        _load_pipeline()
         self.agent_manager = AgentManager()
         self._milvus_connected = False
         self._ensure_milvus_connection()
@@ -44,9 +53,17 @@ class LLMService:
             print("長期記憶功能可能不可用")
 
 
-    def generate_response(self, task_data: Dict[str, Any]) -> str:
+    def generate_response(
+        self,
+        task_data: Dict[str, Any],
+        on_chunk: Optional[Callable[[str], None]] = None,
+        on_reset: Optional[Callable[[], None]] = None,
+    ) -> str:
         """生成回應（包含完整長期追蹤功能和獨立用戶會話管理）
 
+        on_chunk：串流回覆時每產生一句就回呼一次（見 handle_user_message）。
+        on_reset：已送出的片段作廢時呼叫（串流中途失敗、改用其他回覆）。
+
         期待的 task_data 欄位對應：
         - patient_id -> 對應 Final 的 user_id
         - text -> 對應 Final 的 query（可選）
@@ -85,10 +102,14 @@ class LLMService:
                 query=query,
                 audio_id=audio_id,
                 is_final=True,
+                on_chunk=on_chunk,
+                on_reset=on_reset,
             )
             return response_text
         except Exception as e:
             print(f"[LLMService] 發生錯誤：{e}")
+            if on_reset:
+                on_reset()
             return "抱歉，無法生成回應。"
 
     def finalize_user_session_now(self, user_id: str):
@@ -106,7 +127,22 @@ class LLMService:
             # 即使失敗，也確保 agent 被釋放
             self.agent_manager.release_health_agent(user_id)
 
-llm_service_instance = LLMService()
+_llm_service_instance: Optional[LLMService] = None
+_llm_service_lock = threading.Lock()
+
+
+def get_llm_service() -> LLMService:
+    """工廠函式：第一次使用時才建立 LLMService（匯入管道、建立 Agent、連線 Milvus）。"""
+    global _llm_service_instance
+    if _llm_service_instance is None:
+        with _llm_service_lock:
+            if _llm_service_instance is None:
+                from observability.startup import startup_phase
+
+                with startup_phase("llm_service"):
+                    _llm_service_instance = LLMService()
+    return _llm_service_instance
+
 
 def run_interactive_test():
     """互動式測試 - 固定用戶 test_user1，測試 5 分鐘釋放功能"""
@@ -139,7 +175,7 @@ def run_interactive_test():
             task_data = {"patient_id": user_id, "text": message}
 
             print(f"\n🗣️  輸入：{message}")
-            response = llm_service_instance.generate_response(task_data)
+            response = llm_service.generate_response(task_data)
             print(f"🤖 AI 回應：{response}")
 
         except KeyboardInterrupt:
@@ -1,10 +1,12 @@
 # llm_app/models/chat_profile.py
-from sqlalchemy import create_engine, Column, String, DateTime, Integer, ForeignKey
+from sqlalchemy import text, Column, String, DateTime, Integer, ForeignKey
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import sessionmaker, declarative_base
 from datetime import datetime
 import os
 
+from .db_engine import make_engine
+
 # 建立一個獨立的 SQLAlchemy 連線，專供聊天機器人 Profile 使用
 # 這樣可以避免與主框架的 Flask-SQLAlchemy 實例產生衝突
 DATABASE_URL = "postgresql://{user}:{password}@{host}:{port}/{dbname}".format(
@@ -15,8 +17,11 @@ DATABASE_URL = "postgresql://{user}:{password}@{host}:{port}/{dbname}".format(
     dbname=os.getenv('POSTGRES_DB', 'senior_health'),
 )
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# 連線池大小、回收與 pre-ping 見 db_engine（DB_POOL_* 環境變數）
+POOL_NAME = "main"
+engine = make_engine(DATABASE_URL, POOL_NAME)
+# 同一任務的 repository 呼叫共用 Session（repositories.unit_of_work），commit 後物件仍可讀，不需重新查詢
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
 class ChatUserProfile(Base):
@@ -34,10 +39,35 @@ class ChatUserProfile(Base):
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
     updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
 
+# Profile 的深度合併在資料庫端執行（ProfileRepository.update_profile_facts）：
+# 兩邊都是物件時逐鍵遞迴合併，否則以新值取代，與原本 Python 端的 deep_merge 相同
+PROFILE_MERGE_FUNCTION = "chat_profile_merge"
+PROFILE_MERGE_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION {PROFILE_MERGE_FUNCTION}(a jsonb, b jsonb) RETURNS jsonb
+LANGUAGE plpgsql IMMUTABLE AS $$
+DECLARE
+  k text;
+  v jsonb;
+  merged jsonb := a;
+BEGIN
+  IF a IS NULL OR b IS NULL OR jsonb_typeof(a) <> 'object' OR jsonb_typeof(b) <> 'object' THEN
+    RETURN b;
+  END IF;
+  FOR k, v IN SELECT key, value FROM jsonb_each(b) LOOP
+    merged := jsonb_set(merged, ARRAY[k], {PROFILE_MERGE_FUNCTION}(merged -> k, v));
+  END LOOP;
+  RETURN merged;
+END
+$$;
+"""
+
 def create_profile_table_if_not_exists():
-    """在應用啟動時確保表格存在"""
+    """在應用啟動時確保表格與合併函式存在"""
     try:
         Base.metadata.create_all(bind=engine)
+        if engine.dialect.name == "postgresql":
+            with engine.begin() as conn:
+                conn.execute(text(PROFILE_MERGE_FUNCTION_SQL))
         print("✅ [Profile DB] ChatUserProfile 表格已確認存在。")
     except Exception as e:
         print(f"❌ [Profile DB] 建立 ChatUserProfile 表格失敗: {e}")
\ No newline at end of file
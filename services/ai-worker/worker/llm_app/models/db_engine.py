@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+AI worker 的 SQLAlchemy engine 設定與連線池指標
+
+連線池（QueuePool）的大小需涵蓋同時存取資料庫的執行緒：RabbitMQ 消費者、排程（session 收尾、主動關懷、用量彙總）、
+背景摘要與 chat_pipeline 的執行緒池。超過 DB_POOL_SIZE + DB_MAX_OVERFLOW 的請求最多等待 DB_POOL_TIMEOUT_SEC 秒，
+之後拋出 sqlalchemy.exc.TimeoutError，而不是無上限地開新連線。
+取出連線前先 ping（DB_POOL_PRE_PING），Postgres 重啟或 idle 連線被防火牆切斷時自動重連；
+連線存活超過 DB_POOL_RECYCLE_SEC 秒後回收重建。
+
+指標（label pool=engine 名稱）：
+- ai_worker_db_pool_in_use / ai_worker_db_pool_saturation（使用中連線數、使用中 / 上限）
+- ai_worker_db_pool_in_use_at_checkout：每次取出連線時的使用中連線數（分布接近上限代表池子不夠）
+- ai_worker_db_pool_events_total{event="connect|invalidate|timeout"}：新建連線（churn）、失效（ping 失敗等）、等待逾時
+"""
+
+import os
+import threading
+import weakref
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+
+from observability.metrics import registry
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 5))
+DB_POOL_TIMEOUT_SEC = float(os.getenv("DB_POOL_TIMEOUT_SEC", 10))
+DB_POOL_RECYCLE_SEC = int(os.getenv("DB_POOL_RECYCLE_SEC", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+_IN_USE_BUCKETS = (1.0, 2.0, 3.0, 5.0, 8.0, 10.0, 15.0, 20.0, 30.0, 50.0)
+registry.describe("ai_worker_db_pool_in_use", "gauge", "Database connections currently checked out of the pool.")
+registry.describe("ai_worker_db_pool_saturation", "gauge", "Checked-out connections / (pool_size + max_overflow).")
+registry.describe(
+    "ai_worker_db_pool_in_use_at_checkout", "histogram", "Connections in use right after each checkout.", _IN_USE_BUCKETS
+)
+registry.describe("ai_worker_db_pool_events_total", "counter", "Pool connect / invalidate / timeout events.")
+
+_POOL_NAMES: "weakref.WeakKeyDictionary[Engine, str]" = weakref.WeakKeyDictionary()
+
+
+def instrument_pool(engine: Engine, name: str, capacity: int) -> None:
+    """以 pool 事件維護使用中連線數；capacity <= 0（不限 overflow）時不計算飽和度。"""
+    _POOL_NAMES[engine] = name
+    labels = {"pool": name}
+    lock = threading.Lock()
+    in_use = [0]
+
+    def _update(delta: int) -> None:
+        with lock:
+            in_use[0] += delta
+            current = in_use[0]
+        registry.set_gauge("ai_worker_db_pool_in_use", current, labels)
+        if capacity > 0:
+            registry.set_gauge("ai_worker_db_pool_saturation", current / capacity, labels)
+        if delta > 0:
+            registry.observe("ai_worker_db_pool_in_use_at_checkout", current, labels)
+
+    event.listen(engine, "checkout", lambda *args: _update(1))
+    event.listen(engine, "checkin", lambda *args: _update(-1))
+    event.listen(engine, "connect", lambda *args: registry.inc("ai_worker_db_pool_events_total", {**labels, "event": "connect"}))
+    event.listen(
+        engine, "invalidate", lambda *args: registry.inc("ai_worker_db_pool_events_total", {**labels, "event": "invalidate"})
+    )
+
+
+def record_pool_timeout(engine: Engine) -> None:
+    """等待連線逾時（QueuePool 沒有對應事件，由呼叫端在攔到 sqlalchemy.exc.TimeoutError 時記錄）。"""
+    registry.inc("ai_worker_db_pool_events_total", {"pool": _POOL_NAMES.get(engine, "unknown"), "event": "timeout"})
+
+
+def make_engine(url: str, name: str = "main", **overrides) -> Engine:
+    """依 DB_POOL_* 設定建立 engine 並掛上連線池指標；overrides 會覆寫對應的 create_engine 參數。"""
+    kwargs = {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT_SEC,
+        "pool_recycle": DB_POOL_RECYCLE_SEC,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+    kwargs.update(overrides)
+    engine = create_engine(url, **kwargs)
+    capacity = kwargs["pool_size"] + kwargs["max_overflow"] if kwargs["max_overflow"] >= 0 else 0
+    instrument_pool(engine, name, capacity)
+    return engine
@@ -0,0 +1,24 @@
+# llm_app/models/llm_usage.py
+from sqlalchemy import BigInteger, Column, Date, DateTime, Integer, String, UniqueConstraint
+from datetime import datetime
+
+from .chat_profile import Base
+
+
+class LlmUsageDaily(Base):
+    """LLM 用量的每日彙總（由 toolkits.usage_ledger.rollup_day 從 Redis 寫入）。"""
+
+    __tablename__ = 'llm_usage_daily'
+    __table_args__ = (UniqueConstraint('day', 'user_id', 'stage', name='uq_llm_usage_daily'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    day = Column(Date, nullable=False, index=True)
+    # 與 chat_user_profiles.user_id 對應；"0" 代表沒有病患上下文的系統呼叫
+    user_id = Column(String(64), nullable=False, index=True)
+    stage = Column(String(32), nullable=False)
+    calls = Column(BigInteger, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    completion_tokens = Column(BigInteger, nullable=False, default=0)
+    cost_micro_usd = Column(BigInteger, nullable=False, default=0)
+    latency_ms = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
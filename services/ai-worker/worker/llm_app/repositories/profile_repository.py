@@ -1,18 +1,69 @@
 # llm_app/repositories/profile_repository.py
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from ..models.chat_profile import SessionLocal, ChatUserProfile
+from sqlalchemy import bindparam, func, type_coerce, update
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import OperationalError
+from ..models.chat_profile import PROFILE_MERGE_FUNCTION, ChatUserProfile
+from ..toolkits.profile_cache import PROFILE_FIELDS, fill_profile, get_cached_profile, invalidate_profile
+from .unit_of_work import session_scope
 from datetime import datetime
 import json
+import os
+import time
+
+# 等鎖逾時時整筆重做的次數
+PROFILE_UPDATE_RETRIES = int(os.getenv("PROFILE_UPDATE_RETRIES", 3))
+
+
+def _base_expr(dialect: str, column):
+    """欄位為 NULL 時視為空物件。"""
+    if dialect == "sqlite":
+        return func.coalesce(column, "{}")
+    return func.coalesce(column, bindparam(None, {}, type_=JSONB))
+
+
+def _merge_expr(dialect: str, expr, patch: dict):
+    """expr 與 patch 深度合併：dict 對 dict 逐層合併，其餘以 patch 的值取代。"""
+    if dialect == "sqlite":
+        # json_patch（RFC 7396）：同樣逐層合併；差別是 patch 中的 null 會刪除該鍵。
+        # SQLite 以原始文字比對鍵，patch 與路徑須和欄位儲存時一樣以 json.dumps 預設（\u 跳脫）序列化
+        return func.json_patch(expr, json.dumps(patch))
+    return getattr(func, PROFILE_MERGE_FUNCTION)(expr, bindparam(None, patch, type_=JSONB), type_=JSONB)
+
+
+def _remove_expr(dialect: str, expr, path: list):
+    """刪除 expr 中的巢狀鍵；路徑不存在時不變。"""
+    if dialect == "sqlite":
+        return func.json_remove(expr, "$" + "".join("." + json.dumps(p) for p in path))
+    return type_coerce(expr, JSONB).delete_path(path)
+
+
+def _profile_update_values(dialect: str, facts_to_update: dict) -> dict:
+    """
+    把 Profiler 的 add / update / remove 指令轉成 UPDATE 的 SET 運算式（依序套用，與原本 Python 合併的順序相同）；
+    只送出 patch 本身，不送整份文件。remove 的格式為 "<category>.<key>[.<key>...]"。
+    """
+    exprs = {}
+    for op in ('add', 'update'):
+        for category_key, facts in (facts_to_update.get(op) or {}).items():
+            if category_key not in PROFILE_FIELDS or not isinstance(facts, dict) or not facts:
+                continue
+            column = getattr(ChatUserProfile, f"profile_{category_key}")
+            exprs[column] = _merge_expr(dialect, exprs.get(column, _base_expr(dialect, column)), facts)
+    for key_to_remove in facts_to_update.get('remove') or []:
+        parts = str(key_to_remove).split('.')
+        if len(parts) < 2 or parts[0] not in PROFILE_FIELDS:
+            continue
+        column = getattr(ChatUserProfile, f"profile_{parts[0]}")
+        exprs[column] = _remove_expr(dialect, exprs.get(column, _base_expr(dialect, column)), parts[1:])
+    return exprs
+
 
 class ProfileRepository:
-    def _get_db(self) -> Session:
-        return SessionLocal()
+    """各方法經 session_scope() 取得 Session：在 unit_of_work 內共用任務的 Session，否則每次呼叫各開一個。"""
 
     def get_or_create_by_user_id(self, user_id: int, line_user_id: str = None) -> ChatUserProfile:
         """讀取 Profile，若不存在則建立一筆新的空紀錄。"""
-        db = self._get_db()
-        try:
+        with session_scope() as db:
             profile = db.query(ChatUserProfile).filter(ChatUserProfile.user_id == user_id).first()
             if not profile:
                 print(f"[Profile Repo] 找不到 user_id={user_id} 的 Profile，將建立新紀錄。")
@@ -26,117 +77,94 @@ class ProfileRepository:
                 db.commit()
                 db.refresh(profile)
             return profile
-        finally:
-            db.close()
 
-    def read_profile_as_dict(self, user_id: str) -> dict:
-        """讀取 Profile 並以字典格式回傳。"""
-        profile = self.get_or_create_by_user_id(user_id)
+    @staticmethod
+    def _profile_dict(profile: ChatUserProfile) -> dict:
         return {
             "personal_background": profile.profile_personal_background or {},
             "health_status": profile.profile_health_status or {},
             "life_events": profile.profile_life_events or {}
         }
 
+    def read_profile_as_dict(self, user_id: int, line_user_id: str = None) -> dict:
+        """讀取 Profile 並以字典格式回傳；先查 Redis 快取，未命中才讀（或建立）Postgres 紀錄並回填。"""
+        cached, version = get_cached_profile(user_id)
+        if cached is not None:
+            return cached
+        profile_data = self._profile_dict(self.get_or_create_by_user_id(user_id, line_user_id))
+        fill_profile(user_id, version, profile_data)
+        return profile_data
+
     def update_profile_facts(self, user_id: int, facts_to_update: dict) -> None:
-        """根據 Profiler 產生的指令集，安全地更新 Profile。"""
+        """
+        根據 Profiler 產生的指令集，以單一 UPDATE 在資料庫端合併 Profile（見 _profile_update_values），
+        不先讀出整份 JSONB；同一列的並行更新由資料列鎖排隊，各自套用在最新內容上，不會互相覆蓋。
+        commit 後只使 Redis 快取失效，不寫入 RETURNING 的內容（並行更新到達 Redis 的順序可能與提交順序相反）。
+        """
         if not facts_to_update or (not facts_to_update.get('add') and not facts_to_update.get('update') and not facts_to_update.get('remove')):
             print(f"[Profile Repo] 無任何更新指令，跳過 {user_id} 的 Profile 更新。")
             return
 
-        db = self._get_db()
-        try:
-            profile = db.query(ChatUserProfile).filter(ChatUserProfile.user_id == user_id).first()
-            if not profile:
-                print(f"[Profile Repo] 更新失敗，找不到 user_id={user_id} 的 Profile。")
-                return
-
-            is_modified = False
-
-            # 深度合併字典
-            def deep_merge(d1, d2):
-                for k, v in d2.items():
-                    if k in d1 and isinstance(d1[k], dict) and isinstance(v, dict):
-                        d1[k] = deep_merge(d1[k], v)
-                    else:
-                        d1[k] = v
-                return d1
-
-            # 處理 'add' 和 'update'
-            for op in ['add', 'update']:
-                for category_key, facts in facts_to_update.get(op, {}).items():
-                    # Profiler 的輸出是 personal_background, health_status...
-                    field_name = f"profile_{category_key}"
-                    if hasattr(profile, field_name):
-                        current_data = getattr(profile, field_name) or {}
-                        updated_data = deep_merge(dict(current_data), facts)
-                        setattr(profile, field_name, updated_data)
-                        is_modified = True
-
-            # 處理 'remove'
-            for key_to_remove in facts_to_update.get('remove', []):
-                parts = key_to_remove.split('.')
-                if not parts: continue
-                category_key = parts[0]
-                field_name = f"profile_{category_key}"
-                if hasattr(profile, field_name):
-                    current_data = getattr(profile, field_name)
-                    if current_data and isinstance(current_data, dict):
-                        # 創建副本以進行修改
-                        temp_data_root = dict(current_data)
-                        temp_data = temp_data_root
-                        
-                        # 遍歷路徑直到最後一個 key
-                        parent = None
-                        key_to_del = None
-                        for i, part in enumerate(parts[1:]):
-                            if i == len(parts) - 2: # 倒數第二個
-                                parent = temp_data
-                                key_to_del = part
-                                break
-                            if isinstance(temp_data, dict) and part in temp_data:
-                                temp_data = temp_data[part]
-                            else:
-                                temp_data = None
-                                break
-                        
-                        if parent is not None and key_to_del is not None and key_to_del in parent:
-                            del parent[key_to_del]
-                            setattr(profile, field_name, temp_data_root)
-                            is_modified = True
-
-            if is_modified:
-                profile.updated_at = func.now()
-                db.commit()
-                print(f"✅ [Profile Repo] 成功更新 user {user_id} 的 Profile。")
-            else:
-                print(f"ℹ️ [Profile Repo] user {user_id} 的 Profile 無需變動。")
-        except Exception as e:
-            db.rollback()
-            print(f"❌ [Profile Repo] 更新 user {user_id} 的 Profile 失敗: {e}", exc_info=True)
-        finally:
-            db.close()
+        for attempt in range(1, PROFILE_UPDATE_RETRIES + 1):
+            with session_scope() as db:
+                try:
+                    values = _profile_update_values(db.bind.dialect.name, facts_to_update)
+                    if not values:
+                        print(f"ℹ️ [Profile Repo] user {user_id} 的 Profile 無需變動。")
+                        return
+                    values[ChatUserProfile.updated_at] = func.now()
+                    stmt = (
+                        update(ChatUserProfile)
+                        .where(ChatUserProfile.user_id == user_id)
+                        .values(values)
+                        .returning(ChatUserProfile.user_id)
+                    )
+                    row = db.execute(stmt).first()
+                    if row is None:
+                        db.rollback()
+                        print(f"[Profile Repo] 更新失敗，找不到 user_id={user_id} 的 Profile。")
+                        return
+                    db.commit()
+                    invalidate_profile(user_id)
+                    print(f"✅ [Profile Repo] 成功更新 user {user_id} 的 Profile。")
+                    return
+                except OperationalError as e:
+                    # 等鎖逾時（Postgres lock_timeout / SQLite database is locked）：整筆重做，合併本身是冪等的
+                    db.rollback()
+                    if attempt == PROFILE_UPDATE_RETRIES:
+                        print(f"❌ [Profile Repo] 更新 user {user_id} 的 Profile 失敗（重試 {attempt} 次）: {e}")
+                        return
+                    time.sleep(0.05 * attempt)
+                except Exception as e:
+                    db.rollback()
+                    print(f"❌ [Profile Repo] 更新 user {user_id} 的 Profile 失敗: {e}")
+                    return
 
     def touch_last_contact_ts(self, user_id: str, line_user_id: str = None) -> None:
-        """更新最後聯絡時間"""
-        db = self._get_db()
-        try:
-            profile = db.query(ChatUserProfile).filter(ChatUserProfile.user_id == int(user_id)).first()
-
-            # 如果使用者不存在，理論上應該在之前的流程被建立，但此處做個保險
-            if not profile:
-                print(f"DEBUG: Profile for user {user_id} not found, creating it.")
-                profile = ChatUserProfile(
-                    user_id=int(user_id),
-                    line_user_id=line_user_id,
+        """更新最後聯絡時間；畫像內容不變，只有新建紀錄時才回填快取。"""
+        with session_scope() as db:
+            try:
+                # 直接 UPDATE，不先 SELECT 整列（含 JSONB 畫像）
+                updated = db.query(ChatUserProfile).filter(ChatUserProfile.user_id == int(user_id)).update(
+                    {ChatUserProfile.last_contact_ts: func.now()}, synchronize_session=False
                 )
-                db.add(profile)
-            
-            # 更新時間
-            profile.last_contact_ts = func.now()
-            db.commit()
-        except Exception as e:
-            db.rollback()
-            print(f"❌ [Profile Repo] 更新 user_id={user_id} 的 last_contact_ts 失敗: {e}")
-        finally:
-            db.close()
\ No newline at end of file
+
+                # 如果使用者不存在，理論上應該在之前的流程被建立，但此處做個保險
+                version = None
+                if not updated:
+                    print(f"DEBUG: Profile for user {user_id} not found, creating it.")
+                    # commit 前記下版本：之後若有畫像更新提交並使快取失效，下面的回填會被拒絕
+                    _, version = get_cached_profile(int(user_id))
+                    profile = ChatUserProfile(
+                        user_id=int(user_id),
+                        line_user_id=line_user_id,
+                        last_contact_ts=func.now()
+                    )
+                    db.add(profile)
+                db.commit()
+                if not updated:
+                    # 新紀錄的畫像為空：先回填快取，本 session 的第一輪就不必再查 Postgres
+                    fill_profile(int(user_id), version, {})
+            except Exception as e:
+                db.rollback()
+                print(f"❌ [Profile Repo] 更新 user_id={user_id} 的 last_contact_ts 失敗: {e}")
@@ -0,0 +1,97 @@
+# llm_app/repositories/unit_of_work.py
+"""
+每個任務共用一個 SQLAlchemy Session（unit of work）
+
+任務邊界（RabbitMQ 任務、session 收尾、排程工作）以 `with unit_of_work():` 綁定一個 Session，
+範圍內的 repository 呼叫經 session_scope() 取得同一個 Session，不再每個方法各開一個；
+不在任何 unit of work 內時，session_scope() 建立一個用完即關的 Session（與原本行為相同）。
+
+- 綁定存在 contextvar，但只在建立它的執行緒內沿用：chat_pipeline 以 copy_context 交給執行緒池的工作
+  會另開自己的 Session，Session 不會跨執行緒共用
+- repository 方法仍自行 commit / rollback；每次呼叫結束時 session_scope 會結束尚未結束的交易，
+  連線歸還連線池，不會在 LLM 呼叫期間占住（SessionLocal 設 expire_on_commit=False，取出的物件在 commit 後仍可讀）
+- 巢狀的 unit_of_work 沿用外層；結束時關閉 Session（未提交的變更一併 rollback）
+
+統計：Prometheus counter `ai_worker_db_sessions_total{scope="task|call"}`（task = unit of work、call = 單次呼叫）
+"""
+
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional, Tuple
+
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+
+from observability.metrics import registry
+
+from ..models import chat_profile
+from ..models.db_engine import record_pool_timeout
+
+registry.describe("ai_worker_db_sessions_total", "counter", "SQLAlchemy sessions opened, per unit of work or per call.")
+
+_current: ContextVar[Optional[Tuple[Session, int]]] = ContextVar("db_unit_of_work", default=None)
+
+
+def current_session() -> Optional[Session]:
+    """目前執行緒所屬 unit of work 的 Session；沒有時回傳 None。"""
+    bound = _current.get()
+    if bound is not None and bound[1] == threading.get_ident():
+        return bound[0]
+    return None
+
+
+def _record_timeout(session: Session, e: PoolTimeoutError) -> None:
+    # 巢狀的 session_scope / unit_of_work 都會經過同一個例外，只記一次
+    if not getattr(e, "_pool_timeout_recorded", False):
+        e._pool_timeout_recorded = True
+        record_pool_timeout(session.get_bind())
+
+
+@contextmanager
+def _open_session(scope: str) -> Iterator[Session]:
+    registry.inc("ai_worker_db_sessions_total", {"scope": scope})
+    session = chat_profile.SessionLocal()
+    try:
+        yield session
+    except PoolTimeoutError as e:
+        _record_timeout(session, e)
+        raise
+    finally:
+        session.close()
+
+
+@contextmanager
+def unit_of_work() -> Iterator[Session]:
+    """綁定一個 Session 給目前的任務；已在 unit of work 內時沿用外層。"""
+    existing = current_session()
+    if existing is not None:
+        yield existing
+        return
+    with _open_session("task") as session:
+        token = _current.set((session, threading.get_ident()))
+        try:
+            yield session
+        finally:
+            _current.reset(token)
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """repository 方法取得 Session：unit of work 內沿用（不關閉），否則建立一個用完即關。"""
+    existing = current_session()
+    if existing is not None:
+        try:
+            yield existing
+            if existing.in_transaction():
+                # 結束這次呼叫的交易（唯讀查詢也是），連線歸還連線池，不在任務的其餘時間（LLM 呼叫等）占住
+                existing.commit()
+        except Exception as e:
+            # 與獨立 Session 被關閉時相同：失敗的交易不留給同一任務之後的呼叫
+            existing.rollback()
+            if isinstance(e, PoolTimeoutError):
+                _record_timeout(existing, e)
+            raise
+        return
+    with _open_session("call") as session:
+        yield session
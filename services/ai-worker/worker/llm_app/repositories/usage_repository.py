@@ -0,0 +1,64 @@
+# llm_app/repositories/usage_repository.py
+from datetime import date, datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import func
+
+from ..models.llm_usage import LlmUsageDaily
+from .unit_of_work import session_scope
+
+USAGE_METRICS = ("calls", "prompt_tokens", "completion_tokens", "cost_micro_usd", "latency_ms")
+
+
+def _upsert_statement(dialect: str, rows: List[dict]):
+    if dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    stmt = insert(LlmUsageDaily).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=["day", "user_id", "stage"],
+        set_={**{m: getattr(stmt.excluded, m) for m in USAGE_METRICS}, "updated_at": datetime.utcnow()},
+    )
+
+
+class UsageRepository:
+    def upsert_daily(self, rows: List[dict]) -> int:
+        """寫入每日彙總；同一 (day, user_id, stage) 以新值覆寫。"""
+        if not rows:
+            return 0
+        values = [
+            {"day": r["day"], "user_id": str(r["user_id"]), "stage": r["stage"], **{m: int(r.get(m) or 0) for m in USAGE_METRICS}}
+            for r in rows
+        ]
+        with session_scope() as db:
+            try:
+                db.execute(_upsert_statement(db.bind.dialect.name, values))
+                db.commit()
+                return len(values)
+            except Exception as e:
+                db.rollback()
+                print(f"❌ [Usage Repo] 寫入 LLM 用量彙總失敗: {e}")
+                raise
+
+    def top_users(self, start: date, end: date, limit: int = 20, stage: Optional[str] = None) -> List[Dict]:
+        """期間內（含頭尾）成本最高的使用者。"""
+        with session_scope() as db:
+            q = db.query(
+                LlmUsageDaily.user_id,
+                *[func.sum(getattr(LlmUsageDaily, m)).label(m) for m in USAGE_METRICS],
+            ).filter(LlmUsageDaily.day.between(start, end))
+            if stage:
+                q = q.filter(LlmUsageDaily.stage == stage)
+            q = q.group_by(LlmUsageDaily.user_id).order_by(func.sum(LlmUsageDaily.cost_micro_usd).desc()).limit(limit)
+            return [dict(row._mapping) for row in q.all()]
+
+    def stage_summary(self, start: date, end: date) -> List[Dict]:
+        """期間內（含頭尾）各階段的合計用量。"""
+        with session_scope() as db:
+            q = db.query(
+                LlmUsageDaily.stage,
+                *[func.sum(getattr(LlmUsageDaily, m)).label(m) for m in USAGE_METRICS],
+            ).filter(LlmUsageDaily.day.between(start, end))
+            q = q.group_by(LlmUsageDaily.stage).order_by(func.sum(LlmUsageDaily.cost_micro_usd).desc())
+            return [dict(row._mapping) for row in q.all()]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+有上限的 health agent 快取（LRU + TTL）
+
+每位使用者最多保留一個 agent，並記下建立時的 profile 指紋：指紋改變（畫像更新）時視為過期、
+重新建立；超過 AGENT_CACHE_MAX_SIZE 時淘汰最久未使用者；閒置超過 AGENT_CACHE_TTL_SEC 也會淘汰。
+長時間執行的 worker 記憶體因此只與「同時活躍的使用者數」有關，而不是「曾經聊過的使用者數」。
+
+統計以 Prometheus 指標提供：
+- ai_worker_agent_cache_total{result="hit|miss|stale|evicted|expired"}
+- ai_worker_agent_cache_size
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from observability.metrics import registry
+
+AGENT_CACHE_MAX_SIZE = int(os.getenv("AGENT_CACHE_MAX_SIZE", 256))
+AGENT_CACHE_TTL_SEC = float(os.getenv("AGENT_CACHE_TTL_SEC", 1800))
+
+registry.describe("ai_worker_agent_cache_total", "counter", "Health agent cache lookups and removals by result.")
+registry.describe("ai_worker_agent_cache_size", "gauge", "Health agents currently cached.")
+
+
+def profile_fingerprint(profile_text: str) -> str:
+    """畫像內容的短雜湊；空畫像回傳空字串。"""
+    if not profile_text:
+        return ""
+    return hashlib.sha1(profile_text.encode("utf-8")).hexdigest()[:16]
+
+
+class AgentCache:
+    """user_id → (profile 指紋, agent, 最後使用時間)；執行緒安全。"""
+
+    def __init__(
+        self,
+        factory: Callable[[str], Any],
+        max_size: int = AGENT_CACHE_MAX_SIZE,
+        ttl_sec: float = AGENT_CACHE_TTL_SEC,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._factory = factory
+        self.max_size = max(1, max_size)
+        self.ttl_sec = ttl_sec
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[str, Any, float]]" = OrderedDict()
+        self.stats: Dict[str, int] = {"hit": 0, "miss": 0, "stale": 0, "evicted": 0, "expired": 0}
+
+    def _count(self, result: str, n: int = 1) -> None:
+        if n:
+            self.stats[result] += n
+            registry.inc("ai_worker_agent_cache_total", {"result": result}, n)
+
+    def get(self, user_id: str, fingerprint: Optional[str] = None) -> Any:
+        """
+        取得使用者的 agent；不存在、已過期或指紋不符時以 factory 重新建立。
+        fingerprint 為 None 表示呼叫端不檢查畫像（沿用既有 agent）。
+        """
+        now = self._clock()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(user_id)
+            if entry is not None and (fingerprint is None or entry[0] == fingerprint):
+                self._entries[user_id] = (entry[0], entry[1], now)
+                self._entries.move_to_end(user_id)
+                self._count("hit")
+                return entry[1]
+            self._count("stale" if entry is not None else "miss")
+
+        # 建立 agent 可能較慢，不持有鎖
+        agent = self._factory(user_id)
+        with self._lock:
+            # 以建立完成的時間為最後使用時間，否則建立較久的 agent 一放入就可能已接近過期
+            self._entries[user_id] = (fingerprint or "", agent, self._clock())
+            self._entries.move_to_end(user_id)
+            overflow = len(self._entries) - self.max_size
+            for _ in range(max(0, overflow)):
+                self._entries.popitem(last=False)
+            self._count("evicted", max(0, overflow))
+            registry.set_gauge("ai_worker_agent_cache_size", len(self._entries))
+        return agent
+
+    def release(self, user_id: str) -> None:
+        with self._lock:
+            self._entries.pop(user_id, None)
+            registry.set_gauge("ai_worker_agent_cache_size", len(self._entries))
+
+    def _expire(self, now: float) -> None:
+        # 依最後使用時間排序，從最舊的開始檢查即可
+        expired = 0
+        while self._entries and self.ttl_sec > 0:
+            user_id, (_, _, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.ttl_sec:
+                break
+            self._entries.popitem(last=False)
+            expired += 1
+        if expired:
+            self._count("expired", expired)
+            registry.set_gauge("ai_worker_agent_cache_size", len(self._entries))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, user_id: str) -> bool:
+        with self._lock:
+            return user_id in self._entries
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+一般衛教問題的語意答案快取
+
+「吸入器怎麼用」「走路會喘怎麼辦」這類與個人無關的常見問題，反覆走完整的 agent 流程（含 copd_qa 檢索）
+並不划算。這裡保存一份「問題向量 → 已審核答案」的索引：新問題與某個條目的相似度達到門檻，
+且通過個人無關檢查時，直接以該答案回覆，不呼叫主 LLM。
+
+- 條目只有審核過的答案：由 seed（JSONL）匯入，或從候選清單 approve 而來。
+  完整流程回覆過的一般問題會記為候選（含出現次數），供人工審核後才會上線。
+- 個人無關檢查：guardrail 未攔截、memory gate 判定 SKIP（不涉及個人記憶或上一輪內容）、
+  不含緊急字詞（ANSWER_CACHE_BYPASS_WORDS），且問題夠短。
+- 條目有 TTL（ANSWER_CACHE_TTL_SEC），過期後不再使用，需重新審核。
+- 條目存在 Redis hash；每個 worker 保留一份本地索引，每 ANSWER_CACHE_REFRESH_SEC 秒重新載入。
+
+統計：
+- Redis hash `answer_cache:stats`（跨 worker 累計）
+- Prometheus counter `ai_worker_answer_cache_total{result="hit|miss|bypass|ineligible"}`
+
+管理（於 worker/ 目錄下）：
+    python -m llm_app.toolkits.answer_cache stats
+    python -m llm_app.toolkits.answer_cache seed vetted_answers.jsonl
+    python -m llm_app.toolkits.answer_cache candidates
+    python -m llm_app.toolkits.answer_cache approve <id> [--answer "修改後的答案"]
+    python -m llm_app.toolkits.answer_cache list
+    python -m llm_app.toolkits.answer_cache remove <id>
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import sys
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+
+from observability.metrics import registry
+
+from .decision_cache import normalize_text
+from .redis_store import get_redis
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "false").lower() in ("1", "true", "yes")
+# 完整流程回覆的一般問題是否記為候選（只進候選清單，審核後才會上線）
+ANSWER_CACHE_LEARN = os.getenv("ANSWER_CACHE_LEARN", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_SIM_THRESHOLD = float(os.getenv("ANSWER_CACHE_SIM_THRESHOLD", 0.92))
+ANSWER_CACHE_TTL_SEC = int(os.getenv("ANSWER_CACHE_TTL_SEC", 30 * 86400))
+ANSWER_CACHE_REFRESH_SEC = float(os.getenv("ANSWER_CACHE_REFRESH_SEC", 60))
+ANSWER_CACHE_MAX_CHARS = int(os.getenv("ANSWER_CACHE_MAX_CHARS", 40))
+ANSWER_CACHE_MAX_CANDIDATES = int(os.getenv("ANSWER_CACHE_MAX_CANDIDATES", 500))
+ANSWER_CACHE_DIM = int(os.getenv("ANSWER_CACHE_DIM", 256))
+# 問題改寫或答案風格調整時換版本，舊條目自然失效
+ANSWER_CACHE_VERSION = os.getenv("ANSWER_CACHE_VERSION", "v1")
+# 含這些字詞的輸入一律走完整流程（可能需要通報個管師）
+ANSWER_CACHE_BYPASS_WORDS = [
+    w.strip()
+    for w in os.getenv(
+        "ANSWER_CACHE_BYPASS_WORDS", "胸痛,胸悶,喘不過氣,呼吸困難,嘴唇發紫,咳血,昏倒,暈倒,不想活,想死,自殺"
+    ).split(",")
+    if w.strip()
+]
+
+registry.describe("ai_worker_answer_cache_total", "counter", "Semantic answer cache lookups by result.")
+
+
+def _entries_key() -> str:
+    return f"answer_cache:{ANSWER_CACHE_VERSION}"
+
+
+def _candidates_key() -> str:
+    return f"answer_cache:candidates:{ANSWER_CACHE_VERSION}"
+
+
+def _entry_id(norm: str) -> str:
+    return hashlib.sha1(norm.encode("utf-8")).hexdigest()[:12]
+
+
+def _embed(text: str) -> List[float]:
+    from ..embedding import safe_to_vector
+
+    vec = (safe_to_vector(text) or [])[:ANSWER_CACHE_DIM]
+    norm = math.sqrt(sum(x * x for x in vec))
+    return [x / norm for x in vec] if norm else []
+
+
+def is_eligible(text: str) -> bool:
+    """只有夠短、不含緊急字詞的輸入才查快取。"""
+    norm = normalize_text(text)
+    if not norm or len(norm) > ANSWER_CACHE_MAX_CHARS:
+        return False
+    return not any(w in text for w in ANSWER_CACHE_BYPASS_WORDS)
+
+
+class AnswerCache:
+    """Redis 上的已審核答案 + 本地向量索引；執行緒安全。"""
+
+    def __init__(
+        self,
+        redis_getter: Callable = None,
+        embed: Callable[[str], List[float]] = _embed,
+        threshold: float = ANSWER_CACHE_SIM_THRESHOLD,
+        refresh_sec: float = ANSWER_CACHE_REFRESH_SEC,
+        clock: Callable[[], float] = time.time,
+    ):
+        self._redis = redis_getter or get_redis
+        self._embed = embed
+        self.threshold = threshold
+        self.refresh_sec = refresh_sec
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._index: List[Tuple[str, List[float], str, float]] = []  # (id, 向量, 答案, 到期時間)
+        self._loaded_at: Optional[float] = None
+
+    # ---- 查詢 ----
+
+    def _load_index(self) -> List[Tuple[str, List[float], str, float]]:
+        now = self._clock()
+        with self._lock:
+            if self._loaded_at is not None and now - self._loaded_at < self.refresh_sec:
+                return self._index
+        index = []
+        for entry_id, raw in (self._redis().hgetall(_entries_key()) or {}).items():
+            try:
+                e = json.loads(raw)
+                index.append((entry_id, e["v"], e["a"], float(e.get("exp", 0))))
+            except (TypeError, ValueError, KeyError):
+                continue
+        with self._lock:
+            self._index, self._loaded_at = index, now
+        return index
+
+    def lookup(self, text: str) -> Tuple[Optional[Dict], List[float]]:
+        """
+        回傳 (最相近且達門檻的條目 {id, answer, score} 或 None, 問題向量)。
+        只做查詢，不計入統計；是否採用由呼叫端依個人無關檢查決定（見 serve）。
+        """
+        norm = normalize_text(text)
+        vec = self._embed(norm)
+        if not vec:
+            return None, []
+        now = self._clock()
+        best, best_sim = None, self.threshold
+        for entry_id, v, answer, expire_at in self._load_index():
+            if expire_at and expire_at < now:
+                continue
+            sim = sum(a * b for a, b in zip(vec, v))
+            if sim >= best_sim:
+                best, best_sim = {"id": entry_id, "answer": answer, "score": sim}, sim
+        return best, vec
+
+    def serve(self, match: Optional[Dict], gate_decision: str) -> Optional[str]:
+        """
+        依個人無關檢查決定是否採用 lookup 的結果；回傳答案或 None，並記錄統計。
+        guardrail 攔截的輸入由呼叫端直接略過，不會走到這裡。
+        """
+        if match is None:
+            self._count("miss")
+            return None
+        if gate_decision != "SKIP":
+            # 相似的問題，但本輪需要個人記憶或上一輪的內容
+            self._count("bypass")
+            return None
+        self._count("hit")
+        return match["answer"]
+
+    def _count(self, result: str) -> None:
+        registry.inc("ai_worker_answer_cache_total", {"result": result})
+        try:
+            self._redis().hincrby("answer_cache:stats", result, 1)
+        except Exception:
+            pass
+
+    def count_ineligible(self) -> None:
+        self._count("ineligible")
+
+    # ---- 候選與審核 ----
+
+    def record_candidate(self, question: str, answer: str, vec: Optional[List[float]] = None) -> None:
+        """完整流程回覆過的一般問題記為候選；同一問題只累加次數，保留第一次的回覆。"""
+        norm = normalize_text(question)
+        if not norm or not answer:
+            return
+        r = self._redis()
+        key, cid = _candidates_key(), _entry_id(norm)
+        raw = r.hget(key, cid)
+        if raw:
+            entry = json.loads(raw)
+            entry["n"] = entry.get("n", 1) + 1
+        else:
+            if r.hlen(key) >= ANSWER_CACHE_MAX_CANDIDATES:
+                return
+            entry = {"q": question, "a": answer, "n": 1, "v": [round(x, 4) for x in (vec or [])]}
+        entry["t"] = int(self._clock())
+        r.hset(key, cid, json.dumps(entry, ensure_ascii=False))
+
+    def candidates(self) -> List[Dict]:
+        rows = []
+        for cid, raw in (self._redis().hgetall(_candidates_key()) or {}).items():
+            e = json.loads(raw)
+            rows.append({"id": cid, "question": e["q"], "answer": e["a"], "count": e.get("n", 1)})
+        return sorted(rows, key=lambda e: e["count"], reverse=True)
+
+    def add(self, question: str, answer: str, vec: Optional[List[float]] = None, ttl_sec: int = ANSWER_CACHE_TTL_SEC) -> str:
+        """加入（或更新）一筆已審核答案，回傳條目 id。"""
+        norm = normalize_text(question)
+        vec = vec or self._embed(norm)
+        if not vec:
+            raise ValueError(f"無法取得問題向量：{question!r}")
+        entry_id = _entry_id(norm)
+        now = self._clock()
+        entry = {"q": question, "a": answer, "v": [round(x, 4) for x in vec], "t": int(now), "exp": int(now + ttl_sec)}
+        self._redis().hset(_entries_key(), entry_id, json.dumps(entry, ensure_ascii=False))
+        self._invalidate()
+        return entry_id
+
+    def approve(self, candidate_id: str, answer: Optional[str] = None) -> str:
+        r = self._redis()
+        raw = r.hget(_candidates_key(), candidate_id)
+        if not raw:
+            raise KeyError(f"找不到候選 {candidate_id}")
+        c = json.loads(raw)
+        entry_id = self.add(c["q"], answer or c["a"], c.get("v") or None)
+        r.hdel(_candidates_key(), candidate_id)
+        return entry_id
+
+    def remove(self, entry_id: str) -> bool:
+        removed = bool(self._redis().hdel(_entries_key(), entry_id))
+        self._invalidate()
+        return removed
+
+    def entries(self) -> List[Dict]:
+        rows = []
+        for entry_id, raw in (self._redis().hgetall(_entries_key()) or {}).items():
+            e = json.loads(raw)
+            rows.append({"id": entry_id, "question": e["q"], "answer": e["a"], "expire_at": e.get("exp", 0)})
+        return sorted(rows, key=lambda e: e["question"])
+
+    def _invalidate(self) -> None:
+        with self._lock:
+            self._loaded_at = None
+
+
+@lru_cache(maxsize=1)
+def get_answer_cache() -> AnswerCache:
+    return AnswerCache()
+
+
+def answer_cache_stats() -> Dict[str, float]:
+    raw = get_redis().hgetall("answer_cache:stats") or {}
+    counts = {k: int(raw.get(k, 0)) for k in ("hit", "miss", "bypass", "ineligible")}
+    looked_up = counts["hit"] + counts["miss"] + counts["bypass"]
+    counts["hit_rate"] = round(counts["hit"] / looked_up, 4) if looked_up else 0.0
+    return counts
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="一般衛教問題的語意答案快取管理")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("stats", help="命中統計")
+    sub.add_parser("list", help="列出已上線的答案")
+    sub.add_parser("candidates", help="列出待審核的候選")
+    p = sub.add_parser("seed", help="從 JSONL 匯入已審核答案（每行 {\"question\", \"answer\"}）")
+    p.add_argument("file")
+    p = sub.add_parser("approve", help="審核通過一筆候選")
+    p.add_argument("id")
+    p.add_argument("--answer", default="", help="以修改後的答案上線")
+    p = sub.add_parser("remove", help="下架一筆答案")
+    p.add_argument("id")
+    args = parser.parse_args(argv)
+
+    cache = get_answer_cache()
+    if args.command == "stats":
+        st = answer_cache_stats()
+        print(f"hit={st['hit']} miss={st['miss']} bypass={st['bypass']} ineligible={st['ineligible']} "
+              f"hit_rate={st['hit_rate']:.1%} entries={len(cache.entries())} candidates={len(cache.candidates())}")
+    elif args.command == "list":
+        for e in cache.entries():
+            print(f"{e['id']}  {e['question']} → {e['answer']}")
+    elif args.command == "candidates":
+        for c in cache.candidates():
+            print(f"{c['id']}  ×{c['count']:<4} {c['question']} → {c['answer']}")
+    elif args.command == "seed":
+        with open(args.file, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        for row in rows:
+            cache.add(row["question"], row["answer"])
+        print(f"✅ 已匯入 {len(rows)} 筆答案")
+    elif args.command == "approve":
+        print(f"✅ 已上線：{cache.approve(args.id, args.answer or None)}")
+    elif args.command == "remove":
+        print("✅ 已下架" if cache.remove(args.id) else "找不到該筆答案")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Guardrail / MemoryGate 決策快取
+
+以正規化後的輸入文字為鍵，把 LLM 分類結果（OK / BLOCK: … / USE / SKIP）存在 Redis 並設 TTL，
+「早安」「謝謝」這類高頻固定句只需付一次 LLM 成本。可選擇對未命中的輸入做 embedding 相似度比對，
+讓近似說法（「早安啊」「早安～」）也能沿用既有決策。
+
+命中率統計同時寫入：
+- Redis hash `decision:stats:{kind}`（跨 worker 累計；`python -m llm_app.toolkits.decision_cache` 查看）
+- Prometheus counter `ai_worker_decision_cache_total{kind,result}`
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+import time
+import unicodedata
+from typing import Callable, Dict, List, Optional
+
+from .redis_store import get_redis
+from observability.metrics import registry
+
+DECISION_CACHE_ENABLED = os.getenv("DECISION_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+DECISION_CACHE_TTL_SEC = int(os.getenv("DECISION_CACHE_TTL_SEC", 7 * 86400))
+# 提示詞或模型變更時調整版本，讓舊決策自然失效
+DECISION_CACHE_VERSION = os.getenv("DECISION_CACHE_VERSION", "v1")
+# 相似度查找：門檻 0 表示停用；僅對列出的 kind 啟用（guardrail 預設不啟用，避免相近但語意不同的請求被放行）
+DECISION_CACHE_SIM_THRESHOLD = float(os.getenv("DECISION_CACHE_SIM_THRESHOLD", 0))
+DECISION_CACHE_SIM_KINDS = {
+    k.strip() for k in os.getenv("DECISION_CACHE_SIM_KINDS", "memory_gate").split(",") if k.strip()
+}
+DECISION_CACHE_SIM_MAX_ENTRIES = int(os.getenv("DECISION_CACHE_SIM_MAX_ENTRIES", 200))
+# text-embedding-3 系列可截斷後重新正規化；只存前 N 維以降低 Redis 傳輸量
+DECISION_CACHE_SIM_DIM = int(os.getenv("DECISION_CACHE_SIM_DIM", 256))
+
+# 只有短句值得快取：長句重複率低，且相似度比對的誤判風險較高
+DECISION_CACHE_MAX_CHARS = int(os.getenv("DECISION_CACHE_MAX_CHARS", 64))
+
+registry.describe(
+    "ai_worker_decision_cache_total", "counter", "Guardrail / memory-gate decision cache lookups by result."
+)
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """NFKC、轉小寫、去除空白/標點/表情符號，讓「早安！」「早安~」「 早安 」落在同一個鍵。"""
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    t = "".join(ch for ch in t if not unicodedata.category(ch).startswith(("P", "S")))
+    return _SPACE_RE.sub("", t)
+
+
+def _digest(norm: str) -> str:
+    return hashlib.sha1(norm.encode("utf-8")).hexdigest()[:20]
+
+
+def _key(kind: str, norm: str) -> str:
+    return f"decision:{kind}:{DECISION_CACHE_VERSION}:{_digest(norm)}"
+
+
+def _vec_key(kind: str) -> str:
+    return f"decision:vec:{kind}:{DECISION_CACHE_VERSION}"
+
+
+def _record(kind: str, result: str) -> None:
+    registry.inc("ai_worker_decision_cache_total", {"kind": kind, "result": result})
+    try:
+        get_redis().hincrby(f"decision:stats:{kind}", result, 1)
+    except Exception:
+        pass
+
+
+def _similarity_enabled(kind: str) -> bool:
+    return DECISION_CACHE_SIM_THRESHOLD > 0 and kind in DECISION_CACHE_SIM_KINDS
+
+
+def _embed(text: str) -> List[float]:
+    from ..embedding import safe_to_vector
+
+    vec = (safe_to_vector(text) or [])[:DECISION_CACHE_SIM_DIM]
+    norm = math.sqrt(sum(x * x for x in vec))
+    return [x / norm for x in vec] if norm else []
+
+
+def _similar_decision(kind: str, vec: List[float]) -> Optional[str]:
+    best, best_sim = None, DECISION_CACHE_SIM_THRESHOLD
+    for raw in get_redis().hvals(_vec_key(kind)):
+        try:
+            entry = json.loads(raw)
+        except (TypeError, ValueError):
+            continue
+        sim = sum(a * b for a, b in zip(vec, entry["v"]))
+        if sim >= best_sim:
+            best, best_sim = entry["d"], sim
+    return best
+
+
+def _store_vector(kind: str, norm: str, vec: List[float], decision: str) -> None:
+    r = get_redis()
+    key = _vec_key(kind)
+    with r.pipeline() as pipe:
+        pipe.hset(key, _digest(norm), json.dumps({"v": [round(x, 4) for x in vec], "d": decision, "t": int(time.time())}))
+        pipe.expire(key, DECISION_CACHE_TTL_SEC)
+        pipe.hlen(key)
+        _, _, size = pipe.execute()
+    if size > DECISION_CACHE_SIM_MAX_ENTRIES:
+        # 超過上限時淘汰最舊的項目
+        entries = r.hgetall(key)
+        oldest = sorted(entries, key=lambda f: json.loads(entries[f]).get("t", 0))
+        r.hdel(key, *oldest[: size - DECISION_CACHE_SIM_MAX_ENTRIES])
+
+
+def cached_decision(
+    kind: str,
+    text: str,
+    compute: Callable[[str], str],
+    is_valid: Callable[[str], bool] = bool,
+) -> str:
+    """
+    先查決策快取，未命中才呼叫 compute(text)，並把通過 is_valid 的結果寫回快取。
+    compute 拋出的例外照常往外拋（由呼叫端決定故障時的保守預設，且不會被快取）；
+    Redis 本身故障時直接退回 compute。
+    """
+    norm = normalize_text(text)
+    if not DECISION_CACHE_ENABLED or not norm or len(norm) > DECISION_CACHE_MAX_CHARS:
+        return compute(text)
+
+    vec: List[float] = []
+    try:
+        r = get_redis()
+        hit = r.get(_key(kind, norm))
+        if hit is not None:
+            _record(kind, "hit")
+            return hit
+        if _similarity_enabled(kind):
+            vec = _embed(norm)
+            similar = _similar_decision(kind, vec) if vec else None
+            if similar is not None:
+                _record(kind, "similar_hit")
+                r.set(_key(kind, norm), similar, ex=DECISION_CACHE_TTL_SEC)
+                return similar
+    except Exception as e:
+        print(f"⚠️ [Decision Cache] 讀取失敗，直接呼叫 LLM: {e}")
+        return compute(text)
+
+    _record(kind, "miss")
+    decision = compute(text)
+    if is_valid(decision):
+        try:
+            get_redis().set(_key(kind, norm), decision, ex=DECISION_CACHE_TTL_SEC)
+            if vec:
+                _store_vector(kind, norm, vec, decision)
+        except Exception as e:
+            print(f"⚠️ [Decision Cache] 寫入失敗: {e}")
+    return decision
+
+
+def decision_cache_stats(kinds=("guardrail", "memory_gate")) -> Dict[str, Dict[str, float]]:
+    """跨 worker 累計的命中統計：{kind: {hit, similar_hit, miss, hit_rate}}。"""
+    r = get_redis()
+    stats = {}
+    for kind in kinds:
+        raw = r.hgetall(f"decision:stats:{kind}") or {}
+        counts = {k: int(raw.get(k, 0)) for k in ("hit", "similar_hit", "miss")}
+        total = sum(counts.values())
+        counts["hit_rate"] = round((counts["hit"] + counts["similar_hit"]) / total, 4) if total else 0.0
+        stats[kind] = counts
+    return stats
+
+
+if __name__ == "__main__":
+    # 用法（於 worker/ 目錄下）：python -m llm_app.toolkits.decision_cache
+    for kind, st in decision_cache_stats().items():
+        print(f"{kind:<12} hit={st['hit']} similar_hit={st['similar_hit']} miss={st['miss']} hit_rate={st['hit_rate']:.1%}")
@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+共用的 OpenAI client 與跨行程限流
+
+- 整個 worker 行程共用同一個 OpenAI client（httpx 連線池 + keep-alive），不再每次呼叫都建立新 client
+- 所有 worker 行程／副本共用 Redis 上的 token bucket（每分鐘請求數 RPM、每分鐘 token 數 TPM），
+  在送出請求前先取得額度，避免尖峰時一起撞上 provider 的 429 與重試風暴
+- 兩種優先權：interactive（使用者正在等的回覆、guardrail、memory gate）可用滿整個桶；
+  background（摘要、記憶蒸餾、主動關懷）必須留下 OPENAI_BACKGROUND_RESERVE 比例的額度，
+  桶子快見底時背景工作先等，使用者的請求照常送出
+
+token 數在送出前以字數粗估，回應回來後再以實際 usage 多退少補，並依 stage 記入用量帳（usage_ledger）。
+CrewAI 的 Agent 經由自己的 LLM client（litellm）呼叫 OpenAI，無法共用這裡的連線池；
+Crew 一律以 kickoff_crew() 執行，至少計入同一個 token bucket 與用量帳。
+Redis 故障或等候超過上限時放行（fail-open），不讓限流本身卡住回覆。
+OPENAI_RPM_LIMIT / OPENAI_TPM_LIMIT 皆為 0 時不限流，只共用連線池。
+
+指標：
+- ai_worker_openai_ratelimit_total{priority, result="granted|waited|timeout|error"}
+- ai_worker_openai_ratelimit_wait_seconds{priority}
+"""
+
+import json
+import os
+import random
+import time
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from observability.metrics import registry
+
+from .redis_store import get_redis
+from .usage_ledger import record_crew_usage, record_usage
+
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", 20))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", 10))
+OPENAI_TIMEOUT_SEC = float(os.getenv("OPENAI_TIMEOUT_SEC", 30))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 2))
+
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", 0))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", 0))
+OPENAI_BACKGROUND_RESERVE = float(os.getenv("OPENAI_BACKGROUND_RESERVE", 0.3))
+OPENAI_RATELIMIT_KEY = os.getenv("OPENAI_RATELIMIT_KEY", "openai:ratelimit")
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+MAX_WAIT_SEC = {
+    INTERACTIVE: float(os.getenv("OPENAI_INTERACTIVE_MAX_WAIT_SEC", 10)),
+    BACKGROUND: float(os.getenv("OPENAI_BACKGROUND_MAX_WAIT_SEC", 120)),
+}
+# 未指定 max_tokens 時，預估的回覆 token 數
+DEFAULT_COMPLETION_TOKENS = 256
+
+registry.describe("ai_worker_openai_ratelimit_total", "counter", "OpenAI rate-limiter admissions by priority and result.")
+registry.describe("ai_worker_openai_ratelimit_wait_seconds", "histogram", "Time spent waiting for OpenAI rate-limit budget.")
+
+# KEYS: rpm 桶, tpm 桶；ARGV: rpm 容量, tpm 容量, 需要的 token 數, 保留比例
+# 桶以 hash {level, ts} 存放，依經過時間線性補充（每分鐘補滿一次容量）。
+# 額度足夠時扣除並回傳 0，否則回傳建議等候的毫秒數（不扣除）。
+_ACQUIRE_LUA = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local caps = {tonumber(ARGV[1]), tonumber(ARGV[2])}
+local need = {1, tonumber(ARGV[3])}
+local reserve = tonumber(ARGV[4])
+local levels = {}
+local wait = 0
+for i = 1, 2 do
+  local cap = caps[i]
+  if cap > 0 then
+    local v = redis.call('HMGET', KEYS[i], 'level', 'ts')
+    local level = tonumber(v[1]) or cap
+    local ts = tonumber(v[2]) or now
+    level = math.min(cap, level + math.max(0, now - ts) * cap / 60000)
+    levels[i] = level
+    local floor = cap * reserve
+    -- 單次需求大於可用容量時以可用容量計，否則永遠等不到
+    local want = math.min(need[i], cap - floor)
+    local short = floor + want - level
+    if short > 0 then
+      wait = math.max(wait, math.ceil(short * 60000 / cap))
+    end
+  end
+end
+if wait > 0 then
+  return wait
+end
+for i = 1, 2 do
+  if caps[i] > 0 then
+    redis.call('HSET', KEYS[i], 'level', tostring(levels[i] - need[i]), 'ts', now)
+    redis.call('PEXPIRE', KEYS[i], 120000)
+  end
+end
+return 0
+"""
+
+# KEYS: tpm 桶；ARGV: 調整量（預估 - 實際，正數為退還）
+_SETTLE_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+  redis.call('HINCRBYFLOAT', KEYS[1], 'level', ARGV[1])
+end
+return 0
+"""
+
+
+def estimate_tokens(
+    messages: Optional[Iterable[Dict[str, Any]]] = None,
+    tools: Optional[List[Dict[str, Any]]] = None,
+    max_tokens: Optional[int] = None,
+    text: Any = None,
+) -> int:
+    """
+    粗估一次請求的 token 數：中文約一字一 token、英文約四字元一 token，取每兩字元一 token 折衷，
+    再加上回覆上限（未指定時用 DEFAULT_COMPLETION_TOKENS）。只用來預扣額度，回應後會以實際值修正。
+    """
+    chars = sum(len(str(m.get("content") or "")) for m in messages or [])
+    chars += sum(len(json.dumps(t, ensure_ascii=False)) for t in tools or [])
+    if text is not None:
+        chars += sum(len(str(x)) for x in text) if isinstance(text, list) else len(str(text))
+    completion = 0 if text is not None else (max_tokens or DEFAULT_COMPLETION_TOKENS)
+    return chars // 2 + 1 + completion
+
+
+class RateLimiter:
+    """Redis token bucket（RPM + TPM），所有 worker 行程共用同一組 key。"""
+
+    def __init__(
+        self,
+        rpm: int = OPENAI_RPM_LIMIT,
+        tpm: int = OPENAI_TPM_LIMIT,
+        background_reserve: float = OPENAI_BACKGROUND_RESERVE,
+        key: str = OPENAI_RATELIMIT_KEY,
+        redis_client=None,
+        max_wait: Optional[Dict[str, float]] = None,
+    ):
+        self.rpm = max(0, rpm)
+        self.tpm = max(0, tpm)
+        self.background_reserve = min(max(background_reserve, 0.0), 0.9)
+        self.keys = [f"{key}:rpm", f"{key}:tpm"]
+        self.max_wait = dict(MAX_WAIT_SEC, **(max_wait or {}))
+        self._redis = redis_client
+        self._acquire_script = None
+        self._settle_script = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    def _scripts(self):
+        if self._acquire_script is None:
+            r = self._redis or get_redis()
+            self._acquire_script = r.register_script(_ACQUIRE_LUA)
+            self._settle_script = r.register_script(_SETTLE_LUA)
+        return self._acquire_script, self._settle_script
+
+    def acquire(self, tokens: int, priority: str = INTERACTIVE) -> float:
+        """
+        取得一次請求（tokens 個 token）的額度，必要時等候；回傳等候秒數。
+        背景優先權必須在桶內留下 background_reserve 比例的額度。
+        """
+        if not self.enabled:
+            return 0.0
+        reserve = self.background_reserve if priority == BACKGROUND else 0.0
+        deadline = self.max_wait.get(priority, MAX_WAIT_SEC[INTERACTIVE])
+        started = time.monotonic()
+        result = "granted"
+        try:
+            acquire, _ = self._scripts()
+            while True:
+                wait_ms = int(acquire(keys=self.keys, args=[self.rpm, self.tpm, max(0, int(tokens)), reserve]))
+                if wait_ms <= 0:
+                    break
+                result = "waited"
+                remaining = deadline - (time.monotonic() - started)
+                if remaining <= 0:
+                    result = "timeout"
+                    print(f"⚠️ [OpenAI 限流] {priority} 等候超過 {deadline:.0f} 秒，直接送出")
+                    break
+                # 加一點抖動，避免多個行程同時醒來搶同一份額度
+                time.sleep(min(wait_ms / 1000.0 * random.uniform(1.0, 1.2), remaining, 1.0))
+        except Exception as e:
+            result = "error"
+            print(f"⚠️ [OpenAI 限流] Redis 無法使用，直接送出: {e}")
+        waited = time.monotonic() - started
+        registry.inc("ai_worker_openai_ratelimit_total", {"priority": priority, "result": result})
+        registry.observe("ai_worker_openai_ratelimit_wait_seconds", waited, {"priority": priority})
+        return waited
+
+    def settle(self, estimated: int, actual: Optional[int]) -> None:
+        """以實際 token 用量修正預扣的 TPM 額度（預估過多退還，不足補扣）。"""
+        if self.tpm <= 0 or actual is None or actual == estimated:
+            return
+        try:
+            _, settle = self._scripts()
+            settle(keys=[self.keys[1]], args=[estimated - actual])
+        except Exception as e:
+            print(f"⚠️ [OpenAI 限流] 修正 token 額度失敗: {e}")
+
+
+@lru_cache(maxsize=1)
+def get_rate_limiter() -> RateLimiter:
+    return RateLimiter()
+
+
+@lru_cache(maxsize=1)
+def _base_client():
+    """行程內共用的 OpenAI client；httpx 連線池讓連續請求重用 TLS 連線。"""
+    import httpx
+    from openai import OpenAI
+
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+        ),
+        timeout=OPENAI_TIMEOUT_SEC,
+    )
+    return OpenAI(
+        api_key=os.getenv("OPENAI_API_KEY"),
+        http_client=http_client,
+        max_retries=OPENAI_MAX_RETRIES,
+    )
+
+
+def _total_tokens(usage) -> Optional[int]:
+    if usage is None:
+        return None
+    total = getattr(usage, "total_tokens", None)
+    if total is None:
+        total = (getattr(usage, "prompt_tokens", 0) or 0) + (getattr(usage, "completion_tokens", 0) or 0)
+    return total
+
+
+def cached_prompt_tokens(usage) -> int:
+    """回應中命中供應商 prompt cache 的輸入 token 數（usage.prompt_tokens_details.cached_tokens；無此欄位時為 0）。"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        return int(details.get("cached_tokens") or 0)
+    return int(getattr(details, "cached_tokens", 0) or 0)
+
+
+def _record(stage: str, model: Optional[str], usage, started: float) -> None:
+    if usage is None:
+        return
+    record_usage(
+        stage,
+        model,
+        getattr(usage, "prompt_tokens", 0) or 0,
+        getattr(usage, "completion_tokens", 0) or 0,
+        latency_sec=time.monotonic() - started,
+        cached_tokens=cached_prompt_tokens(usage),
+    )
+
+
+class _Completions:
+    def __init__(self, priority: str, stage: str):
+        self._priority = priority
+        self._stage = stage
+
+    def create(self, **kwargs):
+        limiter = get_rate_limiter()
+        estimate = estimate_tokens(kwargs.get("messages"), kwargs.get("tools"), kwargs.get("max_tokens"))
+        limiter.acquire(estimate, self._priority)
+        started = time.monotonic()
+        res = _base_client().chat.completions.create(**kwargs)
+        if kwargs.get("stream"):
+            completion_allowance = kwargs.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+            return self._settle_stream(res, limiter, estimate, estimate - completion_allowance, kwargs.get("model"), started)
+        usage = getattr(res, "usage", None)
+        limiter.settle(estimate, _total_tokens(usage))
+        _record(self._stage, getattr(res, "model", None) or kwargs.get("model"), usage, started)
+        return res
+
+    def _settle_stream(
+        self, stream, limiter: RateLimiter, estimate: int, prompt_estimate: int, model: Optional[str], started: float
+    ) -> Iterator[Any]:
+        """
+        串流的 usage 在最後一個事件（需 stream_options.include_usage）。
+        呼叫端的回呼拋出例外或中途放棄串流（generator 被關閉）時拿不到 usage，
+        改以預估的輸入 token 加上已收到的輸出字數粗估，仍修正額度並記帳，不讓預扣的估計值變成最終用量。
+        """
+        usage = None
+        completion_chars = 0
+        try:
+            for event in stream:
+                if getattr(event, "usage", None):
+                    usage = event.usage
+                for choice in getattr(event, "choices", None) or []:
+                    delta = getattr(choice, "delta", None)
+                    completion_chars += len(getattr(delta, "content", None) or "")
+                    for tc in getattr(delta, "tool_calls", None) or []:
+                        completion_chars += len(getattr(getattr(tc, "function", None), "arguments", None) or "")
+                yield event
+        finally:
+            if usage is None:
+                print(f"⚠️ [OpenAI 限流] {self._stage} 串流沒有 usage（未讀完或未開啟 include_usage），以粗估用量修正額度")
+                usage = SimpleNamespace(
+                    prompt_tokens=max(prompt_estimate, 0),
+                    completion_tokens=completion_chars // 2 + (1 if completion_chars else 0),
+                    total_tokens=None,
+                )
+                close = getattr(stream, "close", None)
+                if close is not None:
+                    try:
+                        close()  # 放棄的串流也釋放 HTTP 連線
+                    except Exception:
+                        pass
+            limiter.settle(estimate, _total_tokens(usage))
+            _record(self._stage, model, usage, started)
+
+
+class _Embeddings:
+    def __init__(self, priority: str, stage: str):
+        self._priority = priority
+        self._stage = stage
+
+    def create(self, **kwargs):
+        limiter = get_rate_limiter()
+        estimate = estimate_tokens(text=kwargs.get("input"))
+        limiter.acquire(estimate, self._priority)
+        started = time.monotonic()
+        res = _base_client().embeddings.create(**kwargs)
+        usage = getattr(res, "usage", None)
+        limiter.settle(estimate, _total_tokens(usage))
+        _record(self._stage, kwargs.get("model"), usage, started)
+        return res
+
+
+class _Chat:
+    def __init__(self, priority: str, stage: str):
+        self.completions = _Completions(priority, stage)
+
+
+class PooledOpenAI:
+    """
+    與 openai.OpenAI 相同的 chat.completions.create / embeddings.create 介面：
+    送出前先經過限流，回應後把 usage 記到 stage 名下。
+    """
+
+    def __init__(self, priority: str = INTERACTIVE, stage: str = "other"):
+        self.priority = priority
+        self.stage = stage
+        self.chat = _Chat(priority, stage)
+        self.embeddings = _Embeddings(priority, stage)
+
+
+def kickoff_crew(crew, stage: str, prompt: str, priority: str = INTERACTIVE):
+    """
+    執行 crew.kickoff()，以 prompt（任務描述）粗估 token 數先取得限流額度，
+    結束後以 output.token_usage 修正額度並記入用量帳（stage）。回傳 kickoff 的結果。
+    一次 kickoff 可能含多次 LLM 呼叫（工具回合），RPM 只預扣一次。
+    """
+    limiter = get_rate_limiter()
+    estimate = estimate_tokens([{"content": prompt}])
+    limiter.acquire(estimate, priority)
+    started = time.monotonic()
+    output = None
+    try:
+        output = crew.kickoff()
+        return output
+    finally:
+        usage = getattr(output, "token_usage", None)
+        limiter.settle(estimate, getattr(usage, "total_tokens", None))
+        record_crew_usage(stage, output, time.monotonic() - started)
+
+
+@lru_cache(maxsize=None)
+def get_openai_client(priority: str = INTERACTIVE, stage: str = "other") -> PooledOpenAI:
+    """
+    取得共用 client。priority 為 "interactive"（使用者等待中的請求）或 "background"（摘要、蒸餾、排程）；
+    stage 為用量帳上的階段名稱（guardrail、memory_gate、main_reply …）。實際連線在第一次呼叫時才建立。
+    """
+    if priority not in MAX_WAIT_SEC:
+        raise ValueError(f"未知的優先權 {priority!r}，可用：{', '.join(MAX_WAIT_SEC)}")
+    return PooledOpenAI(priority, stage)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+MemoryGate 規則式前置分類器
+
+明確需要長期記憶（「上次」「之前」、藥名、家人稱呼）或明確不需要（問候、道謝、附和）的輸入
+直接在本地判定，只有模稜兩可的輸入才交給 LLM。
+
+規則可用 MEMORY_GATE_RULES_FILE 指向 JSON 檔覆寫（欄位同 DEFAULT_RULES，未提供的欄位沿用預設）。
+判定順序：USE 關鍵字/正規式 → SKIP 完全比對/正規式 → 短句 SKIP → 其餘交給 LLM。
+"""
+
+import json
+import os
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from .decision_cache import normalize_text
+
+MEMORY_GATE_RULES_ENABLED = os.getenv("MEMORY_GATE_RULES_ENABLED", "true").lower() in ("1", "true", "yes")
+MEMORY_GATE_RULES_FILE = os.getenv("MEMORY_GATE_RULES_FILE", "")
+
+DEFAULT_RULES = {
+    # 指涉過往、個人事實或醫囑 → USE（比對正規化後的文字，因此不含標點）
+    "use_keywords": [
+        "上次", "上回", "之前", "以前", "前幾天", "昨天", "過敏",
+        "醫師說", "醫生說", "醫囑", "固定", "提醒", "記得", "忘記", "照舊", "老樣子",
+        "我的藥", "吃藥", "用藥", "回診", "複診", "門診",
+        "吸入器", "噴劑", "類固醇", "支氣管擴張", "茶鹼", "抗生素", "氧氣",
+        "spiriva", "symbicort", "seretide", "trelegy", "ventolin", "atrovent",
+    ],
+    "use_regex": [
+        r"我(的|家)?(孫|兒子|女兒|媳婦|女婿|老伴|太太|先生|老公|老婆|阿公|阿嬤)",
+        r"(你|妳)(說|講)過",
+        r"(每天|每日|每週|每晚|早晚)\d*(次|顆|口|下)",
+        # 「還是／那個／一樣」單獨出現多半只是連接詞或指示詞，只在指涉先前狀況或談過的事物時判定
+        r"還是(一樣|老樣子|沒(有)?(好|改善|起色))",
+        r"那個(藥|醫生|醫師|檢查|運動|噴劑|吸入器)",
+        r"(跟|和)(平常|往常)一樣",
+    ],
+    # 問候、道謝、附和 → SKIP（完全比對）
+    "skip_exact": [
+        "早", "早安", "午安", "晚安", "你好", "妳好", "哈囉", "嗨", "hi", "hello",
+        "謝謝", "多謝", "感謝", "謝謝你", "謝謝妳", "好", "好的", "好喔", "好啊", "好哦", "可以",
+        "嗯", "嗯嗯", "喔", "哦", "對", "對啊", "是", "是的", "沒有", "沒事", "收到", "了解", "知道了",
+        "ok", "okay", "掰掰", "拜拜", "再見", "明天見",
+    ],
+    "skip_regex": [
+        r"^[哈呵嘿嗯喔哦啊欸耶]+$",
+        r"^(早安|午安|晚安|謝謝|你好)(啊|喔|哦|呀|囉|唷|你|妳|ally|艾莉)*$",
+    ],
+    # 正規化後不超過此長度且未命中 USE 規則 → SKIP
+    "short_skip_len": 2,
+}
+
+
+@dataclass
+class GateRules:
+    use_keywords: List[str] = field(default_factory=list)
+    use_regex: List[str] = field(default_factory=list)
+    skip_exact: List[str] = field(default_factory=list)
+    skip_regex: List[str] = field(default_factory=list)
+    short_skip_len: int = 0
+
+    def __post_init__(self):
+        self.use_keywords = [normalize_text(k) for k in self.use_keywords if normalize_text(k)]
+        self.skip_exact = {normalize_text(k) for k in self.skip_exact}
+        self._use_re = [re.compile(p) for p in self.use_regex]
+        self._skip_re = [re.compile(p) for p in self.skip_regex]
+
+    def classify(self, text: str) -> Tuple[Optional[str], str]:
+        """回傳 (USE / SKIP / None, 命中的規則)；None 表示無法判定，應交給 LLM。"""
+        norm = normalize_text(text)
+        if not norm:
+            return "SKIP", "empty"
+        for kw in self.use_keywords:
+            if kw in norm:
+                return "USE", f"use_keyword:{kw}"
+        for rx in self._use_re:
+            if rx.search(norm):
+                return "USE", f"use_regex:{rx.pattern}"
+        if norm in self.skip_exact:
+            return "SKIP", f"skip_exact:{norm}"
+        for rx in self._skip_re:
+            if rx.search(norm):
+                return "SKIP", f"skip_regex:{rx.pattern}"
+        if len(norm) <= self.short_skip_len:
+            return "SKIP", "short"
+        return None, ""
+
+
+def load_rules(path: str = "") -> GateRules:
+    config = dict(DEFAULT_RULES)
+    if path:
+        with open(path, encoding="utf-8") as f:
+            config.update(json.load(f))
+    return GateRules(**config)
+
+
+@lru_cache(maxsize=1)
+def get_rules() -> GateRules:
+    try:
+        return load_rules(MEMORY_GATE_RULES_FILE)
+    except (OSError, ValueError, TypeError, re.error) as e:
+        print(f"⚠️ [MemoryGate Rules] 讀取 {MEMORY_GATE_RULES_FILE} 失敗，改用預設規則: {e}")
+        return load_rules()
+
+
+def classify_by_rules(text: str) -> Optional[str]:
+    """規則可判定時回傳 USE / SKIP，否則 None（或規則停用時一律 None）。"""
+    if not MEMORY_GATE_RULES_ENABLED:
+        return None
+    return get_rules().classify(text)[0]
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+使用者畫像的 Redis 快取（read-through，寫入時失效）
+
+每輪組 prompt 都要讀畫像（HealthBot.agent.profile_section），finalize 的 Profiler 也會再讀一次；
+畫像只在 session 收尾時才可能改變，因此以 Redis hash `profile:cache:{user_id}` 保存一份：
+- profile：三個畫像欄位（personal_background / health_status / life_events）的 JSON
+- v：版本戳記，每次寫入遞增
+
+讀取未命中時先記下當下的版本，再讀 Postgres 回填；回填以 Lua 比對版本，
+期間若有寫入（版本已變）就放棄回填，舊資料不會蓋掉剛寫入的新畫像。
+寫入端（ProfileRepository.update_profile_facts）在 commit 後只遞增版本並刪除內容（invalidate_profile），
+由下一次讀取從 Postgres 回填：兩個並行的收尾在 Postgres 依 A→B 提交、到達 Redis 的順序卻可能是 B→A，
+若由寫入端直接寫入內容，較舊的 A 會蓋掉 B；只做失效則與到達順序無關。
+touch_last_contact_ts 建立新紀錄時在 commit 前記下版本，commit 後以 fill_profile 回填空畫像（之後的寫入會讓它失效）。
+Redis 失敗時一律退回直接讀寫 Postgres，TTL（PROFILE_CACHE_TTL_SEC）限制最長的不一致時間。
+
+統計：Prometheus counter `ai_worker_profile_cache_total{result="hit|miss|fill|stale|invalidate|error"}`
+"""
+
+import json
+import os
+from typing import Dict, Optional, Tuple
+
+from observability.metrics import registry
+
+PROFILE_CACHE_ENABLED = os.getenv("PROFILE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+PROFILE_CACHE_TTL_SEC = int(os.getenv("PROFILE_CACHE_TTL_SEC", 86400))
+
+PROFILE_FIELDS = ("personal_background", "health_status", "life_events")
+
+registry.describe("ai_worker_profile_cache_total", "counter", "Chat user profile cache lookups and writes by result.")
+
+# 版本未變才回填（KEYS[1]=hash；ARGV=[讀取前的版本, profile JSON, ttl]）
+_FILL_LUA = """
+local v = redis.call('HGET', KEYS[1], 'v') or '0'
+if v ~= ARGV[1] then
+  return 0
+end
+redis.call('HSET', KEYS[1], 'v', v, 'profile', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+def _redis():
+    # redis_store 依賴 ProfileRepository，延後匯入避免循環
+    from .redis_store import get_redis
+
+    return get_redis()
+
+
+def _key(user_id) -> str:
+    return f"profile:cache:{user_id}"
+
+
+def _record(result: str) -> None:
+    registry.inc("ai_worker_profile_cache_total", {"result": result})
+
+
+def encode_profile(profile: Dict) -> str:
+    return json.dumps({k: profile.get(k) or {} for k in PROFILE_FIELDS}, ensure_ascii=False, sort_keys=True)
+
+
+def get_cached_profile(user_id) -> Tuple[Optional[Dict], Optional[str]]:
+    """
+    回傳 (畫像, 版本)：命中時版本為 None；未命中時回傳讀取當下的版本（供 fill_profile 比對）。
+    停用或 Redis 失敗時回傳 (None, None)，呼叫端直接讀 Postgres、不回填。
+    """
+    if not PROFILE_CACHE_ENABLED:
+        return None, None
+    try:
+        cached = _redis().hgetall(_key(user_id))
+    except Exception as e:
+        print(f"⚠️ [Profile Cache] 讀取 user {user_id} 失敗: {e}")
+        _record("error")
+        return None, None
+    raw = cached.get("profile")
+    if raw:
+        try:
+            profile = json.loads(raw)
+            _record("hit")
+            return profile, None
+        except ValueError:
+            pass
+    _record("miss")
+    return None, cached.get("v", "0")
+
+
+def fill_profile(user_id, version: Optional[str], profile: Dict) -> bool:
+    """讀取未命中後回填；版本已被寫入端推進時放棄（回傳 False）。"""
+    if version is None:
+        return False
+    from .redis_store import lua_script
+
+    try:
+        ok = bool(
+            lua_script(_FILL_LUA)(
+                keys=[_key(user_id)], args=[version, encode_profile(profile), PROFILE_CACHE_TTL_SEC], client=_redis()
+            )
+        )
+    except Exception as e:
+        print(f"⚠️ [Profile Cache] 回填 user {user_id} 失敗: {e}")
+        _record("error")
+        return False
+    _record("fill" if ok else "stale")
+    return ok
+
+
+def invalidate_profile(user_id) -> Optional[int]:
+    """
+    Postgres commit 之後呼叫：遞增版本（讓讀取中的回填放棄）並刪除快取內容，回傳新版本；
+    下一次讀取會從 Postgres 回填。失敗時回傳 None，舊內容最多留到 TTL 到期。
+    """
+    if not PROFILE_CACHE_ENABLED:
+        return None
+    try:
+        with _redis().pipeline() as pipe:
+            pipe.hincrby(_key(user_id), "v", 1)
+            pipe.hdel(_key(user_id), "profile")
+            pipe.expire(_key(user_id), PROFILE_CACHE_TTL_SEC)
+            version = int(pipe.execute()[0])
+    except Exception as e:
+        print(f"⚠️ [Profile Cache] 使 user {user_id} 的快取失效失敗: {e}")
+        _record("error")
+        return None
+    _record("invalidate")
+    return version
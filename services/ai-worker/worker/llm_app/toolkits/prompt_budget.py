@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Prompt 上下文的 token 預算
+
+主回覆的上下文由四段組成，依穩定程度排列：使用者畫像、歷史摘要（同一使用者跨輪穩定），
+長期記憶包、近期對話（每輪變動）。穩定的段落在前，供應商的 prompt caching 才能重用開頭（見 HealthBot.care_prompt）。
+
+以 PROMPT_TOKEN_BUDGET 為總額，依比例（PROMPT_BUDGET_SHARES）切成穩定與變動兩池：
+穩定池只在畫像與摘要之間分配，變動池拿剩下的額度，用不完的再依優先順序（近期對話 > 記憶）補給。
+穩定段落的額度因此只取決於它們自己的長度，不會因本輪記憶多寡而改變截斷位置。
+超出的部分以 tokenizer 截斷：畫像／記憶保留開頭，摘要保留結尾（較新），近期對話保留最新的完整回合。
+
+有安裝 tiktoken 時以實際編碼計數；否則以字元估算（中日韓字一字一 token、其他約四字元一 token）。
+"""
+
+import os
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from observability.metrics import registry
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 2000))
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "o200k_base")
+
+
+def _load_shares() -> Dict[str, float]:
+    """PROMPT_BUDGET_SHARES 格式：profile=0.2,memory=0.3,summary=0.2,recent=0.3"""
+    shares = {"profile": 0.2, "memory": 0.3, "summary": 0.2, "recent": 0.3}
+    raw = os.getenv("PROMPT_BUDGET_SHARES", "").strip()
+    for item in filter(None, (x.strip() for x in raw.split(","))):
+        name, _, value = item.partition("=")
+        try:
+            if name.strip() in shares:
+                shares[name.strip()] = float(value)
+        except ValueError:
+            print(f"⚠️ [Prompt Budget] PROMPT_BUDGET_SHARES 格式錯誤，忽略：{item}")
+    return shares
+
+
+PROMPT_BUDGET_SHARES = _load_shares()
+# 有剩餘額度時的分配順序
+PRIORITY = ("recent", "memory", "summary", "profile")
+# 組出的順序：跨輪穩定的段落在前、每輪變動的在後
+SECTIONS = ("profile", "summary", "memory", "recent")
+STABLE_SECTIONS = ("profile", "summary")
+VOLATILE_SECTIONS = ("memory", "recent")
+
+SUMMARY_HEADER = "📌 歷史摘要：\n"
+RECENT_HEADER = "🕓 近期對話（未摘要）：\n"
+
+_TOKEN_BUCKETS = (50.0, 100.0, 200.0, 400.0, 800.0, 1200.0, 1600.0, 2000.0, 3000.0, 4000.0, 6000.0, 8000.0)
+registry.describe("ai_worker_prompt_tokens", "histogram", "每輪組出的 prompt token 數（section=上下文各段與 total）", _TOKEN_BUCKETS)
+registry.describe("ai_worker_prompt_truncated_total", "counter", "上下文段落因超出 token 預算被截斷的次數")
+
+_CJK = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(PROMPT_TOKENIZER)
+    except Exception as e:
+        print(f"⚠️ [Prompt Budget] 無法載入 tiktoken（{e}），改以字元估算 token 數")
+        return None
+
+
+def _char_cost(ch: str) -> float:
+    return 1.0 if _CJK.match(ch) else 0.25
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _encoding()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    return int(sum(_char_cost(ch) for ch in text) + 0.999)
+
+
+def truncate_tokens(text: str, max_tokens: int, keep: str = "head") -> str:
+    """截到 max_tokens 以內；keep="head" 保留開頭，"tail" 保留結尾。截斷處以「…」標示。"""
+    if max_tokens <= 0 or not text:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    limit = max_tokens - 1  # 留一個 token 給「…」
+    enc = _encoding()
+    if enc is not None:
+        ids = enc.encode(text, disallowed_special=())
+        kept = enc.decode(ids[:limit] if keep == "head" else ids[-limit:]) if limit > 0 else ""
+    else:
+        chars = text if keep == "head" else reversed(text)
+        used, n = 0.0, 0
+        for ch in chars:
+            used += _char_cost(ch)
+            if used > limit:
+                break
+            n += 1
+        kept = text[:n] if keep == "head" else text[len(text) - n:]
+    return kept + "…" if keep == "head" else "…" + kept
+
+
+def allocate(needs: Dict[str, int], budget: int, shares: Optional[Dict[str, float]] = None) -> Dict[str, int]:
+    """依比例分配，各段用不完的額度依 PRIORITY 補給仍不足的段落。"""
+    shares = shares or PROMPT_BUDGET_SHARES
+    alloc = {name: min(need, int(budget * shares.get(name, 0.0))) for name, need in needs.items()}
+    spare = budget - sum(alloc.values())
+    for name in PRIORITY:
+        if spare <= 0:
+            break
+        if name in needs:
+            extra = min(spare, needs[name] - alloc[name])
+            alloc[name] += extra
+            spare -= extra
+    return alloc
+
+
+def _share_of(names: Iterable[str]) -> float:
+    total = sum(PROMPT_BUDGET_SHARES.values()) or 1.0
+    return sum(PROMPT_BUDGET_SHARES.get(n, 0.0) for n in names) / total
+
+
+def _allocate_pool(needs: Dict[str, int], names: Iterable[str], budget: int) -> Dict[str, int]:
+    """在一池（穩定或變動）之內依比例分配；比例以池內各段的份額正規化。"""
+    names = tuple(names)
+    pool = _share_of(names) or 1.0
+    shares = {n: PROMPT_BUDGET_SHARES.get(n, 0.0) / pool for n in names}
+    return allocate({n: needs[n] for n in names}, budget, shares)
+
+
+def render_rounds(rounds: Iterable[Dict]) -> List[str]:
+    """每一回合渲染成「使用者：…\\n助手：…」。"""
+    out = []
+    for r in rounds:
+        q = (r.get("input") or "").strip()
+        a = (r.get("output") or "").strip()
+        out.append(f"使用者：{q}\n助手：{a}")
+    return out
+
+
+def fit_rounds(rendered: List[str], max_tokens: int) -> str:
+    """由新到舊放入完整回合；連最新一輪都放不下時只保留它的結尾。"""
+    kept: List[str] = []
+    used = 0
+    for text in reversed(rendered):
+        cost = count_tokens(text) + 1  # 換行
+        if used + cost > max_tokens:
+            break
+        kept.append(text)
+        used += cost
+    if not kept and rendered:
+        return truncate_tokens(rendered[-1], max_tokens, keep="tail")
+    return "\n".join(reversed(kept))
+
+
+def assemble_context(
+    profile: str = "",
+    memory: str = "",
+    summary: str = "",
+    rounds: Optional[List[Dict]] = None,
+    budget: Optional[int] = None,
+) -> Tuple[str, Dict]:
+    """
+    組出主回覆的上下文；回傳 (文字, 報告)。
+    profile / memory 為已含標題的完整段落（agent.profile_section / memory_section 的輸出），
+    summary 為摘要本文，rounds 為近期回合（舊 → 新）。
+    報告：{"budget", "total", "sections": {段落: token 數}, "truncated": [段落]}
+    """
+    budget = PROMPT_TOKEN_BUDGET if budget is None else budget
+    summary = (summary or "").strip()
+    rendered = render_rounds(rounds or [])
+    recent_full = "\n".join(rendered)
+
+    needs = {
+        "profile": count_tokens(profile),
+        "memory": count_tokens(memory),
+        "summary": count_tokens(SUMMARY_HEADER + summary) if summary else 0,
+        "recent": count_tokens(RECENT_HEADER + recent_full) if rendered else 0,
+    }
+    separators = count_tokens("\n\n") * (len(SECTIONS) - 1)
+    available = max(0, budget - separators)
+    alloc = _allocate_pool(needs, STABLE_SECTIONS, int(available * _share_of(STABLE_SECTIONS)))
+    alloc.update(_allocate_pool(needs, VOLATILE_SECTIONS, available - sum(alloc.values())))
+    truncated = [name for name in SECTIONS if alloc[name] < needs[name]]
+
+    parts = {
+        "profile": truncate_tokens(profile, alloc["profile"], keep="head"),
+        "memory": truncate_tokens(memory, alloc["memory"], keep="head"),
+        "summary": "",
+        "recent": "",
+    }
+    if summary and alloc["summary"] > count_tokens(SUMMARY_HEADER):
+        body = truncate_tokens(summary, alloc["summary"] - count_tokens(SUMMARY_HEADER), keep="tail")
+        parts["summary"] = SUMMARY_HEADER + body
+    if rendered and alloc["recent"] > count_tokens(RECENT_HEADER):
+        body = fit_rounds(rendered, alloc["recent"] - count_tokens(RECENT_HEADER))
+        parts["recent"] = RECENT_HEADER + body if body else ""
+
+    text = "\n\n".join(parts[name] for name in SECTIONS if parts[name].strip())
+    report = {
+        "budget": budget,
+        "total": count_tokens(text),
+        "sections": {name: count_tokens(parts[name]) for name in SECTIONS},
+        "truncated": truncated,
+    }
+    for name in SECTIONS:
+        registry.observe("ai_worker_prompt_tokens", report["sections"][name], {"section": name})
+        if name in truncated:
+            registry.inc("ai_worker_prompt_truncated_total", {"section": name})
+    registry.observe("ai_worker_prompt_tokens", report["total"], {"section": "total"})
+    return text, report
+
+
+def format_report(report: Dict, extra: Optional[Dict[str, int]] = None) -> str:
+    """單行摘要，例如：total=812/2000 (profile=120 memory=0 summary=210 recent=482) truncated=recent"""
+    sections = " ".join(f"{k}={v}" for k, v in report["sections"].items())
+    line = f"total={report['total']}/{report['budget']} ({sections})"
+    for k, v in (extra or {}).items():
+        line += f" {k}={v}"
+    if report["truncated"]:
+        line += " truncated=" + ",".join(report["truncated"])
+    return line
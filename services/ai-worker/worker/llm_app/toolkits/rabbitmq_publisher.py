@@ -3,14 +3,18 @@ import pika
 import os
 import json
 import logging
+from typing import Optional
 
-def publish_alert(user_id: str, reason: str):
+from observability import tracing
+
+def publish_alert(user_id: str, reason: str, request_id: Optional[str] = None):
     """
     發布一個緊急警示訊息到 RabbitMQ 的 alert_queue。
 
     Args:
         user_id (str): 觸發警示的使用者 ID。
         reason (str): 警示的原因或相關訊息。
+        request_id (str, optional): 觸發警示的任務 ID，方便追查。
     """
     try:
         rabbitmq_host = os.environ.get("RABBITMQ_HOST", "rabbitmq")
@@ -26,6 +30,8 @@ def publish_alert(user_id: str, reason: str):
             "user_id": user_id,
             "reason": reason
         }
+        if request_id:
+            message["request_id"] = request_id
 
         # 發布訊息
         channel.basic_publish(
@@ -34,6 +40,7 @@ def publish_alert(user_id: str, reason: str):
             body=json.dumps(message),
             properties=pika.BasicProperties(
                 delivery_mode=2,  # 讓訊息持久化
+                headers=tracing.inject(),
             ))
         
         print(f" [x] 已發送警示到 RabbitMQ: {message}")
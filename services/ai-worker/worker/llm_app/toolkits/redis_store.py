@@ -15,11 +15,43 @@ ALERT_STREAM_GROUP = os.getenv("ALERT_STREAM_GROUP", "case_mgr")
 # 對話閒置超過此時間則視為結束，觸發收尾流程
 SESSION_TIMEOUT_SECONDS = 300
 
+# 以最後活躍時間為 score 的 user_id ZSET，排程只取出已過期的成員，不再 SCAN 整個 keyspace
+SESSION_INDEX_KEY = os.getenv("SESSION_INDEX_KEY", "session:index:last_active")
+# 上線前已存在的 session:last_active:* 只需回填一次；此 key 存在代表已完成
+SESSION_INDEX_BACKFILL_KEY = f"{SESSION_INDEX_KEY}:backfilled"
+
+# session:{user_id}: 底下的所有 key；新增 session 相關 key 時需一併登記，cleanup_session_keys 依此刪除
+SESSION_KEY_SUFFIXES = ("history", "history:base", "summary:text", "summary:rounds", "state")
+
+# 提交摘要時裁切歷史 list：已摘要的回合只保留最近 HISTORY_KEEP_SUMMARIZED 輪，更早的由摘要代表
+# （收尾蒸餾讀取時以摘要補上被裁掉的部分，見 fetch_history_for_distillation）。
+# HISTORY_MAX_ROUNDS = 0 表示每次提交摘要都裁切；> 0 時 list 超過此輪數才裁切（減少 LTRIM 次數）；< 0 表示不裁切
+HISTORY_MAX_ROUNDS = int(os.getenv("HISTORY_MAX_ROUNDS", 0))
+HISTORY_KEEP_SUMMARIZED = int(os.getenv("HISTORY_KEEP_SUMMARIZED", 30))
+# 摘要超過此字數時把較舊的段落併入濃縮摘要（toolkits.summary_compaction）
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", 1500))
+# 背景摘要佇列：sorted set，member 為 user_id、score 為可被取出的時間（秒），同一使用者最多一筆；
+# 取出時把 score 推到租約到期時間（處理中，逾時未確認會再被取出），失敗時推到退避後的時間
+SUMMARY_QUEUE_KEY = os.getenv("SUMMARY_QUEUE_KEY", "summary:jobs")
+SUMMARY_ATTEMPTS_KEY = f"{SUMMARY_QUEUE_KEY}:attempts"
+
+# 歷史回合的精簡編碼欄位順序；舊資料為 JSON 物件，讀取時兩種格式皆可
+_ROUND_FIELDS = ("input", "output", "rid")
+
 @lru_cache(maxsize=1)
 def get_redis() -> redis.Redis:
     url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
     return redis.Redis.from_url(url, decode_responses=True)
 
+
+@lru_cache(maxsize=None)
+def lua_script(source: str):
+    """
+    每段 Lua 只註冊一次（SHA1 只算一次）；呼叫時以 client=r 指定連線，
+    之後一律 EVALSHA，伺服器端快取被清掉時由 redis-py 自動重新載入。
+    """
+    return get_redis().register_script(source)
+
 def start_or_refresh_session(user_id: str, line_user_id: str = None) -> None:
     """
     啟動一個新 Session 或刷新既有 Session 的過期時間。
@@ -33,15 +65,23 @@ def start_or_refresh_session(user_id: str, line_user_id: str = None) -> None:
     is_new_session = not r.exists(active_key)
 
     # 使用 pipeline 確保原子性
+    now = int(time.time())
     with r.pipeline() as pipe:
         # 1. 設置或刷新活躍標記，TTL 為 5 分鐘
         pipe.set(active_key, "1", ex=SESSION_TIMEOUT_SECONDS)
         
         # 2. 更新最後活躍時間戳 (永不過期，供排程任務掃描)
-        pipe.set(last_active_key, int(time.time()))
+        pipe.set(last_active_key, now)
+
+        # 3. 過期索引
+        pipe.zadd(SESSION_INDEX_KEY, {user_id: now})
         
         pipe.execute()
 
+    _on_session_refreshed(user_id, line_user_id, is_new_session)
+
+
+def _on_session_refreshed(user_id: str, line_user_id: Optional[str], is_new_session: bool) -> None:
     # 如果是新 Session，才更新 last_contact_ts
     if is_new_session:
         try:
@@ -65,55 +105,95 @@ def is_session_active(user_id: str) -> bool:
     return bool(r.exists(f"session:active:{user_id}"))
 
 
+def backfill_session_index() -> int:
+    """
+    把索引上線前就存在的 session:last_active:* 補進 SESSION_INDEX_KEY；每個部署只執行一次（以 SET NX 標記），
+    回傳補入筆數。之後的 session 一律由 start_or_refresh_session / commit_turn 維護索引。
+    """
+    r = get_redis()
+    if not r.set(SESSION_INDEX_BACKFILL_KEY, int(time.time()), nx=True):
+        return 0
+    added = 0
+    cursor = 0
+    while True:
+        cursor, keys = r.scan(cursor=cursor, match="session:last_active:*", count=500)
+        if keys:
+            scores = {}
+            for key, value in zip(keys, r.mget(keys)):
+                try:
+                    scores[key.split(":", 2)[2]] = int(value)
+                except (IndexError, TypeError, ValueError):
+                    print(f"⚠️ 無法處理 Redis key: {key}")
+            if scores:
+                # NX：不覆蓋回填期間已由新請求寫入的較新時間
+                added += r.zadd(SESSION_INDEX_KEY, scores, nx=True)
+        if cursor == 0:
+            break
+    if added:
+        print(f"🗂️ [Session 索引] 已回填 {added} 個既有 session")
+    return added
+
+
 def get_expired_sessions(timeout_seconds: int = SESSION_TIMEOUT_SECONDS) -> List[str]:
     """
-    排程任務將呼叫此函式，掃描所有使用者的最後活躍時間，找出已過期的 Session。
+    排程任務將呼叫此函式，從過期索引取出最後活躍時間早於 timeout 的使用者。
+    成本與過期的 session 數成正比，與曾經出現過的 session 總數無關。
     """
     r = get_redis()
-    # 使用 SCAN 避免在大量用戶時阻塞 Redis
-    cursor = '0'
-    expired_users = []
-    now = int(time.time())
-    
-    while cursor != 0:
-        cursor, keys = r.scan(cursor=cursor, match="session:last_active:*", count=100)
-        if not keys:
-            continue
-        
-        last_active_times = r.mget(keys)
-        for i, key in enumerate(keys):
-            try:
-                # 從 "session:last_active:USER_ID" 中提取 USER_ID
-                user_id = key.split(':')[-1]
-                last_active_time = last_active_times[i]
-                if last_active_time and (now - int(last_active_time) > timeout_seconds):
-                    # 檢查 active key 是否也真的消失了，雙重確認
-                    if not is_session_active(user_id):
-                        expired_users.append(user_id)
-            except (IndexError, ValueError, AttributeError):
-                # 處理潛在的鍵格式錯誤或類型錯誤
-                print(f"⚠️ 無法處理 Redis key: {key}")
-                continue
-    return expired_users
+    backfill_session_index()
+    cutoff = int(time.time()) - timeout_seconds
+    # score 為最後活躍時間；「早於 cutoff」與舊版的 now - last_active > timeout 相同
+    candidates = r.zrangebyscore(SESSION_INDEX_KEY, "-inf", f"({cutoff}")
+    if not candidates:
+        return []
+    # 檢查 active key 是否也真的消失了，雙重確認
+    with r.pipeline(transaction=False) as pipe:
+        for user_id in candidates:
+            pipe.exists(f"session:active:{user_id}")
+        active = pipe.execute()
+    return [user_id for user_id, alive in zip(candidates, active) if not alive]
+
+
+def session_keys(user_id: str) -> List[str]:
+    """一個使用者 session 的所有 key 名稱（不含音檔與去重用的短期 key，它們各自有 TTL）。"""
+    return [f"session:{user_id}:{suffix}" for suffix in SESSION_KEY_SUFFIXES] + [
+        f"session:active:{user_id}",
+        f"session:last_active:{user_id}",
+    ]
+
 
 def cleanup_session_keys(user_id: str) -> None:
-    """在 finalize_session 後，清除所有 session 相關的 key"""
+    """在 finalize_session 後，清除所有 session 相關的 key 並移出過期索引"""
     r = get_redis()
-    # 使用 scan 找到所有相關 key，避免硬編碼
-    keys_to_delete = []
-    for key in r.scan_iter(match=f"session:{user_id}:*"):
-        keys_to_delete.append(key)
-    for key in r.scan_iter(match=f"session:active:{user_id}"):
-        keys_to_delete.append(key)
-    for key in r.scan_iter(match=f"session:last_active:{user_id}"):
-        keys_to_delete.append(key)
-
-    if keys_to_delete:
-        r.delete(*keys_to_delete)
+    with r.pipeline() as pipe:
+        pipe.delete(*session_keys(user_id))
+        pipe.zrem(SESSION_INDEX_KEY, user_id)
+        deleted, _ = pipe.execute()
+    if deleted:
         print(f"🧹 user {user_id} 的所有 session keys 已清除。")
 
 
 
+def encode_round(round_obj: Dict) -> str:
+    """歷史回合的精簡編碼：["input","output","rid"(,其他欄位)]，省去每輪重複的欄位名稱與空白。"""
+    row: List[object] = [round_obj.get(f, "") for f in _ROUND_FIELDS]
+    extra = {k: v for k, v in round_obj.items() if k not in _ROUND_FIELDS}
+    if extra:
+        row.append(extra)
+    return json.dumps(row, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode_round(raw: str) -> Dict:
+    """讀取歷史回合；相容舊的 JSON 物件格式。"""
+    data = json.loads(raw)
+    if isinstance(data, dict):
+        return data
+    out = dict(zip(_ROUND_FIELDS, data))
+    if len(data) > len(_ROUND_FIELDS) and isinstance(data[-1], dict):
+        out.update(data[-1])
+    return out
+
+
 def try_register_request(user_id: str, request_id: str) -> bool:
     r = get_redis()
     key = f"processed:{user_id}:{request_id}"
@@ -130,7 +210,7 @@ def make_request_id(user_id: str, text: str, now_ms: Optional[int] = None) -> st
 def append_round(user_id: str, round_obj: Dict, line_user_id: str = None) -> None:
     r = get_redis()
     key = f"session:{user_id}:history"
-    r.rpush(key, json.dumps(round_obj, ensure_ascii=False))
+    r.rpush(key, encode_round(round_obj))
     start_or_refresh_session(user_id, line_user_id=line_user_id)
 
 # 主動關懷專用函式
@@ -138,24 +218,188 @@ def append_proactive_round(user_id: str, round_obj: Dict) -> None:
     """專門用於寫入主動關懷訊息，但不重置閒置計時器。"""
     r = get_redis()
     key = f"session:{user_id}:history"
-    r.rpush(key, json.dumps(round_obj, ensure_ascii=False))
+    r.rpush(key, encode_round(round_obj))
+
+
+# ---- 每輪對話的合併往返（Lua，單一 Redis 內原子執行）----
+# 開始：取得音檔鎖並取出緩衝的語音片段；鎖被占用時改回傳已完成的結果
+_BEGIN_TURN_LUA = """
+if redis.call('SET', KEYS[1], '1', 'NX', 'EX', ARGV[1]) then
+  local parts = redis.call('LRANGE', KEYS[2], 0, -1)
+  redis.call('DEL', KEYS[2])
+  return {1, parts}
+end
+return {0, redis.call('GET', KEYS[3]) or ''}
+"""
+
+# 結束：寫入結果快取 → 去重登記 → 落歷史 → 刷新 session → 取下一段待摘要的回合（或排入摘要佇列）→ 釋放音檔鎖
+# KEYS: processed, history, active, last_active, summary:rounds, session index, history:base,
+#       summary queue, [audio result], [audio lock]
+# ARGV: round_json, processed_ttl, session_ttl, now, chunk_size, reply, result_ttl, has_result, has_lock, user_id, enqueue
+# 游標（summary:rounds）為已摘要的總輪數；list 開頭已被裁掉 history:base 輪，故 list 索引 = 游標 - base
+_COMMIT_TURN_LUA = """
+local i = 9
+if ARGV[8] == '1' then
+  redis.call('SET', KEYS[i], ARGV[6], 'EX', ARGV[7])
+  i = i + 1
+end
+local lock = nil
+if ARGV[9] == '1' then lock = KEYS[i] end
+if not redis.call('SET', KEYS[1], '1', 'NX', 'EX', ARGV[2]) then
+  if lock then redis.call('DEL', lock) end
+  return {0}
+end
+redis.call('RPUSH', KEYS[2], ARGV[1])
+local is_new = redis.call('EXISTS', KEYS[3]) == 0 and 1 or 0
+redis.call('SET', KEYS[3], '1', 'EX', ARGV[3])
+redis.call('SET', KEYS[4], ARGV[4])
+redis.call('ZADD', KEYS[6], ARGV[4], ARGV[10])
+local n = tonumber(ARGV[5])
+local cursor = tonumber(redis.call('GET', KEYS[5]) or '0')
+local offset = cursor - tonumber(redis.call('GET', KEYS[7]) or '0')
+local chunk = {}
+if n > 0 and redis.call('LLEN', KEYS[2]) - offset >= n then
+  if ARGV[11] == '1' then
+    redis.call('ZADD', KEYS[8], 'NX', ARGV[4], ARGV[10])
+  else
+    chunk = redis.call('LRANGE', KEYS[2], offset, offset + n - 1)
+  end
+else
+  cursor = -1
+end
+if lock then redis.call('DEL', lock) end
+return {1, is_new, cursor, chunk}
+"""
+
+
+def begin_audio_turn(user_id: str, audio_id: str, lock_id: str, ttl_sec: int = 60) -> Tuple[bool, str]:
+    """
+    一次往返完成 acquire_audio_lock + read_and_clear_audio_segments。
+    回傳 (是否取得鎖, 文字)：取得鎖時文字為合併後的緩衝片段，否則為已完成的結果（可能為空）。
+    Redis 故障時視同未取得鎖。
+    """
+    r = get_redis()
+    keys = [f"lock:audio:{lock_id}", f"audio:{user_id}:{audio_id}:buf", f"audio:{user_id}:{audio_id}:result"]
+    try:
+        acquired, payload = lua_script(_BEGIN_TURN_LUA)(keys=keys, args=[ttl_sec], client=r)
+    except Exception as e:
+        print(f"⚠️ [Redis] 取得音檔鎖失敗 {lock_id}: {e}")
+        return False, ""
+    if not int(acquired):
+        return False, payload or ""
+    return True, " ".join(p.strip() for p in payload or [] if p)
+
+
+def commit_turn(
+    user_id: str,
+    round_obj: Dict,
+    line_user_id: str = None,
+    chunk_size: int = 0,
+    audio_id: Optional[str] = None,
+    reply: Optional[str] = None,
+    lock_id: Optional[str] = None,
+    result_ttl_sec: int = 86400,
+    enqueue_summary: bool = False,
+) -> Tuple[bool, Optional[int], List[Dict]]:
+    """
+    一次往返完成一輪的收尾：set_audio_result + try_register_request + append_round
+    （含 start_or_refresh_session）+ peek_next_n + release_audio_lock，以 Lua 原子執行。
+    round_obj 須含 rid；重複的 rid 不落歷史但仍寫入結果並釋放鎖。
+    enqueue_summary=True 時，湊滿一段就把使用者排入背景摘要佇列（見 summary_queue），不回傳 chunk 內容。
+    回傳 (是否為新登記的請求, 待摘要段落起點或 None, 待摘要的 chunk_size 輪)。
+    """
+    r = get_redis()
+    keys = [
+        f"processed:{user_id}:{round_obj['rid']}",
+        f"session:{user_id}:history",
+        f"session:active:{user_id}",
+        f"session:last_active:{user_id}",
+        f"session:{user_id}:summary:rounds",
+        SESSION_INDEX_KEY,
+        f"session:{user_id}:history:base",
+        SUMMARY_QUEUE_KEY,
+    ]
+    if audio_id:
+        keys.append(f"audio:{user_id}:{audio_id}:result")
+    if lock_id:
+        keys.append(f"lock:audio:{lock_id}")
+    args = [
+        encode_round(round_obj),
+        SESSION_TIMEOUT_SECONDS * 2,
+        SESSION_TIMEOUT_SECONDS,
+        int(time.time()),
+        int(chunk_size),
+        reply or "",
+        result_ttl_sec,
+        "1" if audio_id else "0",
+        "1" if lock_id else "0",
+        user_id,
+        "1" if enqueue_summary else "0",
+    ]
+    res = lua_script(_COMMIT_TURN_LUA)(keys=keys, args=args, client=r)
+    if not int(res[0]):
+        return False, None, []
+    _on_session_refreshed(user_id, line_user_id, bool(int(res[1])))
+    cursor = int(res[2])
+    if cursor < 0:
+        return True, None, []
+    return True, cursor, [decode_round(x) for x in res[3]]
 
 
 def history_len(user_id: str) -> int:
     return get_redis().llen(f"session:{user_id}:history")
 
 
+def _summary_offset(r, user_id: str) -> Tuple[int, int]:
+    """回傳 (游標, 游標在 list 中的索引)；游標為已摘要的總輪數，list 開頭可能已被裁切。"""
+    cursor, base = r.mget(f"session:{user_id}:summary:rounds", f"session:{user_id}:history:base")
+    cursor = int(cursor or 0)
+    return cursor, cursor - int(base or 0)
+
+
 def fetch_unsummarized_tail(user_id: str, k: int = 6) -> List[Dict]:
     r = get_redis()
-    cursor = int(r.get(f"session:{user_id}:summary:rounds") or 0)
-    items = r.lrange(f"session:{user_id}:history", cursor, -1)
-    return [json.loads(x) for x in items[-k:]]
+    _, offset = _summary_offset(r, user_id)
+    items = r.lrange(f"session:{user_id}:history", offset, -1)
+    return [decode_round(x) for x in items[-k:]]
 
 
 def fetch_all_history(user_id: str) -> List[Dict]:
+    """目前保留的所有回合（較早的已摘要回合可能已裁切）。"""
     r = get_redis()
     items = r.lrange(f"session:{user_id}:history", 0, -1)
-    return [json.loads(x) for x in items]
+    return [decode_round(x) for x in items]
+
+
+def fetch_history_for_distillation(user_id: str) -> Tuple[str, int, List[Dict]]:
+    """
+    一次往返取回收尾蒸餾用的 (摘要, 已裁切的輪數, 保留的回合)。
+    已裁切的輪數為 0 時保留的回合就是整個 session；大於 0 時前面那幾輪只剩摘要可用。
+    """
+    with get_redis().pipeline(transaction=False) as pipe:
+        pipe.mget(f"session:{user_id}:summary:text", f"session:{user_id}:history:base")
+        pipe.lrange(f"session:{user_id}:history", 0, -1)
+        (summary, base), items = pipe.execute()
+    return summary or "", int(base or 0), [decode_round(x) for x in items]
+
+
+def fetch_history_tail(user_id: str, k: int = 6) -> List[Dict]:
+    """只取最後 k 輪（LRANGE 負索引），傳輸量與 session 長度無關。"""
+    if k <= 0:
+        return []
+    items = get_redis().lrange(f"session:{user_id}:history", -k, -1)
+    return [decode_round(x) for x in items]
+
+
+def fetch_session_context(user_id: str, k: int = 6) -> Tuple[str, List[Dict]]:
+    """一次往返取回 (歷史摘要, 最後 k 輪)，供組 prompt 使用。"""
+    if k <= 0:
+        return get_redis().get(f"session:{user_id}:summary:text") or "", []
+    with get_redis().pipeline(transaction=False) as pipe:
+        pipe.get(f"session:{user_id}:summary:text")
+        pipe.lrange(f"session:{user_id}:history", -k, -1)
+        summary, items = pipe.execute()
+    return summary or "", [decode_round(x) for x in items]
 
 
 def get_summary(user_id: str) -> Tuple[str, int]:
@@ -167,46 +411,159 @@ def get_summary(user_id: str) -> Tuple[str, int]:
 
 def peek_next_n(user_id: str, n: int) -> Tuple[Optional[int], List[Dict]]:
     r = get_redis()
-    cursor = int(r.get(f"session:{user_id}:summary:rounds") or 0)
+    cursor, offset = _summary_offset(r, user_id)
     total = r.llen(f"session:{user_id}:history")
-    if (total - cursor) < n:
+    if (total - offset) < n:
         return None, []
-    items = r.lrange(f"session:{user_id}:history", cursor, cursor + n - 1)
-    return cursor, [json.loads(x) for x in items]
+    items = r.lrange(f"session:{user_id}:history", offset, offset + n - 1)
+    return cursor, [decode_round(x) for x in items]
 
 
 def peek_remaining(user_id: str) -> Tuple[int, List[Dict]]:
     r = get_redis()
-    cursor = int(r.get(f"session:{user_id}:summary:rounds") or 0)
+    cursor, offset = _summary_offset(r, user_id)
     total = r.llen(f"session:{user_id}:history")
-    if total <= cursor:
+    if total <= offset:
         return cursor, []
-    items = r.lrange(f"session:{user_id}:history", cursor, total - 1)
-    return cursor, [json.loads(x) for x in items]
+    items = r.lrange(f"session:{user_id}:history", offset, total - 1)
+    return cursor, [decode_round(x) for x in items]
 
 
 def commit_summary_chunk(user_id: str, expected_cursor: int, advance: int, add_text: str) -> bool:
+    """
+    CAS 提交一段摘要並推進游標；同一交易內把最近 HISTORY_KEEP_SUMMARIZED 輪以前的已摘要回合 LTRIM 掉
+    （HISTORY_MAX_ROUNDS > 0 時 list 超過此輪數才裁切）。
+    游標只增不減（裁切只改 history:base），過期的提交一定會因游標不符而失敗。
+    """
     r = get_redis()
     ckey = f"session:{user_id}:summary:rounds"
     tkey = f"session:{user_id}:summary:text"
+    bkey = f"session:{user_id}:history:base"
+    hkey = f"session:{user_id}:history"
     with r.pipeline() as p:
         while True:
             try:
-                p.watch(ckey, tkey)
+                p.watch(ckey, tkey, bkey)
                 cur = int(p.get(ckey) or 0)
                 if cur != expected_cursor:
                     p.unwatch()
                     return False
                 old = p.get(tkey) or ""
+                base = int(p.get(bkey) or 0)
                 new = (old + ("\n\n" if old else "") + (add_text or "").strip()) if add_text else old
+                new_cursor = cur + int(advance)
+                new_base = base
+                if HISTORY_KEEP_SUMMARIZED >= 0 and 0 <= HISTORY_MAX_ROUNDS < p.llen(hkey):
+                    new_base = max(base, new_cursor - HISTORY_KEEP_SUMMARIZED)
                 p.multi()
                 p.set(tkey, new)
-                p.set(ckey, cur + int(advance))
+                p.set(ckey, new_cursor)
+                if new_base > base:
+                    # 只裁 list 開頭；並行的 RPUSH 寫在尾端，不受影響
+                    p.ltrim(hkey, new_base - base, -1)
+                    p.set(bkey, new_base)
                 p.execute()
                 return True
             except redis.WatchError:
                 return False
 
+
+def replace_summary(user_id: str, expected_text: str, new_text: str) -> bool:
+    """摘要重新濃縮後的 CAS 替換；期間有新的摘要段落提交時放棄（下次再濃縮）。"""
+    r = get_redis()
+    tkey = f"session:{user_id}:summary:text"
+    with r.pipeline() as p:
+        try:
+            p.watch(tkey)
+            if (p.get(tkey) or "") != expected_text:
+                p.unwatch()
+                return False
+            p.multi()
+            p.set(tkey, new_text)
+            p.execute()
+            return True
+        except redis.WatchError:
+            return False
+
+# ---- 背景摘要佇列 ----
+# 取出一筆到期的工作並租用（KEYS[1]=queue；ARGV=[now, lease_sec]）
+_POP_SUMMARY_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1)
+if #due == 0 then return false end
+redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[2]), due[1])
+return due[1]
+"""
+
+# 失敗重排：第 n 次失敗延後 min(base * 2^(n-1), max) 秒（KEYS=[queue, attempts]；ARGV=[user_id, now, base, max]）
+_RETRY_SUMMARY_LUA = """
+local n = redis.call('HINCRBY', KEYS[2], ARGV[1], 1)
+local delay = math.min(tonumber(ARGV[3]) * 2 ^ (n - 1), tonumber(ARGV[4]))
+redis.call('ZADD', KEYS[1], tonumber(ARGV[2]) + delay, ARGV[1])
+return tostring(delay)
+"""
+
+# 只有持有者（token 相同）才能釋放，避免鎖逾時後刪掉別人的鎖
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+
+def enqueue_summary(user_id: str) -> bool:
+    """把使用者排入摘要佇列；已在佇列中（等待、處理中或退避中）時不重複排入。回傳是否新排入。"""
+    return bool(get_redis().zadd(SUMMARY_QUEUE_KEY, {user_id: time.time()}, nx=True))
+
+
+def pop_summary_job(timeout_sec: float = 5, lease_sec: int = 300, poll_sec: float = 0.5) -> Optional[str]:
+    """
+    取出下一個到期的使用者，最多等待 timeout_sec 秒（每 poll_sec 秒輪詢一次）。
+    取出與租用在同一個 Lua 內完成：工作留在佇列中、lease_sec 秒內不會再被取出；
+    處理完以 ack_summary_job 移除，持有者當掉時租約到期後由其他執行緒重新取出。
+    """
+    r = get_redis()
+    deadline = time.monotonic() + timeout_sec
+    while True:
+        user_id = lua_script(_POP_SUMMARY_LUA)(keys=[SUMMARY_QUEUE_KEY], args=[time.time(), lease_sec], client=r)
+        if user_id:
+            return user_id
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        time.sleep(min(poll_sec, remaining))
+
+
+def ack_summary_job(user_id: str) -> None:
+    """處理完成：移出佇列並清除失敗次數。"""
+    with get_redis().pipeline() as pipe:
+        pipe.zrem(SUMMARY_QUEUE_KEY, user_id)
+        pipe.hdel(SUMMARY_ATTEMPTS_KEY, user_id)
+        pipe.execute()
+
+
+def retry_summary_job(user_id: str, base_sec: float, max_sec: float) -> float:
+    """處理失敗：依連續失敗次數指數退避後再排入，回傳延後的秒數。"""
+    delay = lua_script(_RETRY_SUMMARY_LUA)(
+        keys=[SUMMARY_QUEUE_KEY, SUMMARY_ATTEMPTS_KEY], args=[user_id, time.time(), base_sec, max_sec], client=get_redis()
+    )
+    return float(delay)
+
+
+def summary_queue_depth() -> int:
+    """已到期、等待取出的工作數（不含處理中與退避中的）。"""
+    return get_redis().zcount(SUMMARY_QUEUE_KEY, "-inf", time.time())
+
+
+def acquire_summary_lock(user_id: str, token: str, ttl_sec: int) -> bool:
+    return bool(get_redis().set(f"lock:summary:{user_id}", token, nx=True, ex=ttl_sec))
+
+
+def release_summary_lock(user_id: str, token: str) -> None:
+    try:
+        lua_script(_RELEASE_LOCK_LUA)(keys=[f"lock:summary:{user_id}"], args=[token], client=get_redis())
+    except Exception as e:
+        print(f"⚠️ [Redis] 釋放摘要鎖失敗 {user_id}: {e}")
+
+
 def set_state_if(user_id: str, expect: str, to: str) -> bool:
     r = get_redis()
     key = f"session:{user_id}:state"
@@ -292,3 +649,35 @@ def release_audio_lock(lock_id: str) -> None:
     except Exception:
         pass
 
+
+
+# ---- Task checkpoints（RabbitMQ 重送時從最後完成的階段續跑）----
+TASK_CHECKPOINT_TTL_SEC = int(os.getenv("TASK_CHECKPOINT_TTL_SEC", 86400))
+
+
+def load_task_checkpoints(task_id: str) -> Dict[str, object]:
+    """讀取任務已完成階段的輸出；Redis 故障時回傳空 dict（等同從頭執行）。"""
+    try:
+        raw = get_redis().hgetall(f"task:{task_id}:stages")
+    except Exception as e:
+        print(f"⚠️ [Task Checkpoint] 讀取 {task_id} 檢查點失敗: {e}")
+        return {}
+    out: Dict[str, object] = {}
+    for stage, value in raw.items():
+        try:
+            out[stage] = json.loads(value)
+        except (TypeError, ValueError):
+            continue
+    return out
+
+
+def save_task_checkpoint(task_id: str, stage: str, output: object) -> None:
+    """記錄某階段的輸出；寫入失敗只影響重送時能否續跑，不中斷主流程。"""
+    key = f"task:{task_id}:stages"
+    try:
+        with get_redis().pipeline() as p:
+            p.hset(key, stage, json.dumps(output, ensure_ascii=False))
+            p.expire(key, TASK_CHECKPOINT_TTL_SEC)
+            p.execute()
+    except Exception as e:
+        print(f"⚠️ [Task Checkpoint] 寫入 {task_id}:{stage} 失敗: {e}")
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+串流回覆的斷句器
+
+LLM 串流回來的 token 片段先累積在緩衝區，湊滿一個句子（遇到句末標點）才往外送，
+讓前端一句一句地收到回覆，而不是一個字一個字地閃動。
+"""
+
+import os
+from typing import Callable
+
+# 句末標點（連續的標點會併入同一句，例如「！！」「…」）
+SENTENCE_END = "。！？!?；;\n…～~"
+# 過短的句子（「嗯。」）併入下一句再送出
+STREAM_CHUNK_MIN_CHARS = int(os.getenv("STREAM_CHUNK_MIN_CHARS", 4))
+
+
+class SentenceChunker:
+    """feed() 接收 token 片段、每湊滿一句就呼叫 emit(句子)；flush() 送出剩餘文字。"""
+
+    def __init__(self, emit: Callable[[str], None], min_chars: int = STREAM_CHUNK_MIN_CHARS):
+        self._emit = emit
+        self._buf = ""
+        self.min_chars = min_chars
+        self.chunks = 0
+
+    def feed(self, delta: str) -> None:
+        self._buf += delta or ""
+        while True:
+            end = self._sentence_end()
+            if end < 0:
+                return
+            sentence, self._buf = self._buf[:end], self._buf[end:]
+            self._send(sentence)
+
+    def flush(self) -> None:
+        rest, self._buf = self._buf, ""
+        self._send(rest)
+
+    def _sentence_end(self) -> int:
+        for i, ch in enumerate(self._buf):
+            if ch in SENTENCE_END and len(self._buf[: i + 1].strip()) >= self.min_chars:
+                end = i + 1
+                while end < len(self._buf) and self._buf[end] in SENTENCE_END:
+                    end += 1
+                return end
+        return -1
+
+    def _send(self, text: str) -> None:
+        text = text.strip()
+        if text:
+            self.chunks += 1
+            self._emit(text)
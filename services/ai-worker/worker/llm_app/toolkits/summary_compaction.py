@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Session 摘要的分層濃縮
+
+摘要（session:{uid}:summary:text）由兩層組成，依時間由舊到新：
+- 濃縮摘要（digest）：「--- 第1至N輪對話摘要（已濃縮）---」，字數上限 SUMMARY_DIGEST_MAX_CHARS
+- 段落摘要：每 SUMMARY_CHUNK_SIZE 輪一段「--- 第a至b輪對話摘要 ---」，逐段附加
+
+摘要總字數超過 SUMMARY_MAX_CHARS，或段落摘要累積超過 SUMMARY_COMPACT_TRIGGER_CHUNKS 段時，
+把舊的濃縮摘要與較舊的段落合併成新的濃縮摘要，最近 SUMMARY_KEEP_RECENT_CHUNKS 段保持原文。
+濃縮由背景摘要佇列在每次排空後觸發（見 summary_queue.drain_user），以 CAS 替換；
+期間有新段落提交時放棄，下次排空再試。
+
+每次濃縮記錄該 session 摘要在 prompt 中的 token 數（前／後）。
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from observability.metrics import registry, stage_timer
+
+from .prompt_budget import count_tokens
+from .redis_store import SUMMARY_MAX_CHARS, get_summary, replace_summary
+
+SUMMARY_KEEP_RECENT_CHUNKS = int(os.getenv("SUMMARY_KEEP_RECENT_CHUNKS", 3))
+SUMMARY_COMPACT_TRIGGER_CHUNKS = int(os.getenv("SUMMARY_COMPACT_TRIGGER_CHUNKS", 8))
+SUMMARY_DIGEST_MAX_CHARS = int(os.getenv("SUMMARY_DIGEST_MAX_CHARS", SUMMARY_MAX_CHARS // 2))
+
+_HEADER = re.compile(r"^--- 第(\d+)至(\d+)輪對話摘要(（已濃縮）)?\s*---")
+
+_TOKEN_BUCKETS = (50.0, 100.0, 200.0, 300.0, 400.0, 600.0, 800.0, 1200.0, 1600.0, 2400.0, 3200.0)
+registry.describe(
+    "ai_worker_summary_tokens", "histogram", "每次濃縮前後的 session 摘要 token 數（phase=before / after）", _TOKEN_BUCKETS
+)
+registry.describe("ai_worker_summary_compactions_total", "counter", "摘要濃縮次數（result=compacted / fallback / conflict / failed）")
+
+# (較舊的摘要文字, 字數上限) → 濃縮後的本文
+Condenser = Callable[[str, int], str]
+
+
+@dataclass(frozen=True)
+class SummaryBlock:
+    text: str
+    start: Optional[int] = None  # 無標題的舊資料為 None
+    end: Optional[int] = None
+    digest: bool = False
+
+
+def split_blocks(text: str) -> List[SummaryBlock]:
+    """依「--- 第a至b輪」標題切段（由舊到新）；開頭沒有標題的文字視為舊的濃縮內容。"""
+    if not text.strip():
+        return []
+    parts = text.split("\n\n--- ")
+    parts = [parts[0]] + ["--- " + p for p in parts[1:]]
+    blocks = []
+    for part in parts:
+        m = _HEADER.match(part)
+        if m:
+            blocks.append(SummaryBlock(part, int(m.group(1)), int(m.group(2)), bool(m.group(3))))
+        else:
+            blocks.append(SummaryBlock(part, digest=True))
+    return blocks
+
+
+def digest_header(end: int) -> str:
+    return f"--- 第1至{end}輪對話摘要（已濃縮）---\n"
+
+
+def plan_compaction(text: str) -> Optional[Tuple[List[SummaryBlock], List[SummaryBlock]]]:
+    """
+    回傳 (要併入濃縮摘要的舊段落, 保持原文的近期段落)；未達門檻或沒有可併入的段落時回傳 None。
+    近期段落本身就超過 SUMMARY_MAX_CHARS 時，只保留最新一段原文。
+    """
+    blocks = split_blocks(text)
+    chunks = [b for b in blocks if not b.digest]
+    if len(text) <= SUMMARY_MAX_CHARS and len(chunks) <= SUMMARY_COMPACT_TRIGGER_CHUNKS:
+        return None
+    keep = max(1, SUMMARY_KEEP_RECENT_CHUNKS)
+    if sum(len(b.text) + 2 for b in blocks[-keep:]) > SUMMARY_MAX_CHARS:
+        keep = 1
+    older, recent = blocks[:-keep], blocks[-keep:]
+    if not any(not b.digest for b in older):
+        # 只剩濃縮摘要可併（它本身已有上限），不重複濃縮
+        return None
+    return older, recent
+
+
+def _keep_recent_blocks(text: str, max_chars: int) -> str:
+    """只保留最近的摘要段落直到 max_chars；最後一段本身過長時保留結尾。"""
+    kept: List[str] = []
+    size = 0
+    for block in reversed(split_blocks(text)):
+        if kept and size + len(block.text) + 2 > max_chars:
+            break
+        kept.append(block.text)
+        size += len(block.text) + 2
+    out = "\n\n".join(reversed(kept))
+    return out if len(out) <= max_chars else out[-max_chars:]
+
+
+def _default_condenser() -> Condenser:
+    # tools 會載入 CrewAI，延後到第一次濃縮才匯入
+    from .tools import condense_summaries
+
+    return condense_summaries
+
+
+def compact_summary(user_id: str, condense: Optional[Condenser] = None) -> Optional[Dict]:
+    """
+    視門檻把較舊的段落併入濃縮摘要並 CAS 替換；未達門檻時回傳 None。
+    回傳 {"result", "tokens_before", "tokens_after", "chars_before", "chars_after", "digest_end"}。
+    LLM 失敗且摘要已超過兩倍上限時，退而只保留最近的段落，確保大小有上限。
+    """
+    text, _ = get_summary(user_id)
+    plan = plan_compaction(text)
+    if plan is None:
+        return None
+    older, recent = plan
+    digest_end = max(b.end for b in older if b.end is not None)
+    try:
+        with stage_timer("summary_compaction"):
+            body = (condense or _default_condenser())("\n\n".join(b.text for b in older), SUMMARY_DIGEST_MAX_CHARS).strip()
+        if not body:
+            raise ValueError("濃縮結果為空")
+        if len(body) > SUMMARY_DIGEST_MAX_CHARS:
+            body = body[: SUMMARY_DIGEST_MAX_CHARS - 1] + "…"
+        new = "\n\n".join([digest_header(digest_end) + body] + [b.text for b in recent])
+        result = "compacted"
+    except Exception as e:
+        print(f"[摘要濃縮錯誤] {e}")
+        if len(text) <= SUMMARY_MAX_CHARS * 2:
+            registry.inc("ai_worker_summary_compactions_total", {"result": "failed"})
+            return {"result": "failed"}
+        new = _keep_recent_blocks(text, SUMMARY_MAX_CHARS)
+        result = "fallback"
+    if not replace_summary(user_id, text, new):
+        registry.inc("ai_worker_summary_compactions_total", {"result": "conflict"})
+        return {"result": "conflict"}
+
+    report = {
+        "result": result,
+        "tokens_before": count_tokens(text),
+        "tokens_after": count_tokens(new),
+        "chars_before": len(text),
+        "chars_after": len(new),
+        "digest_end": digest_end,
+    }
+    registry.inc("ai_worker_summary_compactions_total", {"result": result})
+    registry.observe("ai_worker_summary_tokens", report["tokens_before"], {"phase": "before"})
+    registry.observe("ai_worker_summary_tokens", report["tokens_after"], {"phase": "after"})
+    print(
+        f"🗜️ [Summary] user={user_id} 摘要濃縮（{result}）：tokens {report['tokens_before']} → {report['tokens_after']}，"
+        f"字數 {report['chars_before']} → {report['chars_after']}，濃縮至第 {digest_end} 輪、保留 {len(recent)} 段原文"
+    )
+    return report
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+背景摘要佇列
+
+每湊滿 SUMMARY_CHUNK_SIZE 輪，commit_turn 在同一個 Lua 內把 user_id 排入 Redis sorted set（SUMMARY_QUEUE_KEY，
+score 為可取出的時間），主回覆不再等待摘要的 LLM 呼叫；由本模組的背景執行緒取出並摘要。
+
+一致性沿用原本的游標語意：
+- 摘要仍經 summarize_chunk_and_commit → commit_summary_chunk（CAS 游標），重複或過期的提交一定失敗
+- 同一使用者在佇列中最多一筆（ZADD NX）；取出時以 Lua 原子地租用（score 推到 SUMMARY_LOCK_TTL_SEC 之後），
+  處理完才移除。執行緒在取出後當掉，租約到期時工作會再被取出；處理中排入的新回合不會重複排入
+- 處理時持有每位使用者的摘要鎖（lock:summary:{uid}），一次只摘要一段、依序推進到沒有完整段落為止
+- 摘要進行中又湊滿新段落：排入的工作若被其他執行緒取走但拿不到鎖，直接確認移除；
+  持鎖者釋放鎖、確認自己的工作後會再檢查一次，仍有完整段落就重新排入
+- LLM 失敗時不丟棄，依連續失敗次數指數退避（SUMMARY_RETRY_BASE_SEC 起、最多 SUMMARY_RETRY_MAX_SEC）後再取出；
+  退避期間新回合不會提早排入
+- 只有 Redis 本身遺失資料時工作才會遺失；此時下一輪對話只要還有完整段落，commit_turn 就會重新排入，
+  session 收尾（finalize_session）也會同步摘要剩餘回合
+
+每次排空後視門檻把較舊的段落併入濃縮摘要（summary_compaction.compact_summary），同樣在摘要鎖內執行。
+
+SUMMARY_ASYNC=false 時回到在回覆流程內同步摘要（chat_pipeline.log_session）。
+session 收尾（finalize_session）仍同步摘要剩餘回合，與背景工作之間由 CAS 游標保證不重複。
+"""
+
+import os
+import threading
+import uuid
+from typing import Callable, List, Optional
+
+from observability.metrics import registry
+
+from .redis_store import (
+    ack_summary_job,
+    acquire_summary_lock,
+    enqueue_summary,
+    peek_next_n,
+    pop_summary_job,
+    release_summary_lock,
+    retry_summary_job,
+    summary_queue_depth,
+)
+from .summary_compaction import Condenser, compact_summary
+from .task_context import task_context
+
+SUMMARY_CHUNK_SIZE = int(os.getenv("SUMMARY_CHUNK_SIZE", 5))
+SUMMARY_ASYNC = os.getenv("SUMMARY_ASYNC", "true").lower() in ("1", "true", "yes")
+SUMMARY_WORKERS = int(os.getenv("SUMMARY_WORKERS", 1))
+# 鎖的存活時間需涵蓋一次排空（數段摘要 + 濃縮）；持有者當掉時逾時自動釋放
+SUMMARY_LOCK_TTL_SEC = int(os.getenv("SUMMARY_LOCK_TTL_SEC", 300))
+# 單次排空最多處理的段數，避免長期堆積的使用者一直占住執行緒
+SUMMARY_MAX_CHUNKS_PER_JOB = int(os.getenv("SUMMARY_MAX_CHUNKS_PER_JOB", 10))
+# LLM 失敗後的退避：第 n 次連續失敗延後 min(BASE * 2^(n-1), MAX) 秒再處理
+SUMMARY_RETRY_BASE_SEC = float(os.getenv("SUMMARY_RETRY_BASE_SEC", 30))
+SUMMARY_RETRY_MAX_SEC = float(os.getenv("SUMMARY_RETRY_MAX_SEC", 900))
+
+registry.describe("ai_worker_summary_jobs_total", "counter", "背景摘要工作數（result=done / busy / failed / error）")
+registry.describe("ai_worker_summary_chunks_total", "counter", "背景摘要提交的段數（result=committed / rejected）")
+registry.describe("ai_worker_summary_queue_depth", "gauge", "摘要佇列中等待處理的使用者數")
+
+Summarizer = Callable[[str, int, list], bool]
+
+
+def _default_summarizer() -> Summarizer:
+    # tools 會載入 CrewAI，延後到第一個工作才匯入
+    from .tools import summarize_chunk_and_commit
+
+    return lambda user_id, start, chunk: summarize_chunk_and_commit(user_id, start_round=start, history_chunk=chunk)
+
+
+def drain_user(
+    user_id: str,
+    summarize: Optional[Summarizer] = None,
+    chunk_size: int = SUMMARY_CHUNK_SIZE,
+    condense: Optional[Condenser] = None,
+) -> str:
+    """
+    持鎖摘要該使用者所有完整的待摘要段落，有新段落時再視門檻濃縮；回傳結果（done / busy / failed）。
+    拿不到鎖表示另一個執行緒正在處理，確認移除這筆工作，交由持鎖者在釋放鎖後補排。
+    失敗時依退避時間重新排入；其餘情況確認移除後，仍有完整段落就重新排入。
+    """
+    token = uuid.uuid4().hex
+    if not acquire_summary_lock(user_id, token, SUMMARY_LOCK_TTL_SEC):
+        ack_summary_job(user_id)
+        return "busy"
+    summarize = summarize or _default_summarizer()
+    result = "done"
+    committed = 0
+    try:
+        for _ in range(SUMMARY_MAX_CHUNKS_PER_JOB):
+            start, chunk = peek_next_n(user_id, chunk_size)
+            if start is None:
+                break
+            if summarize(user_id, start, chunk):
+                registry.inc("ai_worker_summary_chunks_total", {"result": "committed"})
+                committed += 1
+                continue
+            # LLM 失敗或游標已被 finalize 推進：退避後再試（游標已推進時下次取出即無段落可摘要）
+            registry.inc("ai_worker_summary_chunks_total", {"result": "rejected"})
+            result = "failed"
+            break
+        if committed:
+            compact_summary(user_id, condense)
+    finally:
+        release_summary_lock(user_id, token)
+    if result == "failed":
+        delay = retry_summary_job(user_id, SUMMARY_RETRY_BASE_SEC, SUMMARY_RETRY_MAX_SEC)
+        print(f"⚠️ [Summary Queue] 使用者 {user_id} 摘要失敗，{delay:.0f} 秒後重試", flush=True)
+        return result
+    # 先確認再檢查：持鎖期間進來的回合（或超過單次上限的段落）在確認之後重新排入
+    ack_summary_job(user_id)
+    if peek_next_n(user_id, chunk_size)[0] is not None:
+        enqueue_summary(user_id)
+    return result
+
+
+class SummaryWorker:
+    """從摘要佇列取工作的背景執行緒（daemon）；每個工作綁定使用者的 task_context 以便用量記帳。"""
+
+    def __init__(
+        self,
+        workers: int = SUMMARY_WORKERS,
+        summarize: Optional[Summarizer] = None,
+        poll_sec: int = 5,
+        condense: Optional[Condenser] = None,
+    ):
+        self.workers = workers
+        self.summarize = summarize
+        self.condense = condense
+        self.poll_sec = poll_sec
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> "SummaryWorker":
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"summary-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                user_id = pop_summary_job(self.poll_sec, lease_sec=SUMMARY_LOCK_TTL_SEC)
+                registry.set_gauge("ai_worker_summary_queue_depth", summary_queue_depth())
+            except Exception as e:
+                print(f"⚠️ [Summary Queue] 取出工作失敗: {e}", flush=True)
+                self._stop.wait(self.poll_sec)
+                continue
+            if user_id is None:
+                continue
+            try:
+                with task_context(user_id=user_id):
+                    result = drain_user(user_id, self.summarize, condense=self.condense)
+            except Exception as e:
+                print(f"⚠️ [Summary Queue] 使用者 {user_id} 摘要失敗: {e}", flush=True)
+                result = "error"
+            registry.inc("ai_worker_summary_jobs_total", {"result": result})
+
+
+def start_summary_workers(workers: int = SUMMARY_WORKERS) -> Optional[SummaryWorker]:
+    """SUMMARY_ASYNC 開啟且 workers > 0 時啟動背景摘要執行緒。"""
+    if not SUMMARY_ASYNC or workers <= 0:
+        return None
+    worker = SummaryWorker(workers).start()
+    print(f"📝 [Summary Queue] 背景摘要已啟動（{workers} 個執行緒）", flush=True)
+    return worker
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+每個任務的執行上下文（取代行程全域的 os.environ["CURRENT_USER_ID"]）
+
+以 contextvars 保存 user_id / line_user_id / trace_id / request_id：
+- 同一執行緒內的巢狀呼叫（agent → tool）直接讀取 current_task()
+- 交給執行緒池的工作需以 contextvars.copy_context().run 執行（見 chat_pipeline._submit），
+  上下文會跟著工作走，不同使用者的任務即使交錯執行也不會互相覆蓋
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from dataclasses import dataclass, replace
+from typing import Iterator, Optional
+
+from observability import tracing
+
+
+@dataclass(frozen=True)
+class TaskContext:
+    user_id: Optional[str] = None
+    line_user_id: Optional[str] = None
+    trace_id: Optional[str] = None
+    request_id: Optional[str] = None
+
+
+_current: ContextVar[TaskContext] = ContextVar("task_context", default=TaskContext())
+
+
+def current_task() -> TaskContext:
+    return _current.get()
+
+
+def bind_task_context(
+    user_id: Optional[str] = None,
+    line_user_id: Optional[str] = None,
+    trace_id: Optional[str] = None,
+    request_id: Optional[str] = None,
+) -> Token:
+    """
+    綁定任務上下文並回傳 token（結束時以 reset_task_context(token) 還原）。
+    未提供的欄位沿用外層（例如 main 綁定 request_id，chat_pipeline 再補上 user_id），
+    trace_id 預設取目前 span 的 trace。
+    """
+    fields = {
+        "user_id": None if user_id is None else str(user_id),
+        "line_user_id": line_user_id,
+        "trace_id": trace_id or tracing.current_trace_id(),
+        "request_id": None if request_id is None else str(request_id),
+    }
+    return _current.set(replace(_current.get(), **{k: v for k, v in fields.items() if v is not None}))
+
+
+def reset_task_context(token: Token) -> None:
+    _current.reset(token)
+
+
+@contextmanager
+def task_context(**fields) -> Iterator[TaskContext]:
+    """bind_task_context 的 with 版本。"""
+    token = bind_task_context(**fields)
+    try:
+        yield _current.get()
+    finally:
+        reset_task_context(token)
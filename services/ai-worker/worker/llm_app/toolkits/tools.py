@@ -1,14 +1,20 @@
 import json
 import os
-from typing import Dict, List, Type
+from typing import Dict, List, Optional, Type
 
 from crewai.tools import BaseTool
-from openai import OpenAI
 from pydantic import BaseModel, Field
 from pymilvus import Collection, connections
 
 from ..embedding import to_vector
 from .redis_store import commit_summary_chunk
+from .decision_cache import cached_decision
+from .llm_client import BACKGROUND, get_openai_client
+from .memory_gate_rules import classify_by_rules
+from .task_context import current_task
+from observability.metrics import registry, stage_timer
+
+registry.describe("ai_worker_memory_gate_total", "counter", "Memory-gate decisions by source (rule / llm).")
 
 _milvus_loaded = False
 _collection = None
@@ -24,28 +30,37 @@ class MemoryGateTool(BaseTool):
     args_schema: Type[BaseModel] = MemoryGateToolSchema
 
     def _run(self, text: str) -> str:
+        # 明確的情況由本地規則判定，只有模稜兩可的輸入才送 LLM（仍經過決策快取）
+        decision = classify_by_rules(text)
+        if decision is not None:
+            registry.inc("ai_worker_memory_gate_total", {"source": "rule"})
+            return decision
+        registry.inc("ai_worker_memory_gate_total", {"source": "llm"})
         try:
-            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-            sys = (
-                "你是決策器。若輸入涉及個人既往事實/偏好/限制/用藥/醫囑/排程/家人稱呼/上一輪內容的指涉，"
-                "或出現『上次/之前/一樣/那個/還是/不要/過敏/醫師說/固定/提醒』等字眼，回 USE；"
-                "否則回 SKIP。只輸出 USE 或 SKIP。"
-            )
-            res = client.chat.completions.create(
-                model=os.getenv("GUARD_MODEL", os.getenv("MODEL_NAME", "gpt-4o-mini")),
-                temperature=0,
-                max_tokens=4,
-                messages=[
-                    {"role": "system", "content": sys},
-                    {"role": "user", "content": text},
-                ],
-            )
-            out = (res.choices[0].message.content or "").strip().upper()
-            return "USE" if out.startswith("USE") else "SKIP"
+            return cached_decision("memory_gate", text, self._classify)
         except Exception:
             # 失敗時保守：直接 SKIP，避免卡流程
             return "SKIP"
 
+    def _classify(self, text: str) -> str:
+        client = get_openai_client(stage="memory_gate")
+        sys = (
+            "你是決策器。若輸入涉及個人既往事實/偏好/限制/用藥/醫囑/排程/家人稱呼/上一輪內容的指涉，"
+            "或出現『上次/之前/一樣/那個/還是/不要/過敏/醫師說/固定/提醒』等字眼，回 USE；"
+            "否則回 SKIP。只輸出 USE 或 SKIP。"
+        )
+        res = client.chat.completions.create(
+            model=os.getenv("GUARD_MODEL", os.getenv("MODEL_NAME", "gpt-4o-mini")),
+            temperature=0,
+            max_tokens=4,
+            messages=[
+                {"role": "system", "content": sys},
+                {"role": "user", "content": text},
+            ],
+        )
+        out = (res.choices[0].message.content or "").strip().upper()
+        return "USE" if out.startswith("USE") else "SKIP"
+
 
 _milvus_loaded = False
 _collection = None
@@ -173,18 +188,19 @@ def summarize_chunk_and_commit(
     )
     prompt = f"請將下列對話做 80-120 字摘要，聚焦：健康問題、情緒、生活要點。\n\n{text}"
     try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        res = client.chat.completions.create(
-            model=os.getenv("MODEL_NAME", "gpt-4o-mini"),
-            messages=[
-                {"role": "system", "content": "你是專業的對話摘要助手。"},
-                {"role": "user", "content": prompt},
-            ],
-            temperature=0.3,
-        )
+        client = get_openai_client(BACKGROUND, stage="summarization")
+        with stage_timer("summarization"):
+            res = client.chat.completions.create(
+                model=os.getenv("MODEL_NAME", "gpt-4o-mini"),
+                messages=[
+                    {"role": "system", "content": "你是專業的對話摘要助手。"},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=0.3,
+            )
         body = (res.choices[0].message.content or "").strip()
         header = f"--- 第{start_round + 1}至{start_round + len(history_chunk)}輪對話摘要 ---\n"
-        return commit_summary_chunk(
+        ok = commit_summary_chunk(
             user_id,
             expected_cursor=start_round,
             advance=len(history_chunk),
@@ -193,6 +209,25 @@ def summarize_chunk_and_commit(
     except Exception as e:
         print(f"[摘要錯誤] {e}")
         return False
+    return ok
+
+
+def condense_summaries(text: str, max_chars: int) -> str:
+    """把較舊的摘要（可能含先前的濃縮摘要，由舊到新）合併成一段不超過 max_chars 字的濃縮摘要；見 summary_compaction。"""
+    client = get_openai_client(BACKGROUND, stage="summarization")
+    res = client.chat.completions.create(
+        model=os.getenv("MODEL_NAME", "gpt-4o-mini"),
+        messages=[
+            {"role": "system", "content": "你是專業的對話摘要助手。"},
+            {
+                "role": "user",
+                "content": f"以下是同一位長輩較早期的對話摘要（可能包含先前已濃縮的摘要，由舊到新），請合併成不超過 {max_chars} 字的一段摘要，"
+                "保留健康問題、用藥與就醫、情緒與生活要點，較新的內容優先；不要加標題。\n\n" + text,
+            },
+        ],
+        temperature=0.2,
+    )
+    return (res.choices[0].message.content or "").strip()
 
 
 class AlertCaseManagerToolSchema(BaseModel):
@@ -210,15 +245,17 @@ class AlertCaseManagerTool(BaseTool):
         "用戶ID由系統自動填入，無需提供。"
     )
     args_schema: Type[BaseModel] = AlertCaseManagerToolSchema  # ★ 關鍵：明確宣告參數鍵
+    # 建立 agent 時注入的使用者（每位使用者各自一個 agent）；未注入時取目前任務上下文
+    user_id: Optional[str] = None
 
     def _run(self, reason: str) -> str:
-        # 安全地抓 user_id；CrewAI 預設沒有 runtime_context
-        uid = None
-        try:
-            uid = (getattr(self, "runtime_context", {}) or {}).get("user_id")
-        except Exception:
-            pass
-        uid = uid or os.getenv("CURRENT_USER_ID") or "unknown"
+        ctx = current_task()
+        uid = self.user_id or ctx.user_id
+        if self.user_id and ctx.user_id and self.user_id != ctx.user_id:
+            # 不應發生：agent 與目前任務的使用者不一致時，以任務上下文為準並留下紀錄
+            print(f"⚠️ AlertCaseManagerTool: agent 綁定 user={self.user_id} 與任務 user={ctx.user_id} 不一致，改用任務上下文")
+            uid = ctx.user_id
+        uid = uid or "unknown"
 
         from datetime import datetime
 
@@ -226,10 +263,14 @@ class AlertCaseManagerTool(BaseTool):
         print(f"[{ts}] 🚨 AlertCaseManagerTool triggered: user={uid}, reason={reason}")
         # 這裡本來有 MQ 發送的註解碼，保留即可
         from .rabbitmq_publisher import publish_alert
-        publish_alert(user_id=uid, reason=reason)
+        publish_alert(user_id=uid, reason=reason, request_id=ctx.request_id)
         return f"⚠️ 已通報個管師使用者ID: {uid}，事由：{reason}"
 
 
+def is_guardrail_decision(decision: str) -> bool:
+    return decision == "OK" or decision.startswith("BLOCK:")
+
+
 class ModelGuardrailTool(BaseTool):
     name: str = "model_guardrail"
     description: str = (
@@ -238,50 +279,53 @@ class ModelGuardrailTool(BaseTool):
 
     def _run(self, text: str) -> str:
         try:
-            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-            guard_model = os.getenv(
-                "GUARD_MODEL", os.getenv("MODEL_NAME", "gpt-4o-mini")
-            )
-            sys = (
-                "你是安全審查器，需精準判斷是否必須攔截。\n"
-                "【允許（回 OK）】以下情況一律放行：\n"
-                "- 症狀敘述或一般健康資訊的詢問（例如：症狀、成因、風險因子、何時就醫的提醒）。\n"
-                "- 一般生活保健/衛教/注意事項等非個案化、非指令性的建議。\n"
-                "- 情緒低落、自殺念頭或求助的表達（不含具體方法）。\n"
-                "【必須攔截（回 BLOCK: <原因>）】符合任一條件：\n"
-                "1) 違法/危險行為的教學、買賣、製作或規避（毒品、武器、暴力、駭客、爆裂物等）。\n"
-                "2) 自傷/他傷/自殺/自殘的『具體方法指導或鼓勵執行』。\n"
-                "3) 成人性內容或未成年相關不當內容的請求。\n"
-                "4) 醫療/用藥/劑量/診斷/處置等『具體、個案化、可執行』的專業指示或方案。\n"
-                "5) 法律、投資、稅務等高風險領域之『具體、可執行』的專業指導。\n"
-                "【判斷原則】僅在請求明確落入上述攔截條件時才 BLOCK；\n"
-                "若是描述狀況或尋求一般性說明/保健建議，請回 OK。\n"
-                "若不確定，預設回 OK。\n"
-                "【輸出格式】只能是：\n"
-                "OK\n"
-                "或\n"
-                "BLOCK: <極簡原因>\n"
-            )
-
-            user = f"使用者輸入：{text}\n請依規則只輸出 OK 或 BLOCK: <原因>。"
-            res = client.chat.completions.create(
-                model=guard_model,
-                messages=[
-                    {"role": "system", "content": sys},
-                    {"role": "user", "content": user},
-                ],
-                temperature=0,
-                max_tokens=24,
-            )
-            out = (res.choices[0].message.content or "").strip()
-            # 預設寬鬆通過：若非明確 BLOCK，一律視為 OK
-            if not out.startswith("BLOCK:"):
-                return "OK"
-            # 僅保留精簡 BLOCK 理由
-            if len(out) > 256:
-                out = out[:256]
-            return out
+            return cached_decision("guardrail", text, self._classify, is_guardrail_decision)
         except Exception as e:
             # Guardrail 故障時，不要阻擋主流程
             print(f"[guardrail_error] {e}")
             return "OK"
+
+    def _classify(self, text: str) -> str:
+        client = get_openai_client(stage="guardrail")
+        guard_model = os.getenv(
+            "GUARD_MODEL", os.getenv("MODEL_NAME", "gpt-4o-mini")
+        )
+        sys = (
+            "你是安全審查器，需精準判斷是否必須攔截。\n"
+            "【允許（回 OK）】以下情況一律放行：\n"
+            "- 症狀敘述或一般健康資訊的詢問（例如：症狀、成因、風險因子、何時就醫的提醒）。\n"
+            "- 一般生活保健/衛教/注意事項等非個案化、非指令性的建議。\n"
+            "- 情緒低落、自殺念頭或求助的表達（不含具體方法）。\n"
+            "【必須攔截（回 BLOCK: <原因>）】符合任一條件：\n"
+            "1) 違法/危險行為的教學、買賣、製作或規避（毒品、武器、暴力、駭客、爆裂物等）。\n"
+            "2) 自傷/他傷/自殺/自殘的『具體方法指導或鼓勵執行』。\n"
+            "3) 成人性內容或未成年相關不當內容的請求。\n"
+            "4) 醫療/用藥/劑量/診斷/處置等『具體、個案化、可執行』的專業指示或方案。\n"
+            "5) 法律、投資、稅務等高風險領域之『具體、可執行』的專業指導。\n"
+            "【判斷原則】僅在請求明確落入上述攔截條件時才 BLOCK；\n"
+            "若是描述狀況或尋求一般性說明/保健建議，請回 OK。\n"
+            "若不確定，預設回 OK。\n"
+            "【輸出格式】只能是：\n"
+            "OK\n"
+            "或\n"
+            "BLOCK: <極簡原因>\n"
+        )
+
+        user = f"使用者輸入：{text}\n請依規則只輸出 OK 或 BLOCK: <原因>。"
+        res = client.chat.completions.create(
+            model=guard_model,
+            messages=[
+                {"role": "system", "content": sys},
+                {"role": "user", "content": user},
+            ],
+            temperature=0,
+            max_tokens=24,
+        )
+        out = (res.choices[0].message.content or "").strip()
+        # 預設寬鬆通過：若非明確 BLOCK，一律視為 OK
+        if not out.startswith("BLOCK:"):
+            return "OK"
+        # 僅保留精簡 BLOCK 理由
+        if len(out) > 256:
+            out = out[:256]
+        return out
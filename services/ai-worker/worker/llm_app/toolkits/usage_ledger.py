@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+LLM token 與成本記帳（依使用者 × 依階段）
+
+每次 LLM 呼叫的 usage 以 HINCRBY 累加到 Redis 的每日 hash，每天再彙總寫入 Postgres（llm_usage_daily），
+供 `python -m llm_app.usage_report` 查詢用量最高的病患與各階段的平均成本／延遲。
+
+Redis 結構（日期以台北時間計）：
+- llm_usage:{YYYYMMDD}:user:{user_id}  欄位為 "{stage}:{metric}"
+- llm_usage:{YYYYMMDD}:users           當天有用量的 user_id 集合
+metric 為 calls / prompt_tokens / completion_tokens / cost_micro_usd / latency_ms。
+沒有病患上下文的呼叫（例如排程中的系統工作）記在 user_id "0"。
+
+直接呼叫 OpenAI 的階段由 llm_client 自動記帳；經由 CrewAI 的階段以 record_crew_usage 記錄 CrewOutput.token_usage。
+記帳失敗只印警告，不影響回覆。
+"""
+
+import json
+import os
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import pytz
+
+from observability.metrics import registry
+
+from .redis_store import get_redis
+from .task_context import current_task
+
+LLM_USAGE_KEY_PREFIX = os.getenv("LLM_USAGE_KEY_PREFIX", "llm_usage")
+# Redis 只保留近幾天的明細，較早的資料以 Postgres 的每日彙總為準
+LLM_USAGE_RETENTION_DAYS = int(os.getenv("LLM_USAGE_RETENTION_DAYS", 8))
+
+TAIPEI_TZ = pytz.timezone("Asia/Taipei")
+SYSTEM_USER = "0"
+METRICS = ("calls", "prompt_tokens", "completion_tokens", "cost_micro_usd", "latency_ms")
+
+# 每百萬 token 的美元價格（輸入, 輸出）；LLM_PRICE_TABLE 可用 JSON 覆寫或新增，例如 {"gpt-4o-mini": [0.15, 0.6]}
+DEFAULT_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+    "text-embedding-3-small": (0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.0),
+}
+
+registry.describe("ai_worker_llm_tokens_total", "counter", "LLM tokens by pipeline stage and kind (prompt / completion).")
+registry.describe("ai_worker_llm_cost_usd_total", "counter", "Estimated LLM cost in USD by pipeline stage.")
+
+
+def _load_prices() -> Dict[str, Tuple[float, float]]:
+    prices = dict(DEFAULT_PRICES)
+    raw = os.getenv("LLM_PRICE_TABLE", "").strip()
+    if raw:
+        try:
+            prices.update({k: (float(v[0]), float(v[1])) for k, v in json.loads(raw).items()})
+        except (ValueError, TypeError, IndexError, AttributeError) as e:
+            print(f"⚠️ [LLM 記帳] LLM_PRICE_TABLE 格式錯誤，改用內建價格: {e}")
+    return prices
+
+
+PRICES = _load_prices()
+
+
+def price_for(model: Optional[str]) -> Tuple[float, float]:
+    """依模型名稱取價格；帶日期後綴的版本（gpt-4o-mini-2024-07-18）以最長前綴比對。"""
+    if not model:
+        model = os.getenv("MODEL_NAME", "gpt-4o-mini")
+    matches = [name for name in PRICES if model == name or model.startswith(name + "-")]
+    if not matches:
+        return 0.0, 0.0
+    return PRICES[max(matches, key=len)]
+
+
+def cost_micro_usd(model: Optional[str], prompt_tokens: int, completion_tokens: int) -> int:
+    price_in, price_out = price_for(model)
+    # 每百萬 token 的美元價格 × token 數 = 微美元
+    return round(prompt_tokens * price_in + completion_tokens * price_out)
+
+
+def usage_day(when: Optional[datetime] = None) -> str:
+    return (when or datetime.now(TAIPEI_TZ)).astimezone(TAIPEI_TZ).strftime("%Y%m%d")
+
+
+def _user_key(day: str, user_id: str) -> str:
+    return f"{LLM_USAGE_KEY_PREFIX}:{day}:user:{user_id}"
+
+
+def _users_key(day: str) -> str:
+    return f"{LLM_USAGE_KEY_PREFIX}:{day}:users"
+
+
+def record_usage(
+    stage: str,
+    model: Optional[str],
+    prompt_tokens: int,
+    completion_tokens: int,
+    latency_sec: float = 0.0,
+    calls: int = 1,
+    user_id: Optional[str] = None,
+    cached_tokens: int = 0,
+) -> None:
+    """
+    累加一筆（或 calls 筆）LLM 呼叫的用量；user_id 未提供時取目前任務上下文。
+    cached_tokens（prompt_tokens 中命中 prompt cache 的部分）只記入指標，不進每日帳。
+    """
+    uid = str(user_id or current_task().user_id or SYSTEM_USER)
+    prompt_tokens, completion_tokens = int(prompt_tokens or 0), int(completion_tokens or 0)
+    cost = cost_micro_usd(model, prompt_tokens, completion_tokens)
+    values = {
+        "calls": calls,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cost_micro_usd": cost,
+        "latency_ms": int(latency_sec * 1000),
+    }
+    registry.inc("ai_worker_llm_tokens_total", {"stage": stage, "kind": "prompt"}, prompt_tokens)
+    registry.inc("ai_worker_llm_tokens_total", {"stage": stage, "kind": "completion"}, completion_tokens)
+    if cached_tokens:
+        registry.inc("ai_worker_llm_tokens_total", {"stage": stage, "kind": "cached"}, int(cached_tokens))
+    registry.inc("ai_worker_llm_cost_usd_total", {"stage": stage}, cost / 1_000_000)
+
+    day = usage_day()
+    ttl = LLM_USAGE_RETENTION_DAYS * 86400
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for metric, value in values.items():
+            if value:
+                pipe.hincrby(_user_key(day, uid), f"{stage}:{metric}", value)
+        pipe.expire(_user_key(day, uid), ttl)
+        pipe.sadd(_users_key(day), uid)
+        pipe.expire(_users_key(day), ttl)
+        pipe.execute()
+    except Exception as e:
+        print(f"⚠️ [LLM 記帳] 寫入 Redis 失敗（stage={stage}）: {e}")
+
+
+def record_crew_usage(stage: str, output: Any, latency_sec: float = 0.0, model: Optional[str] = None) -> None:
+    """記錄一次 Crew kickoff 的 token_usage（CrewAI 內部的 LLM 呼叫不經過 llm_client）。"""
+    usage = getattr(output, "token_usage", None)
+    if usage is None:
+        return
+    record_usage(
+        stage,
+        model or os.getenv("MODEL_NAME", "gpt-4o-mini"),
+        getattr(usage, "prompt_tokens", 0) or 0,
+        getattr(usage, "completion_tokens", 0) or 0,
+        latency_sec=latency_sec,
+        calls=getattr(usage, "successful_requests", 0) or 1,
+        cached_tokens=getattr(usage, "cached_prompt_tokens", 0) or 0,
+    )
+
+
+def read_day(day: str) -> List[Dict[str, Any]]:
+    """讀出某天 Redis 內的明細：[{day, user_id, stage, calls, prompt_tokens, ...}]。"""
+    r = get_redis()
+    users = sorted(r.smembers(_users_key(day)))
+    pipe = r.pipeline(transaction=False)
+    for uid in users:
+        pipe.hgetall(_user_key(day, uid))
+    rows: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for uid, fields in zip(users, pipe.execute()):
+        for field, value in (fields or {}).items():
+            stage, _, metric = field.rpartition(":")
+            if metric not in METRICS:
+                continue
+            row = rows.setdefault((uid, stage), {"day": day, "user_id": uid, "stage": stage, **dict.fromkeys(METRICS, 0)})
+            row[metric] = int(value)
+    return list(rows.values())
+
+
+def rollup_day(day: Optional[date] = None) -> int:
+    """
+    把某天（預設昨天，台北時間）的 Redis 明細寫入 Postgres llm_usage_daily；回傳寫入列數。
+    以 Redis 的累計值覆寫，重複執行不會重複計算。
+    """
+    from ..repositories.usage_repository import UsageRepository
+
+    day = day or (datetime.now(TAIPEI_TZ) - timedelta(days=1)).date()
+    rows = read_day(day.strftime("%Y%m%d"))
+    for row in rows:
+        row["day"] = day
+    return UsageRepository().upsert_daily(rows)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# usage_report.py  (LLM token / 成本用量查詢)
+"""
+查詢 LLM 用量：哪些病患、哪些階段（guardrail、memory_gate、main_reply、summarization、
+distillation、profiler、proactive_care …）花掉最多 token 與成本。
+
+資料來源：
+- db（預設）：Postgres llm_usage_daily 每日彙總（由排程每天寫入前一天的資料）
+- redis：近幾天（LLM_USAGE_RETENTION_DAYS）尚未彙總的即時明細，可查今天
+
+用法（於 worker/ 目錄下）：
+    python -m llm_app.usage_report stages --days 7
+    python -m llm_app.usage_report top --days 7 --limit 20 --stage main_reply
+    python -m llm_app.usage_report top --days 1 --source redis
+    python -m llm_app.usage_report rollup --date 2025-08-20
+"""
+
+import argparse
+import sys
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+from .toolkits.usage_ledger import METRICS, TAIPEI_TZ, read_day, rollup_day
+
+
+def _date_range(days: int, end: Optional[date] = None):
+    end = end or datetime.now(TAIPEI_TZ).date()
+    return end - timedelta(days=max(1, days) - 1), end
+
+
+def _aggregate_redis(start: date, end: date, key: str, stage: Optional[str] = None) -> List[Dict]:
+    totals: Dict[str, Dict[str, int]] = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+    day = start
+    while day <= end:
+        for row in read_day(day.strftime("%Y%m%d")):
+            if stage and row["stage"] != stage:
+                continue
+            for m in METRICS:
+                totals[row[key]][m] += row[m]
+        day += timedelta(days=1)
+    rows = [{key: k, **v} for k, v in totals.items()]
+    return sorted(rows, key=lambda r: r["cost_micro_usd"], reverse=True)
+
+
+def _print_table(rows: List[Dict], key: str, title: str) -> None:
+    print(f"=== {title} ===")
+    if not rows:
+        print("（沒有資料）")
+        return
+    print(f"{key:<16}{'呼叫':>8}{'輸入 token':>14}{'輸出 token':>12}{'成本(USD)':>12}"
+          f"{'平均 token':>12}{'平均成本':>12}{'平均延遲(ms)':>14}")
+    for r in rows:
+        calls = int(r["calls"] or 0) or 1
+        tokens = int(r["prompt_tokens"] or 0) + int(r["completion_tokens"] or 0)
+        cost = int(r["cost_micro_usd"] or 0) / 1_000_000
+        print(f"{str(r[key]):<16}{int(r['calls'] or 0):>8}{int(r['prompt_tokens'] or 0):>14}"
+              f"{int(r['completion_tokens'] or 0):>12}{cost:>12.4f}{tokens / calls:>12.0f}"
+              f"{cost / calls:>12.6f}{int(r['latency_ms'] or 0) / calls:>14.0f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="LLM token / 成本用量查詢")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for name, help_text in (("stages", "各階段合計與平均"), ("top", "用量最高的使用者")):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--days", type=int, default=7, help="查詢最近幾天（含今天）")
+        p.add_argument("--source", choices=("db", "redis"), default="db")
+        if name == "top":
+            p.add_argument("--limit", type=int, default=20)
+            p.add_argument("--stage", default="", help="只看某個階段")
+
+    p = sub.add_parser("rollup", help="把某天的 Redis 明細寫入 Postgres（預設昨天）")
+    p.add_argument("--date", default="", help="YYYY-MM-DD")
+    args = parser.parse_args(argv)
+
+    if args.command == "rollup":
+        day = datetime.strptime(args.date, "%Y-%m-%d").date() if args.date else None
+        count = rollup_day(day)
+        print(f"✅ 已寫入 {count} 筆 LLM 用量彙總")
+        return 0
+
+    start, end = _date_range(args.days)
+    period = f"{start:%Y-%m-%d} ~ {end:%Y-%m-%d}，來源 {args.source}"
+    if args.command == "stages":
+        if args.source == "redis":
+            rows = _aggregate_redis(start, end, "stage")
+        else:
+            from .repositories.usage_repository import UsageRepository
+
+            rows = UsageRepository().stage_summary(start, end)
+        _print_table(rows, "stage", f"各階段 LLM 用量（{period}）")
+    else:
+        if args.source == "redis":
+            rows = _aggregate_redis(start, end, "user_id", args.stage or None)[: args.limit]
+        else:
+            from .repositories.usage_repository import UsageRepository
+
+            rows = UsageRepository().top_users(start, end, args.limit, args.stage or None)
+        stage_note = f"，階段 {args.stage}" if args.stage else ""
+        _print_table(rows, "user_id", f"用量最高的使用者（{period}{stage_note}）")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,19 +9,13 @@ from typing import List
 
 import redis
 from pymilvus import Collection, connections
-# 嘗試使用專案的 embedding.safe_to_vector；若失敗，改用 OpenAI
-try:
-    sys.path.append(os.path.dirname(__file__) or ".")
-    from embedding import safe_to_vector
-    def embed(text: str) -> List[float]:
-        return safe_to_vector(text) or []
-except Exception:
-    from openai import OpenAI
-    _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    _EMB_MODEL = os.getenv("EMB_MODEL", "text-embedding-3-small")
-    def embed(text: str) -> List[float]:
-        r = _client.embeddings.create(model=_EMB_MODEL, input=text)
-        return r.data[0].embedding
+# 以 worker/ 為匯入根目錄，使用專案的 embedding.safe_to_vector（與 worker 共用連線池、限流與用量帳）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from llm_app.embedding import safe_to_vector
+
+
+def embed(text: str) -> List[float]:
+    return safe_to_vector(text) or []
 
 MEM_COLLECTION = os.getenv("MEMORY_COLLECTION", "user_memory_v3")
 MILVUS_HOSTS = [("localhost", 19530), ("milvus", 19530), ("127.0.0.1", 19530)]
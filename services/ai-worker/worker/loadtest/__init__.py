@@ -0,0 +1 @@
+# Offline replay load-test harness for the AI worker task queue
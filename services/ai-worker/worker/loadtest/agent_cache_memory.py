@@ -0,0 +1,124 @@
+"""
+Health agent cache memory test
+
+以合成的多使用者請求流驅動 AgentManager 使用的 AgentCache，記錄 tracemalloc 目前配置量，
+確認快取填滿後記憶體維持平穩（不隨「曾經聊過的使用者數」成長）。--unbounded 改用舊版的
+dict 快取作為對照。
+
+預設以固定大小的替身物件模擬一個 agent（--agent-kb）；安裝了 crewai 時可用 --real-agents
+改為建立真正的 create_health_companion。
+
+用法（於 worker/ 目錄下）：
+    python -m loadtest.agent_cache_memory --users 20000 --requests 60000 --max-size 256
+    python -m loadtest.agent_cache_memory --users 20000 --requests 60000 --unbounded
+    python -m loadtest.agent_cache_memory --real-agents --users 2000 --requests 6000
+穩定階段的記憶體成長超過 --max-growth-mb 時以非零結束碼離開。
+"""
+
+import argparse
+import gc
+import random
+import sys
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional
+
+from llm_app.toolkits.agent_cache import AgentCache
+
+
+class _DictCache:
+    """舊版行為：每位使用者一個 agent，永不淘汰。"""
+
+    def __init__(self, factory: Callable[[str], Any]):
+        self._factory = factory
+        self._entries: Dict[str, Any] = {}
+        self.stats = {"hit": 0, "miss": 0, "stale": 0, "evicted": 0, "expired": 0}
+
+    def get(self, user_id: str, fingerprint: Optional[str] = None) -> Any:
+        if user_id in self._entries:
+            self.stats["hit"] += 1
+        else:
+            self.stats["miss"] += 1
+            self._entries[user_id] = self._factory(user_id)
+        return self._entries[user_id]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _fake_factory(agent_kb: int) -> Callable[[str], Any]:
+    def build(user_id: str) -> Dict[str, Any]:
+        return {"user_id": user_id, "state": bytearray(agent_kb * 1024), "tools": [object(), object()]}
+
+    return build
+
+
+def _real_factory() -> Callable[[str], Any]:
+    from llm_app.HealthBot.agent import create_health_companion
+
+    return create_health_companion
+
+
+def run(users: int, requests: int, cache, hot_ratio: float, profile_change: float, seed: int,
+        checkpoints: int = 10) -> List[Dict[str, float]]:
+    """回傳每個檢查點的 {requests, cached, current_mb}。"""
+    rng = random.Random(seed)
+    hot = max(1, int(users * 0.05))
+    versions: Dict[str, int] = {}
+    samples = []
+    step = max(1, requests // checkpoints)
+    for i in range(1, requests + 1):
+        # 少數常客佔 hot_ratio 的流量，其餘平均分散在所有使用者
+        uid = str(1000 + (rng.randrange(hot) if rng.random() < hot_ratio else rng.randrange(users)))
+        if rng.random() < profile_change:
+            versions[uid] = versions.get(uid, 0) + 1
+        cache.get(uid, f"v{versions.get(uid, 0)}")
+        if i % step == 0:
+            gc.collect()
+            samples.append({
+                "requests": i,
+                "cached": len(cache),
+                "current_mb": tracemalloc.get_traced_memory()[0] / 1024 / 1024,
+            })
+    return samples
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="health agent 快取記憶體壓測")
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=60000)
+    parser.add_argument("--max-size", type=int, default=256, help="快取上限（AGENT_CACHE_MAX_SIZE）")
+    parser.add_argument("--ttl", type=float, default=0, help="閒置秒數上限（0 = 只靠 LRU）")
+    parser.add_argument("--hot-ratio", type=float, default=0.6, help="常客流量比例")
+    parser.add_argument("--profile-change", type=float, default=0.01, help="每次請求畫像改變的機率")
+    parser.add_argument("--agent-kb", type=int, default=64, help="替身 agent 的大小（KB）")
+    parser.add_argument("--real-agents", action="store_true", help="建立真正的 CrewAI agent（需要 crewai）")
+    parser.add_argument("--unbounded", action="store_true", help="對照組：舊版 dict 快取")
+    parser.add_argument("--max-growth-mb", type=float, default=5.0, help="穩定階段允許的記憶體成長")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    factory = _real_factory() if args.real_agents else _fake_factory(args.agent_kb)
+    cache = _DictCache(factory) if args.unbounded else AgentCache(factory, max_size=args.max_size, ttl_sec=args.ttl)
+
+    tracemalloc.start()
+    samples = run(args.users, args.requests, cache, args.hot_ratio, args.profile_change, args.seed)
+    tracemalloc.stop()
+
+    print(f"=== Health agent 快取記憶體壓測（{'dict 對照組' if args.unbounded else f'LRU 上限 {args.max_size}'}）===")
+    print(f"{'請求數':>10}{'快取數':>10}{'記憶體(MB)':>14}")
+    for s in samples:
+        print(f"{s['requests']:>10}{s['cached']:>10}{s['current_mb']:>14.1f}")
+    st = cache.stats
+    total = st["hit"] + st["miss"] + st["stale"]
+    print(f"hit {st['hit']}｜miss {st['miss']}｜stale {st['stale']}｜evicted {st['evicted']}｜expired {st['expired']}"
+          f"｜命中率 {st['hit'] / total:.1%}" if total else "")
+
+    # 穩定階段 = 後半段檢查點；比較其最大與最小記憶體
+    steady = [s["current_mb"] for s in samples[len(samples) // 2:]]
+    growth = max(steady) - min(steady) if steady else 0.0
+    print(f"穩定階段記憶體變化：{growth:.1f} MB（上限 {args.max_growth_mb} MB）")
+    return 0 if growth <= args.max_growth_mb else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+OpenAI rate-limiter check
+
+模擬多個 worker 行程共用同一組 Redis token bucket（llm_app.toolkits.llm_client.RateLimiter）：
+每個「行程」有自己的 RateLimiter 實例，背景執行緒持續灌入摘要類請求，同時以固定速率送出使用者請求。
+不會真的呼叫 OpenAI，只量測取得額度的等候時間與放行數量。
+
+檢查：
+1) 放行的請求數不超過桶容量加上期間內的補充量（所有行程合計，不是每個行程各自計算）
+2) 背景請求被擋下等候時，使用者請求的 p95 等候仍低於 --max-interactive-wait
+3) 串流回應在呼叫端回呼拋出例外、或讀到一半被放棄時，仍以實際／粗估用量修正預扣額度並記入用量帳
+--reserve 0 可對照「沒有優先權」時使用者請求被背景流量拖慢的情形。
+
+用法（於 worker/ 目錄下）：
+    python -m loadtest.openai_ratelimit --processes 4 --rpm 1200 --duration 10
+    python -m loadtest.openai_ratelimit --processes 4 --rpm 1200 --duration 10 --reserve 0
+    python -m loadtest.openai_ratelimit --redis-url redis://localhost:6379/15
+任一檢查失敗時以非零結束碼離開。
+"""
+
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+import llm_app.toolkits.llm_client as llm_client
+from llm_app.toolkits.llm_client import BACKGROUND, INTERACTIVE, RateLimiter
+
+
+def _p95(values: List[float]) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def run(args, redis_client) -> Tuple[Dict[str, List[float]], float]:
+    key = f"loadtest:openai:{int(time.time() * 1000)}"
+    limiters = [
+        RateLimiter(
+            rpm=args.rpm, tpm=args.tpm, background_reserve=args.reserve, key=key,
+            redis_client=redis_client, max_wait={INTERACTIVE: args.duration, BACKGROUND: args.duration},
+        )
+        for _ in range(args.processes)
+    ]
+    waits: Dict[str, List[float]] = {INTERACTIVE: [], BACKGROUND: []}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def call(limiter: RateLimiter, priority: str) -> None:
+        waited = limiter.acquire(args.tokens, priority)
+        with lock:
+            waits[priority].append(waited)
+
+    def background_worker(limiter: RateLimiter) -> None:
+        while time.monotonic() < deadline:
+            call(limiter, BACKGROUND)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.processes * (args.background_threads + 4)) as pool:
+        for limiter in limiters:
+            for _ in range(args.background_threads):
+                pool.submit(background_worker, limiter)
+        # 使用者請求平均分散到各行程
+        n = 0
+        while time.monotonic() < deadline:
+            pool.submit(call, limiters[n % len(limiters)], INTERACTIVE)
+            n += 1
+            time.sleep(1.0 / args.interactive_rate)
+    return waits, time.monotonic() - started
+
+
+class _SettleRecorder(RateLimiter):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.settled: List[Tuple[int, int]] = []
+
+    def settle(self, estimated, actual) -> None:
+        self.settled.append((estimated, actual))
+        super().settle(estimated, actual)
+
+
+def check_stream_settlement(redis_client) -> List[str]:
+    """以假的串流回應走 PooledOpenAI：讀完、回呼例外、中途放棄三種情況都要修正額度並記帳。"""
+    limiter = _SettleRecorder(rpm=0, tpm=100_000, key="loadtest:openai:stream", redis_client=redis_client)
+    recorded: List[Tuple[str, int, int]] = []
+    text = "今天記得帶吸入器出門，" * 4
+
+    def fake_stream(**kwargs):
+        for i in range(0, len(text), 5):
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + 5], tool_calls=None))])
+        yield SimpleNamespace(usage=SimpleNamespace(prompt_tokens=40, completion_tokens=20, total_tokens=60), choices=[])
+
+    originals = (llm_client._base_client, llm_client.get_rate_limiter, llm_client.record_usage)
+    llm_client._base_client = lambda: SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=fake_stream)))
+    llm_client.get_rate_limiter = lambda: limiter
+    llm_client.record_usage = lambda stage, model, prompt, completion, **kw: recorded.append((stage, prompt, completion))
+    client = llm_client.PooledOpenAI(stage="loadtest")
+    request = {"model": "m", "messages": [{"role": "user", "content": "早安" * 20}], "stream": True, "max_tokens": 500}
+    errors: List[str] = []
+    try:
+        for _ in client.chat.completions.create(**request):
+            pass
+        try:
+            for n, _ in enumerate(client.chat.completions.create(**request)):
+                if n == 2:
+                    raise RuntimeError("chunk callback failed")
+        except RuntimeError:
+            pass
+        abandoned = client.chat.completions.create(**request)
+        next(abandoned)
+        abandoned.close()
+    finally:
+        llm_client._base_client, llm_client.get_rate_limiter, llm_client.record_usage = originals
+
+    print(f"串流修正額度  (預扣, 實際)：{limiter.settled}｜用量帳：{recorded}")
+    if len(limiter.settled) != 3 or len(recorded) != 3:
+        errors.append(f"三次串流應各修正額度並記帳一次，實際修正 {len(limiter.settled)} 次、記帳 {len(recorded)} 次")
+        return errors
+    if limiter.settled[0][1] != 60:
+        errors.append(f"讀完的串流應以實際 usage 修正，實際 {limiter.settled[0][1]}")
+    for (estimated, actual), label in zip(limiter.settled[1:], ("回呼例外", "中途放棄")):
+        if not 0 < actual < estimated:
+            errors.append(f"{label}的串流應以粗估用量退還多扣的額度，預扣 {estimated}、修正為 {actual}")
+    return errors
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="OpenAI 跨行程限流檢查")
+    parser.add_argument("--processes", type=int, default=4, help="模擬的 worker 行程數")
+    parser.add_argument("--background-threads", type=int, default=4, help="每個行程持續灌背景請求的執行緒數")
+    parser.add_argument("--interactive-rate", type=float, default=5.0, help="使用者請求速率（次/秒，所有行程合計）")
+    parser.add_argument("--rpm", type=int, default=1200)
+    parser.add_argument("--tpm", type=int, default=0)
+    parser.add_argument("--tokens", type=int, default=300, help="每次請求的 token 數")
+    parser.add_argument("--reserve", type=float, default=0.3, help="背景工作須保留的額度比例")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--max-interactive-wait", type=float, default=0.5, help="使用者請求 p95 等候上限（秒）")
+    parser.add_argument("--redis-url", default="", help="使用真實 Redis（預設 fakeredis）")
+    args = parser.parse_args(argv)
+
+    if args.redis_url:
+        import redis
+
+        redis_client = redis.Redis.from_url(args.redis_url, decode_responses=True)
+    else:
+        import fakeredis
+
+        redis_client = fakeredis.FakeRedis(decode_responses=True)
+
+    waits, elapsed = run(args, redis_client)
+    granted = {p: len(v) for p, v in waits.items()}
+    total = sum(granted.values())
+
+    # 桶一開始是滿的，之後每分鐘補滿一次容量（以實際歷時計：收尾時仍在等候的請求也會拿到補充的額度）
+    allowed = float("inf")
+    if args.rpm > 0:
+        allowed = min(allowed, args.rpm + args.rpm * elapsed / 60 + 1)
+    if args.tpm > 0:
+        allowed = min(allowed, (args.tpm + args.tpm * elapsed / 60) / args.tokens + 1)
+
+    print(f"=== OpenAI 限流（{args.processes} 個行程、rpm={args.rpm}、tpm={args.tpm}、保留 {args.reserve:.0%}）===")
+    print(f"{'優先權':<14}{'放行':>8}{'p95 等候(s)':>14}{'最長等候(s)':>14}")
+    for p in (INTERACTIVE, BACKGROUND):
+        print(f"{p:<14}{granted[p]:>8}{_p95(waits[p]):>14.3f}{max(waits[p] or [0]):>14.3f}")
+    print(f"放行合計 {total}（上限 {allowed:.0f}，歷時 {elapsed:.1f}s）")
+
+    failures = check_stream_settlement(redis_client)
+    if total > allowed:
+        failures.append(f"放行 {total} 次，超過桶容量 {allowed:.0f}")
+    if _p95(waits[BACKGROUND]) > 0 and _p95(waits[INTERACTIVE]) > args.max_interactive_wait:
+        failures.append(
+            f"背景流量壅塞時使用者請求 p95 等候 {_p95(waits[INTERACTIVE]):.3f}s，超過 {args.max_interactive_wait}s"
+        )
+    for line in failures:
+        print("  - " + line)
+    print("通過" if not failures else "失敗")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+Redis round trips per chat turn
+
+比較一輪對話在 Redis 上的往返次數與耗時：
+- separate：逐一呼叫 acquire_audio_lock / read_and_clear_audio_segments / get_summary / fetch_history_tail /
+  set_audio_result / try_register_request / append_round / peek_next_n / release_audio_lock
+- pipelined：begin_audio_turn（Lua）+ fetch_session_context（pipeline）+ commit_turn（Lua）
+
+往返次數在 redis-py 客戶端層計算（單一指令、pipeline.execute、WATCH 模式的即時指令各算一次）。
+預設連本機 Redis（--redis-url，使用獨立的 key 前綴並於結束時清除）；連不上時改用 fakeredis，
+並以 --rtt-ms 在每次往返加上模擬的網路延遲。
+
+另外檢查 pipelined 與 separate 的結果一致：歷史內容、待摘要段落、重複請求去重、鎖被占用時回傳既有結果。
+
+用法（於 worker/ 目錄下）：
+    python -m loadtest.redis_turn_bench
+    python -m loadtest.redis_turn_bench --redis-url redis://localhost:6379/15 --turns 500
+    python -m loadtest.redis_turn_bench --rtt-ms 1.0
+任一檢查失敗時以非零結束碼離開。
+"""
+
+import argparse
+import io
+import sys
+import time
+from contextlib import contextmanager, redirect_stdout
+from typing import Callable, Dict, Iterator, List
+
+import fakeredis
+import redis
+
+import llm_app.toolkits.redis_store as redis_store
+
+CHUNK = 5
+
+
+class _NoopProfileRepository:
+    def touch_last_contact_ts(self, *args, **kwargs) -> None:
+        pass
+
+
+class RoundTrips:
+    """攔截 redis-py 的送出點計算往返次數，並可對每次往返加上模擬延遲。"""
+
+    def __init__(self, rtt_sec: float = 0.0):
+        self.count = 0
+        self.rtt_sec = rtt_sec
+
+    def _hit(self) -> None:
+        self.count += 1
+        if self.rtt_sec:
+            time.sleep(self.rtt_sec)
+
+    @contextmanager
+    def counting(self) -> Iterator["RoundTrips"]:
+        originals = (
+            redis.Redis.execute_command,
+            redis.client.Pipeline.execute,
+            redis.client.Pipeline.immediate_execute_command,
+        )
+
+        def execute_command(client, *args, **kwargs):
+            self._hit()
+            return originals[0](client, *args, **kwargs)
+
+        def execute(pipe, *args, **kwargs):
+            if pipe.command_stack:
+                self._hit()
+            return originals[1](pipe, *args, **kwargs)
+
+        def immediate(pipe, *args, **kwargs):
+            self._hit()
+            return originals[2](pipe, *args, **kwargs)
+
+        redis.Redis.execute_command = execute_command
+        redis.client.Pipeline.execute = execute
+        redis.client.Pipeline.immediate_execute_command = immediate
+        try:
+            yield self
+        finally:
+            (redis.Redis.execute_command, redis.client.Pipeline.execute,
+             redis.client.Pipeline.immediate_execute_command) = originals
+
+
+def separate_turn(uid: str, audio_id: str, text: str, reply: str) -> List:
+    lock_id = f"{uid}#audio:{audio_id}"
+    if not redis_store.acquire_audio_lock(lock_id, ttl_sec=180):
+        return [redis_store.get_audio_result(uid, audio_id)]
+    try:
+        head = redis_store.read_and_clear_audio_segments(uid, audio_id)
+        summary, _ = redis_store.get_summary(uid)
+        rounds = redis_store.fetch_history_tail(uid, 6)
+        redis_store.set_audio_result(uid, audio_id, reply)
+        rid = f"rid-{audio_id}"
+        if not redis_store.try_register_request(uid, rid):
+            return [head, summary, rounds, None, []]
+        redis_store.append_round(uid, {"input": text, "output": reply, "rid": rid})
+        start, chunk = redis_store.peek_next_n(uid, CHUNK)
+        return [head, summary, rounds, start, chunk]
+    finally:
+        redis_store.release_audio_lock(lock_id)
+
+
+def pipelined_turn(uid: str, audio_id: str, text: str, reply: str) -> List:
+    lock_id = f"{uid}#audio:{audio_id}"
+    acquired, head = redis_store.begin_audio_turn(uid, audio_id, lock_id, ttl_sec=180)
+    if not acquired:
+        return [head]
+    summary, rounds = redis_store.fetch_session_context(uid, 6)
+    _, start, chunk = redis_store.commit_turn(
+        uid, {"input": text, "output": reply, "rid": f"rid-{audio_id}"},
+        chunk_size=CHUNK, audio_id=audio_id, reply=reply, lock_id=lock_id,
+    )
+    return [head, summary, rounds, start, chunk]
+
+
+def _p95(values: List[float]) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] if ordered else 0.0
+
+
+def bench(r, prefix: str, name: str, turn: Callable, turns: int, counter: RoundTrips) -> Dict:
+    uid = f"{prefix}{name}"
+    r.set(f"session:{uid}:summary:text", "病況穩定，提醒用藥。")
+    turn(uid, "warmup", "暖身", "好")  # 載入 Lua script，不列入統計
+    latencies, trips, outputs = [], [], []
+    for i in range(turns):
+        r.rpush(f"audio:{uid}:a{i}:buf", f"片段{i}")
+        before = counter.count
+        t0 = time.perf_counter()
+        outputs.append(turn(uid, f"a{i}", f"第 {i} 輪提問", f"第 {i} 輪回覆"))
+        latencies.append(time.perf_counter() - t0)
+        trips.append(counter.count - before)
+        if outputs[-1][3] is not None:
+            # 模擬摘要提交，讓下一段的游標前進
+            redis_store.commit_summary_chunk(uid, outputs[-1][3], CHUNK, f"摘要{i}")
+    return {
+        "uid": uid,
+        "trips": sum(trips) / len(trips),
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p95_ms": _p95(latencies) * 1000,
+        "outputs": outputs,
+    }
+
+
+def check_semantics(r, prefix: str) -> List[str]:
+    errors = []
+    uid = f"{prefix}sem"
+    lock_id = f"{uid}#audio:x"
+    ok, _ = redis_store.begin_audio_turn(uid, "x", lock_id)
+    again, cached = redis_store.begin_audio_turn(uid, "x", lock_id)
+    if not ok or again or cached:
+        errors.append("鎖被占用時應回傳 (False, 尚無結果)")
+    first = redis_store.commit_turn(uid, {"input": "q", "output": "a", "rid": "dup"}, audio_id="x", reply="a", lock_id=lock_id)
+    if not first[0] or r.exists(f"lock:audio:{lock_id}"):
+        errors.append("commit_turn 後應完成登記並釋放鎖")
+    again, cached = redis_store.begin_audio_turn(uid, "x", lock_id)
+    if not again:
+        errors.append("鎖釋放後應可再次取得")
+    dup = redis_store.commit_turn(uid, {"input": "q", "output": "a", "rid": "dup"}, audio_id="x", reply="a", lock_id=lock_id)
+    if dup[0] or r.llen(f"session:{uid}:history") != 1 or r.exists(f"lock:audio:{lock_id}"):
+        errors.append("重複的 rid 不應落歷史，但仍應釋放鎖")
+    if r.get(f"audio:{uid}:x:result") != "a" or r.ttl(f"session:active:{uid}") <= 0:
+        errors.append("commit_turn 應寫入結果快取並刷新 session")
+    return errors
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="每輪對話的 Redis 往返次數")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--rtt-ms", type=float, default=0.3, help="fakeredis 時每次往返的模擬延遲")
+    args = parser.parse_args(argv)
+
+    try:
+        r = redis.Redis.from_url(args.redis_url, decode_responses=True)
+        r.ping()
+        rtt, source = 0.0, args.redis_url
+    except redis.RedisError:
+        r = fakeredis.FakeRedis(decode_responses=True)
+        rtt, source = args.rtt_ms / 1000, f"fakeredis（模擬 RTT {args.rtt_ms}ms）"
+    redis_store.get_redis = lambda: r
+    redis_store.ProfileRepository = _NoopProfileRepository
+    prefix = f"bench{int(time.time() * 1000)}:"
+
+    counter = RoundTrips(rtt)
+    errors: List[str] = []
+    try:
+        # 每輪的 session 啟動/刷新訊息不輸出
+        with counter.counting(), redirect_stdout(io.StringIO()):
+            results = {
+                name: bench(r, prefix, name, fn, args.turns, counter)
+                for name, fn in (("separate", separate_turn), ("pipelined", pipelined_turn))
+            }
+        with redirect_stdout(io.StringIO()):
+            errors += check_semantics(r, prefix)
+    finally:
+        keys = list(r.scan_iter(match=f"*{prefix}*"))
+        if keys:
+            r.delete(*keys)
+
+    print(f"=== 每輪 Redis 往返（{args.turns} 輪，{source}）===")
+    for name, res in results.items():
+        print(f"{name:<10} 往返 {res['trips']:.1f} 次／輪｜平均 {res['mean_ms']:.2f}ms｜p95 {res['p95_ms']:.2f}ms")
+
+    sep, pipe = results["separate"]["outputs"], results["pipelined"]["outputs"]
+    if sep != pipe:
+        errors.append("pipelined 與 separate 的讀取結果或待摘要段落不一致")
+    if results["pipelined"]["trips"] > 3:
+        errors.append(f"pipelined 每輪往返 {results['pipelined']['trips']:.1f} 次，預期不超過 3 次")
+
+    print(f"[檢查] {'通過' if not errors else f'失敗（{len(errors)} 項）'}")
+    for line in errors:
+        print("  - " + line)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
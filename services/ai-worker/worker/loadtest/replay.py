@@ -0,0 +1,314 @@
+"""
+Offline replay load test for the AI worker task queue
+
+以「真實」的消費者程式碼（main.on_task_message → LLMService → chat_pipeline）重播
+錄製或合成的 task_queue 訊息流；LLM / embedding / Milvus / LINE / STT / TTS 換成
+loadtest.stubs 的確定性替身，Redis 使用本地實例（REDIS_URL）或 fakeredis。
+
+用法（於 worker/ 目錄下）：
+    python -m loadtest.replay --messages 200 --users 50 --audio-ratio 0.3 --concurrency 1
+    python -m loadtest.replay --input recorded.jsonl --latency llm=lognormal:1500,0.4 --time-scale 0.1
+    python -m loadtest.replay --fake-redis --json report.json
+    python -m loadtest.replay --input recorded.jsonl --agent-mode direct --live-llm   # 比較主回覆執行模式
+
+錄製檔為 JSONL，每行是一筆 task_queue 訊息 body（或 {"body": {...}}）。
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import queue
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple
+
+WORKER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if WORKER_DIR not in sys.path:
+    sys.path.insert(0, WORKER_DIR)
+
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(WORKER_DIR), "Anya_music.m4a")
+
+_PHRASES = [
+    "早安",
+    "謝謝",
+    "我今天走路有一點喘",
+    "吸入器怎麼用",
+    "上次醫生說的藥要飯後吃嗎",
+    "晚上咳嗽睡不好",
+    "今天孫子來看我",
+]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """nearest-rank 百分位數。"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.4999)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def _audio_duration_ms(path: str) -> int:
+    try:
+        from mutagen import File
+
+        return int(File(path).info.length * 1000)
+    except Exception:
+        return 0
+
+
+def synthetic_stream(n: int, users: int, audio_ratio: float, seed: int) -> List[Dict]:
+    rng = random.Random(seed)
+    messages = []
+    for i in range(n):
+        uid = 1000 + rng.randrange(max(1, users))
+        base = {"patient_id": uid, "line_user_id": f"U{uid:032d}", "task_id": f"lt-{seed}-{i}"}
+        if rng.random() < audio_ratio:
+            base.update({"bucket_name": "audio-uploads", "object_name": f"{uid}_lt{i}.m4a"})
+        else:
+            base["text"] = rng.choice(_PHRASES)
+        messages.append(base)
+    return messages
+
+
+def recorded_stream(path: str) -> List[Dict]:
+    messages = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            messages.append(obj.get("body", obj) if isinstance(obj, dict) else obj)
+    return messages
+
+
+def parse_latencies(specs: List[str]):
+    from loadtest.stubs import BACKENDS, DEFAULT_LATENCIES, LatencyModel
+
+    merged = dict(DEFAULT_LATENCIES)
+    for spec in specs or []:
+        backend, _, model = spec.partition("=")
+        if backend not in BACKENDS:
+            raise SystemExit(f"未知的後端 {backend!r}，可用：{', '.join(BACKENDS)}")
+        merged[backend] = model
+    return {k: LatencyModel.parse(v) for k, v in merged.items()}
+
+
+def install_stubs(clock, fixtures: Dict[str, str], fake_redis: bool, live_llm: bool = False):
+    """
+    匯入消費者程式碼並把外部後端換成替身；回傳 (main 模組, FakeBroker)。
+    live_llm=True 時保留真實的 OpenAI / CrewAI（需要 OPENAI_API_KEY），用於比較延遲與 token 成本。
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "sk-loadtest")
+    os.environ.setdefault("METRICS_PORT", "0")
+
+    # LLMService 在第一個任務建立時會連線 Milvus，先行替換
+    from pymilvus import connections
+
+    connections.connect = lambda *a, **k: None
+    connections.get_connection = lambda *a, **k: None
+
+    import pika
+
+    from loadtest import stubs
+
+    broker = stubs.FakeBroker(clock)
+    pika.BlockingConnection = broker.connection_factory
+    stubs.StubOpenAI.clock = clock
+    stubs.StubSTTService.clock = clock
+    stubs.StubSTTService.fixtures = fixtures
+    stubs.StubTTSService.clock = clock
+
+    import crewai
+    import main
+    import llm_app.HealthBot.agent as agent
+    import llm_app.toolkits.llm_client as llm_client
+    import llm_app.toolkits.redis_store as redis_store
+    import llm_app.toolkits.tools as tools
+    from llm_app.repositories.profile_repository import ProfileRepository
+
+    if not live_llm:
+        stub_client = stubs.StubOpenAI()
+        llm_client._base_client = lambda: stub_client
+        crewai.Crew.kickoff = stubs.stub_crew_kickoff(clock)
+    tools.SearchMilvusTool._run = stubs.stub_search_milvus(clock)
+    agent.retrieve_memory_pack_v3 = stubs.stub_memory_pack(clock)
+    stt, tts = stubs.StubSTTService(), stubs.StubTTSService()
+    main.get_stt_service = lambda: stt
+    main.get_tts_service = lambda: tts
+    stubs.InMemoryProfiles(clock).install(ProfileRepository)
+
+    if fake_redis:
+        import fakeredis
+
+        fake = fakeredis.FakeRedis(decode_responses=True)
+        redis_store.get_redis = lambda: fake
+        llm_client.get_redis = lambda: fake
+    return main, broker
+
+
+def run_replay(on_message, broker, messages: List[Dict], concurrency: int, rate: float, quiet: bool):
+    """以 concurrency 條消費執行緒重播訊息；rate>0 時依固定速率投遞，否則一次全部入列。"""
+    from loadtest.stubs import FakeChannel
+
+    q: "queue.Queue[Optional[Tuple[int, Dict, SimpleNamespace]]]" = queue.Queue()
+    channel = FakeChannel(broker)
+
+    def produce():
+        for i, body in enumerate(messages):
+            props = SimpleNamespace(
+                headers={"x-enqueued-at-ms": int(time.time() * 1000)},
+                message_id=body.get("task_id"),
+                timestamp=int(time.time()),
+            )
+            q.put((i, body, props))
+            if rate > 0:
+                time.sleep(1.0 / rate)
+        for _ in range(concurrency):
+            q.put(None)
+
+    def consume():
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            i, body, props = item
+            method = SimpleNamespace(delivery_tag=i + 1, redelivered=False)
+            on_message(channel, method, props, json.dumps(body, ensure_ascii=False).encode("utf-8"))
+
+    out = io.StringIO() if quiet else sys.stdout
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(out):
+        threads = [threading.Thread(target=consume, name=f"consumer-{n}") for n in range(concurrency)]
+        for t in threads:
+            t.start()
+        produce()
+        for t in threads:
+            t.join()
+    return time.perf_counter() - started
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="AI worker task_queue 離線重播壓測")
+    parser.add_argument("--input", help="錄製的 task_queue 訊息 JSONL；省略則產生合成訊息")
+    parser.add_argument("--messages", type=int, default=100, help="合成訊息數")
+    parser.add_argument("--users", type=int, default=20, help="合成訊息涵蓋的使用者數")
+    parser.add_argument("--audio-ratio", type=float, default=0.2, help="合成訊息中語音任務的比例")
+    parser.add_argument("--fixture", default=DEFAULT_FIXTURE, help="語音任務使用的本地音檔")
+    parser.add_argument("--concurrency", type=int, default=1, help="消費執行緒數")
+    parser.add_argument("--rate", type=float, default=0.0, help="投遞速率（訊息/秒，0=一次全部入列）")
+    parser.add_argument("--latency", action="append", default=[], metavar="BACKEND=SPEC",
+                        help="例如 llm=lognormal:900,0.35、tts=const:5000、stt=uniform:1500,3000")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="替身延遲縮放倍率（0.1 = 快 10 倍）")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--fake-redis", action="store_true", help="使用 fakeredis 取代 REDIS_URL 實例")
+    parser.add_argument("--agent-mode", choices=("crew", "direct"), help="主回覆執行模式（預設沿用 HEALTH_AGENT_MODE）")
+    parser.add_argument("--stream", action="store_true", help="開啟串流回覆（STREAM_REPLY），量測首句延遲")
+    parser.add_argument("--live-llm", action="store_true", help="不替換 OpenAI / CrewAI，實際呼叫 LLM")
+    parser.add_argument("--tracemalloc", action="store_true", help="以 tracemalloc 追蹤 Python 配置高水位")
+    parser.add_argument("--verbose", action="store_true", help="保留消費者程式碼的輸出")
+    parser.add_argument("--json", dest="json_path", help="將報告另存為 JSON")
+    args = parser.parse_args(argv)
+
+    from loadtest.stubs import StubClock
+
+    clock = StubClock(parse_latencies(args.latency), seed=args.seed, time_scale=args.time_scale)
+    messages = recorded_stream(args.input) if args.input else synthetic_stream(
+        args.messages, args.users, args.audio_ratio, args.seed
+    )
+    fixtures = {m["object_name"]: args.fixture for m in messages if m.get("object_name")}
+    duration_ms = _audio_duration_ms(args.fixture)
+    for m in messages:
+        if m.get("object_name") and not m.get("duration_ms"):
+            m["duration_ms"] = duration_ms
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    consumer, broker = install_stubs(clock, fixtures, args.fake_redis, args.live_llm)
+
+    import llm_app.chat_pipeline as chat_pipeline
+
+    if args.agent_mode:
+        chat_pipeline.HEALTH_AGENT_MODE = args.agent_mode
+    if args.stream:
+        consumer.STREAM_REPLY = True
+
+    from observability.metrics import registry
+
+    samples: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+    registry.add_observer(
+        lambda name, value, labels: samples[(name, labels.get("stage") or labels.get("step") or "")].append(value)
+    )
+
+    elapsed = run_replay(
+        consumer.on_task_message, broker, messages, max(1, args.concurrency), args.rate, quiet=not args.verbose
+    )
+
+    errors = sum(registry.get_counter("ai_worker_tasks_total", {"kind": k, "status": "error"}) for k in ("text", "audio"))
+    report = {
+        "messages": len(messages),
+        "concurrency": args.concurrency,
+        "time_scale": args.time_scale,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_msg_per_s": round(len(messages) / elapsed, 3) if elapsed else 0.0,
+        "acked": broker.acked,
+        "notifications": len(broker.published),
+        "errors": int(errors),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+        "stages": {},
+    }
+    mode = chat_pipeline.HEALTH_AGENT_MODE
+    calls = registry.get_counter("ai_worker_main_llm_calls_total", {"mode": mode})
+    tokens = {
+        kind: registry.get_counter("ai_worker_main_llm_tokens_total", {"mode": mode, "kind": kind})
+        for kind in ("prompt", "completion")
+    }
+    report["main_llm"] = {
+        "mode": mode,
+        "live": args.live_llm,
+        "calls": int(calls),
+        "prompt_tokens": int(tokens["prompt"]),
+        "completion_tokens": int(tokens["completion"]),
+        "tokens_per_message": round(sum(tokens.values()) / len(messages), 1) if messages else 0.0,
+    }
+    if args.tracemalloc:
+        report["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0, 1)
+    for (name, label), values in sorted(samples.items()):
+        key = f"{name.replace('ai_worker_', '')}:{label}" if label else name.replace("ai_worker_", "")
+        report["stages"][key] = {
+            "n": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+        }
+
+    print("=== AI Worker 重播壓測報告 ===")
+    print(f"訊息 {report['messages']} 筆｜併發 {report['concurrency']}｜time_scale {report['time_scale']}")
+    print(f"總耗時 {report['elapsed_s']}s｜吞吐 {report['throughput_msg_per_s']} msg/s｜"
+          f"ack {report['acked']}｜通知 {report['notifications']}｜錯誤 {report['errors']}")
+    print(f"記憶體高水位 RSS {report['max_rss_mb']} MB"
+          + (f"｜tracemalloc peak {report['tracemalloc_peak_mb']} MB" if args.tracemalloc else ""))
+    ml = report["main_llm"]
+    print(f"主回覆模式 {ml['mode']}{'（真實 LLM）' if ml['live'] else '（替身）'}｜LLM 呼叫 {ml['calls']}｜"
+          f"prompt {ml['prompt_tokens']}｜completion {ml['completion_tokens']}｜每則 {ml['tokens_per_message']} tokens")
+    print(f"{'指標':<48}{'n':>6}{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}")
+    for key, st in report["stages"].items():
+        print(f"{key:<48}{st['n']:>6}{st['p50_ms']:>10}{st['p95_ms']:>10}{st['p99_ms']:>10}")
+
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+Session storage memory footprint
+
+比較 10k 個進行中 session 在 Redis 上的佔用：
+- legacy：歷史為 JSON 物件字串、list 不裁切、摘要逐段附加不設上限
+- compact：encode_round 精簡編碼、提交摘要時（list 超過 HISTORY_MAX_ROUNDS 輪）LTRIM 到只剩
+  HISTORY_KEEP_SUMMARIZED 輪已摘要回合、摘要超過 SUMMARY_MAX_CHARS 即濃縮
+預設依序量測 20 / 60 / 120 輪的 session：20 輪還沒有可裁切的回合（只有編碼的差異），
+60 與 120 輪超過保留量，裁切與濃縮才會生效。
+
+大量 session 直接以 pipeline 寫入兩種格式的最終狀態；另取 --verify 個 session 以實際的
+commit_turn / commit_summary_chunk / replace_summary 逐輪執行（濃縮以固定長度的假摘要代替 LLM），
+檢查實際產生的狀態與直接寫入的相同。
+
+連得上 --redis-url 時以 INFO used_memory 的差值計算佔用；否則用 fakeredis，改以 key 名稱 + 內容的位元組數估算。
+
+用法（於 worker/ 目錄下）：
+    python -m loadtest.session_memory_bench
+    python -m loadtest.session_memory_bench --redis-url redis://localhost:6379/15 --sessions 10000 --rounds 60,200
+任一檢查失敗時以非零結束碼離開。
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import random
+import sys
+from contextlib import redirect_stdout
+from typing import Dict, List, Tuple
+
+import fakeredis
+import redis
+
+import llm_app.toolkits.redis_store as redis_store
+from llm_app.toolkits.redis_store import HISTORY_KEEP_SUMMARIZED, HISTORY_MAX_ROUNDS, SUMMARY_MAX_CHARS, encode_round
+
+CHUNK = 5
+PHRASES = ["今天早上有點喘", "吸入器有按時用", "晚上咳嗽比較多", "孫子週末要回來", "散步二十分鐘", "胸口悶悶的", "藥快吃完了"]
+
+
+class _NoopProfileRepository:
+    def touch_last_contact_ts(self, *args, **kwargs) -> None:
+        pass
+
+
+def synth_rounds(rng: random.Random, n: int) -> List[Dict]:
+    rounds = []
+    for i in range(n):
+        q = "，".join(rng.sample(PHRASES, rng.randint(1, 3)))
+        a = f"記得{rng.choice(PHRASES)}要跟醫師說喔，{rng.choice(['多喝溫水', '慢慢呼吸', '早點休息'])}。"
+        rid = hashlib.sha1(f"{q}|{i}|{rng.random()}".encode()).hexdigest()
+        rounds.append({"input": q, "output": a, "rid": rid})
+    return rounds
+
+
+def chunk_summary(start: int, size: int, chars: int) -> str:
+    return f"--- 第{start + 1}至{start + size}輪對話摘要 ---\n" + ("長輩近期偶有喘與咳嗽，按時使用吸入器，心情穩定。" * 8)[:chars]
+
+
+def compacted_summary(rounds: int) -> str:
+    """代替 LLM 的濃縮結果：固定為上限的一半長度。"""
+    return f"--- 第1至{rounds}輪對話摘要（已濃縮）---\n" + ("長期追蹤：喘、咳嗽、吸入器使用與家人近況。" * 60)[: SUMMARY_MAX_CHARS // 2]
+
+
+def legacy_state(rounds: List[Dict], chars: int) -> Tuple[List[str], str, int]:
+    cursor = len(rounds) // CHUNK * CHUNK
+    summary = "\n\n".join(chunk_summary(s, CHUNK, chars) for s in range(0, cursor, CHUNK))
+    return [json.dumps(r, ensure_ascii=False) for r in rounds], summary, cursor
+
+
+def compact_state(rounds: List[Dict], chars: int) -> Tuple[List[str], str, int, int]:
+    summary, cursor, base = "", 0, 0
+    for s in range(0, len(rounds) // CHUNK * CHUNK, CHUNK):
+        summary = (summary + "\n\n" if summary else "") + chunk_summary(s, CHUNK, chars)
+        cursor = s + CHUNK
+        # 同步摘要在湊滿一段時提交，此時 list 內有 cursor - base 輪
+        if HISTORY_KEEP_SUMMARIZED >= 0 and 0 <= HISTORY_MAX_ROUNDS < cursor - base:
+            base = max(base, cursor - HISTORY_KEEP_SUMMARIZED)
+        if len(summary) > SUMMARY_MAX_CHARS:
+            summary = compacted_summary(cursor)
+    return [encode_round(r) for r in rounds[base:]], summary, cursor, base
+
+
+def write_legacy(pipe, uid: str, rounds: List[Dict], chars: int) -> None:
+    history, summary, cursor = legacy_state(rounds, chars)
+    pipe.rpush(f"session:{uid}:history", *history)
+    if summary:
+        pipe.set(f"session:{uid}:summary:text", summary)
+        pipe.set(f"session:{uid}:summary:rounds", cursor)
+
+
+def write_compact(pipe, uid: str, rounds: List[Dict], chars: int) -> None:
+    history, summary, cursor, base = compact_state(rounds, chars)
+    pipe.rpush(f"session:{uid}:history", *history)
+    if summary:
+        pipe.set(f"session:{uid}:summary:text", summary)
+        pipe.set(f"session:{uid}:summary:rounds", cursor)
+    if base:
+        pipe.set(f"session:{uid}:history:base", base)
+
+
+def run_real(uid: str, rounds: List[Dict], chars: int) -> None:
+    """以實際的寫入路徑逐輪執行（摘要同步提交，濃縮以假摘要代替）。"""
+    with redirect_stdout(io.StringIO()):
+        for r in rounds:
+            _, start, chunk = redis_store.commit_turn(uid, r, chunk_size=CHUNK)
+            if start is None:
+                continue
+            redis_store.commit_summary_chunk(uid, start, len(chunk), chunk_summary(start, len(chunk), chars))
+            text, done = redis_store.get_summary(uid)
+            if len(text) > SUMMARY_MAX_CHARS:
+                redis_store.replace_summary(uid, text, compacted_summary(done))
+
+
+def footprint(r, prefix: str, real_redis: bool) -> int:
+    if real_redis:
+        return int(r.info("memory")["used_memory"])
+    total = 0
+    for key in r.scan_iter(match=f"session:{prefix}*", count=1000):
+        kind = r.type(key)
+        if kind == "list":
+            total += len(key.encode()) + sum(len(x.encode()) for x in r.lrange(key, 0, -1))
+        elif kind == "string":
+            total += len(key.encode()) + len(r.get(key).encode())
+    return total
+
+
+def measure(r, real_redis: bool, sessions: List[List[Dict]], chars: int) -> Dict[str, int]:
+    results = {}
+    for name, writer in (("legacy", write_legacy), ("compact", write_compact)):
+        prefix = f"mem{name}:"
+        before = footprint(r, prefix, real_redis) if real_redis else 0
+        pipe = r.pipeline(transaction=False)
+        for i, rounds in enumerate(sessions):
+            writer(pipe, f"{prefix}{i}", rounds, chars)
+            if i % 500 == 499:
+                pipe.execute()
+        pipe.execute()
+        results[name] = footprint(r, prefix, real_redis) - before
+        keys = list(r.scan_iter(match=f"session:{prefix}*", count=1000))
+        for j in range(0, len(keys), 1000):
+            r.delete(*keys[j : j + 1000])
+    return results
+
+
+def verify(r, sessions: List[List[Dict]], chars: int) -> List[str]:
+    """實際寫入路徑與直接寫入的最終狀態一致。"""
+    errors = []
+    for i, rounds in enumerate(sessions):
+        uid = f"memverify:{i}"
+        run_real(uid, rounds, chars)
+        history, summary, cursor, base = compact_state(rounds, chars)
+        actual = (
+            r.lrange(f"session:{uid}:history", 0, -1),
+            r.get(f"session:{uid}:summary:text") or "",
+            int(r.get(f"session:{uid}:summary:rounds") or 0),
+            int(r.get(f"session:{uid}:history:base") or 0),
+        )
+        if actual != (history, summary, cursor, base):
+            errors.append(f"session {i}：實際寫入的狀態與預期不同（history {len(actual[0])}/{len(history)}，"
+                          f"summary {len(actual[1])}/{len(summary)}，cursor {actual[2]}/{cursor}，base {actual[3]}/{base}）")
+            break
+        if redis_store.fetch_history_tail(uid, 2) != rounds[-2:]:
+            errors.append(f"session {i}：精簡編碼讀回的內容不一致")
+            break
+        r.delete(*redis_store.session_keys(uid))
+    return errors
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Session 儲存的記憶體佔用")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/15")
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--rounds", default="20,60,120", help="每個 session 的輪數（逗號分隔，逐一量測）")
+    parser.add_argument("--summary-chars", type=int, default=110, help="每段摘要的字數")
+    parser.add_argument("--verify", type=int, default=30, help="以實際寫入路徑驗證的 session 數")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args(argv)
+    round_counts = [int(x) for x in args.rounds.split(",") if x.strip()]
+
+    try:
+        r = redis.Redis.from_url(args.redis_url, decode_responses=True)
+        r.ping()
+        real_redis, source = True, args.redis_url
+    except redis.RedisError:
+        r = fakeredis.FakeRedis(decode_responses=True)
+        real_redis, source = False, "fakeredis（以 key + 內容位元組數估算）"
+    redis_store.get_redis = lambda: r
+    redis_store.ProfileRepository = _NoopProfileRepository
+    rng = random.Random(args.seed)
+    errors: List[str] = []
+
+    print(f"=== {args.sessions} 個 session（{source}）===")
+    print(f"HISTORY_MAX_ROUNDS={HISTORY_MAX_ROUNDS}，HISTORY_KEEP_SUMMARIZED={HISTORY_KEEP_SUMMARIZED}，SUMMARY_MAX_CHARS={SUMMARY_MAX_CHARS}")
+    for n in round_counts:
+        sessions = [synth_rounds(rng, n) for _ in range(args.sessions)]
+        results = measure(r, real_redis, sessions, args.summary_chars)
+        errors += [f"{n} 輪：{e}" for e in verify(r, sessions[: args.verify], args.summary_chars)]
+        kept = len(compact_state(sessions[0], args.summary_chars)[0])
+        saving = 1 - results["compact"] / results["legacy"] if results["legacy"] else 0.0
+        print(
+            f"{n:>4} 輪  legacy {results['legacy'] / 1024 / 1024:8.2f} MiB（{results['legacy'] / args.sessions / 1024:6.2f} KiB/session）｜"
+            f"compact {results['compact'] / 1024 / 1024:8.2f} MiB（{results['compact'] / args.sessions / 1024:6.2f} KiB/session，"
+            f"list 保留 {kept} 輪）｜節省 {saving:.1%}"
+        )
+        if results["compact"] >= results["legacy"]:
+            errors.append(f"{n} 輪：compact 佔用沒有比 legacy 小")
+
+    legacy_uid = "memverify:legacy"
+    first = synth_rounds(rng, 1)
+    r.rpush(f"session:{legacy_uid}:history", json.dumps(first[0], ensure_ascii=False))
+    if redis_store.fetch_all_history(legacy_uid) != first:
+        errors.append("舊格式（JSON 物件）讀取失敗")
+    r.delete(f"session:{legacy_uid}:history")
+
+    print(f"[檢查] {'通過' if not errors else f'失敗（{len(errors)} 項）'}")
+    for line in errors:
+        print("  - " + line)
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
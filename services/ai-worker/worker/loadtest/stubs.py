@@ -0,0 +1,358 @@
+"""
+Load-test backend stubs
+
+壓測用的確定性後端替身：LLM（OpenAI / CrewAI）、embedding、Milvus、Profile DB、
+STT / TTS / MinIO，以及通知佇列（RabbitMQ → LINE）。
+延遲依可設定的分佈以固定 seed 取樣，讓不同消費者設定之間的比較可重現。
+"""
+
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+from observability.metrics import stage_timer
+
+# 所有可設定延遲的後端名稱
+BACKENDS = ("llm", "embedding", "milvus", "postgres", "stt", "tts", "minio", "line")
+
+_REPLIES = [
+    "阿公，今天有記得出去走走嗎？",
+    "辛苦了，喘的時候先坐下來休息喔。",
+    "好的，我記住了，有不舒服要跟我說。",
+    "早安！今天天氣不錯，記得多喝水。",
+]
+_TRANSCRIPTS = [
+    "我今天走路有一點喘",
+    "早安",
+    "醫生說藥要飯後吃",
+    "吸入器怎麼用",
+]
+
+
+@dataclass
+class LatencyModel:
+    """延遲分佈（毫秒）：const:<ms>、uniform:<lo>,<hi>、lognormal:<中位數>,<sigma>。"""
+
+    kind: str
+    a: float
+    b: float = 0.0
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyModel":
+        kind, _, params = spec.partition(":")
+        try:
+            nums = [float(x) for x in params.split(",") if x.strip()]
+        except ValueError:
+            nums = []
+        if kind not in ("const", "uniform", "lognormal") or not nums:
+            raise ValueError(f"無效的延遲設定: {spec!r}")
+        return cls(kind, nums[0], nums[1] if len(nums) > 1 else 0.0)
+
+    def sample_ms(self, rng: random.Random) -> float:
+        if self.kind == "const":
+            return self.a
+        if self.kind == "uniform":
+            return rng.uniform(self.a, self.b)
+        return self.a * math.exp(rng.gauss(0.0, self.b))
+
+
+DEFAULT_LATENCIES = {
+    "llm": "lognormal:900,0.35",
+    "embedding": "lognormal:120,0.3",
+    "milvus": "lognormal:25,0.3",
+    "postgres": "const:3",
+    "stt": "lognormal:2500,0.25",
+    "tts": "lognormal:6000,0.25",
+    "minio": "const:40",
+    "line": "const:15",
+}
+
+
+class StubClock:
+    """依後端取樣延遲並 sleep；time_scale < 1 可壓縮整體執行時間。"""
+
+    def __init__(self, latencies: Dict[str, LatencyModel], seed: int = 42, time_scale: float = 1.0):
+        self._latencies = latencies
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.time_scale = time_scale
+
+    def wait(self, backend: str) -> None:
+        model = self._latencies.get(backend)
+        if model is None:
+            return
+        with self._lock:
+            ms = model.sample_ms(self._rng)
+        time.sleep(max(0.0, ms) * self.time_scale / 1000.0)
+
+
+def _pick(options: List[str], key: str) -> str:
+    idx = int(hashlib.sha1(key.encode("utf-8")).hexdigest(), 16) % len(options)
+    return options[idx]
+
+
+def _fake_vector(text: str, dim: int = 1536) -> List[float]:
+    rng = random.Random(hashlib.sha1(text.encode("utf-8")).hexdigest())
+    return [rng.uniform(-1.0, 1.0) for _ in range(dim)]
+
+
+def _completion(content: Optional[str], prompt_chars: int, tool_calls: Optional[List] = None) -> SimpleNamespace:
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content, tool_calls=tool_calls))],
+        usage=SimpleNamespace(
+            prompt_tokens=prompt_chars // 2,
+            completion_tokens=len(content or ""),
+            total_tokens=prompt_chars // 2 + len(content or ""),
+        ),
+    )
+
+
+def _stream_events(completion: SimpleNamespace, piece: int = 4):
+    """把一次完整回應切成串流事件（文字每 piece 字一段，最後一個事件帶 usage）。"""
+    msg = completion.choices[0].message
+    if msg.tool_calls:
+        yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=None, tool_calls=[
+            SimpleNamespace(index=i, id=c.id, function=c.function) for i, c in enumerate(msg.tool_calls)
+        ]))])
+    content = msg.content or ""
+    for i in range(0, len(content), piece):
+        yield SimpleNamespace(usage=None, choices=[
+            SimpleNamespace(delta=SimpleNamespace(content=content[i:i + piece], tool_calls=None))
+        ])
+    yield SimpleNamespace(usage=completion.usage, choices=[])
+
+
+def _current_query(task_description: str) -> str:
+    _, _, rest = task_description.partition("[使用者本輪輸入]:\n")
+    return rest.split("\n", 1)[0]
+
+
+# direct 模式替身的工具觸發詞：緊急 → alert_case_manager；衛教提問 → search_milvus
+_EMERGENCY_WORDS = ("胸痛", "喘不過氣", "不想活")
+_KNOWLEDGE_WORDS = ("怎麼", "什麼")
+
+
+def _tool_call_for(messages: List[Dict], tools: Optional[List[Dict]], tool_choice) -> Optional[List]:
+    """direct 模式：依本輪輸入的觸發詞，第一輪回傳工具呼叫，之後產生最終回覆。"""
+    if not tools or tool_choice == "none" or any(m.get("role") == "tool" for m in messages):
+        return None
+    offered = {t.get("function", {}).get("name") for t in tools}
+    user = next((m.get("content") or "" for m in messages if m.get("role") == "user"), "")
+    query = _current_query(user)
+    if "alert_case_manager" in offered and any(k in query for k in _EMERGENCY_WORDS):
+        name, args = "alert_case_manager", {"reason": f"EMERGENCY: {query[:20]}"}
+    elif "search_milvus" in offered and any(k in query for k in _KNOWLEDGE_WORDS):
+        name, args = "search_milvus", {"query": query}
+    else:
+        return None
+    call_id = "call_" + hashlib.sha1((name + query).encode("utf-8")).hexdigest()[:12]
+    arguments = json.dumps(args, ensure_ascii=False)
+    return [SimpleNamespace(id=call_id, type="function", function=SimpleNamespace(name=name, arguments=arguments))]
+
+
+def _answer_for(messages: List[Dict]) -> str:
+    system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+    user = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    if "USE 或 SKIP" in system:
+        return "USE" if any(k in user for k in ("上次", "之前", "醫生", "藥")) else "SKIP"
+    if "安全審查" in system:
+        return "OK"
+    if "記憶蒸餾" in system:
+        return "[]"
+    if "摘要" in system or "摘要" in user:
+        return "長輩分享了近況，提到走路會喘，情緒穩定。"
+    return _pick(_REPLIES, user)
+
+
+class StubOpenAI:
+    """取代 openai.OpenAI：chat.completions / embeddings 皆為確定性輸出。"""
+
+    clock: Optional[StubClock] = None
+
+    def __init__(self, *args, **kwargs):
+        clock = StubOpenAI.clock
+
+        def create_chat(model=None, messages=None, **kw):
+            if clock:
+                clock.wait("llm")
+            messages = messages or []
+            chars = sum(len(m.get("content") or "") for m in messages)
+            chars += sum(len(json.dumps(t, ensure_ascii=False)) for t in kw.get("tools") or [])
+            tool_calls = _tool_call_for(messages, kw.get("tools"), kw.get("tool_choice"))
+            if tool_calls:
+                completion = _completion(None, chars, tool_calls)
+            else:
+                completion = _completion(_answer_for(messages), chars)
+            return _stream_events(completion) if kw.get("stream") else completion
+
+        def create_embedding(model=None, input=None, **kw):
+            if clock:
+                clock.wait("embedding")
+            inputs = input if isinstance(input, list) else [input]
+            return SimpleNamespace(data=[SimpleNamespace(embedding=_fake_vector(str(x))) for x in inputs])
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=create_chat))
+        self.embeddings = SimpleNamespace(create=create_embedding)
+
+
+class FakeChannel:
+    """行程內的 RabbitMQ channel：記錄發布的訊息與 ack。"""
+
+    def __init__(self, broker: "FakeBroker"):
+        self._broker = broker
+
+    def queue_declare(self, queue, durable=False, **kwargs):
+        return SimpleNamespace(method=SimpleNamespace(queue=queue))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, **kwargs):
+        if self._broker.clock:
+            self._broker.clock.wait("line")
+        with self._broker.lock:
+            self._broker.published.append((routing_key, body))
+
+    def basic_ack(self, delivery_tag=None, **kwargs):
+        with self._broker.lock:
+            self._broker.acked += 1
+
+
+class FakeBroker:
+    """取代 pika.BlockingConnection 的行程內佇列。"""
+
+    def __init__(self, clock: Optional[StubClock] = None):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.published: List = []
+        self.acked = 0
+
+    def connection_factory(self, *args, **kwargs):
+        broker = self
+        return SimpleNamespace(
+            channel=lambda: FakeChannel(broker),
+            close=lambda: None,
+            is_open=True,
+            is_closed=False,
+        )
+
+
+class StubSTTService:
+    """以本地 fixture 取代 MinIO 下載與 ASR 推論。"""
+
+    clock: Optional[StubClock] = None
+    fixtures: Dict[str, str] = {}
+
+    def transcribe_audio(self, bucket_name: str, object_name: str) -> str:
+        path = self.fixtures.get(object_name)
+        with stage_timer("stt_decode"):
+            if path:
+                with open(path, "rb") as f:
+                    f.read()
+        with stage_timer("asr_inference"):
+            if self.clock:
+                self.clock.wait("stt")
+        return _pick(_TRANSCRIPTS, object_name)
+
+
+class StubTTSService:
+    clock: Optional[StubClock] = None
+
+    def synthesize_text(self, text: str):
+        with stage_timer("tts_generate"):
+            if self.clock:
+                self.clock.wait("tts")
+        with stage_timer("minio_upload"):
+            if self.clock:
+                self.clock.wait("minio")
+        object_name = "loadtest-" + hashlib.sha1(text.encode("utf-8")).hexdigest()[:12] + ".m4a"
+        return object_name, 250 * len(text)
+
+
+class InMemoryProfiles:
+    """Profile DB 替身（以 dict 保存，延遲以 postgres 後端模擬）。"""
+
+    def __init__(self, clock: Optional[StubClock] = None):
+        self.clock = clock
+        self._rows: Dict[int, SimpleNamespace] = {}
+        self._lock = threading.Lock()
+
+    def _row(self, user_id, line_user_id=None) -> SimpleNamespace:
+        if self.clock:
+            self.clock.wait("postgres")
+        with self._lock:
+            uid = int(user_id)
+            if uid not in self._rows:
+                self._rows[uid] = SimpleNamespace(
+                    user_id=uid,
+                    line_user_id=line_user_id,
+                    profile_personal_background={},
+                    profile_health_status={},
+                    profile_life_events={},
+                    last_contact_ts=None,
+                )
+            return self._rows[uid]
+
+    def install(self, repo_cls) -> None:
+        profiles = self
+
+        def get_or_create_by_user_id(self, user_id, line_user_id=None):
+            return profiles._row(user_id, line_user_id)
+
+        def read_profile_as_dict(self, user_id, line_user_id=None):
+            row = profiles._row(user_id, line_user_id)
+            return {
+                "personal_background": row.profile_personal_background,
+                "health_status": row.profile_health_status,
+                "life_events": row.profile_life_events,
+            }
+
+        def touch_last_contact_ts(self, user_id, line_user_id=None):
+            profiles._row(user_id, line_user_id).last_contact_ts = time.time()
+
+        def update_profile_facts(self, user_id, facts_to_update):
+            profiles._row(user_id)
+
+        repo_cls.get_or_create_by_user_id = get_or_create_by_user_id
+        repo_cls.read_profile_as_dict = read_profile_as_dict
+        repo_cls.touch_last_contact_ts = touch_last_contact_ts
+        repo_cls.update_profile_facts = update_profile_facts
+
+
+def stub_crew_kickoff(clock: Optional[StubClock]):
+    """產生取代 crewai.Crew.kickoff 的函式：guardrail 任務回 OK，其餘回確定性短句。"""
+
+    def kickoff(self, *args, **kwargs):
+        if clock:
+            clock.wait("llm")
+        desc = self.tasks[0].description if getattr(self, "tasks", None) else ""
+        raw = "OK" if "只判斷此輸入是否需要『攔截』" in desc else _pick(_REPLIES, desc)
+        # 只依任務描述估算用量，不含 CrewAI 自身的編排提示；兩種模式的實際差異請以 --live-llm 量測
+        usage = SimpleNamespace(
+            successful_requests=1, prompt_tokens=len(desc) // 2, completion_tokens=len(raw), total_tokens=len(desc) // 2 + len(raw)
+        )
+        return SimpleNamespace(raw=raw, token_usage=usage)
+
+    return kickoff
+
+
+def stub_search_milvus(clock: Optional[StubClock]):
+    def _run(self, query: str, topk: int = 5) -> str:
+        if clock:
+            clock.wait("embedding")
+            clock.wait("milvus")
+        return "📚 參考資料（壓測替身）：\nQ: " + query + "\nA: 請依醫囑使用，如有不適請就醫。\n"
+
+    return _run
+
+
+def stub_memory_pack(clock: Optional[StubClock]):
+    def retrieve_memory_pack_v3(user_id: str, query_vec, **kwargs) -> str:
+        if clock:
+            clock.wait("milvus")
+        return "⭐ 個人長期記憶：\n- 使用者每天早上散步（壓測替身）"
+
+    return retrieve_memory_pack_v3
@@ -2,14 +2,71 @@ import os
 import pika
 import json
 import time
+import uuid
 import logging
-from llm_app.llm_service import LLMService, llm_service_instance
+from domain.ai_task import ProcessingStep, TaskResult, TaskStatus
+from llm_app.llm_service import get_llm_service
+from llm_app.repositories.unit_of_work import unit_of_work
+from llm_app.toolkits.redis_store import load_task_checkpoints, save_task_checkpoint
+from llm_app.toolkits.summary_queue import start_summary_workers
+from llm_app.toolkits.task_context import task_context
+from observability.metrics import observe_queue_wait, observe_stage, record_task_result, start_metrics_server, track_task
+from observability import tracing
+from observability.startup import startup_phase, startup_report
 from llm_app.ProactiveCare.scheduler import scheduler, initialize_scheduler
-from stt_app.stt_service import STTService
-from tts_app.tts_service import TTSService
 
 logging.getLogger('apscheduler').setLevel(logging.WARNING)
 
+# 啟動時預先初始化的子系統（逗號分隔：llm, stt, tts；all = 全部）。
+# 未列出的子系統在第一個需要它的任務到來時才匯入與載入模型。
+AI_WORKER_WARMUP = os.environ.get("AI_WORKER_WARMUP", "")
+# 串流回覆：主回覆每產生一句就以 status=streaming 發佈到通知佇列（需 HEALTH_AGENT_MODE=direct），
+# 完整回覆仍以 status=completed 的通知送出
+STREAM_REPLY = os.environ.get("STREAM_REPLY", "false").lower() in ("1", "true", "yes")
+
+
+def get_stt_service():
+    """延遲匯入 STT（torch / transformers / ASR 模型）。"""
+    from stt_app.stt_service import get_stt_service as _get, _stt_service_instance
+
+    if _stt_service_instance is not None:
+        return _get()
+    with startup_phase("stt_service"):
+        return _get()
+
+
+def get_tts_service():
+    """延遲匯入 TTS（torch / transformers / SNAC / Orpheus 模型）。"""
+    from tts_app.tts_service import get_tts_service as _get, _tts_service_instance
+
+    if _tts_service_instance is not None:
+        return _get()
+    with startup_phase("tts_service"):
+        return _get()
+
+
+WARMUP_TARGETS = {
+    "llm": get_llm_service,
+    "stt": get_stt_service,
+    "tts": get_tts_service,
+}
+
+
+def warmup(spec: str = AI_WORKER_WARMUP):
+    """依設定預先初始化子系統；單一子系統失敗不影響 worker 啟動（首次任務時會再試）。"""
+    names = [n.strip().lower() for n in spec.split(",") if n.strip()]
+    if "all" in names:
+        names = list(WARMUP_TARGETS)
+    for name in names:
+        target = WARMUP_TARGETS.get(name)
+        if target is None:
+            print(f"⚠️ [AI Worker] 未知的 warmup 目標: {name}", flush=True)
+            continue
+        try:
+            target()
+        except Exception as e:
+            print(f"⚠️ [AI Worker] 預熱 {name} 失敗: {e}", flush=True)
+
 def initialize_database():
     """
     確保所有必要的資料庫和表格都已建立。
@@ -18,6 +75,7 @@ def initialize_database():
     print("--- 開始進行資料庫初始化檢查 ---", flush=True)
     try:
         from llm_app.models.chat_profile import create_profile_table_if_not_exists
+        import llm_app.models.llm_usage  # noqa: F401（註冊 llm_usage_daily 表）
         # 呼叫 SQLAlchemy 的 create_all()，它會自動檢查表格是否存在
         create_profile_table_if_not_exists()
         print("--- 資料庫初始化檢查完成 ---", flush=True)
@@ -28,6 +86,19 @@ def initialize_database():
         print("[!] 可能是資料庫服務尚未完全就緒，稍後重試...", flush=True)
         raise
 
+def _publish_to_queue(channel, notification_queue: str, message: dict):
+    with tracing.start_span(f"rabbitmq.publish {notification_queue}", kind=tracing.SPAN_KIND_PRODUCER):
+        channel.basic_publish(
+            exchange='',
+            routing_key=notification_queue,
+            body=json.dumps(message),
+            properties=pika.BasicProperties(
+                delivery_mode=2,
+                headers=tracing.inject({'x-enqueued-at-ms': int(time.time() * 1000)}),
+            )
+        )
+
+
 def publish_notification(message: dict, patient_id: int):
     """將訊息發佈到通知佇列。"""
     rabbitmq_host = os.environ.get("RABBITMQ_HOST", "rabbitmq")
@@ -38,77 +109,276 @@ def publish_notification(message: dict, patient_id: int):
         connection = pika.BlockingConnection(pika.ConnectionParameters(host=rabbitmq_host))
         channel = connection.channel()
         channel.queue_declare(queue=notification_queue, durable=True)
-        channel.basic_publish(
-            exchange='',
-            routing_key=notification_queue,
-            body=json.dumps(message_with_id),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
+        _publish_to_queue(channel, notification_queue, message_with_id)
         print(f"已發送通知: {message_with_id}", flush=True)
         connection.close()
+        return True
     except pika.exceptions.AMQPConnectionError as e:
         print(f"連線到 RabbitMQ 以發送通知時出錯: {e}", flush=True)
         raise
 
 
-def process_text_task(task_data={}):
+class ReplyChunkPublisher:
+    """
+    串流回覆的句子片段發佈器：同一任務的片段共用一條 RabbitMQ 連線，依 seq 遞增送出。
+    片段只是提早顯示用，發佈失敗不影響主流程（完整回覆仍會以 completed 通知送出）。
+    串流中途失敗時以 reset() 送出 status=stream_reset，接收端應捨棄已顯示的片段、等待完整回覆。
+    """
+
+    def __init__(self, patient_id, task_id=None):
+        self.patient_id = patient_id
+        self.task_id = task_id
+        self.seq = 0
+        self._started = time.perf_counter()
+        self._connection = None
+        self._channel = None
+        self._queue = os.environ.get("RABBITMQ_NOTIFICATION_QUEUE", "notifications_queue")
+
+    def _publish(self, message: dict) -> None:
+        if self._channel is None:
+            host = os.environ.get("RABBITMQ_HOST", "rabbitmq")
+            self._connection = pika.BlockingConnection(pika.ConnectionParameters(host=host))
+            self._channel = self._connection.channel()
+            self._channel.queue_declare(queue=self._queue, durable=True)
+        _publish_to_queue(self._channel, self._queue, {
+            "task_id": self.task_id,
+            "patient_id": self.patient_id,
+            "seq": self.seq,
+            **message,
+        })
+        self.seq += 1
+
+    def __call__(self, chunk: str) -> None:
+        try:
+            first = self.seq == 0
+            self._publish({"status": "streaming", "chunk": chunk})
+            if first:
+                observe_stage("reply_first_chunk", time.perf_counter() - self._started)
+        except Exception as e:
+            print(f"⚠️ 發佈串流片段失敗（略過）: {e}", flush=True)
+
+    def reset(self) -> None:
+        """已送出的片段作廢；尚未送出任何片段時不需通知。"""
+        if self.seq == 0:
+            return
+        try:
+            self._publish({"status": "stream_reset"})
+        except Exception as e:
+            print(f"⚠️ 發佈串流重置失敗（略過）: {e}", flush=True)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = self._channel = None
+
+
+def _reply_with_streaming(task_data: dict, task_id=None, stream=True) -> str:
+    """
+    產生主回覆；STREAM_REPLY 開啟時同時把句子片段發佈到通知佇列。
+    stream=False（重送的訊息）時不發佈片段：先前的投遞可能已送出部分片段，重送會從 seq 0 重複送出。
+    """
+    if not STREAM_REPLY or not stream:
+        return get_llm_service().generate_response(task_data=task_data)
+    publisher = ReplyChunkPublisher(task_data.get('patient_id'), task_id)
+    try:
+        return get_llm_service().generate_response(task_data=task_data, on_chunk=publisher, on_reset=publisher.reset)
+    except Exception:
+        publisher.reset()
+        raise
+    finally:
+        publisher.close()
+
+
+def resolve_task_id(task_data: dict, properties) -> tuple:
+    """
+    取得任務 ID 與是否可從檢查點續跑：producer 指派的 task_id / message_id 重送時保持不變，可續跑；
+    舊版 producer 未帶 ID 時產生一次性的 ID、不使用檢查點（內容相同的兩則訊息，例如連續回「好」，
+    是不同的任務，不能共用檢查點），重送時與原本一樣從頭執行。
+    """
+    task_id = task_data.get("task_id") or getattr(properties, "message_id", None)
+    if task_id:
+        return str(task_id), True
+    return uuid.uuid4().hex[:16], False
+
+
+def run_stage(task_id, checkpoints: dict, step: ProcessingStep, fn):
+    """
+    執行單一處理階段並寫入檢查點；若該階段已在先前的投遞中完成，直接沿用其輸出。
+    checkpoints 為 None 時（任務不可續跑）不讀也不寫檢查點。
+    """
+    if checkpoints is not None and step.value in checkpoints:
+        print(f" [↺] 任務 {task_id} 的 {step.value} 階段已完成，沿用檢查點結果。", flush=True)
+        return checkpoints[step.value]
+    result = TaskResult(step=step, status=TaskStatus.PENDING)
+    result.mark_started()
+    try:
+        with tracing.start_span(f"ai_worker.{step.value}"):
+            output = fn()
+    except Exception as e:
+        result.mark_failed(str(e))
+        record_task_result(result)
+        raise
+    result.mark_completed(output if isinstance(output, str) else json.dumps(output, ensure_ascii=False))
+    record_task_result(result)
+    if checkpoints is not None:
+        save_task_checkpoint(task_id, step.value, output)
+        checkpoints[step.value] = output
+    return output
+
+
+def enqueued_at_ms(properties):
+    """任務發布時間（毫秒）：優先讀 producer 標頭，否則退回 AMQP timestamp（秒）。"""
+    headers = getattr(properties, "headers", None) or {}
+    if headers.get("x-enqueued-at-ms"):
+        return int(headers["x-enqueued-at-ms"])
+    if getattr(properties, "timestamp", None):
+        return int(properties.timestamp) * 1000
+    return None
+
+
+def process_text_task(task_data={}, task_id=None, stream=True):
     """透過 llm-app 來處理文字訊息。"""
     print("建立 LLM 服務...", flush=True)
-    response = llm_service_instance.generate_response(task_data=task_data)
+    response = _reply_with_streaming(task_data, task_id, stream=stream)
     print(f"成功呼叫 LLM 服務。回應: {response}", flush=True)
     return response
 
 
-def process_audio_task(patient_id: int, audio_duration_ms=60000, task_data={}):
+def _transcribe(task_data: dict) -> str:
+    print(f"--- 開始 STT 處理: {task_data['object_name']} ---", flush=True)
+    user_transcript = get_stt_service().transcribe_audio(task_data['bucket_name'], task_data['object_name'])
+    if not user_transcript:
+        raise ValueError("STT 服務未返回有效的轉錄文字")
+    return user_transcript
+
+
+def _generate_reply(task_data: dict, task_id=None, stream=True) -> str:
+    print(f"--- 開始 LLM 處理 ---", flush=True)
+    ai_response = _reply_with_streaming(task_data, task_id, stream=stream)
+    if not ai_response:
+        raise ValueError("LLM 服務未返回有效的 AI 回應")
+    return ai_response
+
+
+def _synthesize(ai_response: str):
+    print(f"--- 開始 TTS 處理 ---", flush=True)
+    response_audio_url, duration_ms = get_tts_service().synthesize_text(ai_response)
+    if not response_audio_url:
+        raise ValueError("TTS 服務未返回有效的音訊物件名稱")
+    return [response_audio_url, duration_ms]
+
+
+def process_audio_task(patient_id: int, audio_duration_ms=60000, task_data={}, task_id=None, resumable=True,
+                       stream=True):
     """
     透過 STT -> LLM -> TTS 管道處理音訊檔案任務。
+    每個階段完成後寫入檢查點，訊息被重送時會從最後完成的階段續跑（resumable=False 時不使用檢查點）。
+    stream=False 時不發佈串流片段（見 _reply_with_streaming）。
     """
+    checkpoints = load_task_checkpoints(task_id) if task_id and resumable else None
     try:
         # 步驟 1: STT - 語音轉文字
-        print(f"--- 開始 STT 處理: {task_data['object_name']} ---", flush=True)
-        user_transcript = STTService().transcribe_audio(task_data['bucket_name'], task_data['object_name'])
-        if not user_transcript:
-            raise ValueError("STT 服務未返回有效的轉錄文字")
+        user_transcript = run_stage(task_id, checkpoints, ProcessingStep.STT, lambda: _transcribe(task_data))
         task_data['text'] = user_transcript  # 將轉錄文字加入 task_data
         print(f"STT 結果: {user_transcript}", flush=True)
 
-
         # 步驟 2: LLM - 產生 AI 回應
-        print(f"--- 開始 LLM 處理 ---", flush=True)
-        ai_response = llm_service_instance.generate_response(task_data=task_data)
-        if not ai_response:
-            raise ValueError("LLM 服務未返回有效的 AI 回應")
+        ai_response = run_stage(task_id, checkpoints, ProcessingStep.LLM, lambda: _generate_reply(task_data, task_id, stream=stream))
         print(f"LLM 結果: {ai_response}", flush=True)
 
-
         # 步驟 3: TTS - 文字轉語音
-        print(f"--- 開始 TTS 處理 ---", flush=True)
-        response_audio_url, duration_ms = TTSService().synthesize_text(ai_response)
-        if not response_audio_url:
-            raise ValueError("TTS 服務未返回有效的音訊物件名稱")
+        response_audio_url, duration_ms = run_stage(
+            task_id, checkpoints, ProcessingStep.TTS, lambda: _synthesize(ai_response)
+        )
         print(f"TTS 結果: {response_audio_url}", flush=True)
 
         # 步驟 4: 發送成功通知
         notification_message = {
             "status": "completed",
+            "task_id": task_id,
             "original_file": task_data['object_name'],
             "user_transcript": user_transcript,
             "ai_response": ai_response,
             "response_audio_url": response_audio_url,
             "audio_duration_ms": duration_ms
         }
-        publish_notification(notification_message, patient_id)
+        run_stage(
+            task_id, checkpoints, ProcessingStep.NOTIFICATION,
+            lambda: publish_notification(notification_message, patient_id),
+        )
 
     except Exception as e:
         print(f"音訊處理管道中發生錯誤: {e}", flush=True)
         error_notification = {
             "status": "error",
+            "task_id": task_id,
             "original_file": task_data['object_name'],
             "error_message": str(e)
         }
         publish_notification(error_notification, patient_id)
         raise
 
+def on_task_message(ch, method, properties, body):
+    """task_queue 的消費回呼：解析任務、依類型執行管道，最後一律 ack。"""
+    received_ns = time.time_ns()
+    task_data = json.loads(body)
+    task_id, resumable = resolve_task_id(task_data, properties)
+    enqueued_ms = enqueued_at_ms(properties)
+    observe_queue_wait(enqueued_ms)
+    kind = "text" if 'text' in task_data else "audio"
+
+    # 延續 web-app 帶來的 trace；佇列等待記成獨立 span，方便區分排隊與運算時間
+    parent = tracing.extract(getattr(properties, "headers", None))
+    if enqueued_ms and parent:
+        tracing.record_span("rabbitmq.queue task_queue", enqueued_ms * 1_000_000, received_ns,
+                            kind=tracing.SPAN_KIND_CONSUMER, parent=parent)
+    try:
+        with tracing.start_span("ai_worker.task", kind=tracing.SPAN_KIND_CONSUMER, parent=parent,
+                                attributes={"task.id": task_id, "task.kind": kind,
+                                            "messaging.redelivered": bool(method.redelivered)}) as span, \
+                track_task(kind), \
+                task_context(user_id=task_data.get('patient_id'), line_user_id=task_data.get('line_user_id'),
+                             request_id=task_id), \
+                unit_of_work():
+            print(f"\n [x] 收到任務 {task_id}（trace {span.trace_id}）"
+                  f"{' (重送)' if method.redelivered else ''}: {task_data}", flush=True)
+            patient_id = task_data.get('patient_id')
+            if not patient_id:
+                raise ValueError("任務資料缺少 'patient_id'")
+
+            if 'text' in task_data:
+                print(f" [*] 開始為病患 {patient_id} 處理文字任務...", flush=True)
+                checkpoints = load_task_checkpoints(task_id) if resumable else None
+                llm_response = run_stage(
+                    task_id, checkpoints, ProcessingStep.LLM,
+                    lambda: process_text_task(task_data=task_data, task_id=task_id, stream=not method.redelivered),
+                )
+                notification = {
+                    "status": "completed",
+                    "task_id": task_id,
+                    "user_transcript": task_data['text'],
+                    "ai_response": llm_response
+                }
+                run_stage(
+                    task_id, checkpoints, ProcessingStep.NOTIFICATION,
+                    lambda: publish_notification(notification, patient_id),
+                )
+            elif 'bucket_name' in task_data and 'object_name' in task_data:
+                audio_duration_ms = task_data.get('duration_ms')
+                print(f" [*] 開始為病患 {patient_id} 處理音訊任務...", flush=True)
+                process_audio_task(patient_id, audio_duration_ms, task_data=task_data, task_id=task_id,
+                                   resumable=resumable, stream=not method.redelivered)
+            else:
+                print(f" [!] 未知的任務格式: {task_data}", flush=True)
+        print(f" [✔] 任務成功完成。", flush=True)
+    except Exception as e:
+        print(f" [!] 處理任務時出錯: {e}", flush=True)
+    ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
 if __name__ == '__main__':
 
     # 帶有重試機制的啟動檢查，確保在 postgres 容器完全就緒後再繼續
@@ -116,7 +386,8 @@ if __name__ == '__main__':
     retry_delay = 5
     for i in range(max_retries):
         try:
-            initialize_database()
+            with startup_phase("database"):
+                initialize_database()
             break # 初始化成功，跳出循環
         except Exception as e:
             if i < max_retries - 1:
@@ -131,11 +402,24 @@ if __name__ == '__main__':
         # 1. 呼叫初始化函式，將任務新增到排程器中
         initialize_scheduler()
         # 2. 啟動排程器
-        scheduler.start()
+        with startup_phase("scheduler"):
+            scheduler.start()
         print('✅ [AI Worker] 排程服務已成功啟動。', flush=True)
     except Exception as e:
         print(f"❌ [AI Worker] 啟動排程服務失敗: {e}", flush=True)
 
+    try:
+        start_metrics_server()
+    except OSError as e:
+        print(f"⚠️ [AI Worker] 指標端點啟動失敗: {e}", flush=True)
+
+    # 對話摘要改由背景執行緒處理（SUMMARY_ASYNC=false 時回到回覆流程內同步摘要）
+    start_summary_workers()
+
+    # 重型子系統（CrewAI / torch / Milvus）預設延遲到第一個任務；AI_WORKER_WARMUP 可要求預先載入
+    warmup()
+    print(startup_report(), flush=True)
+
     rabbitmq_host = os.environ.get("RABBITMQ_HOST", "rabbitmq")
     task_queue = os.environ.get("RABBITMQ_QUEUE", "task_queue")
 
@@ -146,35 +430,7 @@ if __name__ == '__main__':
             channel.queue_declare(queue=task_queue, durable=True)
             print(' [*] AI Worker 正在等待訊息。按 CTRL+C 離開', flush=True)
 
-            def callback(ch, method, properties, body):
-                task_data = json.loads(body)
-                print(f"\n [x] 收到任務: {task_data}", flush=True)
-                try:
-                    patient_id = task_data.get('patient_id')
-                    if not patient_id:
-                        raise ValueError("任務資料缺少 'patient_id'")
-
-                    if 'text' in task_data:
-                        print(f" [*] 開始為病患 {patient_id} 處理文字任務...", flush=True)
-                        llm_response = process_text_task(task_data=task_data)
-                        notification = {
-                            "status": "completed",
-                            "user_transcript": task_data['text'],
-                            "ai_response": llm_response
-                        }
-                        publish_notification(notification, patient_id)
-                    elif 'bucket_name' in task_data and 'object_name' in task_data:
-                        audio_duration_ms = task_data.get('duration_ms')
-                        print(f" [*] 開始為病患 {patient_id} 處理音訊任務...", flush=True)
-                        process_audio_task(patient_id, audio_duration_ms, task_data=task_data)
-                    else:
-                        print(f" [!] 未知的任務格式: {task_data}", flush=True)
-                    print(f" [✔] 任務成功完成。", flush=True)
-                except Exception as e:
-                    print(f" [!] 處理任務時出錯: {e}", flush=True)
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-
-            channel.basic_consume(queue=task_queue, on_message_callback=callback)
+            channel.basic_consume(queue=task_queue, on_message_callback=on_task_message)
             channel.start_consuming()
         except pika.exceptions.AMQPConnectionError as e:
             print(f"與 RabbitMQ 的連線失敗: {e}。5 秒後重試...", flush=True)
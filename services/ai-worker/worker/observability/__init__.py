@@ -0,0 +1 @@
+# AI Worker observability (metrics / tracing)
@@ -0,0 +1,248 @@
+"""
+AI Worker Metrics
+
+輕量的行程內指標登錄器：各階段延遲直方圖、錯誤計數、佇列等待時間與處理中任務數。
+以 Prometheus 文字格式透過 /metrics 對外提供（僅用標準函式庫，不需額外套件）。
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .tracing import current_span, start_span
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))  # 0 = 不啟動 HTTP 端點
+
+# 秒；涵蓋 5ms 的 Redis/guardrail 快取命中到 60s 的長語音 TTS
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0,
+)
+
+# 已知階段（文件用途；observe 時不限制於此清單）
+STAGES = (
+    "stt_decode",
+    "asr_inference",
+    "guardrail",
+    "memory_gate",
+    "memory_retrieval",
+    "context_load",
+    "main_llm",
+    "reply_first_chunk",
+    "summarization",
+    "summary_compaction",
+    "tts_generate",
+    "snac_decode",
+    "m4a_encode",
+    "minio_upload",
+)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _escape_label_value(value: str) -> str:
+    """Prometheus 文字格式：label 值中的反斜線、雙引號與換行需跳脫。"""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.total += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class MetricsRegistry:
+    """執行緒安全的 counter / gauge / histogram 集合。"""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._gauges: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self._observers: List[Callable[[str, float, Dict[str, str]], None]] = []
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+
+    @staticmethod
+    def _key(labels: Optional[Dict[str, str]]) -> LabelKey:
+        return tuple(sorted((k, str(v)) for k, v in (labels or {}).items()))
+
+    def add_observer(self, fn: Callable[[str, float, Dict[str, str]], None]) -> None:
+        """註冊原始觀測值的接收者（例如壓測工具需要計算 p50/p95/p99）。"""
+        self._observers.append(fn)
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: Optional[Tuple[float, ...]] = None) -> None:
+        """buckets 只用於非秒數的 histogram（例如 token 數）；未指定時為 LATENCY_BUCKETS。"""
+        self._help[name] = (kind, help_text)
+        if buckets:
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None, value: float = 1.0) -> None:
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            key = self._key(labels)
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[self._key(labels)] = value
+
+    def add_gauge(self, name: str, delta: float, labels: Optional[Dict[str, str]] = None) -> None:
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            key = self._key(labels)
+            series[key] = series.get(key, 0.0) + delta
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None) -> None:
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            key = self._key(labels)
+            if key not in series:
+                series[key] = _Histogram(self._buckets.get(name, LATENCY_BUCKETS))
+            series[key].observe(value)
+        for fn in self._observers:
+            fn(name, value, labels or {})
+
+    def get_counter(self, name: str, labels: Optional[Dict[str, str]] = None) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(self._key(labels), 0.0)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """回傳目前所有數值（dict 形式，供除錯或寫入其他儲存）。"""
+        with self._lock:
+            return {
+                "counters": {n: {str(dict(k)): v for k, v in s.items()} for n, s in self._counters.items()},
+                "gauges": {n: {str(dict(k)): v for k, v in s.items()} for n, s in self._gauges.items()},
+                "histograms": {
+                    n: {str(dict(k)): {"count": h.total, "sum": h.sum} for k, h in s.items()}
+                    for n, s in self._histograms.items()
+                },
+            }
+
+    def render_prometheus(self) -> str:
+        def fmt_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+            pairs = list(key) + ([extra] if extra else [])
+            if not pairs:
+                return ""
+            body = ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in pairs)
+            return "{" + body + "}"
+
+        lines: List[str] = []
+        with self._lock:
+            for kind, store in (("counter", self._counters), ("gauge", self._gauges)):
+                for name, series in sorted(store.items()):
+                    help_text = self._help.get(name, (kind, ""))[1]
+                    lines.append(f"# HELP {name} {help_text}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for key, value in sorted(series.items()):
+                        lines.append(f"{name}{fmt_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# HELP {name} {self._help.get(name, ('histogram', ''))[1]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, h in sorted(series.items()):
+                    for bound, count in zip(h.buckets, h.counts):
+                        lines.append(f"{name}_bucket{fmt_labels(key, ('le', str(bound)))} {count}")
+                    lines.append(f"{name}_bucket{fmt_labels(key, ('le', '+Inf'))} {h.total}")
+                    lines.append(f"{name}_sum{fmt_labels(key)} {h.sum}")
+                    lines.append(f"{name}_count{fmt_labels(key)} {h.total}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+registry.describe("ai_worker_stage_latency_seconds", "histogram", "各處理階段耗時（秒）")
+registry.describe("ai_worker_stage_errors_total", "counter", "各處理階段失敗次數")
+registry.describe("ai_worker_task_step_duration_seconds", "histogram", "TaskResult 步驟耗時（秒）")
+registry.describe("ai_worker_queue_wait_seconds", "histogram", "任務從發布到開始處理的等待時間（秒）")
+registry.describe("ai_worker_tasks_in_flight", "gauge", "目前處理中的任務數")
+registry.describe("ai_worker_tasks_total", "counter", "已處理任務數（依類型與結果）")
+
+
+def observe_stage(stage: str, seconds: float, ok: bool = True) -> None:
+    registry.observe("ai_worker_stage_latency_seconds", seconds, {"stage": stage})
+    if not ok:
+        registry.inc("ai_worker_stage_errors_total", {"stage": stage})
+
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """
+    量測區塊耗時；區塊拋出例外時同時累計錯誤數（例外照常往外拋）。
+    若目前在追蹤中的任務內，同時記錄一個子 span。
+    """
+    span_cm = start_span(f"ai_worker.stage.{stage}") if current_span() else nullcontext()
+    start = time.perf_counter()
+    ok = False
+    try:
+        with span_cm:
+            yield
+        ok = True
+    finally:
+        observe_stage(stage, time.perf_counter() - start, ok=ok)
+
+
+def record_task_result(result) -> None:
+    """以 domain TaskResult 的 processing_time_ms 記錄步驟耗時與成敗。"""
+    step = result.step.value
+    if result.processing_time_ms is not None:
+        registry.observe("ai_worker_task_step_duration_seconds", result.processing_time_ms / 1000.0, {"step": step})
+    if result.error_message:
+        registry.inc("ai_worker_stage_errors_total", {"stage": step})
+
+
+def observe_queue_wait(enqueued_at_ms: Optional[int]) -> None:
+    if not enqueued_at_ms:
+        return
+    wait = max(0.0, time.time() - int(enqueued_at_ms) / 1000.0)
+    registry.observe("ai_worker_queue_wait_seconds", wait)
+
+
+@contextmanager
+def track_task(kind: str) -> Iterator[None]:
+    """處理中任務計數 + 任務結果計數。"""
+    registry.add_gauge("ai_worker_tasks_in_flight", 1, {"kind": kind})
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        registry.add_gauge("ai_worker_tasks_in_flight", -1, {"kind": kind})
+        registry.inc("ai_worker_tasks_total", {"kind": kind, "status": status})
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # noqa: N802 (http.server 介面)
+        if self.path.rstrip("/") != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # 不要每次 scrape 都印 log
+        return
+
+
+def start_metrics_server(port: int = METRICS_PORT) -> Optional[ThreadingHTTPServer]:
+    """在背景執行緒啟動 /metrics 端點；port=0 時不啟動。"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    print(f"📈 [Metrics] Prometheus 端點已啟動於 :{port}/metrics", flush=True)
+    return server
@@ -0,0 +1,105 @@
+"""
+AI Worker Startup Profile
+
+記錄啟動與延遲初始化各階段的耗時（匯入重型子系統、載入模型、連線外部服務），
+啟動完成時印出報告，並以 ai_worker_init_seconds{phase} gauge 對外提供。
+
+另提供匯入時間分析（以 `python -X importtime` 量測並依頂層套件彙總）：
+    python -m observability.startup            # 分析 import main
+    python -m observability.startup --module llm_app.chat_pipeline --top 15
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .metrics import registry
+
+# 行程內的啟動起點（main 匯入時最早載入 observability）
+_T0 = time.perf_counter()
+_lock = threading.Lock()
+_phases: List[Tuple[str, float]] = []
+
+registry.describe("ai_worker_init_seconds", "gauge", "Seconds spent in each startup / lazy-initialisation phase.")
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    """量測一個初始化階段（失敗時照常拋出，但不記錄耗時）。"""
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    with _lock:
+        _phases.append((name, elapsed))
+    registry.set_gauge("ai_worker_init_seconds", elapsed, {"phase": name})
+    print(f"⏱️ [Startup] {name}: {elapsed:.2f}s", flush=True)
+
+
+def startup_report() -> str:
+    with _lock:
+        phases = list(_phases)
+    lines = ["=== AI Worker 啟動耗時報告 ==="]
+    for name, elapsed in phases:
+        lines.append(f"  {name:<32}{elapsed:>8.2f}s")
+    lines.append(f"  {'自行程啟動至今':<32}{time.perf_counter() - _T0:>8.2f}s")
+    return "\n".join(lines)
+
+
+def parse_importtime(stderr: str) -> Dict[str, Dict[str, float]]:
+    """
+    解析 -X importtime 輸出，回傳 {頂層套件: {"self_s", "modules"}}。
+    以各模組的 self 時間依頂層套件加總：各套件互不重疊，總和即為整體匯入時間。
+    """
+    totals: Dict[str, Dict[str, float]] = defaultdict(lambda: {"self_s": 0.0, "modules": 0})
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            continue  # 標題列或其他輸出
+        self_us, _, name = parts
+        entry = totals[name.strip().split(".")[0]]
+        entry["self_s"] += int(self_us) / 1e6
+        entry["modules"] += 1
+    return dict(totals)
+
+
+def profile_imports(module: str = "main", cwd: Optional[str] = None) -> Tuple[float, Dict[str, Dict[str, float]]]:
+    """在子行程中 `import module` 並回傳 (總耗時秒, 依頂層套件彙總的匯入時間)。"""
+    cwd = cwd or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, METRICS_PORT="0")
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd, env=env, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        tail = [l for l in proc.stderr.splitlines() if not l.startswith("import time:")][-5:]
+        raise RuntimeError(f"import {module} 失敗：\n" + "\n".join(tail))
+    return elapsed, parse_importtime(proc.stderr)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="AI worker 匯入時間分析")
+    parser.add_argument("--module", default="main", help="要分析的模組（預設 main）")
+    parser.add_argument("--top", type=int, default=20, help="列出前 N 個頂層套件")
+    args = parser.parse_args(argv)
+
+    elapsed, totals = profile_imports(args.module)
+    ranked = sorted(totals.items(), key=lambda kv: kv[1]["self_s"], reverse=True)
+    print(f"=== import {args.module}：{elapsed:.2f}s（含直譯器啟動）===")
+    print(f"{'套件':<28}{'匯入(s)':>10}{'模組數':>8}")
+    for name, st in ranked[: args.top]:
+        print(f"{name:<28}{st['self_s']:>10.3f}{int(st['modules']):>8}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
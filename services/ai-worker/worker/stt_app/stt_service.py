@@ -2,12 +2,15 @@ import io
 import logging
 import os
 import tempfile
+import threading
 from typing import Optional
 
 import torch
 from minio import Minio
 from minio.error import S3Error
 
+from observability.metrics import stage_timer
+
 # 可選匯入：若環境未安裝則保留為佔位 STT
 try:
     import torchaudio
@@ -209,24 +212,26 @@ class STTService:
             # 嘗試以 torchaudio 從 bytes 直接解碼
             if TORCHAUDIO_AVAILABLE:
                 try:
-                    waveform, sample_rate = self._load_audio_robust(
-                        audio_bytes, object_name
-                    )
-
-                    # 轉單聲道
-                    if waveform.dim() > 1 and waveform.size(0) > 1:
-                        waveform = waveform.mean(dim=0, keepdim=True)
-
-                    # 重新採樣到 16kHz (如果需要)
-                    target_sample_rate = 16000
-                    if sample_rate != target_sample_rate and TORCHAUDIO_AVAILABLE:
-                        resampler = torchaudio.transforms.Resample(
-                            orig_freq=sample_rate, new_freq=target_sample_rate
+                    with stage_timer("stt_decode"):
+                        waveform, sample_rate = self._load_audio_robust(
+                            audio_bytes, object_name
                         )
-                        waveform = resampler(waveform)
 
-                    audio_input = waveform.squeeze().numpy()
-                    result = self.asr_pipe(audio_input)
+                        # 轉單聲道
+                        if waveform.dim() > 1 and waveform.size(0) > 1:
+                            waveform = waveform.mean(dim=0, keepdim=True)
+
+                        # 重新採樣到 16kHz (如果需要)
+                        target_sample_rate = 16000
+                        if sample_rate != target_sample_rate and TORCHAUDIO_AVAILABLE:
+                            resampler = torchaudio.transforms.Resample(
+                                orig_freq=sample_rate, new_freq=target_sample_rate
+                            )
+                            waveform = resampler(waveform)
+
+                        audio_input = waveform.squeeze().numpy()
+                    with stage_timer("asr_inference"):
+                        result = self.asr_pipe(audio_input)
                     transcript_text = (result.get("text", "") or "").strip()
                     logger.info("✅ 使用 torchaudio 進行辨識成功")
                 except Exception as e:
@@ -239,7 +244,8 @@ class STTService:
                     tmp.write(audio_bytes)
                     tmp_path = tmp.name
                 try:
-                    result = self.asr_pipe(tmp_path)
+                    with stage_timer("asr_inference"):
+                        result = self.asr_pipe(tmp_path)
                     transcript_text = (result.get("text", "") or "").strip()
                     logger.info("✅ 使用暫存檔進行辨識成功")
                 finally:
@@ -260,11 +266,19 @@ class STTService:
             raise
 
 
-_stt_service_instance = STTService()
+# 單例改為第一次使用時才建立（載入 ASR 模型），只處理文字的 worker 不需付出這個成本
+_stt_service_instance: Optional[STTService] = None
+_stt_service_lock = threading.Lock()
 
 
 def get_stt_service() -> STTService:
-    """Factory function to get the STTService instance."""
+    """Factory function to get the STTService instance (created on first use)."""
+    global _stt_service_instance
+    if _stt_service_instance is None:
+        with _stt_service_lock:
+            if _stt_service_instance is None:
+                logger.info("首次初始化 STTService...")
+                _stt_service_instance = STTService()
     return _stt_service_instance
 
 
@@ -4,6 +4,7 @@
 import os
 import subprocess
 import tempfile
+import threading
 import uuid
 from pathlib import Path
 from typing import List, Optional, Tuple
@@ -22,6 +23,8 @@ from pydub import AudioSegment
 from snac import SNAC
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 
+from observability.metrics import stage_timer
+
 # --- Hugging Face CLI 登入 ---
 # 在 Docker 環境中，.env 的變數由 docker-compose 的 env_file 直接注入，
 # 因此不需要使用 load_dotenv()。我們直接從 os.environ 讀取。
@@ -190,7 +193,7 @@ class OptimizedOrpheusTTS:
             self.model.device
         )
 
-        with torch.no_grad():
+        with stage_timer("tts_generate"), torch.no_grad():
             generated_ids = self.model.generate(
                 input_ids=input_ids,
                 attention_mask=attention_mask,
@@ -202,7 +205,8 @@ class OptimizedOrpheusTTS:
                 eos_token_id=128258,
             )
 
-        output_samples = self._decode_and_redistribute(generated_ids.to("cpu"))
+        with stage_timer("snac_decode"):
+            output_samples = self._decode_and_redistribute(generated_ids.to("cpu"))
 
         if output_samples and output_samples[0].numel() > 0:
             audio_numpy = output_samples[0].squeeze().numpy()
@@ -302,10 +306,11 @@ class TTSService:
             # <<-- 修改處 3: 新增 WAV 到 M4A 的轉換步驟 -->>
             print(f"開始將 {temp_audio_file} 轉換為 M4A 格式...", flush=True)
             temp_m4a_file = temp_audio_file.replace(".wav", ".m4a")
-            # 從 WAV 載入音訊
-            audio = AudioSegment.from_wav(temp_audio_file)
-            # 匯出為 M4A 格式 (AAC 編碼)
-            audio.export(temp_m4a_file, format="mp4", codec="aac")
+            with stage_timer("m4a_encode"):
+                # 從 WAV 載入音訊
+                audio = AudioSegment.from_wav(temp_audio_file)
+                # 匯出為 M4A 格式 (AAC 編碼)
+                audio.export(temp_m4a_file, format="mp4", codec="aac")
             print(f"成功轉換檔案至: {temp_m4a_file}", flush=True)
             # <<------------------------------------>>
 
@@ -320,7 +325,7 @@ class TTSService:
             )
 
             # 使用轉換後的 M4A 檔案進行上傳
-            with open(
+            with stage_timer("minio_upload"), open(
                 temp_m4a_file, "rb"
             ) as audio_file_data:  # <<-- 修改處 5: 開啟 m4a 檔案
                 self.minio_client.put_object(
@@ -351,14 +356,17 @@ class TTSService:
 
 # --- 單例實例與工廠模式 ---
 _tts_service_instance: Optional[TTSService] = None
+_tts_service_lock = threading.Lock()
 
 
 def get_tts_service() -> TTSService:
     """工廠函式，用於獲取 TTSService 的單例。"""
     global _tts_service_instance
     if _tts_service_instance is None:
-        print("首次初始化 TTSService...", flush=True)
-        _tts_service_instance = TTSService()
+        with _tts_service_lock:
+            if _tts_service_instance is None:
+                print("首次初始化 TTSService...", flush=True)
+                _tts_service_instance = TTSService()
     return _tts_service_instance
 
 
@@ -20,6 +20,7 @@ from linebot.v3.webhooks import (
     UnfollowEvent,
     AudioMessageContent
 )
+from . import tracing
 
 # --- Service Singleton (服務單例模式) ---
 # 全域變數，用來存放 LineService 的單一實例
@@ -62,7 +63,9 @@ class LineService:
         :param signature: X-Line-Signature 標頭，用於驗證請求來源
         """
         # 使用 handler 處理請求，它會自動驗證簽名並呼叫對應的事件處理函式
-        self.handler.handle(body, signature)
+        # 事件處理（含發布任務）皆在此 span 之下，trace 會經由 RabbitMQ 延續到 ai-worker
+        with tracing.start_span("line.webhook", kind=tracing.SPAN_KIND_SERVER):
+            self.handler.handle(body, signature)
 
     def _register_handlers(self):
         """註冊 WebhookHandler 的所有事件處理函式。"""
@@ -8,11 +8,20 @@ import logging # 用於記錄錯誤日誌
 from functools import partial # 用於包裝回呼函式，傳遞額外參數
 from app.extensions import db, socketio
 from app.models.models import UserAlert
+from . import tracing
 
 def message_callback(ch, method, properties, body, app):
     """
     處理從 RabbitMQ 收到的聊天通知訊息。
     """
+    received_ns = time.time_ns()
+    # 延續 ai-worker 發佈通知時的 trace，並把通知在佇列中的等待時間記成一個 span
+    headers = getattr(properties, "headers", None) or {}
+    parent = tracing.extract(headers)
+    if parent and headers.get("x-enqueued-at-ms"):
+        tracing.record_span("rabbitmq.queue notifications_queue", int(headers["x-enqueued-at-ms"]) * 1_000_000,
+                            received_ns, kind=tracing.SPAN_KIND_CONSUMER, parent=parent)
+
     # 確保在 Flask 的應用程式上下文 (app_context) 中執行，以便能使用 Flask 的擴展功能
     with app.app_context():
         print(f" [x] 收到通知: {body.decode()}", flush=True)
@@ -23,6 +32,18 @@ def message_callback(ch, method, properties, body, app):
             patient_id = message.get("patient_id") # 獲取使用者 ID
             ai_response = message.get("ai_response") # 獲取 AI 回應內容
 
+            # 串流回覆的句子片段：只轉發給 Web 前端（'notification_chunk' 事件，依 seq 排序顯示），
+            # 不推播 LINE；完整回覆稍後會以 status=completed 的通知送達，前端應以其取代已顯示的片段。
+            # status=stream_reset 表示串流中途失敗，前端應捨棄該任務已顯示的片段、等待完整回覆
+            if message.get("status") in ("streaming", "stream_reset"):
+                if not patient_id or (message["status"] == "streaming" and not message.get("chunk")):
+                    raise ValueError("串流片段缺少 'patient_id' 或 'chunk' 欄位。")
+                with tracing.start_span("socketio.emit notification_chunk", kind=tracing.SPAN_KIND_PRODUCER,
+                                        parent=parent):
+                    socketio.emit('notification_chunk', message, room=str(patient_id))
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                return
+
             # 檢查必要欄位是否存在
             if not patient_id or not ai_response:
                 raise ValueError("通知訊息缺少 'patient_id' 或 'ai_response' 欄位。")
@@ -31,7 +52,8 @@ def message_callback(ch, method, properties, body, app):
             print(f" [>] 正在透過 WebSocket 發送通知: {message}", flush=True)
             # 使用 socketio.emit 向指定房間(room)發送 'notification' 事件
             # 房間名稱設定為 patient_id，確保只有該使用者會收到
-            socketio.emit('notification', message, room=str(patient_id))
+            with tracing.start_span("socketio.emit notification", kind=tracing.SPAN_KIND_PRODUCER, parent=parent):
+                socketio.emit('notification', message, room=str(patient_id))
 
             # --- 2. 將通知推播回 LINE ---
             print(f" [>] 正在將通知推播到 LINE 給使用者 {patient_id}", flush=True)
@@ -40,21 +62,24 @@ def message_callback(ch, method, properties, body, app):
 
             # 根據通知內容決定要傳送文字還是音訊
             response_audio_url = message.get("response_audio_url")
-            if response_audio_url:
-                # 如果有音訊 URL，則先傳送一段引導文字，再傳送音訊
-                line_service.push_text_message(user_id=patient_id, text=ai_response)
-
-                # 直接從訊息中獲取由 ai-worker 計算好的音訊時長
-                duration_ms = message.get("audio_duration_ms", 60000) # 若無提供，預設為 60 秒
-
-                line_service.push_audio_message(
-                    user_id=patient_id,
-                    object_name=response_audio_url,
-                    duration=duration_ms
-                )
-            else:
-                # 如果沒有音訊 URL，只傳送文字回應
-                line_service.push_text_message(user_id=patient_id, text=ai_response)
+            with tracing.start_span("line.push", kind=tracing.SPAN_KIND_CLIENT, parent=parent,
+                                    attributes={"task.id": message.get("task_id"),
+                                                "line.audio": bool(response_audio_url)}):
+                if response_audio_url:
+                    # 如果有音訊 URL，則先傳送一段引導文字，再傳送音訊
+                    line_service.push_text_message(user_id=patient_id, text=ai_response)
+
+                    # 直接從訊息中獲取由 ai-worker 計算好的音訊時長
+                    duration_ms = message.get("audio_duration_ms", 60000) # 若無提供，預設為 60 秒
+
+                    line_service.push_audio_message(
+                        user_id=patient_id,
+                        object_name=response_audio_url,
+                        duration=duration_ms
+                    )
+                else:
+                    # 如果沒有音訊 URL，只傳送文字回應
+                    line_service.push_text_message(user_id=patient_id, text=ai_response)
 
         except (json.JSONDecodeError, ValueError) as e:
             # 處理 JSON 解析錯誤或數值錯誤
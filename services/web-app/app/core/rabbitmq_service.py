@@ -1,6 +1,11 @@
 import pika
 import os
 import json
+import hashlib
+import time
+from datetime import datetime
+
+from . import tracing
 
 class RabbitMQService:
     def __init__(self, rabbitmq_url: str):
@@ -16,21 +21,44 @@ class RabbitMQService:
             self.channel = self.connection.channel()
             print("RabbitMQ connection established.")
 
+    @staticmethod
+    def generate_task_id(patient_id, content: str) -> str:
+        """Generate a producer-assigned task ID (same scheme as the ai-worker AITask)."""
+        timestamp = datetime.utcnow().isoformat()
+        hash_content = f"{patient_id}_{content}_{timestamp}"
+        return hashlib.md5(hash_content.encode()).hexdigest()[:16]
+
     def publish_message(self, queue_name: str, message_body: dict):
         """Publishes a message to the specified queue."""
         try:
             self.connect()
             self.channel.queue_declare(queue=queue_name, durable=True)
-            
+
+            # Assign the task ID once at publish time so that redeliveries of the
+            # same message can be recognised (and resumed) by the consumer.
+            if 'task_id' not in message_body:
+                content = message_body.get('text') or message_body.get('object_name') or ''
+                message_body = {
+                    **message_body,
+                    'task_id': self.generate_task_id(message_body.get('patient_id'), content),
+                }
+
             message = json.dumps(message_body, ensure_ascii=False)
             
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=queue_name,
-                body=message,
-                properties=pika.BasicProperties(
-                    delivery_mode=2,  # make message persistent
-                ))
+            with tracing.start_span(f"rabbitmq.publish {queue_name}", kind=tracing.SPAN_KIND_PRODUCER,
+                                    attributes={"task.id": message_body['task_id']}):
+                self.channel.basic_publish(
+                    exchange='',
+                    routing_key=queue_name,
+                    body=message,
+                    properties=pika.BasicProperties(
+                        delivery_mode=2,  # make message persistent
+                        message_id=message_body['task_id'],
+                        timestamp=int(time.time()),
+                        # Millisecond enqueue time so the worker can report queue wait;
+                        # traceparent links the worker's spans to this publish.
+                        headers=tracing.inject({'x-enqueued-at-ms': int(time.time() * 1000)}),
+                    ))
             print(f" [x] Sent {message} to queue '{queue_name}'")
         except Exception as e:
             print(f"Error publishing message: {e}")
@@ -0,0 +1,293 @@
+# services/web-app/app/core/tracing.py
+"""
+Web App Tracing
+
+輕量的分散式追蹤：以 W3C traceparent 標頭在 RabbitMQ 訊息間傳遞 trace context，
+在每一跳記錄 span（LINE webhook / 發佈任務 / 通知佇列等待與推播），並匯出為 OpenTelemetry
+相容的 OTLP/JSON（ExportTraceServiceRequest）。僅用標準函式庫。
+
+匯出目的地（可同時啟用，皆未設定時只做傳遞、不匯出）：
+- TRACE_EXPORT_FILE：每次匯出追加一行 OTLP/JSON 到本地檔案
+- TRACE_OTLP_ENDPOINT：POST 到 collector 的 {endpoint}/v1/traces
+span 結束時只放進記憶體；背景執行緒每 TRACE_EXPORT_INTERVAL_SEC 秒（或累積滿 TRACE_EXPORT_BATCH_SIZE 個）
+批次匯出，處理訊息的執行緒不會被寫檔或 HTTP 請求阻塞。
+
+ai-worker 端的 observability/tracing.py 使用相同的標頭與格式，兩邊的 span 會串成同一條 trace。
+兩個服務各自打包、無共用套件，因此這是同一份程式碼的兩個複本：修改時兩邊須同步
+（只有檔頭說明與 SERVICE_NAME 預設值不同）。
+"""
+
+import atexit
+import json
+import os
+import secrets
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "web-app")
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "").rstrip("/")
+TRACE_EXPORT_INTERVAL_SEC = float(os.getenv("TRACE_EXPORT_INTERVAL_SEC", 5))
+TRACE_EXPORT_BATCH_SIZE = int(os.getenv("TRACE_EXPORT_BATCH_SIZE", 512))
+TRACE_MAX_PENDING = int(os.getenv("TRACE_MAX_PENDING", 10000))  # collector 停擺時的記憶體上限
+TRACEPARENT_HEADER = "traceparent"
+
+# OTLP SpanKind / StatusCode
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+SPAN_KIND_PRODUCER = 4
+SPAN_KIND_CONSUMER = 5
+STATUS_UNSET = 0
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+SpanContext = Tuple[str, str]  # (trace_id, span_id)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str] = None
+    kind: int = SPAN_KIND_INTERNAL
+    start_ns: int = field(default_factory=time.time_ns)
+    end_ns: Optional[int] = None
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    status_code: int = STATUS_UNSET
+    status_message: str = ""
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    @property
+    def context(self) -> SpanContext:
+        return self.trace_id, self.span_id
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def record_error(self, exc: BaseException) -> None:
+        self.status_code = STATUS_ERROR
+        self.status_message = f"{type(exc).__name__}: {exc}"
+
+    def end(self, end_ns: Optional[int] = None) -> None:
+        if self.end_ns is None:
+            self.end_ns = end_ns or time.time_ns()
+
+    def to_otlp(self) -> Dict[str, Any]:
+        span = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or self.start_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in self.attributes.items()],
+            "status": {"code": self.status_code, "message": self.status_message},
+        }
+        if self.parent_span_id:
+            span["parentSpanId"] = self.parent_span_id
+        return span
+
+
+class SpanExporter:
+    """收集已結束的 span，由背景執行緒定期（或累積滿一批時）批次寫檔 / 送往 collector。"""
+
+    def __init__(self, service_name: str, file_path: str = "", endpoint: str = "",
+                 interval_sec: float = TRACE_EXPORT_INTERVAL_SEC, batch_size: int = TRACE_EXPORT_BATCH_SIZE,
+                 max_pending: int = TRACE_MAX_PENDING):
+        self.service_name = service_name
+        self.file_path = file_path
+        self.endpoint = endpoint
+        self.interval_sec = interval_sec
+        self.batch_size = max(1, batch_size)
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+        self._pending: List[Span] = []
+        self._dropped = 0
+        self._wake = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.file_path or self.endpoint)
+
+    def add(self, span: Span) -> None:
+        """只放進待匯出清單（不做 I/O）；滿一批時喚醒背景執行緒。"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                self._dropped += 1
+                return
+            self._pending.append(span)
+            full = len(self._pending) >= self.batch_size
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name="trace-exporter", daemon=True)
+                self._flusher.start()
+        if full:
+            self._wake.set()
+
+    def to_request(self, spans: List[Span]) -> Dict[str, Any]:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "respiraally.tracing"}, "spans": [s.to_otlp() for s in spans]}],
+            }]
+        }
+
+    def flush(self) -> None:
+        """同步匯出目前累積的 span（背景執行緒與行程結束時呼叫，一般程式碼不需呼叫）。"""
+        with self._lock:
+            spans, self._pending = self._pending, []
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            print(f"⚠️ [Tracing] 待匯出的 span 超過 {self.max_pending} 個，丟棄 {dropped} 個", flush=True)
+        with self._export_lock:
+            for i in range(0, len(spans), self.batch_size):
+                self._export(json.dumps(self.to_request(spans[i:i + self.batch_size]), ensure_ascii=False))
+
+    def _export(self, payload: str) -> None:
+        if self.file_path:
+            try:
+                with open(self.file_path, "a", encoding="utf-8") as f:
+                    f.write(payload + "\n")
+            except OSError as e:
+                print(f"⚠️ [Tracing] 寫入 {self.file_path} 失敗: {e}", flush=True)
+        if self.endpoint:
+            req = urllib.request.Request(
+                f"{self.endpoint}/v1/traces", data=payload.encode("utf-8"), headers={"Content-Type": "application/json"}
+            )
+            try:
+                urllib.request.urlopen(req, timeout=5).close()
+            except Exception as e:
+                print(f"⚠️ [Tracing] 送出至 collector 失敗: {e}", flush=True)
+
+    def _flush_loop(self) -> None:
+        while True:
+            self._wake.wait(self.interval_sec)
+            self._wake.clear()
+            self.flush()
+
+
+exporter = SpanExporter(SERVICE_NAME, TRACE_EXPORT_FILE, TRACE_OTLP_ENDPOINT)
+atexit.register(exporter.flush)
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def new_trace_id() -> str:
+    return secrets.token_hex(16)
+
+
+def new_span_id() -> str:
+    return secrets.token_hex(8)
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[SpanContext]:
+    """解析 `00-<32 hex trace id>-<16 hex span id>-<flags>`；格式不符時回傳 None。"""
+    if not value or not isinstance(value, str):
+        return None
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2]
+
+
+def extract(headers: Optional[Dict[str, Any]]) -> Optional[SpanContext]:
+    """從 AMQP 標頭取出上游的 trace context。"""
+    value = (headers or {}).get(TRACEPARENT_HEADER)
+    if isinstance(value, bytes):
+        value = value.decode("ascii", "ignore")
+    return parse_traceparent(value)
+
+
+def inject(headers: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """把目前 span 的 traceparent 寫入（複製後的）AMQP 標頭。"""
+    headers = dict(headers or {})
+    span = _current_span.get()
+    if span is not None:
+        headers[TRACEPARENT_HEADER] = span.traceparent
+    return headers
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def current_trace_id() -> Optional[str]:
+    span = _current_span.get()
+    return span.trace_id if span else None
+
+
+def _new_span(name: str, kind: int, parent: Optional[SpanContext], attributes: Optional[Dict[str, Any]],
+              start_ns: Optional[int]) -> Span:
+    if parent is None:
+        local = _current_span.get()
+        parent = local.context if local else None
+    span = Span(
+        name=name,
+        trace_id=parent[0] if parent else new_trace_id(),
+        span_id=new_span_id(),
+        parent_span_id=parent[1] if parent else None,
+        kind=kind,
+        start_ns=start_ns or time.time_ns(),
+    )
+    for k, v in (attributes or {}).items():
+        span.set_attribute(k, v)
+    return span
+
+
+@contextmanager
+def start_span(name: str, kind: int = SPAN_KIND_INTERNAL, parent: Optional[SpanContext] = None,
+               attributes: Optional[Dict[str, Any]] = None) -> Iterator[Span]:
+    """
+    開啟 span 並設為目前 span；未指定 parent 時掛在目前 span 之下（沒有則開新 trace）。
+    區塊拋出例外時標記為錯誤（例外照常往外拋）。結束的 span 交給背景執行緒批次匯出。
+    """
+    span = _new_span(name, kind, parent, attributes, None)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.record_error(e)
+        raise
+    finally:
+        span.end()
+        _current_span.reset(token)
+        exporter.add(span)
+
+
+def record_span(name: str, start_ns: int, end_ns: Optional[int] = None, kind: int = SPAN_KIND_INTERNAL,
+                parent: Optional[SpanContext] = None, attributes: Optional[Dict[str, Any]] = None) -> Span:
+    """記錄一段已發生的區間（例如佇列等待），不改變目前 span。"""
+    span = _new_span(name, kind, parent, attributes, start_ns)
+    span.end(end_ns)
+    exporter.add(span)
+    return span
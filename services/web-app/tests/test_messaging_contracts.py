@@ -0,0 +1,133 @@
+"""
+Messaging Contract Tests
+
+RabbitMQ 訊息的契約：web-app 發佈給 ai-worker 的任務訊息屬性（message_id / timestamp /
+x-enqueued-at-ms / traceparent），以及通知監聽器對串流片段（status=streaming / stream_reset →
+'notification_chunk'）與完整回覆（'notification' + LINE 推播）的處理。不需要 RabbitMQ，pika 連線以 mock 取代。
+"""
+
+import json
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+import pytest
+
+from app.core import line_service, notification_service, rabbitmq_service, tracing
+from app.core.rabbitmq_service import RabbitMQService
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    """取代 pika 連線，回傳發佈用的 channel mock。"""
+    connection = MagicMock()
+    connection.is_closed = False
+    monkeypatch.setattr(rabbitmq_service.pika, "BlockingConnection", MagicMock(return_value=connection))
+    return connection.channel.return_value
+
+
+@pytest.fixture
+def exported(monkeypatch):
+    """收集結束的 span（不經過匯出）。"""
+    spans = []
+    monkeypatch.setattr(tracing.exporter, "add", spans.append)
+    monkeypatch.setattr(tracing.exporter, "flush", MagicMock())
+    return spans
+
+
+def published(channel):
+    kwargs = channel.basic_publish.call_args.kwargs
+    return json.loads(kwargs["body"]), kwargs["properties"]
+
+
+class TestTaskPublishContract:
+    def test_producer_assigns_task_id_as_message_id(self, channel, exported):
+        before_ms = int(time.time() * 1000)
+        RabbitMQService("amqp://test").publish_message("task_queue", {"patient_id": "U1", "text": "今天有點喘"})
+
+        body, props = published(channel)
+        assert len(body["task_id"]) == 16
+        assert props.message_id == body["task_id"]
+        assert props.delivery_mode == 2
+        assert isinstance(props.timestamp, int) and abs(props.timestamp - time.time()) < 5
+        assert props.headers["x-enqueued-at-ms"] >= before_ms
+
+    def test_existing_task_id_is_kept(self, channel, exported):
+        RabbitMQService("amqp://test").publish_message("task_queue", {"patient_id": "U1", "task_id": "abc123"})
+
+        body, props = published(channel)
+        assert body["task_id"] == "abc123"
+        assert props.message_id == "abc123"
+
+    def test_traceparent_header_points_at_publish_span(self, channel, exported):
+        RabbitMQService("amqp://test").publish_message("task_queue", {"patient_id": "U1", "text": "hi"})
+
+        _, props = published(channel)
+        trace_id, span_id = tracing.parse_traceparent(props.headers["traceparent"])
+        publish_span = next(s for s in exported if s.name == "rabbitmq.publish task_queue")
+        assert (publish_span.trace_id, publish_span.span_id) == (trace_id, span_id)
+
+
+class TestNotificationContract:
+    PARENT = "00-" + "a" * 32 + "-" + "b" * 16 + "-01"
+
+    @pytest.fixture
+    def socketio(self, monkeypatch):
+        socketio = MagicMock()
+        monkeypatch.setattr(notification_service, "socketio", socketio)
+        return socketio
+
+    @pytest.fixture
+    def line(self, monkeypatch):
+        service = MagicMock()
+        monkeypatch.setattr(line_service, "get_line_service", lambda: service)
+        return service
+
+    def deliver(self, message, headers=None):
+        ch = MagicMock()
+        props = SimpleNamespace(headers=headers or {})
+        method = SimpleNamespace(delivery_tag=7)
+        notification_service.message_callback(ch, method, props, json.dumps(message).encode(), app=MagicMock())
+        return ch
+
+    def test_streaming_chunk_goes_to_web_only(self, socketio, line, exported):
+        chunk = {"status": "streaming", "task_id": "t1", "patient_id": "U1", "seq": 0, "chunk": "您好，"}
+        ch = self.deliver(chunk, {"traceparent": self.PARENT})
+
+        socketio.emit.assert_called_once_with("notification_chunk", chunk, room="U1")
+        line.push_text_message.assert_not_called()
+        ch.basic_ack.assert_called_once_with(delivery_tag=7)
+
+    def test_streaming_chunk_without_text_is_dropped(self, socketio, line, exported):
+        ch = self.deliver({"status": "streaming", "task_id": "t1", "patient_id": "U1", "seq": 0})
+
+        socketio.emit.assert_not_called()
+        ch.basic_ack.assert_called_once_with(delivery_tag=7)
+
+    def test_stream_reset_is_forwarded_to_web(self, socketio, line, exported):
+        reset = {"status": "stream_reset", "task_id": "t1", "patient_id": "U1", "seq": 2}
+        ch = self.deliver(reset)
+
+        socketio.emit.assert_called_once_with("notification_chunk", reset, room="U1")
+        line.push_text_message.assert_not_called()
+        ch.basic_ack.assert_called_once_with(delivery_tag=7)
+
+    def test_completed_reply_goes_to_web_and_line(self, socketio, line, exported):
+        message = {"status": "completed", "task_id": "t1", "patient_id": "U1", "ai_response": "記得多喝水"}
+        ch = self.deliver(message)
+
+        socketio.emit.assert_called_once_with("notification", message, room="U1")
+        line.push_text_message.assert_called_once_with(user_id="U1", text="記得多喝水")
+        ch.basic_ack.assert_called_once_with(delivery_tag=7)
+
+    def test_spans_continue_the_worker_trace_without_sync_export(self, socketio, line, exported):
+        enqueued_ms = int(time.time() * 1000) - 50
+        self.deliver(
+            {"status": "streaming", "task_id": "t1", "patient_id": "U1", "seq": 0, "chunk": "您好"},
+            {"traceparent": self.PARENT, "x-enqueued-at-ms": enqueued_ms},
+        )
+
+        names = {s.name: s for s in exported}
+        assert names["rabbitmq.queue notifications_queue"].parent_span_id == "b" * 16
+        assert names["socketio.emit notification_chunk"].trace_id == "a" * 32
+        tracing.exporter.flush.assert_not_called()